@@ -0,0 +1,420 @@
+# Copyright © 2021-2022 Connectomics Lab
+# University Hospital Center and University of Lausanne (UNIL-CHUV), Switzerland,
+# and contributors
+#
+#  This software is distributed under the open-source license Apache 2.0.
+
+"""Benchmark of the publication pipeline end to end on the local machine, with the local backends of the siblings."""
+
+import os
+import json
+import time
+import random
+import shutil
+import tempfile
+
+from neurodatapub.project import NeuroDataPubProject
+from neurodatapub.utils.backends import get_throttled_store_dir
+from neurodatapub.utils.events import StageFinished
+from neurodatapub.utils.gitperf import time_git_status
+from neurodatapub.utils.process import run
+from neurodatapub.utils.throttle import load_throttle_stats
+
+# Datatypes and suffixes of the images of the synthetic datasets
+SYNTHETIC_IMAGES = [('anat', 'T1w'), ('dwi', 'dwi'), ('func', 'task-rest_bold')]
+
+
+def generate_synthetic_dataset(dataset_dir, subjects=4, sessions=1, file_size=1024 * 1024,
+                               small_files=0, small_file_size=4096, seed=0):
+    """
+    Generate a synthetic BIDS dataset.
+
+    Each session of each subject has a T1w, a diffusion and a functional
+    image of `file_size` random (incompressible) bytes, with their JSON
+    sidecar files, and `small_files` source DICOM files of `small_file_size`
+    bytes in `sourcedata/`.
+
+    Parameters
+    ----------
+    dataset_dir : string
+        Directory of the dataset, created if needed
+
+    subjects : int
+        Number of subjects (Default: `4`)
+
+    sessions : int
+        Number of sessions per subject. If `1`,
+        the dataset has no session level (Default: `1`)
+
+    file_size : int
+        Size in bytes of each image (Default: 1 MiB)
+
+    small_files : int
+        Number of small files per session (Default: `0`)
+
+    small_file_size : int
+        Size in bytes of each small file (Default: 4 KiB)
+
+    seed : int
+        Seed of the random content (Default: `0`)
+
+    Returns
+    -------
+    nb_files : int
+        Number of files of the dataset
+
+    nbytes : int
+        Total size of the files in bytes
+    """
+    rng = random.Random(seed)
+    os.makedirs(dataset_dir, exist_ok=True)
+    nb_files, nbytes = 0, 0
+    files = {
+        'dataset_description.json': json.dumps(
+            {'Name': 'Synthetic dataset', 'BIDSVersion': '1.6.0', 'Authors': ['neurodatapub']},
+            indent=4
+        ).encode(),
+        'README': b'Synthetic dataset generated by the benchmark of neurodatapub\n',
+        'participants.tsv': ('participant_id\n' + ''.join(
+            f'sub-{i:02d}\n' for i in range(1, subjects + 1))).encode()
+    }
+    for i in range(1, subjects + 1):
+        for j in range(1, sessions + 1):
+            session = f'ses-{j:02d}' if sessions > 1 else None
+            prefix = f'sub-{i:02d}_{session}' if session else f'sub-{i:02d}'
+            directory = os.path.join(f'sub-{i:02d}', session) if session else f'sub-{i:02d}'
+            for datatype, suffix in SYNTHETIC_IMAGES:
+                name = os.path.join(directory, datatype, f'{prefix}_{suffix}')
+                files[f'{name}.nii.gz'] = file_size
+                files[f'{name}.json'] = json.dumps({'RepetitionTime': 2.0}).encode()
+            for k in range(1, small_files + 1):
+                path = os.path.join('sourcedata', directory, 'dicom', f'IM_{k:07d}.dcm')
+                files[path] = small_file_size
+            # Written session by session to bound the memory used by large datasets
+            nb_files, nbytes = nb_files + len(files), nbytes + _write_files(dataset_dir, files, rng)
+            files = {}
+    return nb_files + len(files), nbytes + _write_files(dataset_dir, files, rng)
+
+
+def _write_files(dataset_dir, files, rng, block_size=1024 * 1024):
+    """Write files given by their relative path and content (or size of random content), and return their total size."""
+    nbytes = 0
+    for path, content in files.items():
+        os.makedirs(os.path.join(dataset_dir, os.path.dirname(path)), exist_ok=True)
+        with open(os.path.join(dataset_dir, path), 'wb') as f:
+            if isinstance(content, bytes):
+                f.write(content)
+                nbytes += len(content)
+                continue
+            for offset in range(0, content, block_size):
+                size = min(block_size, content - offset)
+                f.write(rng.getrandbits(8 * size).to_bytes(size, 'little'))
+            nbytes += content
+    return nbytes
+
+
+def write_local_sibling_configs(work_dir, sibling_type='ssh', shared_store=False, throttle=None):
+    """
+    Write the configuration files of siblings using the local backends.
+
+    Parameters
+    ----------
+    work_dir : string
+        Directory of the configuration files and of the local siblings
+
+    sibling_type : {"ssh", "osf"}
+        Type of git-annex special sibling (Default: `"ssh"`)
+
+    shared_store : bool
+        If `True`, the annexed files of the ssh special sibling are stored
+        in a shared store (Default: `False`)
+
+    throttle : dict
+        Simulated link to the ssh special sibling, with the `"latency"`,
+        `"bandwidth"`, `"failure_rate"` and `"seed"` entries of the
+        `"throttle"` entry of its configuration (Default: `None`)
+
+    Returns
+    -------
+    special_sibling_config : string
+        Path of the configuration file of the git-annex special sibling
+
+    github_sibling_config : string
+        Path of the configuration file of the github sibling
+    """
+    remotes_dir = os.path.join(work_dir, 'remotes')
+    if sibling_type == 'ssh':
+        special_config = dict(
+            backend='local',
+            remote_sibling_dir=os.path.join(remotes_dir, 'ssh', 'ds-benchmark', '.git')
+        )
+        if shared_store:
+            special_config['remote_shared_store_dir'] = os.path.join(remotes_dir, 'ssh', 'store')
+        if throttle:
+            special_config['throttle'] = throttle
+    else:
+        special_config = dict(
+            backend='local',
+            local_dir=os.path.join(remotes_dir, 'osf'),
+            osf_dataset_title='ds benchmark'
+        )
+    github_config = dict(
+        backend='local',
+        local_dir=os.path.join(remotes_dir, 'github'),
+        github_login='neurodatapub',
+        github_email='neurodatapub@example.org',
+        github_organization='benchmark',
+        github_repo_name='ds-benchmark'
+    )
+    paths = []
+    for name, config in [(f'{sibling_type}_sibling_config.json', special_config),
+                         ('github_sibling_config.json', github_config)]:
+        paths.append(os.path.join(work_dir, name))
+        with open(paths[-1], 'w') as f:
+            json.dump(config, f, indent=4)
+    return tuple(paths)
+
+
+def run_benchmark(
+    work_dir=None,
+    sibling_type='ssh',
+    subjects=4,
+    sessions=1,
+    file_size=1024 * 1024,
+    small_files=0,
+    jobs='auto',
+    shared_store=False,
+    throttle=None,
+    retries=0,
+    updates=1,
+    git_profile=False,
+    keep=False
+):
+    """
+    Run the creation, configuration and publication of a synthetic dataset to local siblings and time its stages.
+
+    Parameters
+    ----------
+    work_dir : string
+        Directory of the benchmark (Default: `None`, a temporary directory)
+
+    sibling_type : {"ssh", "osf"}
+        Type of git-annex special sibling (Default: `"ssh"`)
+
+    subjects, sessions, file_size, small_files :
+        Parameters of :func:`generate_synthetic_dataset`
+
+    jobs : string
+        Number of parallel jobs of the project (Default: `"auto"`)
+
+    shared_store : bool
+        If `True`, the ssh special sibling uses a shared store (Default: `False`)
+
+    throttle : dict
+        Latency, bandwidth and failure rate of the link simulated to
+        the ssh special sibling (See :func:`write_local_sibling_configs`)
+        (Default: `None`, no simulation)
+
+    retries : int
+        Number of retries of the failed transfers by git-annex
+        (`annex.retry`) (Default: `0`)
+
+    updates : int
+        Number of images modified and published with `publish_changes()`
+        after the first publication, `0` to skip the update (Default: `1`)
+
+    git_profile : bool
+        If `True`, the git performance profile is applied to
+        the Datalad dataset (Default: `False`)
+
+    keep : bool
+        If `True`, the work directory is not removed (Default: `False`)
+
+    Returns
+    -------
+    report : dict
+        Report with the `"dataset"` size, the cumulated `"stages"` durations
+        in seconds for the `"publication"` and the `"update"`, their
+        `"total"` durations, the statistics of the simulated link (`"throttle"`),
+        and if all steps succeeded (`"success"`)
+    """
+    work_dir = os.path.abspath(work_dir) if work_dir else tempfile.mkdtemp(prefix='neurodatapub_benchmark_')
+    os.makedirs(work_dir, exist_ok=True)
+    dataset_dir = os.path.join(work_dir, 'dataset')
+    report = dict(work_dir=work_dir, sibling_type=sibling_type, success=False,
+                  stages=dict(publication={}, update={}), total={})
+    throttle_dir = None
+    try:
+        nb_files, nbytes = generate_synthetic_dataset(
+            dataset_dir, subjects, sessions, file_size, small_files=small_files
+        )
+        report['dataset'] = dict(files=nb_files, bytes=nbytes)
+        throttle = throttle if sibling_type == 'ssh' else None
+        special_config, github_config = write_local_sibling_configs(
+            work_dir, sibling_type, shared_store, throttle
+        )
+        if throttle:
+            with open(special_config, 'r') as f:
+                throttle_dir = get_throttled_store_dir(json.load(f))
+        project = NeuroDataPubProject(
+            dataset_dir=dataset_dir,
+            datalad_dataset_dir=os.path.join(work_dir, 'datalad'),
+            git_annex_special_sibling_config=special_config,
+            sibling_type=sibling_type,
+            github_sibling_config=github_config,
+            mode='all',
+            jobs=jobs,
+            git_performance_profile=git_profile
+        )
+        phase = ['publication']
+
+        def record(event):
+            durations = report['stages'][phase[0]]
+            durations[event.stage] = durations.get(event.stage, 0) + event.duration
+
+        project.events.subscribe(record, kinds=(StageFinished,))
+
+        start = time.monotonic()
+        for step in [project.create_datalad_dataset, project.configure_siblings,
+                     project.publish_datalad_dataset]:
+            res, _ = step()
+            if not res:
+                return report
+            if step == project.configure_siblings and retries:
+                run(f'git config annex.retry {int(retries)}', cwd=project.output_datalad_dataset_dir)
+        report['total']['publication'] = time.monotonic() - start
+
+        if updates:
+            phase[0] = 'update'
+            images = sorted(entry.path for entry in project.file_table if entry.path.endswith('.nii.gz'))
+            modified = images[:updates]
+            for path in modified:
+                with open(os.path.join(dataset_dir, path), 'ab') as f:
+                    f.write(os.urandom(1024))
+            start = time.monotonic()
+            project.publish_changes(paths=modified)
+            report['total']['update'] = time.monotonic() - start
+        report['success'] = True
+        return report
+    finally:
+        if throttle_dir is not None:
+            report['throttle'] = dict(throttle, **load_throttle_stats(throttle_dir))
+        if not keep:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def run_git_benchmark(work_dir=None, subjects=1000, sessions=1, modified=100, repeat=3, keep=False):
+    """
+    Compare the durations of `git status` and `datalad save` without and with the git performance profile.
+
+    A synthetic dataset with small images, whose JSON sidecar files are
+    stored in git, is created twice, without and with the profile (See
+    :mod:`neurodatapub.utils.gitperf`). In each Datalad dataset, the duration
+    of the initial save, of `git status` on the clean tree and after `modified`
+    sidecar files are modified, and of the save of these modifications are measured.
+
+    Parameters
+    ----------
+    work_dir : string
+        Directory of the benchmark (Default: `None`, a temporary directory)
+
+    subjects, sessions :
+        Parameters of :func:`generate_synthetic_dataset`
+        (Default: `1000` subjects with `1` session)
+
+    modified : int
+        Number of sidecar files modified (Default: `100`)
+
+    repeat : int
+        Number of runs of `git status`, whose median duration
+        is reported (Default: `3`)
+
+    keep : bool
+        If `True`, the work directory is not removed (Default: `False`)
+
+    Returns
+    -------
+    report : dict
+        Report with the `"dataset"` size, the durations in seconds of each
+        step indexed by profile (`"default"` and `"profile"`), and if all
+        steps succeeded (`"success"`)
+    """
+    work_dir = os.path.abspath(work_dir) if work_dir else tempfile.mkdtemp(prefix='neurodatapub_benchmark_')
+    os.makedirs(work_dir, exist_ok=True)
+    dataset_dir = os.path.join(work_dir, 'dataset')
+    report = dict(work_dir=work_dir, success=False, durations={})
+    try:
+        nb_files, nbytes = generate_synthetic_dataset(dataset_dir, subjects, sessions, file_size=1024)
+        report['dataset'] = dict(files=nb_files, bytes=nbytes)
+        for name, git_profile in [('default', False), ('profile', True)]:
+            project = NeuroDataPubProject(
+                dataset_dir=dataset_dir,
+                datalad_dataset_dir=os.path.join(work_dir, f'datalad-{name}'),
+                mode='create-only',
+                git_performance_profile=git_profile
+            )
+            durations = report['durations'][name] = {}
+
+            def record(event, durations=durations):
+                if event.stage == 'save':
+                    durations['save'] = durations.get('save', 0) + event.duration
+
+            project.events.subscribe(record, kinds=(StageFinished,))
+            res, _ = project.create_datalad_dataset()
+            if not res:
+                return report
+            durations['status_clean'] = time_git_status(project.output_datalad_dataset_dir, repeat)
+            sidecars = sorted(entry.path for entry in project.file_table if entry.path.endswith('.json'))
+            for path in sidecars[:modified]:
+                with open(os.path.join(project.output_datalad_dataset_dir, path), 'w') as f:
+                    json.dump({'RepetitionTime': 2.5, 'Benchmark': name}, f)
+            durations['status_modified'] = time_git_status(project.output_datalad_dataset_dir, repeat)
+            start = time.monotonic()
+            run(f'datalad save -m "Benchmark of the git performance profile" '
+                f'"{project.output_datalad_dataset_dir}"')
+            durations['save_modified'] = time.monotonic() - start
+        report['success'] = True
+        return report
+    finally:
+        if not keep:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def format_git_benchmark(report):
+    """Format the report returned by :func:`run_git_benchmark`."""
+    dataset = report.get('dataset', {})
+    text = f"\n\tDataset : {dataset.get('files', 0)} files"
+    default, profile = report['durations'].get('default', {}), report['durations'].get('profile', {})
+    labels = [('save', 'Initial save'), ('status_clean', 'git status (clean)'),
+              ('status_modified', 'git status (modified)'), ('save_modified', 'Save of the modifications')]
+    for key, label in labels:
+        if key in default and key in profile:
+            text += (f'\n\t{label} : {default[key]:.2f} s without, {profile[key]:.2f} s with the profile '
+                     f'(x{default[key] / max(profile[key], 1e-6):.2f})')
+    if not report['success']:
+        text += '\n\t* ERROR: The benchmark did not complete'
+    return text
+
+
+def format_benchmark(report):
+    """Format the report returned by :func:`run_benchmark`."""
+    dataset = report.get('dataset', {})
+    text = (f"\n\tSpecial sibling : {report['sibling_type']} (local backend)"
+            f"\n\tDataset : {dataset.get('files', 0)} files, "
+            f"{dataset.get('bytes', 0) / 1024 ** 2:.1f} MiB")
+    for phase, durations in report['stages'].items():
+        if phase not in report['total']:
+            continue
+        text += f"\n\t{phase.capitalize()} : {report['total'][phase]:.2f} s"
+        for stage, duration in durations.items():
+            text += f'\n\t  - {stage} : {duration:.2f} s'
+    throttle = report.get('throttle')
+    if throttle:
+        text += (f"\n\tSimulated link : {throttle.get('latency', 0) * 1000:.0f} ms latency, "
+                 f"{throttle.get('bandwidth') or 'unlimited'} MB/s, "
+                 f"{throttle.get('failure_rate', 0):.1%} failure rate"
+                 f"\n\t  - {throttle['requests']} requests, {throttle['stored']} files stored, "
+                 f"{throttle['failures']} simulated failures")
+    if not report['success']:
+        text += '\n\t* ERROR: The benchmark did not complete'
+    return text
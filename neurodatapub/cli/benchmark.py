@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+#
+# Copyright © 2021-2022 Connectomics Lab
+# University Hospital Center and University of Lausanne (UNIL-CHUV), Switzerland,
+# and contributors
+#
+#  This software is distributed under the open-source license Apache 2.0.
+
+"""This module defines the entrypoint script of the benchmark of `neurodatapub` with local siblings."""
+
+# General imports
+import sys
+import json
+
+# Own imports
+from neurodatapub.parser import get_benchmark_parser
+from neurodatapub.benchmark import run_benchmark, format_benchmark, run_git_benchmark, format_git_benchmark
+
+
+def main():
+    """Main function that runs the benchmark of the publication pipeline with local siblings.
+
+    Returns
+    -------
+    exit_code : {0, 1}
+        An exit code given to `sys.exit()` that can be:
+
+            * '0' in case of successful completion
+
+            * '1' in case of an error
+    """
+    # Create and parse arguments
+    parser = get_benchmark_parser()
+    args = parser.parse_args()
+
+    if args.git_benchmark:
+        print(
+            "\n############################################\n"
+            "# Benchmark of the git performance profile\n"
+            "############################################\n"
+        )
+        report = run_git_benchmark(
+            work_dir=args.work_dir,
+            subjects=args.subjects,
+            sessions=args.sessions,
+            modified=args.updates,
+            keep=args.keep
+        )
+        print(f'> Report of the benchmark:{format_git_benchmark(report)}')
+        return _save_report(report, args.output)
+
+    print(
+        "\n############################################\n"
+        "# Benchmark of the publication\n"
+        "############################################\n"
+    )
+    throttle = None
+    if args.latency or args.bandwidth or args.failure_rate:
+        throttle = dict(
+            latency=(args.latency or 0) / 1000,
+            bandwidth=args.bandwidth or 0,
+            failure_rate=args.failure_rate or 0,
+            seed=0
+        )
+    report = run_benchmark(
+        work_dir=args.work_dir,
+        sibling_type=args.sibling_type,
+        subjects=args.subjects,
+        sessions=args.sessions,
+        file_size=int(args.file_size * 1000 ** 2),
+        small_files=args.small_files,
+        jobs=args.jobs,
+        shared_store=args.shared_store,
+        throttle=throttle,
+        retries=args.retries,
+        updates=args.updates,
+        git_profile=args.git_profile,
+        keep=args.keep
+    )
+    print(f'> Report of the benchmark:{format_benchmark(report)}')
+    return _save_report(report, args.output)
+
+
+def _save_report(report, output):
+    """Save the report of a benchmark in `output` if given and return the exit code."""
+    if output:
+        with open(output, 'w') as f:
+            json.dump(report, f, indent=4)
+        print(f'> Saved as {output}')
+    return 0 if report['success'] else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -11,7 +11,7 @@
 # General imports
 import os
 import sys
-import datetime
+import signal
 
 # Configuration of the graphical backend of traitsui
 # Note: Should be at the very beginning before any
@@ -23,13 +23,18 @@ os.environ['QT_API'] = 'pyqt5'  # noqa: E402
 # Suppress QXcbConnection: XCB error
 os.environ['QT_LOGGING_RULES'] = '*.debug=false;qt.qpa.*=false'  # noqa: E402
 
-from bids import BIDSLayout
-
 # Own imports
 from neurodatapub.parser import get_parser
 from neurodatapub.project import NeuroDataPubProject
+from neurodatapub.service import PublicationService, serve
 from neurodatapub.ui.project import NeuroDataPubProjectUI
 from neurodatapub.utils.jsonconfig import validate_json_sibling_config
+from neurodatapub.utils.metrics import PublicationMetrics, MetricsExporter
+from neurodatapub.utils.profiling import StageProfiler, get_profile_run_dir, format_profile_summary
+from neurodatapub.utils.script import write_script
+from neurodatapub.utils.tracing import Tracer, export_trace_timeline
+from neurodatapub.utils.validation import validate_bids_dataset, format_bids_summary
+from neurodatapub.utils.bidsfilter import create_bids_filter
 
 
 def main():
@@ -59,17 +64,25 @@ def main():
         )
         exit_code = 1
         return exit_code
-    elif args.dataset_dir and os.path.exists(args.dataset_dir) and not args.is_not_bids:
-        # 2. Check if the BIDS dataset is successfully loaded by pybids
-        try:
-            layout = BIDSLayout(args.dataset_dir)
-            print(f'PyBIDS summary of input dataset:\n{layout}')
-        except Exception as e:
-            print(f'{e}')
+
+    if args.trace_timeline and not args.trace_file:
+        print('The timeline of a trace requires --trace_file')
+        exit_code = 1
+        return exit_code
+
+    # The Datalad dataset of an in-place conversion is the input dataset
+    if args.in_place and args.dataset_dir:
+        if args.datalad_dir and os.path.abspath(args.datalad_dir) != os.path.abspath(args.dataset_dir):
+            print('The Datalad dataset directory should be the input dataset directory with --in_place')
             exit_code = 1
             return exit_code
+        if create_bids_filter(vars(args)) is not None:
+            print('A selection of files is not supported with --in_place')
+            exit_code = 1
+            return exit_code
+        args.datalad_dir = args.dataset_dir
 
-    # 3. Validate sibling configuration files if given
+    # 2. Validate sibling configuration files if given
     #    Exit if the json schema of the file is invalid
     if args.github_sibling_config:
         if not validate_json_sibling_config(
@@ -99,6 +112,26 @@ def main():
     # Execution of the two modes
     ############################
 
+    # Service mode
+    if args.mode == "serve" and not args.gui:
+        print(
+            "\n############################################\n"
+            "# Publication service\n"
+            "############################################\n"
+        )
+        service = PublicationService(
+            service_dir=args.service_dir,
+            max_jobs=args.max_jobs,
+            max_jobs_per_remote=args.max_jobs_per_remote
+        )
+        # Stop cleanly when the service is stopped
+        signal.signal(signal.SIGTERM, signal.default_int_handler)
+        with MetricsExporter(service.publication_metrics.registry,
+                             textfile=args.metrics_file, port=args.metrics_port):
+            serve(service, port=args.port, socket_path=args.socket, socket_group=args.socket_group)
+        print('Service stopped')
+        return 0
+
     # Commandline mode
     if not args.gui:
 
@@ -109,6 +142,17 @@ def main():
         else:
             git_annex_special_sibling_config = args.osf_sibling_config
             sibling_type = 'osf'
+        profiler = None
+        if args.profile:
+            profiler = StageProfiler(args.profile_dir or get_profile_run_dir(), mode=args.profile)
+            print(f'> Profiles of the stages written in {profiler.output_dir}')
+        metrics, metrics_exporter = None, None
+        if args.metrics_file or args.metrics_port is not None:
+            metrics = PublicationMetrics()
+            metrics_exporter = MetricsExporter(
+                metrics.registry, textfile=args.metrics_file, port=args.metrics_port
+            )
+        tracer = Tracer(args.trace_file) if args.trace_file else None
         # Create a NeuroDataPubProject
         neurodatapub_project = NeuroDataPubProject(
             dataset_dir=args.dataset_dir,
@@ -118,68 +162,135 @@ def main():
             sibling_type=sibling_type,
             github_sibling_config=args.github_sibling_config,
             mode=args.mode,
-            generate_script=args.generate_script
+            generate_script=args.generate_script,
+            jobs=args.jobs,
+            annex_cache_dir=args.annex_cache_dir,
+            annex_cache_size=int(args.annex_cache_size * 1000 ** 3),
+            bids_filter=create_bids_filter(vars(args)),
+            in_place=args.in_place,
+            in_place_unlocked=args.in_place_unlocked,
+            symlink_policy=args.symlink_policy,
+            save_chunk_files=args.save_chunk_files,
+            save_chunk_size=int(args.save_chunk_size * 1000 ** 3),
+            git_performance_profile=args.git_performance_profile,
+            profiler=profiler,
+            metrics=metrics,
+            tracer=tracer
         )
         print(neurodatapub_project)
 
-        # Initialize the script that will log all commands generated
-        cmd_log = '#!/bin/sh\n\n'
+        if metrics_exporter is not None:
+            metrics_exporter.start()
+        try:
+            if args.mode == "plan":
+                print(
+                    "\n############################################\n"
+                    "# Plan of the publication\n"
+                    "############################################\n"
+                )
+                plan = neurodatapub_project.plan_publication(
+                    bandwidth=args.bandwidth * 1024 * 1024 if args.bandwidth else None
+                )
+                return 0 if plan['enough_disk'] else 1
 
-        if args.mode == "create-only" or args.mode == "all":
-            print(
-                "\n############################################\n"
-                "# Creation of Datalad Dataset\n"
-                "############################################\n"
-            )
-            res, cmd_fun_log = neurodatapub_project.create_datalad_dataset()
-            if res:
-                exit_code = 0
-                print('Success')
-                cmd_log += f'{cmd_fun_log}\n'
-            else:
-                exit_code = 1
-                print('An error occurred during the creation of the Datalad dataset')
-                return exit_code
-        if args.mode == "publish-only" or args.mode == "all":
-            print(
-                "\n############################################\n"
-                "# Configuration of the publication siblings\n"
-                "############################################\n"
-            )
-            res, cmd_fun_log = neurodatapub_project.configure_siblings()
-            if not res:
-                exit_code = 1
-                print('An error occurred during the configuration of the publication siblings')
-                return exit_code
-            print(
-                "\n############################################\n"
-                "# Publication of Datalad Dataset\n"
-                "############################################\n"
-            )
-            cmd_log += f'{cmd_fun_log}\n'
-            res, cmd_fun_log = neurodatapub_project.publish_datalad_dataset()
-            if res:
-                exit_code = 0
-                print('Success')
-                cmd_log += f'{cmd_fun_log}\n'
-            else:
-                exit_code = 1
-                print('An error occurred during the publication of the Datalad dataset')
-        if args.generate_script:
-            # Create name of script with time stamp
-            now = datetime.datetime.now()
-            script_basename = f'neurodatapub_{now.strftime("%d-%m-%Y_%H-%M-%S")}.sh'
-            # Create the code folder if it does not exist
-            if not os.path.exists(os.path.join(args.dataset_dir, 'code')):
-                os.makedirs(os.path.join(args.dataset_dir, 'code'), exist_ok=True)
-            script_path = os.path.join(args.dataset_dir, 'code', script_basename)
-            print(
-                "\n############################################\n"
-                f"# Generation of script {script_path}\n"
-                "############################################\n"
-            )
-            with open(script_path, 'w') as f:
-                f.writelines(cmd_log)
+            if args.mode == "watch":
+                print(
+                    "\n############################################\n"
+                    "# Continuous publication of the changes\n"
+                    "############################################\n"
+                )
+                # Stop cleanly when the daemon is stopped
+                signal.signal(signal.SIGTERM, lambda *_: neurodatapub_project.cancel())
+                try:
+                    neurodatapub_project.watch_input_dataset(
+                        debounce=args.debounce,
+                        max_delay=args.max_delay,
+                        poll_interval=args.poll_interval
+                    )
+                except KeyboardInterrupt:
+                    neurodatapub_project.cancel()
+                print('Watch stopped')
+                return 0
+
+            if args.mode == "create-only" or args.mode == "all":
+                # Check if the file names follow the BIDS standard.
+                # The input dataset is only scanned by the modes that
+                # use its file table, once and shared by the project
+                if args.dataset_dir and not args.is_not_bids:
+                    try:
+                        summary = validate_bids_dataset(neurodatapub_project.scan_input_dataset())
+                        print(f'Summary of input dataset:\n{format_bids_summary(summary)}')
+                    except Exception as e:
+                        print(f'{e}')
+                        exit_code = 1
+                        return exit_code
+                print(
+                    "\n############################################\n"
+                    "# Creation of Datalad Dataset\n"
+                    "############################################\n"
+                )
+                res, _ = neurodatapub_project.create_datalad_dataset()
+                if res:
+                    exit_code = 0
+                    print('Success')
+                else:
+                    exit_code = 1
+                    print('An error occurred during the creation of the Datalad dataset')
+                    return exit_code
+            if args.mode == "publish-only" or args.mode == "all":
+                print(
+                    "\n############################################\n"
+                    "# Configuration of the publication siblings\n"
+                    "############################################\n"
+                )
+                res, _ = neurodatapub_project.configure_siblings()
+                if not res:
+                    exit_code = 1
+                    print('An error occurred during the configuration of the publication siblings')
+                    return exit_code
+                print(
+                    "\n############################################\n"
+                    "# Publication of Datalad Dataset\n"
+                    "############################################\n"
+                )
+                res, _ = neurodatapub_project.publish_datalad_dataset()
+                if res:
+                    exit_code = 0
+                    print('Success')
+                else:
+                    exit_code = 1
+                    print('An error occurred during the publication of the Datalad dataset')
+                if args.verify and res:
+                    print(
+                        "\n############################################\n"
+                        "# Verification of the published content\n"
+                        "############################################\n"
+                    )
+                    res, _ = neurodatapub_project.verify_publication(
+                        checksum=args.verify_checksum,
+                        sample=args.verify_sample,
+                        jobs=args.verify_jobs
+                    )
+                    if not res:
+                        exit_code = 1
+                        print('The verification of the published content failed')
+            if args.generate_script:
+                script_path = write_script(
+                    script_plan=neurodatapub_project.script_plan,
+                    dataset_dir=args.dataset_dir,
+                    jobs=args.jobs
+                )
+                print(
+                    "\n############################################\n"
+                    f"# Generation of script {script_path}\n"
+                    "############################################\n"
+                )
+        finally:
+            if metrics_exporter is not None:
+                metrics_exporter.stop()
+            _print_profile_summary(profiler)
+            if tracer is not None:
+                _close_tracer(tracer, args.trace_timeline)
 
     else:
         # GUI mode
@@ -207,7 +318,8 @@ def main():
                 sibling_type=sibling_type,
                 github_sibling_config=args.github_sibling_config,
                 mode=args.mode,
-                generate_script=args.generate_script
+                generate_script=args.generate_script,
+                jobs=args.jobs
         )
         print(neurodatapub_project_gui)
 
@@ -218,5 +330,27 @@ def main():
     return exit_code
 
 
+def _close_tracer(tracer, timeline_file=None):
+    """Close the trace of a run and export its timeline."""
+    tracer.close()
+    print(f'> Trace written in {tracer.trace_file}')
+    if timeline_file:
+        nspans = export_trace_timeline(tracer.trace_file, timeline_file)
+        print(f'> Timeline of {nspans} spans written in {timeline_file}')
+
+
+def _print_profile_summary(profiler):
+    """Print the summary of the stages profiled in a run."""
+    if profiler is None or not profiler.stages:
+        return
+    print(
+        "\n############################################\n"
+        "# Profile of the stages\n"
+        "############################################\n"
+    )
+    print(format_profile_summary(profiler.stages, top_functions=5 if profiler.cpu else 0))
+    print(f'> Profiles written in {profiler.output_dir}')
+
+
 if __name__ == '__main__':
     sys.exit(main())
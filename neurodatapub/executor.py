@@ -0,0 +1,326 @@
+# Copyright © 2021-2022 Connectomics Lab
+# University Hospital Center and University of Lausanne (UNIL-CHUV), Switzerland,
+# and contributors
+#
+#  This software is distributed under the open-source license Apache 2.0.
+
+"""Futures-based API to run :class:`~neurodatapub.project.NeuroDataPubProject` publications in the background."""
+
+import time
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from neurodatapub.project import PublicationCancelled
+from neurodatapub.utils.events import (
+    StageFinished, FileCopied, KeyHashed, KeyTransferred, Error
+)
+from neurodatapub.utils.script import ScriptPlan
+
+
+class StageResult(object):
+
+    """Result of a stage of a publication.
+
+    Attributes
+    ----------
+    name : string
+        Name of the stage
+
+    success : bool
+        `True` if the stage completed without exception
+
+    duration : float
+        Duration of the stage in seconds
+    """
+
+    def __init__(self, name, success, duration):
+        """Constructor of :class:`StageResult` object."""
+        self.name = name
+        self.success = success
+        self.duration = duration
+
+    def to_dict(self):
+        """Return the result as a dictionary."""
+        return dict(name=self.name, success=self.success, duration=self.duration)
+
+
+class PublicationResult(object):
+
+    """Structured result of a publication run with :func:`run_publication`.
+
+    Attributes
+    ----------
+    mode : {"create-only", "publish-only", "all"}
+        Mode in which the publication has been run
+
+    success : bool
+        `True` if all stages completed without exception, reported
+        success and no transfer of the push failed
+
+    cancelled : bool
+        `True` if the publication has been cancelled
+
+    error : string
+        Error message if the publication failed
+
+    start_time, end_time : float
+        Start and end times in seconds since the epoch
+
+    stages : list of StageResult
+        Results of the stages in order of completion
+
+    files_copied, bytes_copied : int
+        Number of files and bytes copied to the Datalad dataset
+
+    keys_hashed, bytes_hashed : int
+        Number of files and bytes hashed and added to the annex
+
+    keys_transferred, bytes_transferred : int
+        Number of annexed files and bytes transferred to the remotes
+
+    failures : list of dict
+        Failures reported during the run, as dictionaries
+        with `"stage"`, `"path"` and `"message"` keys
+
+    commands : list of tuple
+        `(step name, equivalent bash command)` of the commands executed
+    """
+
+    def __init__(self, mode):
+        """Constructor of :class:`PublicationResult` object."""
+        self.mode = mode
+        self.success = False
+        self.cancelled = False
+        self.error = None
+        self.start_time = None
+        self.end_time = None
+        self.stages = []
+        self.files_copied = 0
+        self.bytes_copied = 0
+        self.keys_hashed = 0
+        self.bytes_hashed = 0
+        self.keys_transferred = 0
+        self.bytes_transferred = 0
+        self.failures = []
+        self.commands = []
+        self._lock = threading.Lock()
+
+    @property
+    def duration(self):
+        """Duration of the publication in seconds."""
+        if self.start_time is None or self.end_time is None:
+            return None
+        return self.end_time - self.start_time
+
+    def _on_event(self, event):
+        """Accumulate an event emitted by the project."""
+        with self._lock:
+            if isinstance(event, FileCopied):
+                self.files_copied += event.count
+                self.bytes_copied += event.nbytes
+            elif isinstance(event, KeyHashed):
+                self.keys_hashed += event.count
+                self.bytes_hashed += event.nbytes
+            elif isinstance(event, KeyTransferred):
+                self.keys_transferred += event.count
+                self.bytes_transferred += event.nbytes
+            elif isinstance(event, StageFinished):
+                self.stages.append(StageResult(event.stage, event.success, event.duration))
+            elif isinstance(event, Error):
+                self.failures.append(
+                    dict(stage=event.stage, path=event.path, message=event.message)
+                )
+
+    def to_dict(self):
+        """Return the result as a JSON-serializable dictionary."""
+        return dict(
+            mode=self.mode,
+            success=self.success,
+            cancelled=self.cancelled,
+            error=self.error,
+            start_time=self.start_time,
+            end_time=self.end_time,
+            duration=self.duration,
+            stages=[stage.to_dict() for stage in self.stages],
+            files_copied=self.files_copied,
+            bytes_copied=self.bytes_copied,
+            keys_hashed=self.keys_hashed,
+            bytes_hashed=self.bytes_hashed,
+            keys_transferred=self.keys_transferred,
+            bytes_transferred=self.bytes_transferred,
+            failures=list(self.failures),
+            commands=[list(command) for command in self.commands]
+        )
+
+    def __repr__(self):
+        """Define how a :class:`PublicationResult` object is rendered in `print()`."""
+        return (f'PublicationResult(mode={self.mode!r}, success={self.success}, '
+                f'duration={self.duration}, failures={len(self.failures)})')
+
+
+def run_publication(project, mode='all'):
+    """
+    Run synchronously the stages of a publication and return its structured result.
+
+    Parameters
+    ----------
+    project : NeuroDataPubProject
+        Configured project to be run
+
+    mode : {"create-only", "publish-only", "all"}
+        Mode in which the publication is run
+        (Default: `"all"`)
+
+    Returns
+    -------
+    result : PublicationResult
+        Result of the publication. Exceptions raised by the stages are
+        not propagated but recorded in `result.error`, like the failure
+        reported by a stage, after which the publication stops.
+    """
+    result = PublicationResult(mode)
+    project.mode = mode
+    project.script_plan = ScriptPlan()
+    project.reset_cancel()
+    token = project.events.subscribe(result._on_event)
+    result.start_time = time.time()
+    steps = []
+    if mode in ['create-only', 'all']:
+        steps.append(('creation of the Datalad dataset', project.create_datalad_dataset))
+    if mode in ['publish-only', 'all']:
+        steps.append(('configuration of the publication siblings', project.configure_siblings))
+        steps.append(('publication of the Datalad dataset', project.publish_datalad_dataset))
+    try:
+        for description, step in steps:
+            # Failed transfers do not raise: the push step reports them by its result
+            res, _ = step()
+            if not res:
+                project.events.flush()
+                result.error = f'The {description} failed'
+                push_failures = [failure for failure in result.failures if failure['stage'] == 'push']
+                if push_failures:
+                    result.error += f' ({len(push_failures)} transfers failed during the push)'
+                break
+        else:
+            result.success = True
+    except PublicationCancelled as e:
+        result.cancelled = True
+        result.error = str(e)
+    except Exception as e:
+        result.error = f'{type(e).__name__}: {e}'
+    finally:
+        project.events.flush()
+        project.events.unsubscribe(token)
+        result.end_time = time.time()
+        result.commands = [(step.name, step.cmd) for step in project.script_plan.steps]
+    return result
+
+
+class PublicationExecutor(object):
+
+    """Executor that runs publications in background threads and returns futures.
+
+    It allows a workflow engine to overlap the publication of one dataset
+    with the processing of the next one.
+
+    A running publication can be cancelled with the `cancel()` method
+    of its project.
+
+    Parameters
+    ----------
+    max_workers : int
+        Maximal number of publications run concurrently
+        (Default: `1`)
+
+    Examples
+    --------
+    >>> with PublicationExecutor(max_workers=2) as executor: # doctest: +SKIP
+    ...     future = executor.submit(project, mode='all')
+    ...     # ... process the next dataset ...
+    ...     result = future.result()
+    ...     print(result.to_dict())
+    """
+
+    def __init__(self, max_workers=1):
+        """Constructor of :class:`PublicationExecutor` object."""
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers,
+            thread_name_prefix='neurodatapub'
+        )
+
+    def submit(self, project, mode='all'):
+        """
+        Schedule the publication of a project.
+
+        Parameters
+        ----------
+        project : NeuroDataPubProject
+            Configured project to be run
+
+        mode : {"create-only", "publish-only", "all"}
+            Mode in which the publication is run
+            (Default: `"all"`)
+
+        Returns
+        -------
+        future : concurrent.futures.Future
+            Future resolved with the :class:`PublicationResult`
+        """
+        return self._executor.submit(run_publication, project, mode)
+
+    def submit_async(self, project, mode='all'):
+        """
+        Schedule the publication of a project and return an awaitable.
+
+        It should be called from a running `asyncio` event loop.
+
+        Parameters
+        ----------
+        project : NeuroDataPubProject
+            Configured project to be run
+
+        mode : {"create-only", "publish-only", "all"}
+            Mode in which the publication is run
+            (Default: `"all"`)
+
+        Returns
+        -------
+        future : asyncio.Future
+            Awaitable resolved with the :class:`PublicationResult`
+        """
+        return asyncio.wrap_future(self.submit(project, mode))
+
+    def shutdown(self, wait=True):
+        """Shut down the executor, waiting for the running publications if `wait` is `True`."""
+        self._executor.shutdown(wait=wait)
+
+    def __enter__(self):
+        """Enter the context of the executor."""
+        return self
+
+    def __exit__(self, *args):
+        """Shut down the executor when exiting its context."""
+        self.shutdown(wait=True)
+
+
+async def publish_async(project, mode='all'):
+    """
+    Coroutine that runs the publication of a project in a background thread.
+
+    Parameters
+    ----------
+    project : NeuroDataPubProject
+        Configured project to be run
+
+    mode : {"create-only", "publish-only", "all"}
+        Mode in which the publication is run
+        (Default: `"all"`)
+
+    Returns
+    -------
+    result : PublicationResult
+        Result of the publication
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, run_publication, project, mode)
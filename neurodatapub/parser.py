@@ -12,6 +12,12 @@ from neurodatapub.info import __version__
 from neurodatapub.info import __release_date__
 
 
+def _is_mode(*modes):
+    """Return `True` if ``neurodatapub`` is called in one of the given modes."""
+    argv = " ".join(sys.argv)
+    return any(f"--mode {mode}" in argv or f"--mode={mode}" in argv for mode in modes)
+
+
 def get_parser():
     """Create and return the parser object of NeuroDataPub."""
     p = argparse.ArgumentParser(
@@ -23,8 +29,13 @@ def get_parser():
         help="Mode in which ``neurodatapub`` is run: "
              '``"create-only"`` create the datalad dataset only, '
              '``"publish-only"`` publish the datalad dataset only, '
-             '``"all"`` create and publish the datalad dataset.',
-        choices=["all", "create-only", "publish-only"],
+             '``"all"`` create and publish the datalad dataset, '
+             '``"plan"`` only estimate the size, the number of files, the required disk space '
+             'and the transfer time of the publication, '
+             '``"watch"`` publish continuously the changes of the input dataset, '
+             '``"serve"`` run a local service that queues and runs the publication jobs '
+             'submitted by several users.',
+        choices=["all", "create-only", "publish-only", "plan", "watch", "serve"],
         required='--gui' not in " ".join(sys.argv),
         type=str
     )
@@ -32,7 +43,7 @@ def get_parser():
         "--dataset_dir",
         help="The directory with the input dataset "
              "formatted according to the BIDS standard.",
-        required='--gui' not in " ".join(sys.argv),
+        required='--gui' not in " ".join(sys.argv) and not _is_mode("serve"),
     )
     p.add_argument(
         "--is_not_bids",
@@ -42,18 +53,20 @@ def get_parser():
     )
     p.add_argument(
         "--datalad_dir",
-        help="The local directory where the Datalad dataset should be.",
-        required='--gui' not in " ".join(sys.argv),
+        help="The local directory where the Datalad dataset should be "
+             "(the input dataset directory with ``--in_place``).",
+        required=('--gui' not in " ".join(sys.argv) and not _is_mode("serve")
+                  and "--in_place" not in sys.argv),
     )
     p.add_argument(
         "--github_sibling_config",
         help="Path to a JSON file containing configuration "
              "parameters for the GitHub dataset repository sibling.",
-        required='--gui' not in " ".join(sys.argv),
+        required='--gui' not in " ".join(sys.argv) and not _is_mode("plan", "serve"),
         type=str
     )
     storage_sibling_config = p.add_mutually_exclusive_group(
-        required='--gui' not in " ".join(sys.argv)
+        required='--gui' not in " ".join(sys.argv) and not _is_mode("plan", "serve")
     )
     storage_sibling_config.add_argument(
         "--git_annex_ssh_special_sibling_config",
@@ -80,6 +93,369 @@ def get_parser():
         action="store_true",
         default=False
     )
+    p.add_argument(
+        "--jobs",
+        help="Number of parallel jobs used by `datalad save` and `datalad push` "
+             '(``"auto"`` or an integer). In the script generated with ``--generate_script``, '
+             "it sets the default value of the ``NEURODATAPUB_JOBS`` environment variable "
+             "that controls also the number of parallel copy processes.",
+        default="auto",
+        type=str
+    )
+    selection = p.add_argument_group(
+        "selection",
+        "Selection of the files of the input dataset to be copied, saved and pushed. "
+        "Files of a subject are selected if their BIDS entities are in the given lists, "
+        "while files at the dataset level are selected unless excluded by a pattern. "
+        "Files matching the patterns of the `.bidsignore` file are excluded."
+    )
+    selection.add_argument(
+        "--subjects",
+        help="Labels of the subjects to publish (e.g. ``01 02`` or ``sub-01 sub-02``).",
+        nargs="+",
+        type=str
+    )
+    selection.add_argument(
+        "--sessions",
+        help="Labels of the sessions to publish.",
+        nargs="+",
+        type=str
+    )
+    selection.add_argument(
+        "--datatypes",
+        help="Datatypes to publish (e.g. ``anat func``).",
+        nargs="+",
+        type=str
+    )
+    selection.add_argument(
+        "--suffixes",
+        help="Suffixes of the files to publish (e.g. ``T1w bold``).",
+        nargs="+",
+        type=str
+    )
+    selection.add_argument(
+        "--include",
+        help="If given, only the files matching one of these glob patterns are published "
+             "(``.gitignore``-like patterns, e.g. ``sub-0*/anat/``).",
+        nargs="+",
+        type=str
+    )
+    selection.add_argument(
+        "--exclude",
+        help="Glob patterns of the files not published (``.gitignore``-like patterns, "
+             "e.g. ``sourcedata/ derivatives/``).",
+        nargs="+",
+        type=str
+    )
+    p.add_argument(
+        "--verify",
+        help="After the publication, check that the annexed content is present in the special remote. "
+             "An interrupted verification is resumed by the next run.",
+        action="store_true",
+        default=False
+    )
+    p.add_argument(
+        "--verify_checksum",
+        help="With ``--verify``, download the annexed content and verify its checksum "
+             "instead of only checking its presence.",
+        action="store_true",
+        default=False
+    )
+    p.add_argument(
+        "--verify_sample",
+        help="With ``--verify``, only check a random sample of the annexed files: "
+             "a fraction of the files if lower than 1, a number of files otherwise.",
+        type=float
+    )
+    p.add_argument(
+        "--verify_jobs",
+        help="With ``--verify``, number of parallel checks (Default: ``--jobs``, or 4 if ``auto``).",
+        type=int
+    )
+    p.add_argument(
+        "--annex_cache_dir",
+        help="Directory of an annex object cache shared by the Datalad datasets created on the host. "
+             "Files already hashed in another dataset are hardlinked from the cache instead of being "
+             "copied and hashed again. It must be on the same filesystem as the Datalad datasets.",
+        type=str
+    )
+    p.add_argument(
+        "--annex_cache_size",
+        help="Maximal size in GB of the annex object cache. The least recently used objects "
+             "are evicted from the cache when it is exceeded.",
+        default=100,
+        type=float
+    )
+    p.add_argument(
+        "--save_chunk_files",
+        help="Maximal number of files saved per commit when the Datalad dataset is created. "
+             "The dataset is saved in chunks of whole directories when possible, each chunk is committed "
+             "such that an interrupted save is resumed by the next run, and the commits are finally "
+             "consolidated in a single commit (Default: the dataset is saved at once).",
+        default=0,
+        type=int
+    )
+    p.add_argument(
+        "--save_chunk_size",
+        help="Maximal size in GB of the files saved per commit when the Datalad dataset is created "
+             "(See ``--save_chunk_files``).",
+        default=0,
+        type=float
+    )
+    p.add_argument(
+        "--git_performance_profile",
+        help="Apply a git performance profile to the Datalad dataset (index version 4, split index, "
+             "untracked cache, commit-graph, pack settings, and the file system monitor where available) "
+             "and maintain its repository (``git maintenance``) before each push.",
+        action="store_true",
+        default=False
+    )
+    p.add_argument(
+        "--profile",
+        help="Profile each stage of the creation and publication separately: "
+             '``"cpu"`` records a ``cProfile`` dump per stage (Datalad calls included), '
+             '``"memory"`` traces the Python allocations (``tracemalloc``) and '
+             '``"both"`` does both. The resource usage of the subprocesses '
+             "(``rsync``, ``git-annex``) and the peak RSS are recorded in any case.",
+        choices=["cpu", "memory", "both"],
+        type=str
+    )
+    p.add_argument(
+        "--profile_dir",
+        help="Run directory of the profiles written with ``--profile`` "
+             "(Default: ``$XDG_CACHE_HOME/neurodatapub/profiles/<date>-<time>``).",
+        type=str
+    )
+    p.add_argument(
+        "--metrics_file",
+        help="Export the metrics of the publication (files copied, bytes hashed, bytes transferred per remote, "
+             'errors, stage durations, batches and pending changes in ``"watch"`` mode, jobs in '
+             '``"serve"`` mode) to this file, rewritten every 15 seconds in the format of the textfile '
+             "collector of the Prometheus node exporter (name ending with ``.prom``).",
+        type=str
+    )
+    p.add_argument(
+        "--metrics_port",
+        help="Serve the metrics of the publication in the Prometheus and OpenMetrics text formats "
+             'on ``http://127.0.0.1:<port>/metrics`` while running (mostly useful in ``"watch"`` mode).',
+        type=int
+    )
+    p.add_argument(
+        "--trace_file",
+        help="Record each stage, Datalad call and command of the run as a span (with the dataset, remote, "
+             "command, bytes and exit code) appended to this JSON-lines file, in the OTLP/JSON format of "
+             "OpenTelemetry.",
+        type=str
+    )
+    p.add_argument(
+        "--trace_timeline",
+        help="With ``--trace_file``, also write the spans as a timeline in the Chrome trace event format "
+             "to this JSON file, to be opened in Perfetto (https://ui.perfetto.dev) or ``chrome://tracing``.",
+        type=str
+    )
+    p.add_argument(
+        "--symlink_policy",
+        help="Policy of the ingestion of the symbolic links of the input dataset: "
+             '``"dereference"`` copies each link as a regular file, '
+             '``"preserve-internal"`` recreates the links to files of the dataset as relative links, '
+             '``"annex-once"`` in addition copies and hashes once the content shared by several links '
+             "(or hard links) and adds the other paths with the same git-annex key.",
+        choices=["dereference", "preserve-internal", "annex-once"],
+        default="dereference",
+        type=str
+    )
+    p.add_argument(
+        "--in_place",
+        help="Convert the input dataset directory itself into the Datalad dataset, "
+             "without copying its content. The conversion is refused if the directory is "
+             "already in a git repository, and a manifest of its files is recorded in "
+             "``.git/neurodatapub/inplace-manifest.tsv`` before the conversion.",
+        action="store_true",
+        default=False
+    )
+    p.add_argument(
+        "--in_place_unlocked",
+        help="With ``--in_place``, keep the annexed files as regular files hard linked "
+             "to the annex instead of symbolic links, such that existing analysis "
+             "tools can keep modifying them.",
+        action="store_true",
+        default=False
+    )
+    p.add_argument(
+        "--bandwidth",
+        help='Upload bandwidth to the remotes in MB/s used in ``"plan"`` mode to estimate '
+             "the transfer time. If not given, it is measured with a short upload "
+             "to the git-annex SSH special remote.",
+        type=float
+    )
+    p.add_argument(
+        "--debounce",
+        help='In ``"watch"`` mode, quiet period in seconds after which a batch of changes is published.',
+        default=60,
+        type=float
+    )
+    p.add_argument(
+        "--max_delay",
+        help='In ``"watch"`` mode, maximal delay in seconds between a change and its publication '
+             "when the input dataset changes continuously.",
+        default=600,
+        type=float
+    )
+    p.add_argument(
+        "--poll_interval",
+        help='In ``"watch"`` mode, scan the input dataset every ``poll_interval`` seconds instead of '
+             "relying on inotify notifications (e.g. on network filesystems modified by other hosts).",
+        type=float
+    )
+    p.add_argument(
+        "--port",
+        help='In ``"serve"`` mode, port on localhost where the service listens.',
+        default=8765,
+        type=int
+    )
+    p.add_argument(
+        "--socket",
+        help='In ``"serve"`` mode, path of a Unix socket where the service listens instead of localhost.',
+        type=str
+    )
+    p.add_argument(
+        "--socket_group",
+        help='In ``"serve"`` mode, group whose members can submit jobs through the Unix socket '
+             "(Default: only the user running the service).",
+        type=str
+    )
+    p.add_argument(
+        "--service_dir",
+        help='In ``"serve"`` mode, directory of the job queue of the service '
+             "(Default: ``$XDG_DATA_HOME/neurodatapub/service``).",
+        type=str
+    )
+    p.add_argument(
+        "--max_jobs",
+        help='In ``"serve"`` mode, maximal number of jobs running concurrently.',
+        default=2,
+        type=int
+    )
+    p.add_argument(
+        "--max_jobs_per_remote",
+        help='In ``"serve"`` mode, maximal number of jobs publishing to the same remote concurrently.',
+        default=1,
+        type=int
+    )
+    p.add_argument(
+        "-v",
+        "--version",
+        action="version",
+        version=f"``neurodatapub`` version {__version__} (Released: {__release_date__})",
+    )
+    return p
+
+
+def get_benchmark_parser():
+    """Create and return the parser object of the benchmark of NeuroDataPub."""
+    p = argparse.ArgumentParser(
+        description="Benchmark of the creation and publication of a synthetic BIDS dataset "
+                    f"to local siblings with `NeuroDataPub` (v{__version__})"
+    )
+    p.add_argument(
+        "--sibling_type",
+        help="Type of the git-annex special sibling, stood in by a local directory.",
+        choices=["ssh", "osf"],
+        default="ssh",
+        type=str
+    )
+    p.add_argument(
+        "--subjects",
+        help="Number of subjects of the synthetic dataset.",
+        default=4,
+        type=int
+    )
+    p.add_argument(
+        "--sessions",
+        help="Number of sessions per subject of the synthetic dataset.",
+        default=1,
+        type=int
+    )
+    p.add_argument(
+        "--file_size",
+        help="Size in MB of each image of the synthetic dataset.",
+        default=1.0,
+        type=float
+    )
+    p.add_argument(
+        "--small_files",
+        help="Number of small source files (4 KB) per session of the synthetic dataset.",
+        default=0,
+        type=int
+    )
+    p.add_argument(
+        "--jobs",
+        help="The number of parallel jobs used by ``datalad save`` and ``datalad push``.",
+        default="auto",
+        type=str
+    )
+    p.add_argument(
+        "--latency",
+        help="Latency in milliseconds added to each request to the ssh special sibling "
+             "by a simulated network link.",
+        type=float
+    )
+    p.add_argument(
+        "--bandwidth",
+        help="Bandwidth in MB/s of the simulated network link to the ssh special sibling, "
+             "shared by all transfers.",
+        type=float
+    )
+    p.add_argument(
+        "--failure_rate",
+        help="Probability that a transfer through the simulated network link fails.",
+        type=float
+    )
+    p.add_argument(
+        "--retries",
+        help="Number of retries of the failed transfers by git-annex (``annex.retry``).",
+        default=0,
+        type=int
+    )
+    p.add_argument(
+        "--shared_store",
+        action='store_true',
+        help="Store the annexed files of the ssh special sibling in a shared store."
+    )
+    p.add_argument(
+        "--updates",
+        help="Number of images modified and published after the first publication "
+             "(``0`` to skip the update). With ``--git_benchmark``, number of sidecar files modified.",
+        default=1,
+        type=int
+    )
+    p.add_argument(
+        "--git_profile",
+        action='store_true',
+        help="Apply the git performance profile to the Datalad dataset."
+    )
+    p.add_argument(
+        "--git_benchmark",
+        action='store_true',
+        help="Instead of the publication, compare the durations of ``git status`` and ``datalad save`` "
+             "without and with the git performance profile, on a dataset of ``--subjects`` subjects "
+             "with small images (e.g. ``--subjects 5000 --updates 100``)."
+    )
+    p.add_argument(
+        "--work_dir",
+        help="Directory of the benchmark (Default: a temporary directory).",
+        type=str
+    )
+    p.add_argument(
+        "--keep",
+        action='store_true',
+        help="Do not remove the work directory at the end of the benchmark."
+    )
+    p.add_argument(
+        "--output",
+        help="JSON file where the report of the benchmark is saved.",
+        type=str
+    )
     p.add_argument(
         "-v",
         "--version",
@@ -6,24 +6,79 @@
 
 import os
 import json
+import time
+import tempfile
+import functools
+import threading
+import contextlib
 from traits.api import (
     HasTraits, File, Directory, Str, Enum,
-    List, Password, Bool
+    List, Password, Bool, Instance, Int, Dict
 )
 
 import datalad.api
 
 from neurodatapub.info import __version__
 from neurodatapub.utils.datalad import (
-    create_dataset, create_bids_dataset,
-    create_ssh_sibling, create_github_sibling,
-    authenticate_osf, create_osf_sibling, publish_dataset,
+    create_dataset, create_bids_dataset, publish_dataset, get_osf_environment,
     DEFAULT_SSH_REMOTE_NAME, DEFAULT_OSF_REMOTE_NAME
 )
-from neurodatapub.utils.gitannex import init_ssh_special_sibling, enable_ssh_special_sibling
+from neurodatapub.utils.gitannex import (
+    configure_rsync_options, get_annexed_content_not_in_remote, get_keys_in_remote,
+    get_shared_store_keys, record_shared_store_keys, mark_keys_present_in_remote
+)
+from neurodatapub.utils.annexcache import AnnexObjectCache, DEFAULT_MAX_SIZE
+from neurodatapub.utils.backends import BACKENDS, get_sibling_backend
+from neurodatapub.utils.bidsfilter import BIDSFilter
+from neurodatapub.utils.chunks import (
+    plan_save_chunks, load_save_chunks_state, record_save_chunks_state, consolidate_commits
+)
+from neurodatapub.utils.gitperf import (
+    apply_git_performance_profile, validate_git_performance_profile, run_git_maintenance
+)
+from neurodatapub.utils.inplace import (
+    check_in_place_conversion, write_in_place_manifest,
+    check_in_place_manifest, configure_unlocked_files
+)
+from neurodatapub.utils.compression import get_compression_policy, get_rsync_compression_options
 from neurodatapub.utils.io import copy_content_to_datalad_dataset
-from neurodatapub.utils.sshconfig import update_ssh_config
-from neurodatapub.utils.github import authenticate_github_email, authenticate_github_token
+from neurodatapub.utils.metrics import PublicationMetrics
+from neurodatapub.utils.events import (
+    EventBus, StageStarted, StageFinished, Progress,
+    FileCopied, KeyHashed, KeyTransferred, Error
+)
+from neurodatapub.utils.plan import plan_publication, measure_ssh_bandwidth, format_plan
+from neurodatapub.utils.process import ProcessRegistry, track_processes
+from neurodatapub.utils.profiling import StageProfiler
+from neurodatapub.utils.pubstate import (
+    get_repository_state, get_worktree_changes, is_ancestor,
+    load_publication_states, record_publication_state
+)
+from neurodatapub.utils.scan import FileTable, scan_directory, get_scan_cache_file
+from neurodatapub.utils.script import ScriptPlan, SCRIPT_JOBS_VAR, SCRIPT_NPROC_VAR
+from neurodatapub.utils.symlinks import SYMLINK_POLICIES, plan_symlinks, create_symlinks, add_duplicates
+from neurodatapub.utils.tracing import Tracer, instrument_datalad_api, set_span_attributes
+from neurodatapub.utils.verify import verify_remote_content, format_verification_summary
+from neurodatapub.utils.watch import make_watcher, watch_batches
+
+
+class PublicationCancelled(Exception):
+
+    """Exception raised when an operation of a :class:`NeuroDataPubProject` has been cancelled."""
+
+
+def _stage(name):
+    """Decorate a :class:`NeuroDataPubProject` method executed as the stage `name`.
+
+    See :meth:`NeuroDataPubProject.stage`.
+    """
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            with self.stage(name):
+                return method(self, *args, **kwargs)
+        return wrapper
+    return decorator
 
 
 class NeuroDataPubProject(HasTraits):
@@ -84,6 +139,28 @@ class NeuroDataPubProject(HasTraits):
     remote_sibling_name : Str
         Datalad sibling name of the git-annex special sibling
 
+    special_sibling_backend : {"remote", "local"}
+        Backend of the git-annex special sibling: the SSH server or OSF
+        (`"remote"`), or their stand-ins on the local machine (`"local"`).
+        See :mod:`neurodatapub.utils.backends`
+
+    special_sibling_local_dir : Str
+        Directory of the local stand-in of OSF (optional)
+
+    throttle : Dict
+        Simulated network link to the local stand-in of the SSH server, with
+        the `"latency"` in seconds, the `"bandwidth"` in MB/s, the `"failure_rate"`
+        of the transfers and the `"seed"` of the failures (See
+        :class:`neurodatapub.utils.throttle.ThrottledRemote`). If empty,
+        the transfers are not throttled
+
+    github_backend : {"remote", "local"}
+        Backend of the github sibling: GitHub (`"remote"`) or
+        local bare repositories (`"local"`)
+
+    github_local_dir : Str
+        Directory of the local bare repositories standing for GitHub (optional)
+
     osf_token : Password
         Personal OSF token for authentication
 
@@ -107,6 +184,68 @@ class NeuroDataPubProject(HasTraits):
         all commands for later execution"
         (Default: `False`)
 
+    jobs : Str
+        Number of parallel jobs used by `datalad save`
+        and `datalad push`
+        (Default: `"auto"`)
+
+    script_plan : ScriptPlan
+        Structured plan of the commands recorded in `generate_script` mode,
+        from which the bash script is rendered
+
+    events : EventBus
+        Bus of the progress events (stage start and end, file copied,
+        key hashed, key transferred, errors) emitted by the project.
+        See :mod:`neurodatapub.utils.events`
+
+    file_table : FileTable
+        Table of the files of the input dataset computed by
+        `scan_input_dataset()` (`None` until the input dataset is scanned)
+
+    annex_cache_dir : Str
+        Directory of the annex object cache shared by the Datalad datasets
+        of the host (See :class:`neurodatapub.utils.annexcache.AnnexObjectCache`).
+        If empty, no cache is used
+
+    annex_cache_size : Int
+        Maximal size in bytes of the annex object cache
+
+    bids_filter : BIDSFilter
+        Selection of the files of the input dataset to be copied,
+        saved and pushed (`None` to publish all files)
+
+    in_place : Bool
+        If `True`, the input dataset directory is itself converted into
+        the Datalad dataset, without copying its content
+        (Default: `False`)
+
+    in_place_unlocked : Bool
+        If `True`, the annexed files of a dataset converted in place stay
+        regular files (unlocked), hard linked to the annex, instead of being
+        replaced by symbolic links (Default: `False`)
+
+    symlink_policy : {"dereference", "preserve-internal", "annex-once"}
+        Policy of the ingestion of the symbolic links of the input dataset:
+        links are copied as regular files (`"dereference"`), links to files of
+        the dataset are recreated (`"preserve-internal"`), and in addition the
+        content shared by several links is copied and hashed once (`"annex-once"`).
+        See :func:`neurodatapub.utils.symlinks.plan_symlinks`
+        (Default: `"dereference"`)
+
+    git_performance_profile : Bool
+        If `True`, the git performance profile (index version 4, split index,
+        untracked cache, commit-graph, ...) is applied to the Datalad dataset
+        and its repository is maintained before each push.
+        See :mod:`neurodatapub.utils.gitperf` (Default: `False`)
+
+    save_chunk_files : Int
+        Maximal number of files saved per commit when the Datalad dataset
+        is created (Default: `0`, the dataset is saved at once)
+
+    save_chunk_size : Int
+        Maximal size in bytes of the files saved per commit when the
+        Datalad dataset is created (Default: `0`, the dataset is saved at once)
+
     References
     ----------
     .. [1] https://bids-specification.readthedocs.io/en/stable/
@@ -165,9 +304,39 @@ class NeuroDataPubProject(HasTraits):
         desc='the remote absolute path of the sibling dataset on '
              'the git-annex special sibling'
     )
+    remote_shared_store_dir = Str(
+        desc='the remote absolute path of an annex object store shared by several datasets '
+             'on the git-annex special sibling (optional)'
+    )
+    transfer_compression = Dict(
+        desc='the compression policy of the transfers to the git-annex special sibling '
+             '(See :func:`neurodatapub.utils.compression.get_compression_policy`). '
+             'If empty, transfers are not compressed'
+    )
     remote_sibling_name = Str(
         desc='the Datalad sibling name of the git-annex special sibling'
     )
+    _backends = List(BACKENDS)
+    special_sibling_backend = Enum(
+        values='_backends',
+        desc='the backend of the git-annex special sibling '
+             '(the SSH server or OSF (`"remote"`) or a stand-in on the local machine (`"local"`))'
+    )
+    special_sibling_local_dir = Str(
+        desc='the directory of the local stand-in of OSF (optional)'
+    )
+    throttle = Dict(
+        desc='the latency, bandwidth and failure rate of the link simulated '
+             'to the local stand-in of the SSH server (optional)'
+    )
+    github_backend = Enum(
+        values='_backends',
+        desc='the backend of the github sibling '
+             '(GitHub (`"remote"`) or local bare repositories (`"local"`))'
+    )
+    github_local_dir = Str(
+        desc='the directory of the local bare repositories standing for GitHub (optional)'
+    )
     osf_token = Password(
         desc='Personal OSF token for authentication'
     )
@@ -186,6 +355,50 @@ class NeuroDataPubProject(HasTraits):
              'folder of the input dataset '
              'for later execution'
     )
+    jobs = Str(
+        'auto',
+        desc='the number of parallel jobs used by `datalad save` and `datalad push`'
+    )
+    script_plan = Instance(ScriptPlan, ())
+    events = Instance(EventBus, ())
+    profiler = Instance(StageProfiler)
+    metrics = Instance(PublicationMetrics)
+    tracer = Instance(Tracer)
+    file_table = Instance(FileTable)
+    annex_cache_dir = Str(
+        desc='the directory of the annex object cache shared by the Datalad datasets of the host'
+    )
+    annex_cache_size = Int(
+        DEFAULT_MAX_SIZE,
+        desc='the maximal size in bytes of the annex object cache'
+    )
+    bids_filter = Instance(BIDSFilter)
+    in_place = Bool(
+        False,
+        desc='to convert the input dataset directory itself into the Datalad dataset'
+    )
+    in_place_unlocked = Bool(
+        False,
+        desc='to keep the annexed files of a dataset converted in place unlocked'
+    )
+    git_performance_profile = Bool(
+        False,
+        desc='to apply the git performance profile to the Datalad dataset '
+             'and run the maintenance of its repository before each push'
+    )
+    save_chunk_files = Int(
+        0,
+        desc='the maximal number of files saved per commit when the Datalad dataset is created'
+    )
+    save_chunk_size = Int(
+        0,
+        desc='the maximal size in bytes of the files saved per commit when the Datalad dataset is created'
+    )
+    _symlink_policies = List(SYMLINK_POLICIES)
+    symlink_policy = Enum(
+        values='_symlink_policies',
+        desc='the policy of the ingestion of the symbolic links of the input dataset'
+    )
 
     def __init__(
         self,
@@ -196,12 +409,58 @@ class NeuroDataPubProject(HasTraits):
         sibling_type=None,
         github_sibling_config=None,
         mode=None,
-        generate_script=False
+        generate_script=False,
+        jobs='auto',
+        annex_cache_dir=None,
+        annex_cache_size=None,
+        bids_filter=None,
+        in_place=False,
+        in_place_unlocked=False,
+        symlink_policy='dereference',
+        save_chunk_files=0,
+        save_chunk_size=0,
+        git_performance_profile=False,
+        profiler=None,
+        metrics=None,
+        tracer=None
     ):
         """Constructor of :class:`NeuroDataPubProject` object."""
         HasTraits.__init__(self)
 
+        self._cancel_event = threading.Event()
+        self._process_registry = ProcessRegistry()
+
         self.generate_script = generate_script
+        self.jobs = str(jobs)
+
+        if annex_cache_dir is not None:
+            self.annex_cache_dir = os.path.abspath(annex_cache_dir)
+        if annex_cache_size is not None:
+            self.annex_cache_size = int(annex_cache_size)
+
+        self.bids_filter = bids_filter
+
+        self.in_place = in_place
+        self.in_place_unlocked = in_place_unlocked
+        self.symlink_policy = symlink_policy
+        self.save_chunk_files = int(save_chunk_files or 0)
+        self.save_chunk_size = int(save_chunk_size or 0)
+        self.git_performance_profile = git_performance_profile
+        self.profiler = profiler
+        self.metrics = metrics
+        if metrics is not None:
+            metrics.attach(self.events)
+        self.tracer = tracer
+        if tracer is not None:
+            instrument_datalad_api()
+        if in_place:
+            if bids_filter is not None:
+                raise ValueError('A selection of files is not supported with an in-place conversion')
+            if datalad_dataset_dir is None:
+                datalad_dataset_dir = dataset_dir
+            elif (dataset_dir is not None and
+                  os.path.abspath(datalad_dataset_dir) != os.path.abspath(dataset_dir)):
+                raise ValueError('The Datalad dataset of an in-place conversion is the input dataset')
 
         if sibling_type is not None:
             self.sibling_type = sibling_type
@@ -236,6 +495,18 @@ class NeuroDataPubProject(HasTraits):
                     self.remote_ssh_url = git_annex_special_sibling_config_dict['remote_ssh_url']
                 if 'remote_sibling_dir' in git_annex_special_sibling_config_dict.keys():
                     self.remote_sibling_dir = git_annex_special_sibling_config_dict['remote_sibling_dir']
+                if 'remote_shared_store_dir' in git_annex_special_sibling_config_dict.keys():
+                    self.remote_shared_store_dir = git_annex_special_sibling_config_dict['remote_shared_store_dir']
+                if 'transfer_compression' in git_annex_special_sibling_config_dict.keys():
+                    self.transfer_compression = get_compression_policy(
+                        git_annex_special_sibling_config_dict['transfer_compression']
+                    ) or {}
+                if 'backend' in git_annex_special_sibling_config_dict.keys():
+                    self.special_sibling_backend = git_annex_special_sibling_config_dict['backend']
+                if 'local_dir' in git_annex_special_sibling_config_dict.keys():
+                    self.special_sibling_local_dir = git_annex_special_sibling_config_dict['local_dir']
+                if 'throttle' in git_annex_special_sibling_config_dict.keys():
+                    self.throttle = git_annex_special_sibling_config_dict['throttle']
                 if 'osf_token' in git_annex_special_sibling_config_dict.keys():
                     self.osf_token = git_annex_special_sibling_config_dict['osf_token']
                 if 'osf_dataset_title' in git_annex_special_sibling_config_dict.keys():
@@ -256,6 +527,10 @@ class NeuroDataPubProject(HasTraits):
                     self.github_token = github_sibling_config_dict['github_token']
                 if 'github_repo_name' in github_sibling_config_dict.keys():
                     self.github_repo_name = github_sibling_config_dict['github_repo_name']
+                if 'backend' in github_sibling_config_dict.keys():
+                    self.github_backend = github_sibling_config_dict['backend']
+                if 'local_dir' in github_sibling_config_dict.keys():
+                    self.github_local_dir = github_sibling_config_dict['local_dir']
 
     def __str__(self):
         """Define how a :class:`NeuroDataPubProject` object is rendered in `print()`."""
@@ -265,6 +540,7 @@ class NeuroDataPubProject(HasTraits):
         desc = f"""
 NeuroDataPubProject object attribute summary:
 \tgenerate_script : {self.generate_script}
+\tjobs : {self.jobs}
 \tinput_dataset_dir : {self.input_dataset_dir}
 \tdataset_is_bids : {self.dataset_is_bids}
 \toutput_datalad_dataset_dir : {self.output_datalad_dataset_dir}
@@ -275,6 +551,9 @@ NeuroDataPubProject object attribute summary:
 \tgithub_organization : {self.github_organization}
 \tgithub_token : {encrypted_github_token}
 \tgithub_repo_name : {self.github_repo_name}"""
+        if self.github_backend != 'remote':
+            desc += f"""
+\tgithub_backend : {self.github_backend}"""
         if self.sibling_type == 'ssh':
             desc += f"""
 \tremote_ssh_login : {self.remote_ssh_login}
@@ -285,8 +564,130 @@ NeuroDataPubProject object attribute summary:
             desc += f"""
 \tosf_dataset_title : {self.osf_dataset_title}
 \tosf_token : {encrypted_osf_token}"""
+        if self.special_sibling_backend != 'remote':
+            desc += f"""
+\tspecial_sibling_backend : {self.special_sibling_backend}"""
+        if self.symlink_policy != 'dereference':
+            desc += f"""
+\tsymlink_policy : {self.symlink_policy}"""
+        if self.in_place:
+            desc += f"""
+\tin_place : {self.in_place}
+\tin_place_unlocked : {self.in_place_unlocked}"""
         return desc
 
+    def cancel(self):
+        """Cancel the operation in progress.
+
+        The running subprocesses are terminated and :class:`PublicationCancelled`
+        is raised in the thread executing the operation at the next checkpoint.
+        Call `reset_cancel()` before starting a new operation.
+        """
+        self._cancel_event.set()
+        self._process_registry.terminate()
+
+    def reset_cancel(self):
+        """Clear a previous cancellation request."""
+        self._cancel_event.clear()
+
+    def check_cancelled(self):
+        """Raise :class:`PublicationCancelled` if `cancel()` has been called."""
+        if self._cancel_event.is_set():
+            raise PublicationCancelled('Operation cancelled')
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """Context manager that executes a block of code as the stage `name`.
+
+        Cancellation is checked before the stage starts, all subprocesses launched
+        in the stage are recorded such that they can be terminated by `cancel()`,
+        and :class:`~neurodatapub.utils.events.StageStarted`,
+        :class:`~neurodatapub.utils.events.StageFinished` and
+        :class:`~neurodatapub.utils.events.Error` events are emitted.
+        If the project has a `profiler`, the stage is profiled separately
+        (See :class:`~neurodatapub.utils.profiling.StageProfiler`), and if it
+        has a `tracer`, the stage, the Datalad calls and the commands run in it
+        are recorded as spans (See :class:`~neurodatapub.utils.tracing.Tracer`).
+
+        Parameters
+        ----------
+        name : string
+            Name of the stage
+        """
+        self.check_cancelled()
+        self.events.emit(StageStarted(name))
+        start = time.monotonic()
+        success = False
+        try:
+            profile = self.profiler.profile(name) if self.profiler is not None else contextlib.nullcontext()
+            span = contextlib.nullcontext()
+            if self.tracer is not None:
+                span = self.tracer.span(f'stage {name}', **{
+                    'neurodatapub.stage': name,
+                    'neurodatapub.dataset': self.output_datalad_dataset_dir or None
+                })
+            with track_processes(self._process_registry), span, profile:
+                yield
+            success = True
+        except Exception as e:
+            # Report the error only in the innermost stage
+            if not getattr(e, '_neurodatapub_reported', False):
+                self.events.emit(Error(stage=name, message=str(e)))
+                e._neurodatapub_reported = True
+            raise
+        finally:
+            self.events.emit(StageFinished(name, success, time.monotonic() - start))
+
+    def _report_progress(self, stage, completed, total, completed_bytes=0, total_bytes=0):
+        """Emit a :class:`~neurodatapub.utils.events.Progress` event and check for cancellation."""
+        self.check_cancelled()
+        set_span_attributes({'neurodatapub.files': completed, 'neurodatapub.bytes': completed_bytes})
+        self.events.emit(Progress(stage, completed, total, completed_bytes, total_bytes))
+
+    def _report_result_error(self, stage, result):
+        """Emit an :class:`~neurodatapub.utils.events.Error` event for a failed Datalad result."""
+        if result.get('status') in ['error', 'impossible']:
+            self.events.emit(Error(
+                stage=stage,
+                message=str(result.get('message', result.get('status'))),
+                path=result.get('path')
+            ))
+
+    def _special_remote_env(self):
+        """Return the environment variables giving its credentials to the commands on the special remote."""
+        if self.sibling_type == 'osf' and not self.generate_script:
+            return get_osf_environment(self.osf_token)
+        return None
+
+    def get_backend(self, kind):
+        """
+        Return the backend of a sibling of the project.
+
+        Parameters
+        ----------
+        kind : {"ssh", "osf", "github"}
+            Kind of sibling
+
+        Returns
+        -------
+        backend : neurodatapub.utils.backends.SiblingBackend
+            Backend selected by the `"backend"` entry of the configuration of the sibling
+        """
+        if kind == 'github':
+            return get_sibling_backend('github', self.github_backend, self.github_local_dir)
+        return get_sibling_backend(kind, self.special_sibling_backend, self.special_sibling_local_dir)
+
+    def _get_jobs(self):
+        """Return the value of `jobs` passed to `datalad save` and `datalad push`.
+
+        In `generate_script` mode, it refers to the shell variable defined in
+        the header of the generated script.
+        """
+        if self.generate_script:
+            return SCRIPT_JOBS_VAR
+        return int(self.jobs) if self.jobs.isdigit() else self.jobs
+
+    @_stage('create')
     def create_datalad_dataset(self):
         """Create the Datalad dataset."""
         # Initialize the command log of the method
@@ -296,11 +697,14 @@ NeuroDataPubProject object attribute summary:
         if not os.path.exists(
             os.path.join(self.output_datalad_dataset_dir, '.datalad')
         ):
+            if self.in_place:
+                return self._create_in_place()
             if self.dataset_is_bids:
                 msg = f'Initialize the BIDS Datalad dataset {self.output_datalad_dataset_dir}'
                 print(f'> {msg}')
                 proc, cmd = create_bids_dataset(
                     datalad_dataset_dir=self.output_datalad_dataset_dir,
+                    git_profile=self.git_performance_profile,
                     dryrun=self.generate_script
                 )
                 if proc:
@@ -310,21 +714,85 @@ NeuroDataPubProject object attribute summary:
                 print(f'> {msg}')
                 proc, cmd = create_dataset(
                     datalad_dataset_dir=self.output_datalad_dataset_dir,
+                    git_profile=self.git_performance_profile,
                     dryrun=self.generate_script
                 )
                 if proc:
                     print(f'{proc}')
+            self._validate_git_profile()
             cmd_fun_log += f'# {msg}\n{cmd}\n\n'
+            self.script_plan.add_step(
+                'create_dataset', msg, cmd,
+                check=f'[ -d "{self.output_datalad_dataset_dir}/.datalad" ]'
+            )
 
             msg = (f'Copy content of {self.input_dataset_dir} to '
                    f'{self.output_datalad_dataset_dir}')
             print(f'> {msg}')
-            proc, cmd = copy_content_to_datalad_dataset(
-                bids_dir=self.input_dataset_dir,
-                datalad_dataset_dir=self.output_datalad_dataset_dir,
-                dryrun=self.generate_script
-            )
+            copy_progress = None
+            files_from = None
+            total, total_bytes = 0, 0
+            annex_cache, cached = self._open_annex_cache(), []
+            if annex_cache is not None:
+                with self.stage('cache'):
+                    cached = annex_cache.checkout(
+                        self.output_datalad_dataset_dir,
+                        annex_cache.lookup(self.get_selected_table())
+                    )
+                print(f'\t* {len(cached)} files added from the annex object cache')
+            # Internal links and duplicates of other files are not copied
+            links, duplicates = plan_symlinks(self.get_selected_table(), self.symlink_policy)
+            duplicates = {path: primary for path, primary in duplicates.items() if path not in cached}
+            skipped = set(cached) | set(links) | set(duplicates)
+            with self.stage('copy'), tempfile.NamedTemporaryFile(
+                prefix='neurodatapub_', suffix='.files'
+            ) as file_list:
+                if self.generate_script and (self.bids_filter is not None or skipped):
+                    # The selection is recorded next to the generated script, under its name
+                    # such that the scripts generated before keep their own selection
+                    files_from = os.path.join(
+                        self.input_dataset_dir, 'code', f'{self.script_plan.name}.files'
+                    )
+                    os.makedirs(os.path.dirname(files_from), exist_ok=True)
+                    table = self.get_selected_table()
+                    with open(files_from, 'wb') as selection:
+                        table.write_file_list(
+                            selection, paths=[path for path in table.paths if path not in skipped]
+                        )
+                elif not self.generate_script:
+                    # rsync copies the files of the table instead of walking the dataset again
+                    table = self.get_selected_table()
+                    if skipped:
+                        table.write_file_list(
+                            file_list, paths=[path for path in table.paths if path not in skipped]
+                        )
+                    else:
+                        table.write_file_list(file_list)
+                    file_list.flush()
+                    files_from = file_list.name
+                    total, total_bytes = len(table), table.total_bytes
+                    if self.events.listening:
+                        copy_progress = self._copy_progress_handler(total, total_bytes)
+                proc, cmd = copy_content_to_datalad_dataset(
+                    bids_dir=self.input_dataset_dir,
+                    datalad_dataset_dir=self.output_datalad_dataset_dir,
+                    jobs=SCRIPT_NPROC_VAR if self.generate_script else None,
+                    files_from=files_from,
+                    stdout_callback=copy_progress,
+                    dryrun=self.generate_script
+                )
+                if links:
+                    nb_links, links_cmd = create_symlinks(
+                        self.output_datalad_dataset_dir, links, dryrun=self.generate_script
+                    )
+                    cmd += f'\n{links_cmd}'
+                    if nb_links:
+                        print(f'\t* {nb_links} internal symbolic links recreated')
             cmd_fun_log += f'# {msg}\n{cmd}\n\n'
+            self.script_plan.add_step(
+                'copy_content', msg, cmd,
+                depends_on=['create_dataset']
+            )
 
             if proc is not None:
                 print(proc.stdout)
@@ -332,130 +800,519 @@ NeuroDataPubProject object attribute summary:
             print(f'> {msg}')
             save_msg = (f'Save dataset state after performing the rsync command '
                         f'with neurodatapub {__version__}')
+            jobs = self._get_jobs()
             if not self.generate_script:
-                datalad.api.save(
-                    dataset=self.output_datalad_dataset_dir,
-                    message=save_msg,
-                    jobs='auto'
-                )
-            cmd = f'datalad save -d "{self.output_datalad_dataset_dir}" -m "{save_msg}" -J "auto"'
+                with self.stage('save'):
+                    if not self._save_in_chunks(message=save_msg, jobs=jobs, table=table, exclude=duplicates):
+                        return False, cmd_fun_log
+                if annex_cache is not None:
+                    with self.stage('cache'):
+                        nb_objects = annex_cache.ingest(
+                            self.output_datalad_dataset_dir, table, skip=set(cached) | set(links)
+                        )
+                        annex_cache.close()
+                    print(f'\t* {nb_objects} objects added to the annex object cache')
+            cmd = f'datalad save -d "{self.output_datalad_dataset_dir}" -m "{save_msg}" -J "{jobs}"'
+            if duplicates:
+                with self.stage('save'):
+                    cmd += f'\n{self._add_duplicates(duplicates, jobs)}'
             cmd_fun_log += f'# {msg}\n{cmd}\n'
+            self.script_plan.add_step(
+                'save_dataset', msg, cmd,
+                depends_on=['copy_content']
+            )
         else:
-            print(f'> Creation of Datalad dataset {self.output_datalad_dataset_dir} '
-                  'skipped as a Datalad dataset is already present!')
+            # An unfinished save is finished before anything else,
+            # including the consolidation of the commits of its chunks
+            state = None if self.generate_script else load_save_chunks_state(self.output_datalad_dataset_dir)
+            if state is not None:
+                if state['done'] < len(state['chunks']):
+                    print(f'> Resume the save of {self.output_datalad_dataset_dir} '
+                          f'at chunk {state["done"] + 1}/{len(state["chunks"])}')
+                else:
+                    print(f'> Consolidate the commits of the {len(state["chunks"])} chunks '
+                          f'saved in {self.output_datalad_dataset_dir}')
+                with self.stage('save'):
+                    if not self._resume_save_chunks(state, jobs=self._get_jobs()):
+                        return False, cmd_fun_log
+            else:
+                print(f'> Creation of Datalad dataset {self.output_datalad_dataset_dir} '
+                      'skipped as a Datalad dataset is already present!')
         return True, cmd_fun_log
 
+    def _validate_git_profile(self):
+        """Check that the git performance profile is applied to the Datalad dataset if enabled, and return `True` if it is."""
+        if not self.git_performance_profile or self.generate_script:
+            return True
+        mismatches = validate_git_performance_profile(self.output_datalad_dataset_dir)
+        for name, (expected, actual) in mismatches.items():
+            print(f'\t* WARNING: git configuration {name} is {actual} instead of {expected}')
+        return not mismatches
+
+    def _add_duplicates(self, duplicates, jobs):
+        """Add and save the duplicates of saved files with their git-annex key, and return the equivalent command.
+
+        See :func:`neurodatapub.utils.symlinks.add_duplicates`.
+        """
+        added, cmd = add_duplicates(self.output_datalad_dataset_dir, duplicates, dryrun=self.generate_script)
+        save_msg = f'Add {len(duplicates)} duplicated files with neurodatapub {__version__}'
+        if added:
+            print(f'\t* {len(added)} duplicated files added without copy')
+            self._save(
+                message=save_msg,
+                jobs=jobs,
+                paths=[os.path.join(self.output_datalad_dataset_dir, path) for path in added]
+            )
+        return f'{cmd}\ndatalad save -d "{self.output_datalad_dataset_dir}" -m "{save_msg}" -J "{jobs}"'
+
+    def _create_in_place(self):
+        """Convert the input dataset directory itself into the Datalad dataset.
+
+        The conversion is refused if the directory is already in a git
+        repository or not writable. The files of the dataset are recorded in a
+        manifest (See :func:`neurodatapub.utils.inplace.write_in_place_manifest`)
+        before they are saved, and checked against it after the save.
+        """
+        cmd_fun_log = ''
+        dataset_dir = self.output_datalad_dataset_dir
+        msg = f'Check that {dataset_dir} can be converted in place'
+        print(f'> {msg}')
+        # The manifest must record the current size and modification time of every file
+        table = self.scan_input_dataset(use_cache=False)
+        problems, warnings = check_in_place_conversion(dataset_dir, table)
+        for warning in warnings:
+            print(f'\t* WARNING: {warning}')
+        if problems:
+            for problem in problems:
+                print(f'\t* ERROR: {problem}')
+            return False, cmd_fun_log
+
+        create = create_bids_dataset if self.dataset_is_bids else create_dataset
+        msg = f'Initialize the Datalad dataset in place in {dataset_dir}'
+        print(f'> {msg}')
+        proc, cmd = create(
+            datalad_dataset_dir=dataset_dir,
+            force=True,
+            git_profile=self.git_performance_profile,
+            dryrun=self.generate_script
+        )
+        if proc:
+            print(f'{proc}')
+        self._validate_git_profile()
+        cmd_fun_log += f'# {msg}\n{cmd}\n\n'
+        self.script_plan.add_step(
+            'create_dataset', msg, cmd,
+            check=f'[ -d "{dataset_dir}/.datalad" ]'
+        )
+
+        msg = 'Record the manifest of the files before the conversion'
+        print(f'> {msg}')
+        manifest_file, cmd = write_in_place_manifest(dataset_dir, table, dryrun=self.generate_script)
+        if manifest_file:
+            print(f'\t* {len(table)} files recorded in {manifest_file}')
+        cmd_fun_log += f'# {msg}\n{cmd}\n\n'
+        self.script_plan.add_step('write_manifest', msg, cmd, depends_on=['create_dataset'])
+        save_depends_on = ['write_manifest']
+
+        if self.in_place_unlocked:
+            msg = 'Keep the annexed files unlocked'
+            print(f'> {msg}')
+            _, cmd = configure_unlocked_files(dataset_dir, dryrun=self.generate_script)
+            cmd_fun_log += f'# {msg}\n{cmd}\n\n'
+            self.script_plan.add_step('configure_unlocked', msg, cmd, depends_on=['create_dataset'])
+            save_depends_on.append('configure_unlocked')
+
+        msg = 'Save dataset state...'
+        print(f'> {msg}')
+        save_msg = f'Save dataset state after its conversion in place with neurodatapub {__version__}'
+        jobs = self._get_jobs()
+        if not self.generate_script:
+            with self.stage('save'):
+                if not self._save_in_chunks(message=save_msg, jobs=jobs, table=table):
+                    return False, cmd_fun_log
+            missing = check_in_place_manifest(dataset_dir)
+            if missing:
+                print(f'\t* ERROR: {len(missing)} files of the manifest are missing or changed '
+                      f'after the conversion (e.g. {missing[0]})')
+                return False, cmd_fun_log
+            print(f'\t* All {len(table)} files of the manifest are present')
+            # Annexed files have been replaced or hard linked by git-annex
+            self.scan_input_dataset(use_cache=False)
+        cmd = f'datalad save -d "{dataset_dir}" -m "{save_msg}" -J "{jobs}"'
+        cmd_fun_log += f'# {msg}\n{cmd}\n'
+        self.script_plan.add_step('save_dataset', msg, cmd, depends_on=save_depends_on)
+        return True, cmd_fun_log
+
+    def _open_annex_cache(self):
+        """Return the annex object cache, or `None` if it is not used.
+
+        The cache is not used in `generate_script` mode, for an in-place
+        conversion and if it is not on the same filesystem as the Datalad dataset.
+        """
+        if not self.annex_cache_dir or self.generate_script or self.in_place:
+            return None
+        annex_cache = AnnexObjectCache(self.annex_cache_dir, max_size=self.annex_cache_size)
+        if not annex_cache.is_usable_for(self.output_datalad_dataset_dir):
+            print(f'\t* WARNING: {self.annex_cache_dir} is not on the same filesystem '
+                  f'as {self.output_datalad_dataset_dir}: annex object cache not used')
+            annex_cache.close()
+            return None
+        return annex_cache
+
+    def scan_input_dataset(self, refresh=False, use_cache=True):
+        """
+        Scan in parallel the input dataset and return its file table.
+
+        The table is computed once and shared by the copy, the validation
+        and the planning. The scan reuses the cached table of the previous run
+        for the directories that have not been modified.
+
+        Parameters
+        ----------
+        refresh : bool
+            If `True`, scan again the input dataset even if
+            `file_table` is already set (Default: `False`)
+
+        use_cache : bool
+            If `False`, every file is stat-ed again instead of reusing
+            the cached table, whose sizes and modification times may be
+            outdated, and `refresh` is implied (Default: `True`)
+
+        Returns
+        -------
+        file_table : neurodatapub.utils.scan.FileTable
+            Table of the files of the input dataset
+        """
+        if (refresh or not use_cache or self.file_table is None
+                or self.file_table.root != os.path.abspath(self.input_dataset_dir)):
+            self.file_table = scan_directory(
+                self.input_dataset_dir,
+                cache_file=get_scan_cache_file(self.input_dataset_dir) if use_cache else None
+            )
+        return self.file_table
+
+    def get_selected_table(self):
+        """Return the table of the files of the input dataset selected by `bids_filter` for publication."""
+        table = self.scan_input_dataset()
+        if self.bids_filter is None:
+            return table
+        return self.bids_filter.filter_table(table)
+
+    def plan_publication(self, bandwidth=None):
+        """
+        Estimate the resources needed by the publication without running it.
+
+        Parameters
+        ----------
+        bandwidth : float
+            Upload bandwidth to the remotes in bytes per second. If `None`
+            and a ssh special remote is configured, it is measured with a
+            short probe (Default: `None`)
+
+        Returns
+        -------
+        plan : dict
+            Plan returned by :func:`neurodatapub.utils.plan.plan_publication`
+        """
+        print(f'> Scan the content of {self.input_dataset_dir}')
+        start = time.monotonic()
+        table = self.scan_input_dataset()
+        print(f'\t* {len(table)} files scanned in {time.monotonic() - start:.1f} s')
+        if self.bids_filter is not None:
+            table = self.get_selected_table()
+            print(f'\t* {len(table)} files selected by {self.bids_filter}')
+        rtt = 0
+        if (bandwidth is None and self.sibling_type == 'ssh' and self.remote_ssh_url
+                and self.special_sibling_backend == 'remote'):
+            print(f'> Measure the bandwidth to {self.remote_ssh_url}')
+            bandwidth, rtt = measure_ssh_bandwidth(
+                sshurl=self.remote_ssh_url,
+                user=self.remote_ssh_login
+            )
+        compression = None
+        if self.sibling_type == 'ssh' and self.transfer_compression:
+            compression = self.transfer_compression
+        plan = plan_publication(
+            table=table,
+            datalad_dataset_dir=self.output_datalad_dataset_dir,
+            bandwidth=bandwidth,
+            rtt=rtt,
+            compression=compression,
+            in_place=self.in_place
+        )
+        print(f'> Plan of the publication:{format_plan(plan)}')
+        return plan
+
+    def _copy_progress_handler(self, total, total_bytes):
+        """Return a function that reports the progress of the copy from the lines printed by `rsync`."""
+        counts = {'files': 0, 'bytes': 0}
+        self._report_progress('copy', 0, total, 0, total_bytes)
+
+        def handler(line):
+            # rsync -v lists the copied files relative to the input directory
+            # in addition to directories (ending with "/") and a summary
+            entry = self.file_table.get(line) if self.file_table is not None else None
+            if entry is not None:
+                nbytes = entry.size
+                counts['files'] += 1
+                counts['bytes'] += nbytes
+                self.events.emit(FileCopied(path=line, nbytes=nbytes))
+                self._report_progress('copy', counts['files'], total, counts['bytes'], total_bytes)
+        return handler
+
+    def _save(self, message, jobs, total=0, total_bytes=0, paths=None, start=(0, 0)):
+        """Save the state of the Datalad dataset, reporting the progress of the `"save"` stage.
+
+        `total` and `total_bytes` are the expected number of files and bytes
+        to be saved, if known (`0` otherwise). If `paths` is given, only
+        these paths of the dataset are saved. The progress is counted from
+        the number of files and bytes `start` already saved, and the
+        updated counts are returned.
+        """
+        if not self.events.listening:
+            datalad.api.save(
+                dataset=self.output_datalad_dataset_dir,
+                path=paths,
+                message=message,
+                jobs=jobs
+            )
+            return start
+        completed, completed_bytes = start
+        for result in datalad.api.save(
+            dataset=self.output_datalad_dataset_dir,
+            path=paths,
+            message=message,
+            jobs=jobs,
+            return_type='generator'
+        ):
+            if result.get('action') == 'add' and result.get('status') == 'ok':
+                nbytes = os.path.getsize(result['path']) if os.path.exists(result['path']) else 0
+                completed += 1
+                completed_bytes += nbytes
+                if result.get('key'):
+                    self.events.emit(KeyHashed(path=result['path'], nbytes=nbytes))
+                self._report_progress('save', completed, total, completed_bytes, total_bytes)
+            else:
+                self._report_result_error('save', result)
+        return completed, completed_bytes
+
+    def _save_in_chunks(self, message, jobs, table, exclude=()):
+        """Save the files of `table` in the Datalad dataset in chunks of at most `save_chunk_files` files and `save_chunk_size` bytes.
+
+        Each chunk is committed and recorded (See :mod:`neurodatapub.utils.chunks`),
+        such that an interrupted save is resumed by the next run. The commits of
+        the chunks are then consolidated in a single commit with `message`.
+        The files of `exclude` are not saved. Return `False` if the commits
+        could not be consolidated, which is retried by the next run.
+        """
+        if not self.save_chunk_files and not self.save_chunk_size:
+            self._save(message=message, jobs=jobs, total=len(table), total_bytes=table.total_bytes)
+            return True
+        state = dict(
+            message=message,
+            base=get_repository_state(self.output_datalad_dataset_dir)['commit'],
+            chunks=plan_save_chunks(table, self.save_chunk_files, self.save_chunk_size, exclude=exclude),
+            done=0,
+            consolidated=False
+        )
+        record_save_chunks_state(self.output_datalad_dataset_dir, state)
+        return self._resume_save_chunks(state, jobs, total=len(table), total_bytes=table.total_bytes)
+
+    def _resume_save_chunks(self, state, jobs, total=0, total_bytes=0):
+        """Save the remaining chunks of a save in chunks, consolidate their commits and return `True` if it succeeded."""
+        chunks = state['chunks']
+        completed = (0, 0)
+        for i in range(state['done'], len(chunks)):
+            self.check_cancelled()
+            print(f'\t* Save chunk {i + 1}/{len(chunks)} ({len(chunks[i])} paths)')
+            completed = self._save(
+                message=f'{state["message"]} (chunk {i + 1}/{len(chunks)})',
+                jobs=jobs,
+                total=total,
+                total_bytes=total_bytes,
+                paths=[os.path.join(self.output_datalad_dataset_dir, path) for path in chunks[i]],
+                start=completed
+            )
+            state['done'] = i + 1
+            record_save_chunks_state(self.output_datalad_dataset_dir, state)
+        if len(chunks) > 1 and not consolidate_commits(
+            self.output_datalad_dataset_dir, state['base'],
+            f'{state["message"]}\n\nSaved in {len(chunks)} chunks by neurodatapub {__version__}'
+        ):
+            return False
+        state['consolidated'] = True
+        record_save_chunks_state(self.output_datalad_dataset_dir, state)
+        return True
+
+    @_stage('configure_ssh')
     def configure_ssh_sibling(self):
         """Configure a ssh sibling of the Datalad dataset for publication of annexed files."""
         # Initialize the command log of the method
         cmd_fun_log = ''
+        backend = self.get_backend('ssh')
 
         # Update SSH config file to use self.remote_ssh_login
         # by default when connecting to self.remote_ssh_url
         msg = 'Update SSH config with special remote entry'
-        print('> {msg}')
-        cmd = update_ssh_config(
+        print(f'> {msg}')
+        cmd = backend.update_ssh_config(
             sshurl=self.remote_ssh_url,
             user=self.remote_ssh_login,
             dryrun=self.generate_script
         )
         cmd_fun_log += f'# {msg}\n{cmd}\n\n'
+        self.script_plan.add_step('update_ssh_config', msg, cmd)
         # Configuration of git-annex special remote sibling to host annexed files
         git_annex_special_sibling_config_dict = dict(
             {
                 "remote_ssh_login": self.remote_ssh_login,
                 "remote_ssh_url": self.remote_ssh_url,
-                "remote_sibling_dir": self.remote_sibling_dir
+                "remote_sibling_dir": self.remote_sibling_dir,
+                "remote_shared_store_dir": self.remote_shared_store_dir,
+                "throttle": self.throttle
             }
         )
+        if self.throttle and backend.name == 'remote':
+            print('\t* WARNING: The throttling of the transfers only applies to the local backend')
         msg = f'Create the ssh remote sibling to {self.remote_ssh_url}'
         print(f'> {msg}')
-        proc, cmd = create_ssh_sibling(
+        proc, cmd = backend.create_ssh_sibling(
             datalad_dataset_dir=self.output_datalad_dataset_dir,
             ssh_special_sibling_args=git_annex_special_sibling_config_dict,
             dryrun=self.generate_script
         )
         cmd_fun_log += f'# {msg}\n{cmd}\n\n'
+        self.script_plan.add_step(
+            'create_ssh_sibling', msg, cmd,
+            depends_on=['save_dataset', 'update_ssh_config']
+        )
         if proc:
             print(proc)
         msg = 'Make the ssh remote sibling "special git-annex remote"'
         print(f'> {msg}')
-        proc, cmd = init_ssh_special_sibling(
+        proc, cmd = backend.init_ssh_special_sibling(
             datalad_dataset_dir=self.output_datalad_dataset_dir,
             ssh_special_sibling_args=git_annex_special_sibling_config_dict,
             ssh_special_sibling_name='ssh_remote',
             dryrun=self.generate_script
         )
         cmd_fun_log += f'# {msg}\n{cmd}\n\n'
+        self.script_plan.add_step(
+            'init_special_remote', msg, f'cd "{self.output_datalad_dataset_dir}"\n{cmd}',
+            depends_on=['create_ssh_sibling'],
+            check=(f'git -C "{self.output_datalad_dataset_dir}" '
+                   'config --get remote.ssh_remote.annex-uuid > /dev/null')
+        )
         if proc is not None:
             print(proc.stdout)
         msg = 'Enable the ssh remote sibling "special git-annex remote"'
         print(f'> {msg}')
-        proc, cmd = enable_ssh_special_sibling(
+        proc, cmd = backend.enable_ssh_special_sibling(
             datalad_dataset_dir=self.output_datalad_dataset_dir,
             ssh_special_sibling_name='ssh_remote',
             dryrun=self.generate_script
         )
         cmd_fun_log += f'# {msg}\n{cmd}\n'
+        self.script_plan.add_step(
+            'enable_special_remote', msg, f'cd "{self.output_datalad_dataset_dir}"\n{cmd}',
+            depends_on=['init_special_remote']
+        )
         if proc is not None:
             print(proc.stdout)
 
+        if self.transfer_compression and backend.name == 'remote':
+            # Already compressed files (e.g. `.nii.gz`) are transferred as is
+            # (the local remotes are not reached through `rsync`)
+            msg = 'Compress the transfers to the ssh remote sibling "special git-annex remote"'
+            print(f'> {msg}')
+            proc, cmd = configure_rsync_options(
+                datalad_dataset_dir=self.output_datalad_dataset_dir,
+                rsync_options=get_rsync_compression_options(self.transfer_compression),
+                ssh_special_sibling_name='ssh_remote',
+                dryrun=self.generate_script
+            )
+            cmd_fun_log += f'# {msg}\n{cmd}\n'
+            self.script_plan.add_step(
+                'configure_compression', msg, f'cd "{self.output_datalad_dataset_dir}"\n{cmd}',
+                depends_on=['init_special_remote']
+            )
+
         return cmd_fun_log
 
+    @_stage('configure_osf')
     def configure_osf_sibling(self):
         """Configure the osf sibling of the Datalad dataset for publication of annexed files."""
         # Initialize the command log of the method
         cmd_fun_log = ''
+        backend = self.get_backend('osf')
 
         # Authentication to OSF
         msg = 'Authentication to OSF...'
         print(f'> {msg}')
-        proc, cmd = authenticate_osf(
+        proc, cmd = backend.authenticate_osf(
             osf_token=self.osf_token,
             dryrun=self.generate_script
         )
         cmd_fun_log += f'# {msg}\n{cmd}\n\n'
+        self.script_plan.add_step('authenticate_osf', msg, cmd)
         if proc:
             print(proc)
         # Creation of OSF dataset sibling
         msg = f'Create the {self.osf_dataset_title} OSF sibling'
         print(f'> {msg}')
-        proc, cmd = create_osf_sibling(
+        proc, cmd = backend.create_osf_sibling(
             dataset_dir=self.input_dataset_dir,
             datalad_dataset_dir=self.output_datalad_dataset_dir,
             osf_dataset_title=self.osf_dataset_title,
+            osf_token=self.osf_token,
             dryrun=self.generate_script
         )
         cmd_fun_log += f'# {msg}\n{cmd}\n'
+        self.script_plan.add_step(
+            'create_osf_sibling', msg, cmd,
+            depends_on=['save_dataset', 'authenticate_osf']
+        )
         if proc:
             print(proc)
 
         return cmd_fun_log
 
+    @_stage('configure_github')
     def configure_github_sibling(self):
         """Configure Git and the github sibling of the Datalad dataset for publication of repository (no-annex)."""
         # Initialize the command log of the method
         cmd_fun_log = ''
+        backend = self.get_backend('github')
 
         # Authentication to GitHub
         msg = 'Set Git user.email associated with GitHub account'
         print(f'> {msg}')
-        proc, cmd = authenticate_github_email(
+        proc, cmd = backend.authenticate_github_email(
             datalad_dataset_dir=self.output_datalad_dataset_dir,
             github_email=self.github_email,
             dryrun=self.generate_script
         )
         cmd_fun_log += f'# {msg}\n{cmd}\n\n'
+        # Git does not wait for the lock of the repository config file:
+        # the steps writing it cannot run concurrently
+        self.script_plan.add_step(
+            'github_email', msg, cmd,
+            depends_on=['create_dataset', 'enable_special_remote', 'create_osf_sibling']
+        )
         if proc is not None:
             print(proc.stdout)
         msg = 'Set Git hub.oauthtoken with the associated GitHub token'
         print(f'> {msg}')
-        proc, cmd = authenticate_github_token(
+        proc, cmd = backend.authenticate_github_token(
             datalad_dataset_dir=self.output_datalad_dataset_dir,
             github_token=self.github_token,
             dryrun=self.generate_script
         )
         cmd_fun_log += f'# {msg}\n{cmd}\n\n'
+        self.script_plan.add_step(
+            'github_token', msg, cmd,
+            depends_on=['github_email']
+        )
         if proc is not None:
             print(proc.stdout)
 
@@ -473,18 +1330,27 @@ NeuroDataPubProject object attribute summary:
             gitannex_remote_name = DEFAULT_SSH_REMOTE_NAME
         else:
             gitannex_remote_name = DEFAULT_OSF_REMOTE_NAME
-        proc, cmd = create_github_sibling(
+        proc, cmd = backend.create_github_sibling(
             datalad_dataset_dir=self.output_datalad_dataset_dir,
             github_sibling_args=github_sibling_config_dict,
             gitannex_remote_name=gitannex_remote_name,
+            github_token=self.github_token,
             dryrun=self.generate_script
         )
         cmd_fun_log += f'# {msg}\n{cmd}\n'
+        self.script_plan.add_step(
+            'create_github_sibling', msg, cmd,
+            depends_on=[
+                'save_dataset', 'github_email', 'github_token',
+                'enable_special_remote', 'create_osf_sibling'
+            ]
+        )
         if proc:
             print(proc)
 
         return cmd_fun_log
 
+    @_stage('configure')
     def configure_siblings(self):
         """Configure the siblings of the Datalad dataset for publication."""
         # Initialize the command log of the method
@@ -499,33 +1365,422 @@ NeuroDataPubProject object attribute summary:
         cmd_fun_log += f'{cmd_fun_log1}\n{cmd_fun_log2}'
         return True, cmd_fun_log
 
+    def _push_progress_handler(self):
+        """Return a function that reports the progress of the push from the results of `datalad push`."""
+        if self.sibling_type == "osf":
+            gitannex_remote_name = DEFAULT_OSF_REMOTE_NAME
+        else:
+            gitannex_remote_name = DEFAULT_SSH_REMOTE_NAME
+        total, total_bytes = get_annexed_content_not_in_remote(
+            datalad_dataset_dir=self.output_datalad_dataset_dir,
+            remote_name=gitannex_remote_name
+        )
+        counts = {'files': 0, 'bytes': 0}
+        set_span_attributes({'neurodatapub.remote': gitannex_remote_name})
+        self._report_progress('push', 0, total, 0, total_bytes)
+
+        def handler(result):
+            # Transfers of annexed files are reported with the "copy" action
+            if result.get('action') == 'copy' and result.get('status') in ['ok', 'notneeded']:
+                nbytes = os.path.getsize(result['path']) if os.path.exists(result['path']) else 0
+                counts['files'] += 1
+                counts['bytes'] += nbytes
+                if result.get('status') == 'ok':
+                    self.events.emit(KeyTransferred(
+                        path=result['path'],
+                        remote=result.get('target', gitannex_remote_name),
+                        nbytes=nbytes
+                    ))
+                self._report_progress('push', counts['files'], total, counts['bytes'], total_bytes)
+            else:
+                self._report_result_error('push', result)
+                self.check_cancelled()
+        return handler
+
+    @contextlib.contextmanager
+    def _shared_store(self):
+        """Context manager around a push to the shared store of the ssh special remote.
+
+        The keys already in the shared store, uploaded by other datasets,
+        are marked as present in the special remote such that they are
+        not uploaded again, and the keys uploaded by the push are
+        added to the index of the store.
+        """
+        if (self.sibling_type != 'ssh' or not self.remote_shared_store_dir
+                or self.generate_script):
+            yield
+            return
+        store_host = self.get_backend('ssh').shared_store_host(self.remote_ssh_url)
+        with self.stage('deduplicate'):
+            store_keys = get_shared_store_keys(store_host, self.remote_shared_store_dir)
+            nb_keys = mark_keys_present_in_remote(
+                self.output_datalad_dataset_dir, store_keys, DEFAULT_SSH_REMOTE_NAME
+            )
+        print(f'\t* {nb_keys} annexed files already in the shared store will not be uploaded')
+        try:
+            yield
+        finally:
+            # Keys uploaded before a failure are recorded as well
+            try:
+                uploaded = get_keys_in_remote(self.output_datalad_dataset_dir, DEFAULT_SSH_REMOTE_NAME)
+            except Exception as e:
+                print(f'\t* WARNING: Could not list the keys uploaded to the shared store: {e}')
+            else:
+                record_shared_store_keys(
+                    store_host, self.remote_shared_store_dir, uploaded - store_keys
+                )
+
+    @_stage('publish')
     def publish_datalad_dataset(self):
         """Publish the Datalad dataset."""
         # Initialize the command log of the method
         cmd_fun_log = ''
+        if not self.generate_script and load_save_chunks_state(self.output_datalad_dataset_dir) is not None:
+            # The commits of an unfinished save in chunks would be published
+            print(f'\t* ERROR: The save in chunks of {self.output_datalad_dataset_dir} is unfinished: '
+                  'run the "create-only" or "all" mode to finish it before the publication')
+            return False, cmd_fun_log
         if self.mode == "publish-only":
             msg = 'Save dataset state ("publish-only" mode)...'
             print(f'> {msg}')
             save_msg = ('Save dataset state before publication '
                         f'with neurodatapub {__version__} ("publish-only" mode)')
+            jobs = self._get_jobs()
             if not self.generate_script:
-                datalad.api.save(
-                        dataset=self.output_datalad_dataset_dir,
-                        message=save_msg,
-                        jobs='auto'
-                )
+                # Only the files reported by `git status` are saved
+                changes = get_worktree_changes(self.output_datalad_dataset_dir)
+                if changes:
+                    with self.stage('save'):
+                        self._save(
+                            message=save_msg, jobs=jobs, total=len(changes),
+                            paths=[os.path.join(self.output_datalad_dataset_dir, path) for path in changes]
+                        )
+                else:
+                    print('\t* No change to save')
             cmd = f'datalad save -d "{self.output_datalad_dataset_dir}" '
-            cmd += f'-m "{save_msg}" -J "auto"'
+            cmd += f'-m "{save_msg}" -J "{jobs}"'
             cmd_fun_log += f'# {msg}\n{cmd}\n\n'
+            self.script_plan.add_step('save_before_publish', msg, cmd)
+
+        if self.git_performance_profile:
+            msg = 'Maintain the git repository before the push'
+            print(f'> {msg}')
+            cmd = ''
+            if not self._validate_git_profile():
+                # Dataset created without the profile
+                _, cmd = apply_git_performance_profile(self.output_datalad_dataset_dir)
+                cmd += '\n'
+                print('\t* Git performance profile applied')
+            with self.stage('maintenance'):
+                _, maintenance_cmd = run_git_maintenance(
+                    self.output_datalad_dataset_dir, dryrun=self.generate_script
+                )
+            cmd += maintenance_cmd
+            cmd_fun_log += f'# {msg}\n{cmd}\n\n'
+            self.script_plan.add_step(
+                'git_maintenance', msg, cmd,
+                depends_on=['save_dataset', 'save_before_publish']
+            )
 
         msg = (f'Publish the dataset repo to {self.github_repo_name} and '
                f'the annexed files to {self.remote_ssh_url}:{self.remote_sibling_dir}')
         print(f'> {msg}')
-        proc, cmd = publish_dataset(
-            datalad_dataset_dir=self.output_datalad_dataset_dir,
-            dryrun=self.generate_script
-        )
+        since = None
+        if not self.generate_script:
+            published = load_publication_states(self.output_datalad_dataset_dir).get('github')
+            current = self._get_publication_state()
+            if published is not None and current is not None:
+                if all(published.get(key) == value for key, value in current.items()):
+                    print(f'\t* Nothing changed since the last publication ({published["time"]})')
+                    return True, cmd_fun_log
+                # Content selected or sent to another special remote than at the last
+                # publication may be unchanged since its commit: it needs a full push
+                same_target = all(
+                    published.get(key) == current[key] for key in ['selection', 'special_remote']
+                )
+                if same_target and is_ancestor(self.output_datalad_dataset_dir, published['commit']):
+                    # Only the changes since the last publication are pushed
+                    since = published['commit']
+                    print(f'\t* Push the changes since the last published commit {since[:8]}')
+        push_progress = None
+        paths = None
+        if self.bids_filter is not None and not self.generate_script:
+            # Only the content of the selected files is pushed
+            paths = self._selected_dataset_paths(self.get_selected_table().paths)
+            if not paths:
+                print('\t* WARNING: No selected file in the Datalad dataset: nothing to push')
+        with self.stage('push'), self._shared_store():
+            if self.events.listening and not self.generate_script:
+                push_progress = self._push_progress_handler()
+            proc, cmd = publish_dataset(
+                datalad_dataset_dir=self.output_datalad_dataset_dir,
+                jobs=self._get_jobs(),
+                result_callback=push_progress,
+                paths=paths,
+                since=since,
+                env=self._special_remote_env(),
+                dryrun=self.generate_script
+            )
         cmd_fun_log += f'# {msg}\n{cmd}\n'
+        self.script_plan.add_step(
+            'publish', msg, cmd,
+            depends_on=['create_github_sibling', 'save_before_publish', 'git_maintenance']
+        )
         if proc:
             print(str(proc))
+            if not self._record_publication(proc):
+                return False, cmd_fun_log
         return True, cmd_fun_log
+
+    @_stage('verify')
+    def verify_publication(self, checksum=False, sample=None, jobs=None):
+        """
+        Verify that the annexed content of the Datalad dataset is intact in the special remote.
+
+        Parameters
+        ----------
+        checksum : bool
+            If `True`, the content is downloaded and its checksum verified,
+            otherwise only its presence is checked (Default: `False`)
+
+        sample : float or int
+            If given, only a random sample of the annexed files is checked:
+            a fraction of the files if lower than 1, a number of files otherwise
+            (Default: `None`, all files)
+
+        jobs : int
+            Number of parallel checks (Default: `jobs` of the project, or `4` if `"auto"`)
+
+        Returns
+        -------
+        res : bool
+            `True` if all the selected files were checked and are intact in the remote
+
+        cmd_fun_log : string
+            Log of the equivalent commands
+        """
+        remote_name = DEFAULT_OSF_REMOTE_NAME if self.sibling_type == 'osf' else DEFAULT_SSH_REMOTE_NAME
+        if jobs is None:
+            jobs = int(self.jobs) if self.jobs.isdigit() else 4
+        mode = 'checksum' if checksum else 'presence'
+        msg = f'Verify the {mode} of the annexed content in {remote_name}'
+        print(f'> {msg}')
+        cmd = f'git -C "{self.output_datalad_dataset_dir}" annex fsck --from={remote_name} -J {jobs}'
+        if not checksum:
+            cmd += ' --fast'
+        self.script_plan.add_step('verify', msg, cmd, depends_on=['publish'])
+        cmd_fun_log = f'# {msg}\n{cmd}\n'
+        if self.generate_script:
+            return True, cmd_fun_log
+        summary = verify_remote_content(
+            datalad_dataset_dir=self.output_datalad_dataset_dir,
+            remote_name=remote_name,
+            checksum=checksum,
+            sample=sample,
+            jobs=jobs,
+            cancel_event=self._cancel_event,
+            env=self._special_remote_env()
+        )
+        print(f'> Summary of the verification:{format_verification_summary(summary)}')
+        self.check_cancelled()
+        # Files without a result of `git annex fsck` are not considered intact
+        success = (summary['complete'] and summary['checked'] == summary['selected']
+                   and not summary['failed'])
+        return success, cmd_fun_log
+
+    def _get_publication_state(self):
+        """Return the state of the Datalad dataset and of the publication settings compared between runs."""
+        state = get_repository_state(self.output_datalad_dataset_dir)
+        if state is not None:
+            state.update(
+                special_remote=(DEFAULT_OSF_REMOTE_NAME if self.sibling_type == 'osf'
+                                else DEFAULT_SSH_REMOTE_NAME),
+                selection=repr(self.bids_filter) if self.bids_filter is not None else None
+            )
+        return state
+
+    def _record_publication(self, results):
+        """Record the published state of the Datalad dataset and return `True` if the push reported no error.
+
+        The push does not raise on failed transfers (See
+        :func:`neurodatapub.utils.datalad.publish_dataset`): its results
+        are the only report of the failures.
+        """
+        failed = [result for result in results if result.get('status') in ['error', 'impossible']]
+        if failed:
+            print(f'\t* ERROR: The push reported {len(failed)} errors: the published state is not recorded')
+            return False
+        state = self._get_publication_state()
+        if state is not None:
+            # All siblings are pushed through the GitHub sibling, which depends on the special remote
+            record_publication_state(self.output_datalad_dataset_dir, 'github', state)
+        return True
+
+    def _selected_dataset_paths(self, paths):
+        """Return the paths in the Datalad dataset of the relative `paths` that exist in it."""
+        paths = [os.path.join(self.output_datalad_dataset_dir, path) for path in paths]
+        return [path for path in paths if os.path.lexists(path)]
+
+    def get_watch_state_file(self):
+        """Return the file where the table of the last published state of the input dataset is saved."""
+        return os.path.join(self.output_datalad_dataset_dir, '.git', 'neurodatapub', 'watch.ndpscan')
+
+    @_stage('sync')
+    def publish_changes(self, paths=None):
+        """
+        Copy, save and push the changes of the input dataset since the last publication.
+
+        The changes are found by comparing the table of the input dataset with
+        `file_table`, the table of the last published state, which is
+        updated and saved in `get_watch_state_file()` on success.
+
+        Parameters
+        ----------
+        paths : iterable of string
+            Relative paths of the files and directories of the input dataset
+            that changed. If `None`, the whole input dataset is scanned again
+            (Default: `None`)
+
+        Returns
+        -------
+        nb_changes : int
+            Number of files added, modified or removed
+        """
+        previous = self.file_table
+        if previous is None or paths is None:
+            current = scan_directory(self.input_dataset_dir)
+            if previous is None:
+                previous = FileTable(self.input_dataset_dir)
+        else:
+            current = previous.updated(paths)
+        if self.bids_filter is None:
+            selected = current
+            added, removed, modified = current.diff(previous)
+        else:
+            is_selected = self.bids_filter.predicate(self.input_dataset_dir)
+            selected = current.filtered(is_selected)
+            added, removed, modified = selected.diff(previous.filtered(is_selected))
+        nb_changes = len(added) + len(removed) + len(modified)
+        if nb_changes:
+            print(f'> Publish {len(added)} added, {len(modified)} modified '
+                  f'and {len(removed)} removed files')
+            links, duplicates = {}, {}
+            if not self.in_place:
+                links, duplicates = plan_symlinks(selected, self.symlink_policy, paths=added + modified)
+            with self.stage('copy'):
+                # Files added since the last state may already be present in the
+                # Datalad dataset (first run), while modified files must be overwritten.
+                # A dataset converted in place has nothing to copy
+                for changed, ignore_existing in [(added, True), (modified, False)]:
+                    changed = [path for path in changed if path not in links and path not in duplicates]
+                    if not changed or self.in_place:
+                        continue
+                    with tempfile.NamedTemporaryFile(prefix='neurodatapub_', suffix='.files') as file_list:
+                        current.write_file_list(file_list, paths=changed)
+                        file_list.flush()
+                        proc, _ = copy_content_to_datalad_dataset(
+                            bids_dir=self.input_dataset_dir,
+                            datalad_dataset_dir=self.output_datalad_dataset_dir,
+                            files_from=file_list.name,
+                            ignore_existing=ignore_existing
+                        )
+                    if proc is None:
+                        raise RuntimeError('Copy of the changes of the input dataset failed')
+                for path in ([] if self.in_place else removed):
+                    target = os.path.join(self.output_datalad_dataset_dir, path)
+                    if os.path.lexists(target):
+                        os.remove(target)
+                create_symlinks(self.output_datalad_dataset_dir, links)
+            with self.stage('save'):
+                self._save(
+                    message=(f'Save {nb_changes} changes of the input dataset '
+                             f'with neurodatapub {__version__}'),
+                    jobs=self._get_jobs(),
+                    paths=[
+                        os.path.join(self.output_datalad_dataset_dir, path)
+                        for path in added + modified + removed
+                        if path not in duplicates
+                    ]
+                )
+                if duplicates:
+                    self._add_duplicates(duplicates, self._get_jobs())
+            with self.stage('push'), self._shared_store():
+                push_progress = None
+                if self.events.listening:
+                    push_progress = self._push_progress_handler()
+                results, _ = publish_dataset(
+                    datalad_dataset_dir=self.output_datalad_dataset_dir,
+                    jobs=self._get_jobs(),
+                    result_callback=push_progress,
+                    env=self._special_remote_env(),
+                    paths=(self._selected_dataset_paths(added + modified)
+                           if self.bids_filter is not None else None)
+                )
+                if not self._record_publication(results):
+                    raise RuntimeError('The push of the changes reported errors')
+        self.file_table = current
+        current.save(self.get_watch_state_file())
+        return nb_changes
+
+    def watch_input_dataset(self, debounce=60, max_delay=600, poll_interval=None):
+        """
+        Publish continuously the changes of the input dataset.
+
+        The Datalad dataset is created and its siblings configured if needed.
+        The changes made since the last run (or all files at the first run)
+        are then published, and the input dataset is watched: bursts of changes
+        are batched and published with `publish_changes()`.
+        It returns when `cancel()` is called.
+
+        Parameters
+        ----------
+        debounce : float
+            Quiet period in seconds after which a batch of changes
+            is published (Default: `60`)
+
+        max_delay : float
+            Maximal delay in seconds between a change and its publication
+            during a continuous flow of changes (Default: `600`)
+
+        poll_interval : float
+            If given, the input dataset is scanned every `poll_interval` seconds
+            instead of being watched with `inotify` (Default: `None`)
+        """
+        self.reset_cancel()
+        if not os.path.exists(os.path.join(self.output_datalad_dataset_dir, '.datalad')):
+            self.create_datalad_dataset()
+        self.configure_siblings()
+
+        state_file = self.get_watch_state_file()
+        self.file_table = None
+        if os.path.exists(state_file):
+            try:
+                self.file_table = FileTable.load(state_file)
+            except (OSError, ValueError, EOFError) as e:
+                print(f'\t* WARNING: Could not load watch state {state_file}: {e}')
+        # The watcher is started before the initial publication to not miss changes
+        watcher = make_watcher(self.input_dataset_dir, poll_interval=poll_interval)
+        try:
+            print('> Publish the changes made since the last run')
+            rescan = not self._publish_batch(None)
+            print(f'> Watch the changes of {self.input_dataset_dir}')
+            pending_callback = self.metrics.set_pending if self.metrics is not None else None
+            for paths in watch_batches(watcher, debounce, max_delay, self._cancel_event, pending_callback):
+                # After a failure, the whole dataset is scanned again to retry the lost changes
+                rescan = not self._publish_batch(None if rescan else paths, retry=rescan)
+        finally:
+            watcher.close()
+
+    def _publish_batch(self, paths, retry=False):
+        """Publish a batch of changes and return `False` if it failed (the watch goes on)."""
+        try:
+            self.publish_changes(paths)
+            success = True
+        except PublicationCancelled:
+            return True
+        except Exception as e:
+            print(f'\t* WARNING: Publication of the changes failed: {e}')
+            success = False
+        if self.metrics is not None:
+            self.metrics.record_batch(None if paths is None else len(paths), success, retry=retry)
+        return success
@@ -0,0 +1,794 @@
+# Copyright © 2021-2022 Connectomics Lab
+# University Hospital Center and University of Lausanne (UNIL-CHUV), Switzerland,
+# and contributors
+#
+#  This software is distributed under the open-source license Apache 2.0.
+
+"""Local publication service that runs the publication jobs of several users from a persistent queue."""
+
+import os
+import grp
+import pwd
+import hmac
+import json
+import time
+import socket
+import struct
+import sqlite3
+import secrets
+import threading
+import socketserver
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from neurodatapub.executor import PublicationExecutor
+from neurodatapub.project import NeuroDataPubProject
+from neurodatapub.utils.bidsfilter import FILTER_PARAMS, create_bids_filter
+from neurodatapub.utils.jsonconfig import validate_sibling_config
+from neurodatapub.utils.metrics import (
+    PublicationMetrics, render_metrics, accepts_openmetrics,
+    PROMETHEUS_CONTENT_TYPE, OPENMETRICS_CONTENT_TYPE
+)
+from neurodatapub.utils.redact import redact_secrets
+from neurodatapub.utils.symlinks import SYMLINK_POLICIES
+
+# Modes in which a job can be run
+JOB_MODES = ['create-only', 'publish-only', 'all']
+
+# Statuses of a job
+JOB_STATUSES = ['queued', 'running', 'succeeded', 'failed', 'cancelled']
+
+# Parameters of a job that are sibling configurations,
+# given as the path of a JSON file or as a JSON object
+CONFIG_PARAMS = {
+    'github_sibling_config': 'github-sibling',
+    'git_annex_ssh_special_sibling_config': 'git-annex-special-sibling',
+    'osf_sibling_config': 'osf-sibling'
+}
+
+DEFAULT_PORT = 8765
+
+
+def get_service_dir():
+    """Return the default directory of the service (`$XDG_DATA_HOME/neurodatapub/service`)."""
+    data_home = os.environ.get(
+        'XDG_DATA_HOME',
+        os.path.join(os.path.expanduser('~'), '.local', 'share')
+    )
+    return os.path.join(data_home, 'neurodatapub', 'service')
+
+
+def get_service_token(service_dir):
+    """
+    Return the shared secret of the HTTP API of a service, created if needed.
+
+    The secret is stored in the file `token` of the service directory,
+    readable only by the user running the service. Clients send it in the
+    `Authorization: Bearer <token>` header of their requests on `localhost`.
+
+    Parameters
+    ----------
+    service_dir : string
+        Directory of the service
+
+    Returns
+    -------
+    token : string
+        Shared secret
+    """
+    token_file = os.path.join(service_dir, 'token')
+    try:
+        with open(token_file, 'r') as f:
+            token = f.read().strip()
+        if token:
+            return token
+    except OSError:
+        pass
+    token = secrets.token_urlsafe(32)
+    fd = os.open(token_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, 'w') as f:
+        f.write(token + '\n')
+    return token
+
+
+def _redact_result(result):
+    """Hide the secrets in the commands and messages of the result of a job."""
+    if not result:
+        return result
+    result = dict(result)
+    result['error'] = redact_secrets(result.get('error'))
+    result['commands'] = [
+        [name, redact_secrets(cmd)] for name, cmd in result.get('commands') or []
+    ]
+    result['failures'] = [
+        dict(failure, message=redact_secrets(failure.get('message')))
+        for failure in result.get('failures') or []
+    ]
+    return result
+
+
+class JobQueue(object):
+
+    """Persistent queue of publication jobs stored in a SQLite database.
+
+    A job goes through the statuses `"queued"`, `"running"` and then
+    `"succeeded"`, `"failed"` or `"cancelled"`.
+
+    Parameters
+    ----------
+    db_file : string
+        Path of the SQLite database
+    """
+
+    _SCHEMA = """
+        CREATE TABLE IF NOT EXISTS jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            status TEXT NOT NULL,
+            remote TEXT,
+            params TEXT NOT NULL,
+            submitted REAL NOT NULL,
+            started REAL,
+            finished REAL,
+            result TEXT,
+            error TEXT,
+            submitter TEXT
+        )
+    """
+
+    def __init__(self, db_file):
+        """Constructor of :class:`JobQueue` object."""
+        self._db = sqlite3.connect(db_file, check_same_thread=False, isolation_level=None)
+        self._db.row_factory = sqlite3.Row
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute(self._SCHEMA)
+        # Databases created before the submitters were recorded
+        if 'submitter' not in [row[1] for row in self._db.execute('PRAGMA table_info(jobs)')]:
+            self._db.execute('ALTER TABLE jobs ADD COLUMN submitter TEXT')
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _to_dict(row):
+        job = dict(row)
+        job['params'] = json.loads(job['params'])
+        job['result'] = json.loads(job['result']) if job['result'] else None
+        return job
+
+    def _execute(self, sql, args=()):
+        with self._lock:
+            return self._db.execute(sql, args).fetchall()
+
+    def submit(self, params, remote=None, submitter=None):
+        """Add a job to the queue, with the name of the user who submitted it, and return its id."""
+        with self._lock:
+            cursor = self._db.execute(
+                'INSERT INTO jobs (status, remote, params, submitted, submitter) VALUES (?, ?, ?, ?, ?)',
+                ('queued', remote, json.dumps(params), time.time(), submitter)
+            )
+            return cursor.lastrowid
+
+    def get(self, job_id):
+        """Return the job `job_id` as a dictionary, or `None` if it does not exist."""
+        rows = self._execute('SELECT * FROM jobs WHERE id = ?', (job_id,))
+        return self._to_dict(rows[0]) if rows else None
+
+    def list(self, status=None, limit=100):
+        """Return the most recent jobs, optionally with a given `status`."""
+        if status is None:
+            rows = self._execute('SELECT * FROM jobs ORDER BY id DESC LIMIT ?', (limit,))
+        else:
+            rows = self._execute(
+                'SELECT * FROM jobs WHERE status = ? ORDER BY id DESC LIMIT ?', (status, limit)
+            )
+        return [self._to_dict(row) for row in rows]
+
+    def counts(self):
+        """Return the number of jobs per status."""
+        rows = self._execute('SELECT status, COUNT(*) FROM jobs GROUP BY status')
+        return {status: count for status, count in rows}
+
+    def start_next(self, is_runnable):
+        """
+        Mark as running the oldest queued job accepted by `is_runnable`.
+
+        Parameters
+        ----------
+        is_runnable : function
+            Function called with a queued job that returns `True`
+            if it can be started now
+
+        Returns
+        -------
+        job : dict
+            Started job or `None`
+        """
+        with self._lock:
+            rows = self._db.execute("SELECT * FROM jobs WHERE status = 'queued' ORDER BY id").fetchall()
+            for row in rows:
+                job = self._to_dict(row)
+                if is_runnable(job):
+                    job['status'], job['started'] = 'running', time.time()
+                    self._db.execute(
+                        "UPDATE jobs SET status = 'running', started = ? WHERE id = ?",
+                        (job['started'], job['id'])
+                    )
+                    return job
+        return None
+
+    def finish(self, job_id, status, result=None, error=None):
+        """Record the end of a job, without the secrets of its commands and messages."""
+        result = _redact_result(result)
+        self._execute(
+            'UPDATE jobs SET status = ?, finished = ?, result = ?, error = ? WHERE id = ?',
+            (status, time.time(), json.dumps(result) if result else None, redact_secrets(error), job_id)
+        )
+
+    def requeue(self, job_id=None):
+        """Put back in the queue the running job `job_id`, or all running jobs if `None`."""
+        if job_id is None:
+            self._execute("UPDATE jobs SET status = 'queued', started = NULL WHERE status = 'running'")
+        else:
+            self._execute("UPDATE jobs SET status = 'queued', started = NULL WHERE id = ?", (job_id,))
+
+    def cancel_queued(self, job_id):
+        """Cancel a job that is still queued and return `True` if it was."""
+        with self._lock:
+            cursor = self._db.execute(
+                "UPDATE jobs SET status = 'cancelled', finished = ? WHERE id = ? AND status = 'queued'",
+                (time.time(), job_id)
+            )
+            return cursor.rowcount > 0
+
+    def close(self):
+        """Close the database."""
+        with self._lock:
+            self._db.close()
+
+
+def get_job_remote(params):
+    """Return the key of the remote targeted by a job, used by the per-remote concurrency limit."""
+    if params['mode'] == 'create-only':
+        return None
+    if params.get('osf_sibling_config'):
+        return 'osf'
+    config = params.get('git_annex_ssh_special_sibling_config')
+    if isinstance(config, str):
+        with open(config, 'r') as f:
+            config = json.load(f)
+    return config.get('remote_ssh_url') if config else None
+
+
+def validate_job_params(params):
+    """
+    Check the parameters of a job.
+
+    The parameters are the ones of the command-line interface: `"mode"`,
+    `"dataset_dir"`, `"datalad_dir"`, `"is_not_bids"`, `"jobs"`, `"annex_cache_dir"`,
+    `"annex_cache_size"`, `"in_place"`, `"in_place_unlocked"`, `"symlink_policy"`, `"save_chunk_files"`,
+    `"save_chunk_size"` (in GB), `"git_performance_profile"`, the selection of the files (see
+    :data:`neurodatapub.utils.bidsfilter.FILTER_PARAMS`) and the sibling configurations, given as the path of a JSON file or as a JSON object.
+    The `"datalad_dir"` of an in-place conversion is set to the `"dataset_dir"` if missing.
+
+    Raises
+    ------
+    ValueError
+        If the parameters are invalid
+    """
+    if not isinstance(params, dict):
+        raise ValueError('The job should be a JSON object')
+    if params.get('mode') not in JOB_MODES:
+        raise ValueError(f'"mode" should be one of {JOB_MODES}')
+    if params.get('symlink_policy', 'dereference') not in SYMLINK_POLICIES:
+        raise ValueError(f'"symlink_policy" should be one of {SYMLINK_POLICIES}')
+    if params.get('in_place'):
+        if params.get('datalad_dir') and params['datalad_dir'] != params.get('dataset_dir'):
+            raise ValueError('"datalad_dir" should be "dataset_dir" for an in-place conversion')
+        if any(params.get(name) for name in FILTER_PARAMS):
+            raise ValueError('A selection of files is not supported for an in-place conversion')
+        params['datalad_dir'] = params.get('dataset_dir')
+    for name in ['dataset_dir', 'datalad_dir']:
+        if not params.get(name):
+            raise ValueError(f'"{name}" is missing')
+    if not os.path.isdir(params['dataset_dir']):
+        raise ValueError(f'The input dataset directory ({params["dataset_dir"]}) does not exist')
+    if params['mode'] != 'create-only':
+        if not params.get('github_sibling_config'):
+            raise ValueError('"github_sibling_config" is missing')
+        if bool(params.get('git_annex_ssh_special_sibling_config')) == bool(params.get('osf_sibling_config')):
+            raise ValueError('One of "git_annex_ssh_special_sibling_config" or '
+                             '"osf_sibling_config" should be given')
+    for name in FILTER_PARAMS:
+        value = params.get(name)
+        if value is not None and (not isinstance(value, list)
+                                  or not all(isinstance(item, str) for item in value)):
+            raise ValueError(f'"{name}" should be a list of strings')
+    for name, sibling_type in CONFIG_PARAMS.items():
+        config = params.get(name)
+        if not config:
+            continue
+        if isinstance(config, str):
+            try:
+                with open(config, 'r') as f:
+                    config = json.load(f)
+            except (OSError, ValueError) as e:
+                raise ValueError(f'Could not read "{name}": {e}')
+        if not validate_sibling_config(config, sibling_type=sibling_type):
+            raise ValueError(f'"{name}" is not a valid {sibling_type} configuration')
+
+
+def create_project(params, config_dir):
+    """
+    Create the :class:`~neurodatapub.project.NeuroDataPubProject` of a job.
+
+    Sibling configurations given as JSON objects are written in `config_dir`,
+    only readable by the user running the service.
+
+    Parameters
+    ----------
+    params : dict
+        Parameters of the job (see :func:`validate_job_params`)
+
+    config_dir : string
+        Directory where the sibling configurations of the job are written
+
+    Returns
+    -------
+    project : NeuroDataPubProject
+        Project of the job
+    """
+    configs = {}
+    for name in CONFIG_PARAMS:
+        config = params.get(name)
+        if isinstance(config, dict):
+            os.makedirs(config_dir, mode=0o700, exist_ok=True)
+            path = os.path.join(config_dir, f'{name}.json')
+            with open(os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w') as f:
+                json.dump(config, f)
+            config = path
+        configs[name] = config
+    if configs['osf_sibling_config']:
+        special_sibling_config, sibling_type = configs['osf_sibling_config'], 'osf'
+    else:
+        special_sibling_config, sibling_type = configs['git_annex_ssh_special_sibling_config'], 'ssh'
+    return NeuroDataPubProject(
+        dataset_dir=params['dataset_dir'],
+        dataset_is_bids=not params.get('is_not_bids', False),
+        datalad_dataset_dir=params['datalad_dir'],
+        git_annex_special_sibling_config=special_sibling_config,
+        sibling_type=sibling_type,
+        github_sibling_config=configs['github_sibling_config'],
+        mode=params['mode'],
+        jobs=params.get('jobs', 'auto'),
+        annex_cache_dir=params.get('annex_cache_dir'),
+        annex_cache_size=(int(float(params['annex_cache_size']) * 1000 ** 3)
+                          if params.get('annex_cache_size') else None),
+        bids_filter=create_bids_filter(params),
+        in_place=bool(params.get('in_place')),
+        in_place_unlocked=bool(params.get('in_place_unlocked')),
+        symlink_policy=params.get('symlink_policy', 'dereference'),
+        save_chunk_files=int(params.get('save_chunk_files') or 0),
+        save_chunk_size=int(float(params.get('save_chunk_size') or 0) * 1000 ** 3),
+        git_performance_profile=bool(params.get('git_performance_profile'))
+    )
+
+
+class PublicationService(object):
+
+    """Service that runs the publication jobs of a :class:`JobQueue`.
+
+    Jobs are run in the order of submission, with at most `max_jobs` jobs
+    running at the same time, at most `max_jobs_per_remote` of them publishing
+    to the same special remote, and never two jobs on the same Datalad dataset.
+    Jobs interrupted by a stop of the service are queued again at restart.
+
+    Parameters
+    ----------
+    service_dir : string
+        Directory of the queue database and of the job configurations
+        (Default: see :func:`get_service_dir`)
+
+    max_jobs : int
+        Maximal number of jobs running concurrently (Default: `2`)
+
+    max_jobs_per_remote : int
+        Maximal number of jobs publishing to the same remote concurrently (Default: `1`)
+
+    project_factory : function
+        Function called with the parameters of a job and its configuration
+        directory that returns the project to run. It allows a test to run
+        the jobs with local stand-in remotes (Default: :func:`create_project`)
+    """
+
+    def __init__(
+        self,
+        service_dir=None,
+        max_jobs=2,
+        max_jobs_per_remote=1,
+        project_factory=None
+    ):
+        """Constructor of :class:`PublicationService` object."""
+        self.service_dir = service_dir or get_service_dir()
+        os.makedirs(self.service_dir, mode=0o700, exist_ok=True)
+        self.max_jobs = max_jobs
+        self.max_jobs_per_remote = max_jobs_per_remote
+        self.project_factory = project_factory or create_project
+        self.queue = JobQueue(os.path.join(self.service_dir, 'jobs.sqlite'))
+        self.start_time = None
+        self._executor = PublicationExecutor(max_workers=max_jobs)
+        self._running = {}
+        self._totals = dict(
+            files_copied=0, bytes_copied=0,
+            keys_transferred=0, bytes_transferred=0,
+            failures=0, duration=0
+        )
+        # Reentrant as the callback of a job may be called by `_start_job()`
+        self._lock = threading.RLock()
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+        self._scheduler = None
+        # Metrics of the jobs exported in the Prometheus and OpenMetrics formats
+        self.publication_metrics = PublicationMetrics()
+        self._jobs_gauge = self.publication_metrics.registry.gauge(
+            'neurodatapub_service_jobs', 'Jobs of the service per status', ('status',))
+        self._running_gauge = self.publication_metrics.registry.gauge(
+            'neurodatapub_service_running_jobs', 'Running jobs of the service per remote', ('remote',))
+        self.publication_metrics.registry.add_collector(self._collect_metrics)
+
+    def _collect_metrics(self):
+        """Update the gauges of the queue before an export of the metrics."""
+        counts = self.queue.counts()
+        for status in JOB_STATUSES:
+            self._jobs_gauge.set(counts.get(status, 0), status=status)
+        with self._lock:
+            remotes = [r['job']['remote'] or 'none' for r in self._running.values()]
+        self._running_gauge.clear()
+        for remote in set(remotes):
+            self._running_gauge.set(remotes.count(remote), remote=remote)
+
+    def submit(self, params, submitter=None):
+        """Validate and queue a job submitted by the user `submitter`, and return its id."""
+        validate_job_params(params)
+        job_id = self.queue.submit(params, remote=get_job_remote(params), submitter=submitter)
+        self._wakeup.set()
+        return job_id
+
+    def cancel(self, job_id):
+        """Cancel a queued or running job and return `True` if it was found."""
+        if self.queue.cancel_queued(job_id):
+            return True
+        with self._lock:
+            running = self._running.get(job_id)
+        if running is None:
+            return False
+        threading.Thread(target=running['project'].cancel, daemon=True).start()
+        return True
+
+    def _is_runnable(self, job):
+        running = list(self._running.values())
+        if any(r['job']['params']['datalad_dir'] == job['params']['datalad_dir'] for r in running):
+            return False
+        if job['remote'] is not None:
+            same_remote = [r for r in running if r['job']['remote'] == job['remote']]
+            if len(same_remote) >= self.max_jobs_per_remote:
+                return False
+        return True
+
+    def _schedule(self):
+        while not self._stopping.is_set():
+            self._wakeup.wait(timeout=1)
+            self._wakeup.clear()
+            while not self._stopping.is_set():
+                with self._lock:
+                    if len(self._running) >= self.max_jobs:
+                        break
+                    job = self.queue.start_next(self._is_runnable)
+                    if job is None:
+                        break
+                    self._start_job(job)
+
+    def _start_job(self, job):
+        """Start a job (called with the lock held)."""
+        print(f'> Start job {job["id"]} ({job["params"]["mode"]} {job["params"]["dataset_dir"]})')
+        config_dir = os.path.join(self.service_dir, 'jobs', str(job['id']))
+        try:
+            project = self.project_factory(job['params'], config_dir)
+        except Exception as e:
+            self.queue.finish(job['id'], 'failed', error=f'{type(e).__name__}: {e}')
+            return
+        token = self.publication_metrics.attach(project.events)
+        self._running[job['id']] = dict(job=job, project=project, metrics_token=token)
+        future = self._executor.submit(project, mode=job['params']['mode'])
+        future.add_done_callback(lambda f, job_id=job['id']: self._on_job_done(job_id, f))
+
+    def _on_job_done(self, job_id, future):
+        try:
+            result = future.result()
+        except Exception as e:
+            self.queue.finish(job_id, 'failed', error=f'{type(e).__name__}: {e}')
+        else:
+            if result.cancelled and self._stopping.is_set():
+                # Interrupted by the stop of the service: run it again at restart
+                self.queue.requeue(job_id)
+            else:
+                if result.success:
+                    status = 'succeeded'
+                elif result.cancelled:
+                    status = 'cancelled'
+                else:
+                    status = 'failed'
+                self.queue.finish(job_id, status, result=result.to_dict(), error=result.error)
+                print(f'> Job {job_id} {status}')
+            with self._lock:
+                for name in ['files_copied', 'bytes_copied', 'keys_transferred', 'bytes_transferred']:
+                    self._totals[name] += getattr(result, name)
+                self._totals['failures'] += len(result.failures)
+                self._totals['duration'] += result.duration or 0
+        with self._lock:
+            running = self._running.pop(job_id, None)
+        if running is not None:
+            self.publication_metrics.detach(running['project'].events, running['metrics_token'])
+        self._wakeup.set()
+
+    def status(self):
+        """Return the status of the service as a dictionary."""
+        with self._lock:
+            running = [
+                dict(id=job_id, remote=r['job']['remote'], started=r['job']['started'],
+                     datalad_dir=r['job']['params']['datalad_dir'])
+                for job_id, r in self._running.items()
+            ]
+        return dict(
+            start_time=self.start_time,
+            max_jobs=self.max_jobs,
+            max_jobs_per_remote=self.max_jobs_per_remote,
+            jobs=self.queue.counts(),
+            running=running
+        )
+
+    def metrics(self):
+        """Return the metrics of the service as a dictionary (See also `publication_metrics`)."""
+        with self._lock:
+            totals = dict(self._totals)
+            running_per_remote = {}
+            for r in self._running.values():
+                remote = r['job']['remote'] or 'none'
+                running_per_remote[remote] = running_per_remote.get(remote, 0) + 1
+        return dict(
+            uptime=time.time() - self.start_time if self.start_time else 0,
+            jobs=self.queue.counts(),
+            running_per_remote=running_per_remote,
+            **totals
+        )
+
+    def start(self):
+        """Queue again the jobs interrupted by a previous stop and start the scheduler."""
+        self.queue.requeue()
+        self.start_time = time.time()
+        self._stopping.clear()
+        self._scheduler = threading.Thread(target=self._schedule, name='neurodatapub-scheduler', daemon=True)
+        self._scheduler.start()
+
+    def stop(self):
+        """Stop the scheduler, cancel the running jobs (queued again at restart) and wait for them."""
+        self._stopping.set()
+        self._wakeup.set()
+        if self._scheduler is not None:
+            self._scheduler.join()
+        with self._lock:
+            projects = [r['project'] for r in self._running.values()]
+        for project in projects:
+            project.cancel()
+        self._executor.shutdown(wait=True)
+        self.queue.close()
+
+
+def _user_name(uid):
+    """Return the name of the user `uid` (its number if it has no name)."""
+    try:
+        return pwd.getpwuid(uid).pw_name
+    except KeyError:
+        return str(uid)
+
+
+def _redact_job(job):
+    """Hide the tokens of the sibling configurations given as JSON objects and of the result."""
+    params = dict(job['params'])
+    for name in CONFIG_PARAMS:
+        if isinstance(params.get(name), dict):
+            params[name] = {
+                key: '***' if key.endswith('token') else value
+                for key, value in params[name].items()
+            }
+    # Results stored before the secrets were removed at the end of the jobs
+    return dict(job, params=params, result=_redact_result(job.get('result')),
+                error=redact_secrets(job.get('error')))
+
+
+class _ServiceRequestHandler(BaseHTTPRequestHandler):
+
+    """Handler of the requests of the HTTP API of a :class:`PublicationService`."""
+
+    def address_string(self):
+        # Clients of a Unix socket have no address
+        return self.client_address[0] if isinstance(self.client_address, tuple) else 'unix'
+
+    def _send_text(self, code, text, content_type):
+        body = text.encode()
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_json(self, code, obj):
+        body = json.dumps(obj).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _authorized(self):
+        """Check the shared secret of the request (not required on the Unix socket)."""
+        token = getattr(self.server, 'token', None)
+        if token is None:
+            return True
+        expected = f'Bearer {token}'.encode()
+        if hmac.compare_digest((self.headers.get('Authorization') or '').encode(), expected):
+            return True
+        self._send_json(401, dict(error='Unauthorized'))
+        return False
+
+    def _peer_user(self):
+        """Return the name of the user connected to the Unix socket (`None` on `localhost`)."""
+        if not isinstance(self.server, _UnixHTTPServer) or not hasattr(socket, 'SO_PEERCRED'):
+            return None
+        _, uid, _ = struct.unpack('3i', self.request.getsockopt(
+            socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize('3i')
+        ))
+        return _user_name(uid)
+
+    def _job_id(self, part):
+        try:
+            return int(part)
+        except ValueError:
+            return None
+
+    def do_GET(self):
+        if not self._authorized():
+            return
+        service = self.server.service
+        parts = self.path.strip('/').split('/')
+        if parts == ['status']:
+            self._send_json(200, service.status())
+        elif parts == ['metrics']:
+            # Prometheus scrapers ask for a text format, other clients get JSON
+            accept = self.headers.get('Accept') or ''
+            if accepts_openmetrics(accept):
+                self._send_text(200, render_metrics(service.publication_metrics.registry, openmetrics=True),
+                                OPENMETRICS_CONTENT_TYPE)
+            elif 'text/plain' in accept:
+                self._send_text(200, render_metrics(service.publication_metrics.registry),
+                                PROMETHEUS_CONTENT_TYPE)
+            else:
+                self._send_json(200, service.metrics())
+        elif parts == ['jobs']:
+            self._send_json(200, [_redact_job(job) for job in service.queue.list()])
+        elif len(parts) == 2 and parts[0] == 'jobs' and self._job_id(parts[1]) is not None:
+            job = service.queue.get(self._job_id(parts[1]))
+            if job is None:
+                self._send_json(404, dict(error='Job not found'))
+            else:
+                self._send_json(200, _redact_job(job))
+        else:
+            self._send_json(404, dict(error='Not found'))
+
+    def do_POST(self):
+        if not self._authorized():
+            return
+        service = self.server.service
+        parts = self.path.strip('/').split('/')
+        if parts == ['jobs']:
+            try:
+                length = int(self.headers.get('Content-Length', 0))
+                params = json.loads(self.rfile.read(length) or b'null')
+                job_id = service.submit(params, submitter=self._peer_user())
+            except ValueError as e:
+                self._send_json(400, dict(error=str(e)))
+                return
+            self._send_json(201, dict(id=job_id))
+        elif (len(parts) == 3 and parts[0] == 'jobs' and parts[2] == 'cancel'
+              and self._job_id(parts[1]) is not None):
+            job = service.queue.get(self._job_id(parts[1]))
+            user = self._peer_user()
+            if (job is not None and user is not None and user != job['submitter']
+                    and user != _user_name(os.getuid())):
+                # On the Unix socket, users only cancel their own jobs
+                self._send_json(403, dict(error='Job submitted by another user'))
+            elif service.cancel(self._job_id(parts[1])):
+                self._send_json(202, dict(id=self._job_id(parts[1])))
+            else:
+                self._send_json(404, dict(error='Job not found or already finished'))
+        else:
+            self._send_json(404, dict(error='Not found'))
+
+
+class _UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+
+    """HTTP server listening on a Unix socket."""
+
+    daemon_threads = True
+
+
+def serve(service, port=DEFAULT_PORT, socket_path=None, socket_group=None):
+    """
+    Run the HTTP API of a publication service until interrupted.
+
+    The API listens on `localhost` or on a Unix socket and provides:
+
+        * `POST /jobs`: submit a job (JSON object with the parameters of
+          the command-line interface, see :func:`validate_job_params`)
+
+        * `GET /jobs` and `GET /jobs/<id>`: list the jobs or get one
+
+        * `POST /jobs/<id>/cancel`: cancel a queued or running job
+
+        * `GET /status` and `GET /metrics`: status and metrics of the service.
+          The metrics are rendered in the Prometheus or OpenMetrics text
+          format when the `Accept` header of the request asks for it
+
+    On `localhost`, the requests must carry the shared secret of the service
+    in an `Authorization: Bearer <token>` header (See :func:`get_service_token`),
+    which is only readable by the user running the service. To share the
+    service with other users, use a Unix socket accessible to the members of
+    `socket_group`: the jobs are recorded with the name of the user who
+    submitted them (from the credentials of the connection, `SO_PEERCRED`),
+    and users can only cancel their own jobs. The jobs are run by the user
+    of the service, who must be able to read their datasets.
+
+    Parameters
+    ----------
+    service : PublicationService
+        Service to be run
+
+    port : int
+        Port on `localhost` (Default: `8765`)
+
+    socket_path : string
+        If given, path of the Unix socket to listen on instead
+        of `localhost` (Default: `None`)
+
+    socket_group : string
+        If given, group whose members can connect to the Unix socket,
+        otherwise only the user of the service can (Default: `None`)
+    """
+    if socket_path is not None:
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        # The socket is created accessible only to the user of the service,
+        # such that no other user can connect before its group is set
+        umask = os.umask(0o177)
+        try:
+            server = _UnixHTTPServer(socket_path, _ServiceRequestHandler)
+        finally:
+            os.umask(umask)
+        if socket_group is not None:
+            os.chown(socket_path, -1, grp.getgrnam(socket_group).gr_gid)
+            os.chmod(socket_path, 0o660)
+        server.token = None
+        print(f'> Service listening on {socket_path}'
+              + (f' (group {socket_group})' if socket_group is not None else ''))
+    else:
+        server = ThreadingHTTPServer(('127.0.0.1', port), _ServiceRequestHandler)
+        server.token = get_service_token(service.service_dir)
+        print(f'> Service listening on http://127.0.0.1:{port} '
+              f'(token in {os.path.join(service.service_dir, "token")})')
+    server.service = service
+    service.start()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.stop()
+        if socket_path is not None and os.path.exists(socket_path):
+            os.remove(socket_path)
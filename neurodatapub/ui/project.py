@@ -5,30 +5,84 @@
 #  This software is distributed under the open-source license Apache 2.0.
 
 # General imports
-import datetime
 import os
 import pkg_resources
 import json
 import re
-from bids import BIDSLayout
+import time
+import threading
 from traitsui.qt4.extra.qt_view import QtView
 from traitsui.api import (
     Item, Group, HGroup, VGroup, spring,
-    DirectoryEditor  # FileEditor
+    DirectoryEditor, ProgressEditor  # FileEditor
 )
-from traits.api import Button, Str, Bool
+from traits.api import Button, Str, Bool, Int, Any
 
-from pyface.api import FileDialog, OK
+from pyface.api import FileDialog, OK, GUI
 
 # Own imports
 from neurodatapub.info import __version__, __license__, __copyright__
-from neurodatapub.project import NeuroDataPubProject
+from neurodatapub.project import NeuroDataPubProject, PublicationCancelled
+from neurodatapub.utils.events import Progress
+from neurodatapub.utils.plan import format_size
+from neurodatapub.utils.script import ScriptPlan, write_script
+from neurodatapub.utils.validation import validate_bids_dataset, format_bids_summary
 from neurodatapub.utils.qt import (
     return_global_style_sheet,
     return_folder_button_style_sheet,
     return_save_json_button_style_sheet
 )
 
+# Minimal time in seconds between two updates of a progress bar
+PROGRESS_UPDATE_INTERVAL = 0.25
+
+
+def _format_progress(completed, total, completed_bytes, total_bytes, elapsed):
+    """Return the percentage and the status message of a stage in progress.
+
+    Parameters
+    ----------
+    completed : int
+        Number of files processed
+
+    total : int
+        Total number of files to process (`0` if unknown)
+
+    completed_bytes : int
+        Number of bytes processed
+
+    total_bytes : int
+        Total number of bytes to process (`0` if unknown)
+
+    elapsed : float
+        Time in seconds since the start of the stage
+
+    Returns
+    -------
+    percent : int
+        Progress in percent (`0` if the totals are unknown)
+
+    status : string
+        Status message with counts, throughput and ETA
+    """
+    if total_bytes:
+        fraction = completed_bytes / total_bytes
+    elif total:
+        fraction = completed / total
+    else:
+        fraction = 0
+    fraction = min(fraction, 1)
+    status = f'{completed}/{total} files' if total else f'{completed} files'
+    status += f', {format_size(completed_bytes)}'
+    if total_bytes:
+        status += f' / {format_size(total_bytes)}'
+    if elapsed > 0:
+        status += f', {format_size(completed_bytes / elapsed)}/s'
+    if 0 < fraction < 1:
+        eta = int(elapsed * (1 - fraction) / fraction)
+        status += f', ETA {eta // 3600:02d}:{eta % 3600 // 60:02d}:{eta % 60:02d}'
+    return int(100 * fraction), status
+
 
 class NeuroDataPubProjectUI(NeuroDataPubProject):
 
@@ -56,6 +110,20 @@ class NeuroDataPubProjectUI(NeuroDataPubProject):
         Button to save the GitHub sibling settings
         in a JSON configuration file
 
+    cancel_button : Button
+        Button to cancel the operation running in the background
+
+    is_running : Bool
+        Boolean that indicates if an operation is running in the background
+        (Default: False)
+
+    copy_progress, save_progress, push_progress : Int
+        Progress in percent of the copy, save and push stages
+
+    copy_status, save_status, push_status : Str
+        Status message (counts, throughput, ETA) of the copy,
+        save and push stages
+
     config_is_valid : Bool
         Boolean that is updated by the `Check Config` button
         (Default: False)
@@ -79,8 +147,19 @@ class NeuroDataPubProjectUI(NeuroDataPubProject):
 
     save_special_sibling_config_button = Button('')
     save_github_sibling_config_button = Button('')
+    cancel_button = Button('Cancel')
 
     config_is_valid = Bool(False)
+    is_running = Bool(False)
+
+    copy_progress = Int(0)
+    copy_status = Str('')
+    save_progress = Int(0)
+    save_status = Str('')
+    push_progress = Int(0)
+    push_status = Str('')
+
+    _worker = Any()
 
     version = Str(__version__)
     license = Str(__license__)
@@ -110,6 +189,7 @@ class NeuroDataPubProjectUI(NeuroDataPubProject):
                                      editor=DirectoryEditor(dialog_style='open'),
                                      style_sheet=return_folder_button_style_sheet(),
                                      visible_when='sibling_type == "ssh"'),
+                                Item('remote_shared_store_dir', visible_when='sibling_type == "ssh"'),
                                 Item('osf_dataset_title', visible_when='sibling_type == "osf"'),
                                 Item('osf_token', visible_when='sibling_type == "osf"'),
                             ),
@@ -158,13 +238,36 @@ class NeuroDataPubProjectUI(NeuroDataPubProject):
                 layout='tabbed'
             ),
             spring,
+            VGroup(
+                HGroup(
+                    Item('copy_progress', editor=ProgressEditor(min=0, max=100, show_percent=True),
+                         label='Copy'),
+                    Item('copy_status', style='readonly', show_label=False),
+                ),
+                HGroup(
+                    Item('save_progress', editor=ProgressEditor(min=0, max=100, show_percent=True),
+                         label='Save'),
+                    Item('save_status', style='readonly', show_label=False),
+                ),
+                HGroup(
+                    Item('push_progress', editor=ProgressEditor(min=0, max=100, show_percent=True),
+                         label='Push'),
+                    Item('push_status', style='readonly', show_label=False),
+                ),
+                visible_when='is_running'
+            ),
             HGroup(
                 spring,
-                Item('check_config', width=90, show_label=False), spring,
-                Item('create_and_publish_button', width=90, enabled_when='config_is_valid', show_label=False), spring,
-                Item('create_only_button', width=90, enabled_when='config_is_valid', show_label=False), spring,
-                Item('publish_only_button', width=90, enabled_when='config_is_valid', show_label=False),
-                Item('generate_script', enabled_when='config_is_valid', label='Generate script only'),
+                Item('check_config', width=90, enabled_when='not is_running', show_label=False), spring,
+                Item('create_and_publish_button', width=90,
+                     enabled_when='config_is_valid and not is_running', show_label=False), spring,
+                Item('create_only_button', width=90,
+                     enabled_when='config_is_valid and not is_running', show_label=False), spring,
+                Item('publish_only_button', width=90,
+                     enabled_when='config_is_valid and not is_running', show_label=False),
+                Item('generate_script', enabled_when='config_is_valid and not is_running',
+                     label='Generate script only'),
+                Item('cancel_button', width=90, enabled_when='is_running', show_label=False),
                 spring
             )
         ),
@@ -197,10 +300,11 @@ class NeuroDataPubProjectUI(NeuroDataPubProject):
             )
             self.config_is_valid = False
 
-        if self.dataset_is_bids:
+        elif self.dataset_is_bids:
             try:
-                layout = BIDSLayout(self.input_dataset_dir)
-                print(f'\t* PyBIDS summary:\n\t{layout}')
+                # Scan again the dataset as it may have been modified since the last check
+                summary = validate_bids_dataset(self.scan_input_dataset(refresh=True))
+                print(f'\t* BIDS summary:\n\t{format_bids_summary(summary)}')
             except Exception as e:
                 print(f'\t* BIDS ERROR: {e}')
                 self.config_is_valid = False
@@ -238,7 +342,7 @@ class NeuroDataPubProjectUI(NeuroDataPubProject):
             else:
                 masked_token = "*" * (len(self.osf_token) - 6)
                 masked_token += f'{self.osf_token[-6:]}'
-                print(f'\t* osf_token: {self.osf_token}')
+                print(f'\t* osf_token: {masked_token}')
     
             if not self.osf_dataset_title:
                 print('\t* osf_dataset_title: UNDEFINED')
@@ -288,107 +392,115 @@ class NeuroDataPubProjectUI(NeuroDataPubProject):
             "############################################\n"
         )
 
-    def _create_only_button_fired(self):
-        """Executed when `create_only_button` is clicked."""
+    def _write_script(self):
+        """Write the script of the commands recorded in `script_plan`."""
+        script_path = write_script(
+            script_plan=self.script_plan,
+            dataset_dir=self.input_dataset_dir,
+            jobs=self.jobs
+        )
         print(
             "\n############################################\n"
-            "# Creation of Datalad Dataset\n"
+            f"# Generation of script {script_path}\n"
             "############################################\n"
         )
-        # Initialize the script that will log all commands generated
-        cmd_log = '#!/bin/sh\n\n'
-        _, cmd_fun_log = self.create_datalad_dataset()
-        if self.generate_script:
-            # Create name of script with time stamp
-            now = datetime.datetime.now()
-            script_basename = f'neurodatapub_{now.strftime("%d-%m-%Y_%H-%M-%S")}.sh'
-            # Create the code folder if it does not exist
-            if not os.path.exists(os.path.join(self.input_dataset_dir, 'code')):
-                os.makedirs(os.path.join(self.input_dataset_dir, 'code'), exist_ok=True)
-            script_path = os.path.join(self.input_dataset_dir, 'code', script_basename)
-            print(
-                "\n############################################\n"
-                f"# Generation of script {script_path}\n"
-                "############################################\n"
-            )
-            cmd_log += f'{cmd_fun_log}\n'
-            with open(script_path, 'w') as f:
-                f.writelines(cmd_log)
 
-    def _publish_only_button_fired(self):
-        """Executed when `publish_only_button` is clicked."""
-        # Initialize the script that will log all commands generated
-        cmd_log = '#!/bin/sh\n\n'
-        print(
-            "\n############################################\n"
-            "# Configuration of the publication siblings\n"
-            "############################################\n"
+    def _on_progress(self, event):
+        """Executed in the background worker when the project emits a `Progress` event.
+
+        Updates of the progress bars are throttled and delegated to the GUI thread.
+        """
+        stage = event.stage
+        now = time.monotonic()
+        start = self._stage_start_times.setdefault(stage, now)
+        finished = event.total and event.completed >= event.total
+        if not finished and now - self._stage_last_updates.get(stage, 0) < PROGRESS_UPDATE_INTERVAL:
+            return
+        self._stage_last_updates[stage] = now
+        percent, status = _format_progress(
+            event.completed, event.total, event.completed_bytes, event.total_bytes, now - start
         )
-        _, cmd_fun_log = self.configure_siblings()
-        cmd_log += f'{cmd_fun_log}\n'
-        print(
-            "\n############################################\n"
-            "# Publication of Datalad Dataset\n"
-            "############################################\n"
+        GUI.invoke_later(setattr, self, f'{stage}_progress', percent)
+        GUI.invoke_later(setattr, self, f'{stage}_status', status)
+
+    def _start_worker(self, stages):
+        """Run the stages in a background worker to keep the GUI responsive.
+
+        Parameters
+        ----------
+        stages : list of {"create", "publish"}
+            Stages to be executed in order
+        """
+        if self._worker is not None and self._worker.is_alive():
+            print('> An operation is already running!')
+            return
+        # Initialize the plan that will record all commands generated
+        self.script_plan = ScriptPlan()
+        self.reset_cancel()
+        for stage in ['copy', 'save', 'push']:
+            setattr(self, f'{stage}_progress', 0)
+            setattr(self, f'{stage}_status', '')
+        self._stage_start_times = {}
+        self._stage_last_updates = {}
+        self._progress_token = self.events.subscribe(self._on_progress, kinds=(Progress,))
+        self.is_running = True
+        self._worker = threading.Thread(
+            target=self._run_stages,
+            args=(stages,),
+            daemon=True
         )
-        _, cmd_fun_log = self.publish_datalad_dataset()
-        cmd_log += f'{cmd_fun_log}'
-        if self.generate_script:
-            # Create name of script with time stamp
-            now = datetime.datetime.now()
-            script_basename = f'neurodatapub_{now.strftime("%d-%m-%Y_%H-%M-%S")}.sh'
-            # Create the code folder if it does not exist
-            if not os.path.exists(os.path.join(self.input_dataset_dir, 'code')):
-                os.makedirs(os.path.join(self.input_dataset_dir, 'code'), exist_ok=True)
-            script_path = os.path.join(self.input_dataset_dir, 'code', script_basename)
-            print(
-                "\n############################################\n"
-                f"# Generation of script {script_path}\n"
-                "############################################\n"
-            )
-            with open(script_path, 'w') as f:
-                f.writelines(cmd_log)
+        self._worker.start()
+
+    def _run_stages(self, stages):
+        """Executed in the background worker to run the stages."""
+        try:
+            if 'create' in stages:
+                print(
+                    "\n############################################\n"
+                    "# Creation of Datalad Dataset\n"
+                    "############################################\n"
+                )
+                self.create_datalad_dataset()
+            if 'publish' in stages:
+                print(
+                    "\n############################################\n"
+                    "# Configuration of the publication siblings\n"
+                    "############################################\n"
+                )
+                self.configure_siblings()
+                print(
+                    "\n############################################\n"
+                    "# Publication of Datalad Dataset\n"
+                    "############################################\n"
+                )
+                self.publish_datalad_dataset()
+            if self.generate_script:
+                self._write_script()
+        except PublicationCancelled:
+            print('> Operation was cancelled!')
+        except Exception as e:
+            print(f'> ERROR: {e}')
+        finally:
+            self.events.unsubscribe(self._progress_token)
+            GUI.invoke_later(setattr, self, 'is_running', False)
+
+    def _create_only_button_fired(self):
+        """Executed when `create_only_button` is clicked."""
+        self._start_worker(['create'])
+
+    def _publish_only_button_fired(self):
+        """Executed when `publish_only_button` is clicked."""
+        self._start_worker(['publish'])
 
     def _create_and_publish_button_fired(self):
         """Executed when `create_and_publish_button` is clicked."""
-        # Initialize the script that will log all commands generated
-        cmd_log = '#!/bin/sh\n\n'
-        print(
-            "\n############################################\n"
-            "# Creation of Datalad Dataset\n"
-            "############################################\n"
-        )
-        _, cmd_fun_log = self.create_datalad_dataset()
-        cmd_log += f'{cmd_fun_log}\n'
-        print(
-            "\n############################################\n"
-            "# Configuration of the publication siblings\n"
-            "############################################\n"
-        )
-        _, cmd_fun_log = self.configure_siblings()
-        cmd_log += f'{cmd_fun_log}\n'
-        print(
-            "\n############################################\n"
-            "# Publication of Datalad Dataset\n"
-            "############################################\n"
-        )
-        _, cmd_fun_log = self.publish_datalad_dataset()
-        cmd_log += f'{cmd_fun_log}'
-        if self.generate_script:
-            # Create name of script with time stamp
-            now = datetime.datetime.now()
-            script_basename = f'neurodatapub_{now.strftime("%d-%m-%Y_%H-%M-%S")}.sh'
-            # Create the code folder if it does not exist
-            if not os.path.exists(os.path.join(self.input_dataset_dir, 'code')):
-                os.makedirs(os.path.join(self.input_dataset_dir, 'code'), exist_ok=True)
-            script_path = os.path.join(self.input_dataset_dir, 'code', script_basename)
-            print(
-                "\n############################################\n"
-                f"# Generation of script {script_path}\n"
-                "############################################\n"
-            )
-            with open(script_path, 'w') as f:
-                f.writelines(cmd_log)
+        self._start_worker(['create', 'publish'])
+
+    def _cancel_button_fired(self):
+        """Executed when `cancel_button` is clicked to cancel the operation running in the background."""
+        print('> Cancel the operation in progress...')
+        # Terminating the subprocesses may take a few seconds
+        threading.Thread(target=self.cancel, daemon=True).start()
 
     def _save_special_sibling_config_button_fired(self):
         """Executed when `save_special_sibling_config_button` is clicked."""
@@ -424,6 +536,14 @@ class NeuroDataPubProjectUI(NeuroDataPubProject):
                         "remote_sibling_dir": self.remote_sibling_dir.strip()
                     }
                 )
+                if self.remote_shared_store_dir.strip():
+                    git_annex_special_sibling_config_dict["remote_shared_store_dir"] = \
+                        self.remote_shared_store_dir.strip()
+                if self.transfer_compression:
+                    git_annex_special_sibling_config_dict["transfer_compression"] = dict(
+                        level=self.transfer_compression['level'],
+                        skip_extensions=self.transfer_compression['skip']
+                    )
             else:
                 git_annex_special_sibling_config_dict = dict(
                     {
@@ -431,6 +551,13 @@ class NeuroDataPubProjectUI(NeuroDataPubProject):
                         "osf_dataset_title": self.osf_dataset_title.strip()
                     }
                 )
+            # Keep the local backend selected in the loaded configuration
+            if self.special_sibling_backend != 'remote':
+                git_annex_special_sibling_config_dict["backend"] = self.special_sibling_backend
+                if self.special_sibling_local_dir:
+                    git_annex_special_sibling_config_dict["local_dir"] = self.special_sibling_local_dir
+                if self.throttle and self.sibling_type == 'ssh':
+                    git_annex_special_sibling_config_dict["throttle"] = dict(self.throttle)
             with open(self.git_annex_special_sibling_config, 'w+') as outfile:
                 json.dump(git_annex_special_sibling_config_dict, outfile, indent=4)
             print(f'> Saved as {self.git_annex_special_sibling_config}')
@@ -474,6 +601,10 @@ class NeuroDataPubProjectUI(NeuroDataPubProject):
                     "github_repo_name": self.github_repo_name.strip()
                 }
             )
+            if self.github_backend != 'remote':
+                github_sibling_config_dict["backend"] = self.github_backend
+                if self.github_local_dir:
+                    github_sibling_config_dict["local_dir"] = self.github_local_dir
             with open(self.github_sibling_config, 'w+') as outfile:
                 json.dump(github_sibling_config_dict, outfile, indent=4)
             print(f'> Saved as {self.github_sibling_config}')
@@ -0,0 +1,334 @@
+# Copyright © 2021-2022 Connectomics Lab
+# University Hospital Center and University of Lausanne (UNIL-CHUV), Switzerland,
+# and contributors
+#
+#  This software is distributed under the open-source license Apache 2.0.
+
+"""`neurodatapub.utils.annexcache`: shared local cache of git-annex objects across Datalad datasets."""
+
+import os
+import time
+import errno
+import sqlite3
+import hashlib
+import threading
+import contextlib
+import subprocess
+
+from .process import run
+
+# Default bound of the size of the cache (100 GB)
+DEFAULT_MAX_SIZE = 100 * 1000 ** 3
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS objects (
+    key TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    last_used REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS fingerprints (
+    device INTEGER NOT NULL,
+    inode INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    mtime INTEGER NOT NULL,
+    key TEXT NOT NULL,
+    PRIMARY KEY (device, inode, size, mtime)
+);
+CREATE INDEX IF NOT EXISTS fingerprints_key ON fingerprints (key);
+CREATE INDEX IF NOT EXISTS objects_last_used ON objects (last_used);
+"""
+
+
+def _git_annex_lines(cmd, cwd, lines=None):
+    """Run a git-annex command, optionally in `--batch` mode, and return its output lines (`None` on failure)."""
+    try:
+        proc = run(
+            cmd,
+            cwd=cwd,
+            input=''.join(f'{line}\n' for line in lines).encode() if lines is not None else None
+        )
+    except (OSError, subprocess.CalledProcessError) as e:
+        print(f'\t* WARNING: `{cmd}` failed: {e}')
+        return None
+    return os.fsdecode(proc.stdout).splitlines()
+
+
+class AnnexObjectCache(object):
+
+    """Content-addressed store of git-annex objects shared by the Datalad datasets of the host.
+
+    The objects hashed by git-annex in a dataset are hardlinked in the cache
+    under their key, and the files of the input dataset they come from are
+    recorded by fingerprint (device, inode, size and modification time).
+    When a new dataset is created from files already seen, their objects are
+    hardlinked from the cache into the annex of the dataset and the files are
+    added with `git annex fromkey`: they are neither copied nor hashed again,
+    and their content is stored once on disk.
+
+    Objects are never modified in place by git-annex, so sharing them is safe
+    as long as the datasets do not use `annex.thin`. The cache must be on the
+    same filesystem as the datasets. When its size exceeds `max_size`,
+    the least recently used objects are removed from the cache (the datasets
+    keep their own hardlinks).
+
+    Parameters
+    ----------
+    cache_dir : string
+        Directory of the cache
+
+    max_size : int
+        Maximal size of the cache in bytes (Default: 100 GB)
+    """
+
+    def __init__(self, cache_dir, max_size=DEFAULT_MAX_SIZE):
+        """Constructor of :class:`AnnexObjectCache` object."""
+        self.cache_dir = os.path.abspath(cache_dir)
+        self.objects_dir = os.path.join(self.cache_dir, 'objects')
+        self.max_size = max_size
+        os.makedirs(self.objects_dir, exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(
+            os.path.join(self.cache_dir, 'index.sqlite'),
+            timeout=60,
+            check_same_thread=False
+        )
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.executescript(_SCHEMA)
+
+    def close(self):
+        """Close the index of the cache."""
+        with self._lock:
+            self._db.close()
+
+    def object_path(self, key):
+        """Return the path of the object of `key` in the cache."""
+        return os.path.join(self.objects_dir, hashlib.md5(key.encode()).hexdigest()[:2], key)
+
+    def is_usable_for(self, datalad_dataset_dir):
+        """Return `True` if objects can be hardlinked between the cache and `datalad_dataset_dir`."""
+        return os.stat(self.objects_dir).st_dev == os.stat(datalad_dataset_dir).st_dev
+
+    @staticmethod
+    def _fingerprints(table):
+        """Yield the path and the current fingerprint of each file of a file table.
+
+        The fingerprint is taken from `os.stat()` (following symlinks) and not
+        from the table, which may come from a cached scan: the files that no
+        longer exist, or that changed since the table was made, are skipped.
+        """
+        for entry in table:
+            try:
+                st = os.stat(os.path.join(table.root, entry.path))
+            except OSError:
+                continue
+            if st.st_size != entry.size or st.st_mtime_ns != entry.mtime:
+                continue
+            yield entry.path, (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+
+    def lookup(self, table):
+        """
+        Find the files of a file table whose object is in the cache.
+
+        The files are matched by their fingerprint at the time of the lookup,
+        such that a file rewritten since the scan is copied and hashed again.
+
+        Parameters
+        ----------
+        table : neurodatapub.utils.scan.FileTable
+            Table of the files of the input dataset
+
+        Returns
+        -------
+        keys : dict
+            Dictionary of the git-annex keys indexed by
+            the relative paths of the files
+        """
+        keys = {}
+        with self._lock:
+            for path, fingerprint in self._fingerprints(table):
+                row = self._db.execute(
+                    'SELECT key FROM fingerprints WHERE device=? AND inode=? AND size=? AND mtime=?',
+                    fingerprint
+                ).fetchone()
+                if row is not None and os.path.exists(self.object_path(row[0])):
+                    keys[path] = row[0]
+        return keys
+
+    def _touch(self, keys):
+        with self._lock, self._db:
+            self._db.executemany(
+                'UPDATE objects SET last_used=? WHERE key=?',
+                [(time.time(), key) for key in set(keys)]
+            )
+
+    def checkout(self, datalad_dataset_dir, keys):
+        """
+        Add files to a Datalad dataset from the objects of the cache.
+
+        The objects are hardlinked in the annex of the dataset and the files
+        are created and staged with `git annex fromkey`. They still need to be saved.
+
+        Parameters
+        ----------
+        datalad_dataset_dir : string
+            Local path of the Datalad dataset
+
+        keys : dict
+            Keys of the files indexed by their relative paths,
+            as returned by :meth:`lookup`
+
+        Returns
+        -------
+        added : list of string
+            Relative paths of the files added. The other files
+            (e.g. whose object has been evicted in the meantime)
+            should be copied as usual.
+        """
+        keys = {path: key for path, key in keys.items() if '\n' not in path}
+        if not keys:
+            return []
+        unique_keys = sorted(set(keys.values()))
+        relpaths = _git_annex_lines(
+            "git annex examinekey --batch --format='${hashdirmixed}${key}/${key}\\n'",
+            cwd=datalad_dataset_dir,
+            lines=unique_keys
+        )
+        if relpaths is None:
+            return []
+        annex_objects_dir = os.path.join(datalad_dataset_dir, '.git', 'annex', 'objects')
+        linked = set()
+        for key, relpath in zip(unique_keys, relpaths):
+            target = os.path.join(annex_objects_dir, relpath)
+            try:
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                if not os.path.exists(target):
+                    os.link(self.object_path(key), target)
+                # Freeze the content directory as git-annex does
+                os.chmod(os.path.dirname(target), 0o555)
+                linked.add(key)
+            except OSError as e:
+                if e.errno == errno.EXDEV:
+                    print(f'\t* WARNING: {self.cache_dir} is not on the same filesystem '
+                          f'as {datalad_dataset_dir}: annex object cache not used')
+                    return []
+        added = sorted(path for path, key in keys.items() if key in linked)
+        for path in added:
+            os.makedirs(os.path.join(datalad_dataset_dir, os.path.dirname(path)), exist_ok=True)
+        if _git_annex_lines(
+            'git annex fromkey --batch',
+            cwd=datalad_dataset_dir,
+            lines=[f'{keys[path]} {path}' for path in added]
+        ) is None:
+            # Files added before the failure are kept
+            return [path for path in added if os.path.lexists(os.path.join(datalad_dataset_dir, path))]
+        self._touch(keys[path] for path in added)
+        return added
+
+    def ingest(self, datalad_dataset_dir, table, skip=()):
+        """
+        Add the annexed objects of a Datalad dataset to the cache.
+
+        The objects of the files of `table` are hardlinked in the cache
+        and their fingerprints recorded. The least recently used objects
+        are then evicted if the cache exceeds `max_size`.
+
+        Parameters
+        ----------
+        datalad_dataset_dir : string
+            Local path of the Datalad dataset
+
+        table : neurodatapub.utils.scan.FileTable
+            Table of the files of the input dataset copied in the Datalad dataset
+
+        skip : container of string
+            Relative paths of the files already known by the cache (Default: `()`)
+
+        Returns
+        -------
+        nb_objects : int
+            Number of objects added to the cache
+        """
+        lines = _git_annex_lines(
+            "git annex find --format='${key}\\t${hashdirmixed}\\t${file}\\n'",
+            cwd=datalad_dataset_dir
+        )
+        if lines is None:
+            return 0
+        annexed = {}
+        for line in lines:
+            key, hashdir, path = line.split('\t', 2)
+            annexed[path] = (key, hashdir)
+        annex_objects_dir = os.path.join(datalad_dataset_dir, '.git', 'annex', 'objects')
+        objects, fingerprints = [], []
+        for path, fingerprint in self._fingerprints(table):
+            if path in skip or path not in annexed:
+                continue
+            key, hashdir = annexed[path]
+            fingerprints.append(fingerprint + (key,))
+            target = self.object_path(key)
+            if os.path.exists(target):
+                continue
+            source = os.path.join(annex_objects_dir, hashdir, key, key)
+            tmp_path = f'{target}.{os.getpid()}.tmp'
+            try:
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                os.link(source, tmp_path)
+                os.replace(tmp_path, target)
+            except OSError as e:
+                if e.errno == errno.EXDEV:
+                    print(f'\t* WARNING: {self.cache_dir} is not on the same filesystem '
+                          f'as {datalad_dataset_dir}: annex object cache not used')
+                    return 0
+                continue
+            objects.append((key, fingerprint[2], time.time()))
+        with self._lock, self._db:
+            self._db.executemany(
+                'INSERT INTO objects (key, size, last_used) VALUES (?, ?, ?) '
+                'ON CONFLICT(key) DO UPDATE SET last_used=excluded.last_used',
+                objects
+            )
+            self._db.executemany(
+                'INSERT OR REPLACE INTO fingerprints (device, inode, size, mtime, key) '
+                'VALUES (?, ?, ?, ?, ?)',
+                fingerprints
+            )
+        self.evict()
+        return len(objects)
+
+    def size(self):
+        """Return the number of objects and the total size in bytes of the cache."""
+        with self._lock:
+            count, total = self._db.execute('SELECT COUNT(*), SUM(size) FROM objects').fetchone()
+        return count, total or 0
+
+    def evict(self, max_size=None):
+        """
+        Remove the least recently used objects until the cache fits in `max_size` bytes.
+
+        Parameters
+        ----------
+        max_size : int
+            Maximal size of the cache in bytes (Default: `max_size` of the cache)
+
+        Returns
+        -------
+        nb_objects : int
+            Number of objects removed
+
+        nbytes : int
+            Number of bytes removed
+        """
+        max_size = self.max_size if max_size is None else max_size
+        _, total = self.size()
+        evicted, evicted_bytes = [], 0
+        with self._lock, self._db:
+            for key, size in self._db.execute('SELECT key, size FROM objects ORDER BY last_used').fetchall():
+                if total - evicted_bytes <= max_size:
+                    break
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(self.object_path(key))
+                evicted.append((key,))
+                evicted_bytes += size
+            self._db.executemany('DELETE FROM objects WHERE key=?', evicted)
+            self._db.executemany('DELETE FROM fingerprints WHERE key=?', evicted)
+        return len(evicted), evicted_bytes
@@ -0,0 +1,580 @@
+# Copyright © 2021-2022 Connectomics Lab
+# University Hospital Center and University of Lausanne (UNIL-CHUV), Switzerland,
+# and contributors
+#
+#  This software is distributed under the open-source license Apache 2.0.
+
+"""`neurodatapub.utils.backends`: pluggable backends of the siblings, with local stand-ins of the SSH server, GitHub and OSF."""
+
+import os
+import re
+import json
+import shlex
+import shutil
+import threading
+import subprocess
+import urllib.error
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import datalad.api
+
+from .datalad import (
+    DEFAULT_SSH_REMOTE_NAME, DEFAULT_OSF_REMOTE_NAME, DEFAULT_DATALAD_SSH_SIBLING_NAME,
+    create_ssh_sibling, create_github_sibling, authenticate_osf, create_osf_sibling
+)
+from .gitannex import init_ssh_special_sibling, enable_ssh_special_sibling
+from .github import authenticate_github_email, authenticate_github_token
+from .process import run
+from .sshconfig import update_ssh_config
+from .throttle import THROTTLE_EXTERNAL_TYPE, get_throttle_initremote_options
+
+# Backends that can be selected with the `"backend"` entry of the sibling configuration files
+BACKENDS = ['remote', 'local']
+
+# Name of the sibling of the GitHub repository
+GITHUB_SIBLING_NAME = 'github'
+
+
+def get_local_backend_dir(kind):
+    """Return the default directory of the local backend of a kind of sibling (`"ssh"`, `"github"` or `"osf"`)."""
+    data_home = os.environ.get('XDG_DATA_HOME') or os.path.join(os.path.expanduser('~'), '.local', 'share')
+    return os.path.join(data_home, 'neurodatapub', 'backends', kind)
+
+
+def get_throttled_store_dir(ssh_special_sibling_args):
+    """Return the directory of the annexed files of a local ssh special sibling reached through a throttled link."""
+    if ssh_special_sibling_args.get("remote_shared_store_dir"):
+        return ssh_special_sibling_args["remote_shared_store_dir"]
+    sibling_dir = ssh_special_sibling_args["remote_sibling_dir"].rstrip('/')
+    return os.path.join(os.path.dirname(sibling_dir), 'annex-throttled')
+
+
+def _run_step(cmd, cwd=None):
+    """Run a command of a local backend like the utils functions do (`None` on failure)."""
+    try:
+        print(f'... cmd: {cmd}')
+        return run(cmd, cwd=cwd)
+    except Exception as e:
+        print('Failed')
+        print(e)
+        return None
+
+
+def _has_remote(datalad_dataset_dir, remote_name, key='url'):
+    """Return `True` if a remote with a `remote.<name>.<key>` entry is configured in the dataset."""
+    try:
+        run(f'git config --get remote.{remote_name}.{key}', cwd=datalad_dataset_dir)
+    except subprocess.CalledProcessError:
+        return False
+    return True
+
+
+class SiblingBackend(object):
+
+    """Base class of the backends of the siblings.
+
+    The methods of the backends have the signatures of the utils
+    functions creating and configuring the siblings, and return
+    the same `(res, cmd)` pairs.
+
+    Parameters
+    ----------
+    local_dir : string
+        Directory of the local stand-ins, unused by the
+        remote backends (Default: `None`)
+    """
+
+    name = 'remote'
+
+    def __init__(self, local_dir=None):
+        """Constructor of :class:`SiblingBackend` object."""
+        self.local_dir = local_dir
+
+    def __repr__(self):
+        """Define how a backend object is rendered in `print()`."""
+        return f'{self.__class__.__name__}({self.local_dir or ""})'
+
+
+class SSHSiblingBackend(SiblingBackend):
+
+    """Backend of the ssh special sibling on a SSH-accessible server (default)."""
+
+    def shared_store_host(self, sshurl):
+        """Return the host of the shared store passed to the `neurodatapub.utils.gitannex` functions."""
+        return sshurl
+
+    def update_ssh_config(self, sshurl, user, dryrun=False):
+        """See :func:`neurodatapub.utils.sshconfig.update_ssh_config`."""
+        return update_ssh_config(sshurl=sshurl, user=user, dryrun=dryrun)
+
+    def create_ssh_sibling(self, datalad_dataset_dir, ssh_special_sibling_args,
+                           datalad_sibling_name=DEFAULT_DATALAD_SSH_SIBLING_NAME, dryrun=False):
+        """See :func:`neurodatapub.utils.datalad.create_ssh_sibling`."""
+        return create_ssh_sibling(
+            datalad_dataset_dir=datalad_dataset_dir,
+            ssh_special_sibling_args=ssh_special_sibling_args,
+            datalad_sibling_name=datalad_sibling_name,
+            dryrun=dryrun
+        )
+
+    def init_ssh_special_sibling(self, datalad_dataset_dir, ssh_special_sibling_args,
+                                 ssh_special_sibling_name=DEFAULT_SSH_REMOTE_NAME, dryrun=False):
+        """See :func:`neurodatapub.utils.gitannex.init_ssh_special_sibling`."""
+        return init_ssh_special_sibling(
+            datalad_dataset_dir=datalad_dataset_dir,
+            ssh_special_sibling_args=ssh_special_sibling_args,
+            ssh_special_sibling_name=ssh_special_sibling_name,
+            dryrun=dryrun
+        )
+
+    def enable_ssh_special_sibling(self, datalad_dataset_dir,
+                                   ssh_special_sibling_name=DEFAULT_SSH_REMOTE_NAME, dryrun=False):
+        """See :func:`neurodatapub.utils.gitannex.enable_ssh_special_sibling`."""
+        return enable_ssh_special_sibling(
+            datalad_dataset_dir=datalad_dataset_dir,
+            ssh_special_sibling_name=ssh_special_sibling_name,
+            dryrun=dryrun
+        )
+
+
+class LocalSSHSiblingBackend(SSHSiblingBackend):
+
+    """Local stand-in of the SSH server hosting the ssh special sibling.
+
+    The sibling is created by Datalad at the local path `remote_sibling_dir`
+    and the special remote is a `type=git` remote of this repository,
+    or a `type=directory` remote if a shared store is configured.
+    The SSH URL and login are not used.
+
+    If the arguments of the sibling have a `"throttle"` entry, the special
+    remote is a :class:`neurodatapub.utils.throttle.ThrottledRemote` storing
+    the annexed files in the shared store or in :func:`get_throttled_store_dir`,
+    through a link with the given `"latency"` (in seconds), `"bandwidth"`
+    (in MB/s), `"failure_rate"` and `"seed"`.
+    """
+
+    name = 'local'
+
+    def shared_store_host(self, sshurl):
+        """The shared store is a local directory (see :func:`neurodatapub.utils.gitannex.get_shared_store_keys`)."""
+        return None
+
+    def update_ssh_config(self, sshurl, user, dryrun=False):
+        """Do not update the SSH config: return a no-op command."""
+        print('\t* Local backend: the SSH config is not updated')
+        return ': # The local backend does not connect through SSH'
+
+    def create_ssh_sibling(self, datalad_dataset_dir, ssh_special_sibling_args,
+                           datalad_sibling_name=DEFAULT_DATALAD_SSH_SIBLING_NAME, dryrun=False):
+        """Create the sibling in the local directory `remote_sibling_dir` via `datalad.api.create_sibling()`."""
+        sibling_dir = ssh_special_sibling_args["remote_sibling_dir"]
+        res = None
+        if not dryrun:
+            os.makedirs(os.path.dirname(sibling_dir.rstrip('/')), exist_ok=True)
+            res = datalad.api.create_sibling(
+                sshurl=sibling_dir,
+                name=datalad_sibling_name,
+                dataset=datalad_dataset_dir,
+                existing='skip'
+            )
+        cmd = f'datalad create-sibling -s {datalad_sibling_name} \\\n\t'
+        cmd += f'--dataset "{datalad_dataset_dir}" \\\n\t'
+        cmd += f'"{sibling_dir}"'
+        return res, cmd
+
+    def init_ssh_special_sibling(self, datalad_dataset_dir, ssh_special_sibling_args,
+                                 ssh_special_sibling_name=DEFAULT_SSH_REMOTE_NAME, dryrun=False):
+        """Initialize the special remote in the local sibling or shared store with `git annex initremote`."""
+        store_dir = ssh_special_sibling_args.get("remote_shared_store_dir")
+        throttle = ssh_special_sibling_args.get("throttle")
+        cmd = f'git annex initremote {ssh_special_sibling_name} '
+        if throttle:
+            store_dir = get_throttled_store_dir(ssh_special_sibling_args)
+            cmd += get_throttle_initremote_options(
+                directory=store_dir,
+                latency=throttle.get('latency', 0),
+                bandwidth=throttle.get('bandwidth', 0) * 1024 * 1024,
+                failure_rate=throttle.get('failure_rate', 0),
+                seed=throttle.get('seed')
+            ) + ' '
+            if not dryrun and shutil.which(f'git-annex-remote-{THROTTLE_EXTERNAL_TYPE}') is None:
+                print(f'\t* WARNING: git-annex-remote-{THROTTLE_EXTERNAL_TYPE} is not in the PATH '
+                      '(Is neurodatapub installed in the environment?)')
+        elif store_dir:
+            cmd += f'type=directory directory={shlex.quote(store_dir)} encryption=none '
+        else:
+            cmd += f'type=git location={shlex.quote(ssh_special_sibling_args["remote_sibling_dir"])} '
+        cmd += 'autoenable=true'
+        if store_dir:
+            # A directory special remote needs an existing directory
+            cmd = f'mkdir -p {shlex.quote(store_dir)} && {cmd}'
+        proc = None
+        if not dryrun:
+            proc = _run_step(cmd, cwd=datalad_dataset_dir)
+        return proc, cmd
+
+
+class GitHubSiblingBackend(SiblingBackend):
+
+    """Backend of the sibling of the dataset repository on GitHub (default)."""
+
+    def authenticate_github_email(self, datalad_dataset_dir, github_email, dryrun=False):
+        """See :func:`neurodatapub.utils.github.authenticate_github_email`."""
+        return authenticate_github_email(
+            datalad_dataset_dir=datalad_dataset_dir, github_email=github_email, dryrun=dryrun
+        )
+
+    def authenticate_github_token(self, datalad_dataset_dir, github_token, dryrun=False):
+        """See :func:`neurodatapub.utils.github.authenticate_github_token`."""
+        return authenticate_github_token(
+            datalad_dataset_dir=datalad_dataset_dir, github_token=github_token, dryrun=dryrun
+        )
+
+    def create_github_sibling(self, datalad_dataset_dir, github_sibling_args,
+                              gitannex_remote_name=DEFAULT_SSH_REMOTE_NAME,
+                              github_token=None, dryrun=False):
+        """See :func:`neurodatapub.utils.datalad.create_github_sibling`."""
+        # The token is taken from the repository configuration (`hub.oauthtoken`)
+        return create_github_sibling(
+            datalad_dataset_dir=datalad_dataset_dir,
+            github_sibling_args=github_sibling_args,
+            gitannex_remote_name=gitannex_remote_name,
+            dryrun=dryrun
+        )
+
+
+class _GitHubAPIHandler(BaseHTTPRequestHandler):
+
+    """Handler of the requests to the :class:`GitHubAPIStub`."""
+
+    def log_message(self, format, *args):
+        # Keep the output of the publication clean
+        pass
+
+    def _reply(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _authenticated(self):
+        if not self.headers.get('Authorization', '').split(' ', 1)[-1].strip():
+            self._reply(401, {'message': 'Requires authentication'})
+            return False
+        return True
+
+    def do_GET(self):
+        if not self._authenticated():
+            return
+        match = re.fullmatch(r'/repos/([\w.-]+)/([\w.-]+)', self.path)
+        repo = match and self.server.stub.get_repository(*match.groups())
+        if repo is None:
+            self._reply(404, {'message': 'Not Found'})
+        else:
+            self._reply(200, repo)
+
+    def do_POST(self):
+        if not self._authenticated():
+            return
+        match = re.fullmatch(r'/orgs/([\w.-]+)/repos|/user/repos', self.path)
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+            name = body['name']
+        except (ValueError, KeyError):
+            self._reply(400, {'message': 'Problems parsing JSON'})
+            return
+        if match is None or not re.fullmatch(r'[\w.-]+', name):
+            self._reply(404, {'message': 'Not Found'})
+            return
+        owner = match.group(1) or self.server.stub.user
+        if self.server.stub.get_repository(owner, name) is not None:
+            self._reply(422, {'message': 'Repository creation failed.',
+                              'errors': [{'message': 'name already exists on this account'}]})
+            return
+        self._reply(201, self.server.stub.create_repository(owner, name, body.get('private', False)))
+
+
+class GitHubAPIStub(object):
+
+    """Minimal stand-in of the REST API of GitHub serving local bare repositories.
+
+    It implements the two endpoints used to create a repository sibling:
+    `GET /repos/<owner>/<repo>` and `POST /orgs/<org>/repos` (or `/user/repos`).
+    The repositories are bare repositories `<root>/<owner>/<repo>.git`
+    and their `clone_url` is their local path. Requests must
+    have an `Authorization` header, whatever the token.
+
+    Parameters
+    ----------
+    root : string
+        Directory of the repositories
+
+    user : string
+        Login of the authenticated user, owner of the repositories
+        created with `POST /user/repos` (Default: `"neurodatapub"`)
+
+    Examples
+    --------
+    >>> with GitHubAPIStub('/tmp/github') as api_url:  # doctest: +SKIP
+    ...     github_api_request(api_url, '/orgs/NCCR-SYNAPSY/repos', 'token', {'name': 'ds-example'})
+    """
+
+    def __init__(self, root, user='neurodatapub'):
+        """Constructor of :class:`GitHubAPIStub` object."""
+        self.root = os.path.abspath(root)
+        self.user = user
+        self._server = None
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def repository_path(self, owner, name):
+        """Return the path of the bare repository `owner/name`."""
+        return os.path.join(self.root, owner, f'{name}.git')
+
+    def _describe(self, owner, name, private):
+        path = self.repository_path(owner, name)
+        return dict(name=name, full_name=f'{owner}/{name}', private=private,
+                    clone_url=path, html_url=f'file://{path}')
+
+    def get_repository(self, owner, name):
+        """Return the description of the repository `owner/name` (`None` if it does not exist)."""
+        path = self.repository_path(owner, name)
+        if not os.path.isdir(path):
+            return None
+        return self._describe(owner, name, os.path.exists(os.path.join(path, 'private')))
+
+    def create_repository(self, owner, name, private=False):
+        """Create the bare repository `owner/name` and return its description."""
+        path = self.repository_path(owner, name)
+        with self._lock:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            run(f'git init -q --bare {shlex.quote(path)}')
+            if private:
+                open(os.path.join(path, 'private'), 'w').close()
+        return self._describe(owner, name, private)
+
+    def start(self):
+        """Start to serve the API on a free port of `127.0.0.1` and return its URL."""
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), _GitHubAPIHandler)
+        self._server.daemon_threads = True
+        self._server.stub = self
+        self._thread = threading.Thread(
+            target=self._server.serve_forever, name='github-api-stub', daemon=True
+        )
+        self._thread.start()
+        return f'http://127.0.0.1:{self._server.server_address[1]}'
+
+    def stop(self):
+        """Stop to serve the API."""
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._thread.join()
+            self._server = None
+
+    def __enter__(self):
+        """Start the stub in a `with` statement."""
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        """Stop the stub at the end of a `with` statement."""
+        self.stop()
+
+
+def github_api_request(api_url, path, token, data=None):
+    """
+    Send a request to the REST API of GitHub (or of a :class:`GitHubAPIStub`).
+
+    Parameters
+    ----------
+    api_url : string
+        Base URL of the API
+
+    path : string
+        Path of the endpoint (e.g. `"/repos/<owner>/<repo>"`)
+
+    token : string
+        Access token sent in the `Authorization` header
+
+    data : dict
+        If given, it is sent as JSON in a `POST` request (Default: `None`, `GET`)
+
+    Returns
+    -------
+    status : int
+        HTTP status of the response
+
+    body : dict
+        Decoded JSON body of the response
+    """
+    request = urllib.request.Request(
+        f'{api_url}{path}',
+        data=json.dumps(data).encode() if data is not None else None,
+        headers={'Authorization': f'token {token}', 'Content-Type': 'application/json',
+                 'Accept': 'application/vnd.github.v3+json'},
+        method='POST' if data is not None else 'GET'
+    )
+    try:
+        with urllib.request.urlopen(request, timeout=30) as response:
+            return response.status, json.loads(response.read() or b'{}')
+    except urllib.error.HTTPError as e:
+        return e.code, json.loads(e.read() or b'{}')
+
+
+class LocalGitHubSiblingBackend(GitHubSiblingBackend):
+
+    """Local stand-in of GitHub: the dataset repository is pushed to a local bare repository.
+
+    The repository is created through a :class:`GitHubAPIStub` serving
+    the repositories of `local_dir`, such that the requests of a
+    publication are exercised, and added as the `github` sibling.
+    The Git configuration is set as with the remote backend.
+    """
+
+    name = 'local'
+
+    def create_github_sibling(self, datalad_dataset_dir, github_sibling_args,
+                              gitannex_remote_name=DEFAULT_SSH_REMOTE_NAME,
+                              github_token=None, dryrun=False):
+        """Create the repository in `local_dir` and add it as sibling via `datalad.api.siblings()`."""
+        local_dir = self.local_dir or get_local_backend_dir('github')
+        owner = github_sibling_args["github_organization"] or github_sibling_args["github_login"]
+        name = github_sibling_args["github_repo_name"]
+        stub = GitHubAPIStub(local_dir, user=github_sibling_args["github_login"] or 'neurodatapub')
+        repo_path = stub.repository_path(owner, name)
+        res = None
+        if not dryrun:
+            if _has_remote(datalad_dataset_dir, GITHUB_SIBLING_NAME):
+                print(f'\t* Sibling {GITHUB_SIBLING_NAME} already exists: skipped')
+            else:
+                with stub as api_url:
+                    status, repo = github_api_request(api_url, f'/repos/{owner}/{name}', github_token or 'local')
+                    if status == 404:
+                        status, repo = github_api_request(
+                            api_url, f'/orgs/{owner}/repos', github_token or 'local',
+                            dict(name=name, private=True)
+                        )
+                if status not in (200, 201):
+                    print('Failed')
+                    print(f'{status}: {repo.get("message")}')
+                    return None, None
+                res = datalad.api.siblings(
+                    action='add',
+                    dataset=datalad_dataset_dir,
+                    name=GITHUB_SIBLING_NAME,
+                    url=repo['clone_url'],
+                    publish_depends=gitannex_remote_name
+                )
+        cmd = f'[ -d "{repo_path}" ] || git init -q --bare "{repo_path}"\n'
+        cmd += 'datalad siblings add \\\n\t'
+        cmd += f'--dataset "{datalad_dataset_dir}" \\\n\t'
+        cmd += f'-s {GITHUB_SIBLING_NAME} \\\n\t'
+        cmd += f'--url "{repo_path}" \\\n\t'
+        cmd += f'--publish-depends {gitannex_remote_name}'
+        return res, cmd
+
+
+class OSFSiblingBackend(SiblingBackend):
+
+    """Backend of the OSF sibling (default)."""
+
+    def authenticate_osf(self, osf_token, dryrun=False):
+        """See :func:`neurodatapub.utils.datalad.authenticate_osf`."""
+        return authenticate_osf(osf_token=osf_token, dryrun=dryrun)
+
+    def create_osf_sibling(self, dataset_dir, datalad_dataset_dir, osf_dataset_title,
+                           osf_token=None, dryrun=False):
+        """See :func:`neurodatapub.utils.datalad.create_osf_sibling`."""
+        return create_osf_sibling(
+            dataset_dir=dataset_dir,
+            datalad_dataset_dir=datalad_dataset_dir,
+            osf_dataset_title=osf_dataset_title,
+            osf_token=osf_token,
+            dryrun=dryrun
+        )
+
+
+class LocalOSFSiblingBackend(OSFSiblingBackend):
+
+    """Local stand-in of OSF: the annexed files are stored in a directory of `local_dir`.
+
+    Each OSF project is a directory named after the slug of its title, with
+    a `project.json` file recording the metadata that would be sent to OSF,
+    and the special remote is a `type=directory` remote named as the
+    storage of the OSF sibling. No token is needed.
+    """
+
+    name = 'local'
+
+    def project_dir(self, osf_dataset_title):
+        """Return the directory standing for the OSF project of a dataset."""
+        slug = re.sub(r'[^\w-]+', '-', osf_dataset_title.strip()).strip('-').lower()
+        return os.path.join(self.local_dir or get_local_backend_dir('osf'), slug or 'untitled')
+
+    def authenticate_osf(self, osf_token, dryrun=False):
+        """Do not authenticate: return a no-op command."""
+        print('\t* Local backend: no authentication to OSF')
+        return None, ': # The local backend does not need an OSF token'
+
+    def create_osf_sibling(self, dataset_dir, datalad_dataset_dir, osf_dataset_title,
+                           osf_token=None, dryrun=False):
+        """Create the project directory and initialize its special remote with `git annex initremote`."""
+        project_dir = self.project_dir(osf_dataset_title)
+        cmd = f'mkdir -p {shlex.quote(project_dir)} && '
+        cmd += f'git annex initremote {DEFAULT_OSF_REMOTE_NAME} '
+        cmd += f'type=directory directory={shlex.quote(project_dir)} encryption=none autoenable=true'
+        proc = None
+        if not dryrun:
+            if _has_remote(datalad_dataset_dir, DEFAULT_OSF_REMOTE_NAME, key='annex-uuid'):
+                print(f'\t* Sibling {DEFAULT_OSF_REMOTE_NAME} already exists: skipped')
+                return None, cmd
+            os.makedirs(project_dir, exist_ok=True)
+            readme_file = os.path.join(dataset_dir, 'README')
+            description = None
+            if os.path.exists(readme_file):
+                with open(readme_file, encoding='utf-8') as f:
+                    description = f.read()
+            with open(os.path.join(project_dir, 'project.json'), 'w') as f:
+                json.dump(dict(title=osf_dataset_title, category='data', tags=['neuroimaging'],
+                               public=False, description=description), f, indent=4)
+            proc = _run_step(cmd, cwd=datalad_dataset_dir)
+        return proc, cmd
+
+
+_BACKEND_CLASSES = {
+    'ssh': {'remote': SSHSiblingBackend, 'local': LocalSSHSiblingBackend},
+    'github': {'remote': GitHubSiblingBackend, 'local': LocalGitHubSiblingBackend},
+    'osf': {'remote': OSFSiblingBackend, 'local': LocalOSFSiblingBackend},
+}
+
+
+def get_sibling_backend(kind, backend='remote', local_dir=None):
+    """
+    Return the backend of a kind of sibling.
+
+    Parameters
+    ----------
+    kind : {"ssh", "github", "osf"}
+        Kind of sibling
+
+    backend : {"remote", "local"}
+        `"remote"` for the real SSH server, GitHub and OSF, or
+        `"local"` for their stand-ins on the local machine (Default: `"remote"`)
+
+    local_dir : string
+        Directory of the local stand-ins of GitHub and OSF
+        (Default: `None`, see :func:`get_local_backend_dir`)
+
+    Returns
+    -------
+    backend : SiblingBackend
+        Object with the functions creating and configuring the sibling
+    """
+    try:
+        return _BACKEND_CLASSES[kind][backend or 'remote'](local_dir=local_dir or None)
+    except KeyError:
+        raise ValueError(f'Unknown backend {backend!r} for the {kind} sibling '
+                         f'(It should be one of {BACKENDS})')
@@ -0,0 +1,191 @@
+# Copyright © 2021-2022 Connectomics Lab
+# University Hospital Center and University of Lausanne (UNIL-CHUV), Switzerland,
+# and contributors
+#
+#  This software is distributed under the open-source license Apache 2.0.
+
+"""`neurodatapub.utils.bidsfilter`: utils functions to select the files of a BIDS dataset to be published."""
+
+import os
+import fnmatch
+
+# Datatype directories of the BIDS specification
+BIDS_DATATYPES = [
+    'anat', 'beh', 'dwi', 'eeg', 'fmap', 'func', 'ieeg', 'meg',
+    'micr', 'motion', 'nirs', 'perf', 'pet'
+]
+
+# Parameters of the command-line interface (and of the jobs of the service) describing a selection
+FILTER_PARAMS = ['subjects', 'sessions', 'datatypes', 'suffixes', 'include', 'exclude']
+
+
+def parse_bids_entities(path):
+    """
+    Extract the BIDS entities of a file from its relative path.
+
+    Parameters
+    ----------
+    path : string
+        Path of the file relative to the root of the dataset
+
+    Returns
+    -------
+    entities : dict
+        Dictionary with the `"subject"`, `"session"`, `"datatype"`,
+        `"suffix"` and `"extension"` of the file (`None` if not defined)
+    """
+    parts = path.split(os.sep)
+    name = parts[-1]
+    stem, dot, extension = name.partition('.')
+    entities = dict(
+        subject=None,
+        session=None,
+        datatype=parts[-2] if len(parts) > 1 and parts[-2] in BIDS_DATATYPES else None,
+        suffix=stem.rsplit('_', 1)[-1] if '_' in stem else None,
+        extension=dot + extension if dot else None
+    )
+    # Directories first, then the entities of the file name
+    for part in parts[:-1] + stem.split('_'):
+        if part.startswith('sub-') and entities['subject'] is None:
+            entities['subject'] = part[4:]
+        elif part.startswith('ses-') and entities['session'] is None:
+            entities['session'] = part[4:]
+    return entities
+
+
+def match_pattern(path, pattern):
+    """
+    Return `True` if a relative path matches a pattern of a `.gitignore`-like file.
+
+    A pattern without `/` matches the name of the file or of any of its parent
+    directories, a pattern ending with `/` matches only directories, and
+    other patterns match the path (or the path of a parent directory) from the root.
+    """
+    parts = path.split(os.sep)
+    dir_only = pattern.endswith('/')
+    pattern = pattern.strip('/') if pattern.startswith('/') or dir_only else pattern
+    candidates = range(1, len(parts)) if dir_only else range(1, len(parts) + 1)
+    if '/' not in pattern:
+        return any(fnmatch.fnmatchcase(parts[i - 1], pattern) for i in candidates)
+    return any(fnmatch.fnmatchcase('/'.join(parts[:i]), pattern) for i in candidates)
+
+
+def read_ignore_file(path):
+    """Return the patterns of a `.gitignore`-like file such as `.bidsignore` (empty if it does not exist)."""
+    if not os.path.exists(path):
+        return []
+    with open(path, 'r') as f:
+        lines = [line.strip() for line in f]
+    # Negated patterns are not supported and ignored
+    return [line for line in lines if line and not line.startswith(('#', '!'))]
+
+
+def _labels(labels):
+    """Return the set of labels given with or without their prefix (e.g. `"sub-01"` or `"01"`)."""
+    return {label.split('-', 1)[1] if '-' in label else label for label in labels} if labels else None
+
+
+class BIDSFilter(object):
+
+    """Selection of the files of a BIDS dataset by BIDS entities and glob patterns.
+
+    The entity filters apply to the files of the subjects: a file of a subject
+    is selected only if its subject, session, datatype and suffix are
+    in the given lists (when given and defined for the file). Files at the
+    dataset level (e.g. `dataset_description.json`, `participants.tsv`)
+    are selected unless they are excluded by a pattern. If `include`
+    patterns are given, only the files matching one of them are selected.
+    Files matching an `exclude` pattern or a pattern of the `.bidsignore`
+    file of the dataset are never selected.
+
+    Parameters
+    ----------
+    subjects, sessions, datatypes, suffixes : list of string
+        Labels of the subjects and sessions (with or without prefix),
+        datatypes (e.g. `"anat"`) and suffixes (e.g. `"T1w"`) selected
+
+    include, exclude : list of string
+        Patterns of the files included and excluded
+        (e.g. `"sourcedata/"` or `"*_physio.tsv.gz"`)
+
+    bidsignore : bool
+        If `True`, the files matching the patterns of the `.bidsignore`
+        file of the dataset are excluded (Default: `True`)
+    """
+
+    def __init__(self, subjects=None, sessions=None, datatypes=None, suffixes=None,
+                 include=None, exclude=None, bidsignore=True):
+        """Constructor of :class:`BIDSFilter` object."""
+        self.subjects = _labels(subjects)
+        self.sessions = _labels(sessions)
+        self.datatypes = set(datatypes) if datatypes else None
+        self.suffixes = set(suffixes) if suffixes else None
+        self.include = list(include or [])
+        self.exclude = list(exclude or [])
+        self.bidsignore = bidsignore
+
+    def __repr__(self):
+        """Define how a :class:`BIDSFilter` object is rendered in `print()`."""
+        criteria = ', '.join(
+            f'{name}={sorted(value) if isinstance(value, set) else value!r}'
+            for name, value in vars(self).items() if value and name != 'bidsignore'
+        )
+        return f'BIDSFilter({criteria})'
+
+    def _entities_match(self, path):
+        entities = parse_bids_entities(path)
+        if entities['subject'] is None:
+            return True
+        for name, selected in [('subject', self.subjects), ('session', self.sessions),
+                               ('datatype', self.datatypes), ('suffix', self.suffixes)]:
+            if selected is not None and entities[name] is not None and entities[name] not in selected:
+                return False
+        return True
+
+    def predicate(self, root):
+        """Return the function telling if a relative path of the dataset at `root` is selected."""
+        exclude = list(self.exclude)
+        if self.bidsignore:
+            exclude += read_ignore_file(os.path.join(root, '.bidsignore'))
+
+        def is_selected(path):
+            if self.include and not any(match_pattern(path, pattern) for pattern in self.include):
+                return False
+            if any(match_pattern(path, pattern) for pattern in exclude):
+                return False
+            return self._entities_match(path)
+        return is_selected
+
+    def filter_table(self, table):
+        """
+        Select the files of a file table.
+
+        Parameters
+        ----------
+        table : neurodatapub.utils.scan.FileTable
+            Table of the files of the dataset
+
+        Returns
+        -------
+        selection : neurodatapub.utils.scan.FileTable
+            Table of the selected files
+        """
+        return table.filtered(self.predicate(table.root))
+
+
+def create_bids_filter(params):
+    """
+    Create the :class:`BIDSFilter` described by parameters of the command-line interface.
+
+    Parameters
+    ----------
+    params : dict
+        Parameters, in which the ones of :data:`FILTER_PARAMS` are lists of strings
+
+    Returns
+    -------
+    bids_filter : BIDSFilter
+        Filter of the files to be published, or `None` if no selection is given
+    """
+    criteria = {name: params[name] for name in FILTER_PARAMS if params.get(name)}
+    return BIDSFilter(**criteria) if criteria else None
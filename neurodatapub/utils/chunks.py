@@ -0,0 +1,170 @@
+# Copyright © 2021-2022 Connectomics Lab
+# University Hospital Center and University of Lausanne (UNIL-CHUV), Switzerland,
+# and contributors
+#
+#  This software is distributed under the open-source license Apache 2.0.
+
+"""`neurodatapub.utils.chunks`: utils functions to save a large Datalad dataset in bounded chunks."""
+
+import os
+import json
+import tempfile
+import contextlib
+import subprocess
+
+from .process import run
+
+
+def get_save_chunks_state_file(datalad_dataset_dir):
+    """Return the file where the progress of a save in chunks of a Datalad dataset is recorded."""
+    return os.path.join(datalad_dataset_dir, '.git', 'neurodatapub', 'save-chunks.json')
+
+
+def plan_save_chunks(table, max_files=0, max_bytes=0, exclude=()):
+    """
+    Split the files of a table in chunks saved one after the other.
+
+    Whole directories are put in a chunk as long as they fit in its bounds,
+    such that a chunk is mostly given by a few directory paths. Directories
+    exceeding the bounds are split by subdirectory, and their files are
+    distributed across chunks.
+
+    Parameters
+    ----------
+    table : neurodatapub.utils.scan.FileTable
+        Table of the files to save
+
+    max_files : int
+        Maximal number of files per chunk (Default: `0`, no bound)
+
+    max_bytes : int
+        Maximal size in bytes of the files of a chunk
+        (Default: `0`, no bound)
+
+    exclude : iterable of string
+        Relative paths of the files that are not saved with the chunks
+        (Default: `()`)
+
+    Returns
+    -------
+    chunks : list of list of string
+        Relative paths of the directories and files of each chunk
+    """
+    exclude = set(exclude)
+    # Tree of the directories with their files and the totals of their subtree
+    root = dict(files=[], dirs={}, nfiles=0, nbytes=0)
+    for path, size in zip(table.paths, table.sizes):
+        if path in exclude:
+            continue
+        node = root
+        node['nfiles'] += 1
+        node['nbytes'] += size
+        parts = path.split(os.sep)
+        for part in parts[:-1]:
+            node = node['dirs'].setdefault(part, dict(files=[], dirs={}, nfiles=0, nbytes=0))
+            node['nfiles'] += 1
+            node['nbytes'] += size
+        node['files'].append((path, size))
+
+    chunks, current = [], dict(paths=[], nfiles=0, nbytes=0)
+
+    def fits(nfiles, nbytes, chunk_nfiles=0, chunk_nbytes=0):
+        return ((not max_files or chunk_nfiles + nfiles <= max_files)
+                and (not max_bytes or chunk_nbytes + nbytes <= max_bytes))
+
+    def add(path, nfiles, nbytes):
+        if current['paths'] and not fits(nfiles, nbytes, current['nfiles'], current['nbytes']):
+            chunks.append(current['paths'])
+            current.update(paths=[], nfiles=0, nbytes=0)
+        current['paths'].append(path)
+        current['nfiles'] += nfiles
+        current['nbytes'] += nbytes
+
+    def visit(node, reldir):
+        for path, size in sorted(node['files']):
+            add(path, 1, size)
+        for name, child in sorted(node['dirs'].items()):
+            path = os.path.join(reldir, name) if reldir else name
+            if fits(child['nfiles'], child['nbytes']):
+                # The whole directory fits in a chunk
+                add(path, child['nfiles'], child['nbytes'])
+            else:
+                visit(child, path)
+
+    visit(root, '')
+    if current['paths']:
+        chunks.append(current['paths'])
+    return chunks
+
+
+def load_save_chunks_state(datalad_dataset_dir):
+    """Return the state of an unfinished save in chunks of a Datalad dataset (`None` if there is none).
+
+    A save is unfinished until all its chunks are saved and their commits
+    consolidated. The states recorded without the `"consolidated"` flag
+    are considered consolidated once all their chunks are saved.
+    """
+    try:
+        with open(get_save_chunks_state_file(datalad_dataset_dir), 'r') as f:
+            state = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if state.get('done', 0) < len(state.get('chunks', [])) or state.get('consolidated') is False:
+        return state
+    return None
+
+
+def record_save_chunks_state(datalad_dataset_dir, state):
+    """Record the state of a save in chunks of a Datalad dataset, with the `"message"`, the `"base"` commit, the `"chunks"`, the number of chunks `"done"` and if their commits are `"consolidated"`."""
+    state_file = get_save_chunks_state_file(datalad_dataset_dir)
+    os.makedirs(os.path.dirname(state_file), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(state_file), prefix='.save-chunks.')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(state, f)
+        os.replace(tmp_path, state_file)
+    except BaseException:
+        with contextlib.suppress(OSError):
+            os.remove(tmp_path)
+        raise
+
+
+def consolidate_commits(datalad_dataset_dir, base, message):
+    """
+    Replace the commits made since `base` by a single commit.
+
+    Only the branch is moved (`git reset --soft`): the index, the working
+    tree and the `git-annex` branch are left untouched. A consolidation
+    interrupted after the reset is finished by committing the staged changes.
+
+    Parameters
+    ----------
+    datalad_dataset_dir : string
+        Local path of the Datalad dataset
+
+    base : string
+        Commit before the first commit to consolidate
+
+    message : string
+        Message of the consolidated commit
+
+    Returns
+    -------
+    success : bool
+        `True` if the commits have been consolidated
+    """
+    try:
+        if run('git rev-parse HEAD', cwd=datalad_dataset_dir).stdout.decode().strip() != base:
+            run(f'git reset -q --soft {base}', cwd=datalad_dataset_dir)
+        try:
+            run('git diff --cached --quiet', cwd=datalad_dataset_dir)
+            # Nothing has been committed
+            return True
+        except subprocess.CalledProcessError as e:
+            if e.returncode != 1:
+                raise
+        run('git commit -q --no-verify -F -', cwd=datalad_dataset_dir, input=message.encode())
+    except subprocess.CalledProcessError as e:
+        print(f'\t* WARNING: Consolidation of the commits failed: {e}')
+        return False
+    return True
@@ -0,0 +1,118 @@
+# Copyright © 2021-2022 Connectomics Lab
+# University Hospital Center and University of Lausanne (UNIL-CHUV), Switzerland,
+# and contributors
+#
+#  This software is distributed under the open-source license Apache 2.0.
+
+"""`neurodatapub.utils.compression`: utils functions for the compression of the transfers to the SSH special remote."""
+
+import os
+import zlib
+
+# Suffixes of the files already compressed, transferred without compression
+# (the default list of `rsync` completed with neuroimaging formats)
+DEFAULT_SKIP_COMPRESS = [
+    '7z', 'avi', 'bz2', 'deb', 'gpg', 'gz', 'iso', 'jpeg', 'jpg', 'lz', 'lzma',
+    'lzo', 'mgz', 'mov', 'mp3', 'mp4', 'npz', 'ogg', 'pdf', 'png', 'rar', 'rpm',
+    'tbz', 'tgz', 'tlz', 'txz', 'xz', 'z', 'zip', 'zst'
+]
+
+DEFAULT_COMPRESS_LEVEL = 6
+
+
+def get_compression_policy(config):
+    """
+    Return the compression policy described by the `"transfer_compression"` entry of a special sibling configuration.
+
+    Parameters
+    ----------
+    config : string or dict
+        `"none"` (default), `"auto"` to compress all files except the ones
+        of :data:`DEFAULT_SKIP_COMPRESS`, or a dictionary with optional
+        `"level"` (1 to 9) and `"skip_extensions"` entries
+
+    Returns
+    -------
+    policy : dict
+        Dictionary with the compression `"level"` and the list of
+        suffixes of files not compressed (`"skip"`),
+        or `None` if transfers are not compressed
+    """
+    if not config or config == 'none':
+        return None
+    if config == 'auto':
+        config = {}
+    skip = config.get('skip_extensions', DEFAULT_SKIP_COMPRESS)
+    return dict(
+        level=int(config.get('level', DEFAULT_COMPRESS_LEVEL)),
+        skip=sorted({ext.lstrip('.').lower() for ext in skip})
+    )
+
+
+def get_rsync_compression_options(policy):
+    """Return the `rsync` options implementing a compression policy returned by :func:`get_compression_policy`."""
+    options = f'--compress --compress-level={policy["level"]}'
+    if policy['skip']:
+        options += f' --skip-compress={"/".join(policy["skip"])}'
+    return options
+
+
+def _suffix(path):
+    return os.path.splitext(path)[1].lstrip('.').lower()
+
+
+def estimate_compressed_size(root, files, policy, sample_files=16, sample_bytes=1024 * 1024):
+    """
+    Estimate the number of bytes on the wire of the transfer of files with a compression policy.
+
+    The compression ratio of each file suffix not skipped by the policy
+    is measured by compressing with `zlib` (as `rsync` does) the beginning
+    of a few files of the suffix.
+
+    Parameters
+    ----------
+    root : string
+        Directory of the files
+
+    files : list of (string, int)
+        Relative paths and sizes of the files transferred
+
+    policy : dict
+        Compression policy returned by :func:`get_compression_policy`
+
+    sample_files : int
+        Maximal number of files sampled per suffix (Default: `16`)
+
+    sample_bytes : int
+        Number of bytes read at the beginning of each sampled file (Default: 1 MB)
+
+    Returns
+    -------
+    wire_bytes : int
+        Estimated number of bytes on the wire
+
+    ratios : dict
+        Measured compression ratio (compressed / original size)
+        indexed by the suffixes of the compressed files
+    """
+    sizes, samples = {}, {}
+    for path, size in files:
+        suffix = _suffix(path)
+        sizes[suffix] = sizes.get(suffix, 0) + size
+        if suffix not in policy['skip'] and len(samples.setdefault(suffix, [])) < sample_files:
+            samples[suffix].append(path)
+    ratios = {}
+    for suffix, paths in samples.items():
+        original, compressed = 0, 0
+        for path in paths:
+            try:
+                with open(os.path.join(root, path), 'rb') as f:
+                    data = f.read(sample_bytes)
+            except OSError:
+                continue
+            original += len(data)
+            compressed += len(zlib.compress(data, policy['level']))
+        # Never worse than no compression, as rsync falls back on literal data
+        ratios[suffix] = min(compressed / original, 1.0) if original else 1.0
+    wire_bytes = sum(int(nbytes * ratios.get(suffix, 1.0)) for suffix, nbytes in sizes.items())
+    return wire_bytes, ratios
@@ -7,16 +7,105 @@
 """`neurodatapub.utils.datalad`: utils functions for Datalad."""
 
 import os
+import json
+import shlex
+import subprocess
 import datalad.api
 
+from .gitperf import apply_git_performance_profile
+from .process import run
+
 GITHUB_ORGANIZATION='NCCR-SYNAPSY'
 DEFAULT_SSH_REMOTE_NAME = 'ssh_remote'
 DEFAULT_OSF_REMOTE_NAME = 'osf-storage'
 DEFAULT_DATALAD_SSH_SIBLING_NAME = 'datalad_ssh_sibling'
 
+# Maximal number of paths given to a `datalad push` command run in a subprocess
+PUSH_PATHS_PER_COMMAND = 1000
+
+
+def _run_datalad(command, cwd=None, env=None, result_callback=None, on_failure='continue'):
+    """
+    Run a Datalad command in a subprocess and return its result records.
+
+    Parameters
+    ----------
+    command : string
+        Datalad command and its arguments, without the `datalad` executable
+
+    cwd : string
+        Working directory of the command (Default: `None`)
+
+    env : dict
+        Environment variables set only for the command (Default: `None`)
+
+    result_callback : function
+        Function called with each result record as soon as it
+        is printed by the command (Default: `None`)
+
+    on_failure : {"continue", "ignore"}
+        With `"ignore"`, a command that fails after reporting error
+        results returns them instead of raising (Default: `"continue"`)
+
+    Returns
+    -------
+    records : list of dict
+        Result records of the command
+
+    Raises
+    ------
+    subprocess.CalledProcessError
+        If the command fails, and with `"ignore"` only if
+        it reported no error result
+    """
+    records = []
+
+    def _parse(line):
+        try:
+            record = json.loads(line)
+        except ValueError:
+            return
+        records.append(record)
+        if result_callback is not None:
+            result_callback(record)
+
+    try:
+        run(f'datalad -f json {command}', cwd=cwd, env=env, stdout_callback=_parse)
+    except subprocess.CalledProcessError:
+        if on_failure != 'ignore' or not any(
+            record.get('status') in ['error', 'impossible'] for record in records
+        ):
+            raise
+    return records
+
+
+def get_osf_environment(osf_token):
+    """
+    Return the environment variables that give an OSF token to the commands of a publication.
+
+    `datalad-osf` and the `git-annex` OSF special remote read the token from
+    the `OSF_TOKEN` environment variable. It is set only in the environment
+    of the commands run on the OSF sibling, and never in the environment of
+    the process, such that concurrent publications with different OSF
+    accounts do not share it.
+
+    Parameters
+    ----------
+    osf_token : string
+        Personal OSF access token
+
+    Returns
+    -------
+    env : dict
+        Environment variables to give to :func:`~neurodatapub.utils.process.run`
+    """
+    return {'OSF_TOKEN': osf_token}
+
 
 def create_bids_dataset(
     datalad_dataset_dir,
+    force=False,
+    git_profile=False,
     dryrun=False
 ):
     """
@@ -27,6 +116,15 @@ def create_bids_dataset(
     datalad_dataset_dir : string
         Local path of Datalad dataset to be published
 
+    force : bool
+        If `True`, create the dataset in a non-empty directory,
+        whose content is left untracked (Default: `False`)
+
+    git_profile : bool
+        If `True`, apply the git performance profile to the repository
+        of the dataset (See :func:`neurodatapub.utils.gitperf.apply_git_performance_profile`)
+        (Default: `False`)
+
     dryrun : bool
         If `True`, only generates the commands and
         do not execute them
@@ -49,13 +147,20 @@ def create_bids_dataset(
         res = datalad.api.create(
             dataset=datalad_dataset_dir,
             cfg_proc=['text2git', 'bids'],
+            force=force
         )
-    cmd = f'datalad create -c text2git -c bids "{datalad_dataset_dir}"'
+    cmd = 'datalad create --force' if force else 'datalad create'
+    cmd += f' -c text2git -c bids "{datalad_dataset_dir}"'
+    if git_profile:
+        _, profile_cmd = apply_git_performance_profile(datalad_dataset_dir, dryrun=dryrun)
+        cmd += f' && {profile_cmd}'
     return res, cmd
 
 
 def create_dataset(
     datalad_dataset_dir,
+    force=False,
+    git_profile=False,
     dryrun=False
 ):
     """
@@ -66,6 +171,15 @@ def create_dataset(
     datalad_dataset_dir : string
         Local path of Datalad dataset to be published
 
+    force : bool
+        If `True`, create the dataset in a non-empty directory,
+        whose content is left untracked (Default: `False`)
+
+    git_profile : bool
+        If `True`, apply the git performance profile to the repository
+        of the dataset (See :func:`neurodatapub.utils.gitperf.apply_git_performance_profile`)
+        (Default: `False`)
+
     dryrun : bool
         If `True`, only generates the commands and
         do not execute them
@@ -88,8 +202,13 @@ def create_dataset(
         res = datalad.api.create(
             dataset=datalad_dataset_dir,
             cfg_proc=['text2git'],
+            force=force
         )
-    cmd = f'datalad create -c text2git "{datalad_dataset_dir}"'
+    cmd = 'datalad create --force' if force else 'datalad create'
+    cmd += f' -c text2git "{datalad_dataset_dir}"'
+    if git_profile:
+        _, profile_cmd = apply_git_performance_profile(datalad_dataset_dir, dryrun=dryrun)
+        cmd += f' && {profile_cmd}'
     return res, cmd
 
 
@@ -154,7 +273,11 @@ def create_github_sibling(
     dryrun=False
 ):
     """
-    Function that creates the GitHub dataset repository siblings via `datalad.api.create_sibling_github()`.
+    Function that creates the GitHub dataset repository siblings via `datalad create-sibling-github`.
+
+    The command is run in the dataset, such that Datalad authenticates with
+    the token set in its repository configuration (`hub.oauthtoken`) by
+    :func:`neurodatapub.utils.github.authenticate_github_token`.
 
     Parameters
     ----------
@@ -182,30 +305,23 @@ def create_github_sibling(
 
     Returns
     -------
-    `res` : string
-        Output of `datalad.api.create_sibling_github()
+    `res` : list of dict
+        Result records of `datalad create-sibling-github`
 
     `cmd` : string
         Equivalent bash command
     """
+    command = 'create-sibling-github \\\n\t'
+    command += f'--dataset "{datalad_dataset_dir}" \\\n\t'
+    command += f'--publish-depends {gitannex_remote_name} \\\n\t'
+    command += f'--github-login {github_sibling_args["github_login"]} \\\n\t'
+    command += f'--github-organization {github_sibling_args["github_organization"]} \\\n\t'
+    command += '--existing skip \\\n\t'
+    command += f'--private {github_sibling_args["github_repo_name"]}'
     res = None
     if not dryrun:
-        res = datalad.api.create_sibling_github(
-            reponame=github_sibling_args["github_repo_name"],
-            github_login=github_sibling_args["github_login"],
-            github_organization=github_sibling_args["github_organization"],
-            publish_depends=gitannex_remote_name,
-            private=True,
-            dataset=datalad_dataset_dir,
-            existing='skip'
-        )
-    cmd = 'datalad create-sibling-github \\\n\t'
-    cmd += f'--dataset "{datalad_dataset_dir}" \\\n\t'
-    cmd += f'--publish-depends {gitannex_remote_name} \\\n\t'
-    cmd += f'--github-login {github_sibling_args["github_login"]} \\\n\t'
-    cmd += f'--github-organization {github_sibling_args["github_organization"]} \\\n\t'
-    cmd += f'--private {github_sibling_args["github_repo_name"]}'
-    return res, cmd
+        res = _run_datalad(command, cwd=datalad_dataset_dir)
+    return res, f'datalad {command}'
 
 
 def authenticate_osf(
@@ -215,6 +331,12 @@ def authenticate_osf(
     """
     Function that initialize the authentication to OSF using a personnal OSF TOKEN.
 
+    When executed, the token is not stored in the keyring of the user, as
+    it would be shared by all publications: the commands run on the OSF sibling
+    are instead given the token in their own environment (See
+    :func:`get_osf_environment`). The equivalent command stores the token
+    with `datalad osf-credentials` for the steps of the generated script.
+
     Parameters
     ----------
     osf_token : string
@@ -229,21 +351,14 @@ def authenticate_osf(
 
     Returns
     -------
-    `res` : string
-        Output of ` datalad.api.osf_credentials()`
+    `res` : None
+        Nothing is executed, the token being given to the
+        commands run on the OSF sibling by :func:`get_osf_environment`
 
     `cmd` : string
         Equivalent bash command
     """
-    # Set OSF_TOKEN and reload datalad.api module
-    os.environ['OSF_TOKEN'] = osf_token
     res = None
-    if not dryrun:
-        # OSF credentials
-        res = datalad.api.osf_credentials(
-            method='token',
-            reset=False
-        )
     cmd = f'export OSF_TOKEN="{osf_token}"\n'
     cmd += 'datalad osf-credentials --method token  --reset'
     return res, cmd
@@ -253,10 +368,11 @@ def create_osf_sibling(
     dataset_dir,
     datalad_dataset_dir,
     osf_dataset_title,
+    osf_token=None,
     dryrun=False
 ):
     """
-    Function that creates the OSF dataset repository sibling via `datalad.api.create_sibling_osf()` of the `datalad-osf` extension.
+    Function that creates the OSF dataset repository sibling via `datalad create-sibling-osf` of the `datalad-osf` extension.
 
     Parameters
     ----------
@@ -269,6 +385,11 @@ def create_osf_sibling(
     osf_dataset_title : string
         Title of the dataset on OSF
 
+    osf_token : string
+        Personal OSF access token, given only to
+        the command (See :func:`get_osf_environment`)
+        (Default: `None`)
+
     dryrun : bool
         If `True`, only generates the commands and
         do not execute them
@@ -276,8 +397,8 @@ def create_osf_sibling(
 
     Returns
     -------
-    `res` : string
-        Output of `datalad.api.create_sibling_osf()
+    `res` : list of dict
+        Result records of `datalad create-sibling-osf`
 
     `cmd` : string
         Equivalent bash command
@@ -291,46 +412,71 @@ def create_osf_sibling(
     else:
         dataset_description = None
 
+    # Create the OSF sibling.
+    # If the sibling is existing, this will be skipped.
+    command = 'create-sibling-osf \\\n\t'
+    command += f'--dataset "{datalad_dataset_dir}" \\\n\t'
+    command += f'--title {shlex.quote(osf_dataset_title)} \\\n\t'
+    command += '-s osf \\\n\t'
+    command += '--mode annex \\\n\t'
+    command += '--existing skip \\\n\t'
+    command += '--tag neuroimaging \\\n\t'
+    command += '--category data'
+    if dataset_description is not None:
+        command += f' \\\n\t--description {shlex.quote(dataset_description)}'
     res = None
     if not dryrun:
-        # Create the OSF sibling.
-        # If the sibling is existing, this will be skipped.
-        res = datalad.api.create_sibling_osf(
-            title=osf_dataset_title,
-            name='osf',
-            dataset=datalad_dataset_dir,
-            mode='annex',
-            existing='skip',
-            trust_level=None,
-            tags='neuroimaging',
-            public=False,
-            category='data',
-            description=dataset_description
+        res = _run_datalad(
+            command,
+            env=get_osf_environment(osf_token) if osf_token else None
         )
-    cmd = 'datalad create-sibling-osf \\\n\t'
-    cmd += f'--dataset "{datalad_dataset_dir}" \\\n\t'
-    cmd += f'--title "{osf_dataset_title}" \\\n\t'
-    cmd += '-s osf \\\n\t'
-    cmd += '--mode annex \\\n\t'
-    cmd += '--existing skip \\\n\t'
-    cmd += '--tag neuroimaging \\\n\t'
-    cmd += '--category data \\\n\t'
-    cmd += f'--description "{dataset_description}"\n\t'
-    return res, cmd
+    return res, f'datalad {command}'
 
 
 def publish_dataset(
     datalad_dataset_dir,
+    jobs='auto',
+    result_callback=None,
+    paths=None,
+    since=None,
+    env=None,
     dryrun=False
 ):
     """
     Function that publishes the dataset repository to GitHub and the annexed files to a SSH special remote.
 
+    If environment variables are given, e.g. the credentials of the special
+    remote, the push is run by `datalad push` commands in subprocesses
+    having them in their environment, and in process otherwise. In both
+    cases, failed transfers are returned as results with an error status
+    and do not raise.
+
     Parameters
     ----------
     datalad_dataset_dir : string
         Local path of Datalad dataset to be published
 
+    jobs : int or string
+        Number of parallel jobs used by `datalad push`
+        (Default: `"auto"`)
+
+    result_callback : function
+        Function called with each result record of `datalad.api.push()`
+        as soon as it is generated
+        (Default: `None`)
+
+    paths : list of string
+        If given, only the annexed content of these paths is pushed,
+        and nothing if it is empty (Default: `None`, all paths)
+
+    since : string
+        If given, only the changes made since this commit
+        are considered for the push (Default: `None`)
+
+    env : dict
+        Environment variables set only for the push,
+        e.g. from :func:`get_osf_environment` (Default: `None`)
+
     dryrun : bool
         If `True`, only generates the commands and
         do not execute them
@@ -338,17 +484,46 @@ def publish_dataset(
 
     Returns
     -------
-    `res` : string
-        Output of `datalad.api.publish()
+    `res` : list of dict
+        Result records of `datalad.api.push()`
 
     `cmd` : string
         Equivalent bash command
     """
+    command = f'push --dataset "{datalad_dataset_dir}" --to github -J "{jobs}"'
+    if since:
+        command += f' --since {since}'
     res = None
-    if not dryrun:
-        res = datalad.api.push(
+    if paths is not None and not paths:
+        # An empty selection has nothing to push
+        return ([] if not dryrun else None), f'# Nothing selected to push (datalad {command})'
+    if not dryrun and env is not None:
+        res = []
+        if paths is None:
+            res = _run_datalad(command, env=env, result_callback=result_callback, on_failure='ignore')
+        for i in range(0, len(paths or []), PUSH_PATHS_PER_COMMAND):
+            chunk = paths[i:i + PUSH_PATHS_PER_COMMAND]
+            res += _run_datalad(
+                command + ' -- ' + ' '.join(shlex.quote(path) for path in chunk),
+                env=env,
+                result_callback=result_callback,
+                on_failure='ignore'
+            )
+    elif not dryrun:
+        res = []
+        for result in datalad.api.push(
             dataset=datalad_dataset_dir,
-            to='github'
-        )
-    cmd = f'datalad push --dataset "{datalad_dataset_dir}" --to github'
+            to='github',
+            path=paths,
+            since=since,
+            jobs=jobs,
+            on_failure='ignore',
+            return_type='generator'
+        ):
+            res.append(result)
+            if result_callback is not None:
+                result_callback(result)
+    cmd = f'datalad {command}'
+    if paths:
+        cmd += ' -- ' + ' '.join(f'"{path}"' for path in paths)
     return res, cmd
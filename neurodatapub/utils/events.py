@@ -0,0 +1,427 @@
+# Copyright © 2021-2022 Connectomics Lab
+# University Hospital Center and University of Lausanne (UNIL-CHUV), Switzerland,
+# and contributors
+#
+#  This software is distributed under the open-source license Apache 2.0.
+
+"""`neurodatapub.utils.events`: progress events emitted by a `NeuroDataPubProject` and their event bus."""
+
+import time
+import queue
+import threading
+
+
+class Event(object):
+
+    """Base class of the events emitted by a :class:`EventBus`.
+
+    Attributes
+    ----------
+    time : float
+        Time of the event in seconds since the epoch
+    """
+
+    __slots__ = ('time',)
+
+    def __init__(self):
+        """Constructor of :class:`Event` object."""
+        self.time = time.time()
+
+    def __repr__(self):
+        """Define how an event is rendered in `print()`."""
+        attrs = ', '.join(
+            f'{name}={getattr(self, name)!r}'
+            for cls in type(self).__mro__ for name in getattr(cls, '__slots__', ())
+        )
+        return f'{type(self).__name__}({attrs})'
+
+
+class CoalescedEvent(Event):
+
+    """Base class of the high-rate events that can be coalesced by a :class:`EventBus`.
+
+    Coalesced events emitted within the coalescing interval of the bus
+    are merged into a single event before being dispatched.
+    """
+
+    __slots__ = ()
+
+    def coalesce_key(self):
+        """Return the key identifying the events that can be merged together."""
+        return type(self)
+
+    def merge(self, other):
+        """Merge a more recent event of the same key into this event."""
+        raise NotImplementedError
+
+
+class StageStarted(Event):
+
+    """Event emitted when a stage starts.
+
+    Attributes
+    ----------
+    stage : string
+        Name of the stage
+    """
+
+    __slots__ = ('stage',)
+
+    def __init__(self, stage):
+        """Constructor of :class:`StageStarted` object."""
+        super().__init__()
+        self.stage = stage
+
+
+class StageFinished(Event):
+
+    """Event emitted when a stage ends.
+
+    Attributes
+    ----------
+    stage : string
+        Name of the stage
+
+    success : bool
+        `True` if the stage completed without exception
+
+    duration : float
+        Duration of the stage in seconds
+    """
+
+    __slots__ = ('stage', 'success', 'duration')
+
+    def __init__(self, stage, success, duration):
+        """Constructor of :class:`StageFinished` object."""
+        super().__init__()
+        self.stage = stage
+        self.success = success
+        self.duration = duration
+
+
+class _FileCounterEvent(CoalescedEvent):
+
+    """Base class of the events counting files and bytes.
+
+    Attributes
+    ----------
+    path : string
+        Path of the (last) file
+
+    nbytes : int
+        Number of bytes
+
+    count : int
+        Number of files (greater than 1 if events have been coalesced)
+    """
+
+    __slots__ = ('path', 'nbytes', 'count')
+
+    def __init__(self, path, nbytes=0, count=1):
+        """Constructor of the event."""
+        super().__init__()
+        self.path = path
+        self.nbytes = nbytes
+        self.count = count
+
+    def merge(self, other):
+        """Accumulate the counts of a more recent event."""
+        self.path = other.path
+        self.nbytes += other.nbytes
+        self.count += other.count
+        self.time = other.time
+
+
+class FileCopied(_FileCounterEvent):
+
+    """Event emitted when a file of the input dataset has been copied to the Datalad dataset."""
+
+    __slots__ = ()
+
+
+class KeyHashed(_FileCounterEvent):
+
+    """Event emitted when a file has been hashed and added to the annex of the Datalad dataset."""
+
+    __slots__ = ()
+
+
+class KeyTransferred(_FileCounterEvent):
+
+    """Event emitted when the content of an annexed file has been transferred to a remote.
+
+    Attributes
+    ----------
+    remote : string
+        Name of the remote
+    """
+
+    __slots__ = ('remote',)
+
+    def __init__(self, path, remote=None, nbytes=0, count=1):
+        """Constructor of :class:`KeyTransferred` object."""
+        super().__init__(path=path, nbytes=nbytes, count=count)
+        self.remote = remote
+
+    def coalesce_key(self):
+        """Events are only merged for the same remote."""
+        return (type(self), self.remote)
+
+
+class Progress(CoalescedEvent):
+
+    """Event emitted to report the progress of a stage.
+
+    Attributes
+    ----------
+    stage : string
+        Name of the stage (`"copy"`, `"save"` or `"push"`)
+
+    completed : int
+        Number of files processed
+
+    total : int
+        Total number of files to process (`0` if unknown)
+
+    completed_bytes : int
+        Number of bytes processed
+
+    total_bytes : int
+        Total number of bytes to process (`0` if unknown)
+    """
+
+    __slots__ = ('stage', 'completed', 'total', 'completed_bytes', 'total_bytes')
+
+    def __init__(self, stage, completed, total, completed_bytes=0, total_bytes=0):
+        """Constructor of :class:`Progress` object."""
+        super().__init__()
+        self.stage = stage
+        self.completed = completed
+        self.total = total
+        self.completed_bytes = completed_bytes
+        self.total_bytes = total_bytes
+
+    def coalesce_key(self):
+        """Events are only merged for the same stage."""
+        return (type(self), self.stage)
+
+    def merge(self, other):
+        """Keep the most recent progress."""
+        for name in self.__slots__:
+            setattr(self, name, getattr(other, name))
+        self.time = other.time
+
+
+class Error(Event):
+
+    """Event emitted when an error occurs.
+
+    Attributes
+    ----------
+    stage : string
+        Name of the stage in which the error occurred
+
+    message : string
+        Error message
+
+    path : string
+        Path of the file concerned by the error if any
+    """
+
+    __slots__ = ('stage', 'message', 'path')
+
+    def __init__(self, stage, message, path=None):
+        """Constructor of :class:`Error` object."""
+        super().__init__()
+        self.stage = stage
+        self.message = message
+        self.path = path
+
+
+class EventBus(object):
+
+    """Thread-safe bus dispatching events to the subscribed callbacks.
+
+    Emitting an event is a no-op when nobody listens, and high-rate
+    events (:class:`CoalescedEvent`) are merged and dispatched at most
+    once per coalescing interval.
+
+    Attributes
+    ----------
+    coalesce_interval : float
+        Minimal time in seconds between two dispatches of
+        coalesced events. `0` disables coalescing
+        (Default: `0.1`)
+
+    Examples
+    --------
+    >>> bus = EventBus()
+    >>> token = bus.subscribe(print, kinds=(StageStarted, StageFinished))
+    >>> bus.emit(StageStarted('copy')) # doctest: +SKIP
+    StageStarted(time=..., stage='copy')
+    >>> bus.unsubscribe(token)
+    """
+
+    def __init__(self, coalesce_interval=0.1):
+        """Constructor of :class:`EventBus` object."""
+        self.coalesce_interval = coalesce_interval
+        self._subscribers = {}
+        self._next_token = 0
+        self._pending = {}
+        self._last_flush = 0
+        self._lock = threading.RLock()
+
+    @property
+    def listening(self):
+        """`True` if at least one callback is subscribed.
+
+        It can be used to skip the creation of events on hot paths.
+        """
+        return bool(self._subscribers)
+
+    def subscribe(self, callback, kinds=None):
+        """
+        Subscribe a callback to the events of the bus.
+
+        Parameters
+        ----------
+        callback : function
+            Function called with each event
+
+        kinds : tuple of Event subclasses
+            If given, only the events of these types are dispatched to the callback
+            (Default: `None`)
+
+        Returns
+        -------
+        token : int
+            Token to be given to `unsubscribe()`
+        """
+        with self._lock:
+            token = self._next_token
+            self._next_token += 1
+            # Copy on write such that dispatch does not need the lock
+            subscribers = dict(self._subscribers)
+            subscribers[token] = (callback, kinds)
+            self._subscribers = subscribers
+        return token
+
+    def unsubscribe(self, token):
+        """Unsubscribe the callback identified by `token`."""
+        with self._lock:
+            subscribers = dict(self._subscribers)
+            subscribers.pop(token, None)
+            self._subscribers = subscribers
+
+    def emit(self, event):
+        """
+        Emit an event.
+
+        Coalesced events are merged with the pending events of the same
+        key and dispatched when the coalescing interval has elapsed.
+        Other events first flush the pending events to preserve ordering.
+
+        Parameters
+        ----------
+        event : Event
+            Event to be dispatched
+        """
+        if not self._subscribers:
+            return
+        if self.coalesce_interval and isinstance(event, CoalescedEvent):
+            with self._lock:
+                key = event.coalesce_key()
+                pending = self._pending.get(key)
+                if pending is None:
+                    self._pending[key] = event
+                else:
+                    pending.merge(event)
+                if event.time - self._last_flush < self.coalesce_interval:
+                    return
+            self.flush()
+            return
+        self.flush()
+        self._dispatch(event)
+
+    def flush(self):
+        """Dispatch the pending coalesced events."""
+        with self._lock:
+            pending = list(self._pending.values())
+            self._pending = {}
+            self._last_flush = time.time()
+            for event in pending:
+                self._dispatch(event)
+
+    def _dispatch(self, event):
+        for callback, kinds in self._subscribers.values():
+            if kinds is None or isinstance(event, kinds):
+                try:
+                    callback(event)
+                except Exception as e:
+                    print(f'\t* WARNING: Event callback {callback} failed: {e}')
+
+    def stream(self, kinds=None):
+        """
+        Return an iterable over the events emitted from now on.
+
+        Parameters
+        ----------
+        kinds : tuple of Event subclasses
+            If given, only the events of these types are streamed
+            (Default: `None`)
+
+        Returns
+        -------
+        stream : EventStream
+            Iterable of events, to be closed with `close()` or used as
+            a context manager
+
+        Examples
+        --------
+        >>> with project.events.stream() as events: # doctest: +SKIP
+        ...     for event in events:
+        ...         print(event)
+        """
+        return EventStream(self, kinds=kinds)
+
+
+class EventStream(object):
+
+    """Iterable over the events dispatched by a :class:`EventBus`.
+
+    Events are queued as soon as the stream is created, so that it can be
+    consumed from a thread different from the one emitting the events.
+    Iteration ends when the stream is closed.
+    """
+
+    _CLOSED = object()
+
+    def __init__(self, bus, kinds=None):
+        """Constructor of :class:`EventStream` object."""
+        self._bus = bus
+        self._queue = queue.Queue()
+        self._token = bus.subscribe(self._queue.put, kinds=kinds)
+
+    def close(self):
+        """Stop receiving events and end the iteration once the queued events have been consumed."""
+        if self._token is not None:
+            self._bus.flush()
+            self._bus.unsubscribe(self._token)
+            self._token = None
+            self._queue.put(self._CLOSED)
+
+    def __iter__(self):
+        """Yield the events until the stream is closed."""
+        while True:
+            event = self._queue.get()
+            if event is self._CLOSED:
+                return
+            yield event
+
+    def __enter__(self):
+        """Enter the context of the stream."""
+        return self
+
+    def __exit__(self, *args):
+        """Close the stream when exiting its context."""
+        self.close()
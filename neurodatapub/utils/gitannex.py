@@ -6,9 +6,14 @@
 
 """`neurodatapub.utils.gitannex`: utils functions for Git-annex."""
 
+import shlex
+
 from .datalad import DEFAULT_SSH_REMOTE_NAME
 from .process import run
 
+# File listing the keys present in a shared store, at the root of the store
+SHARED_STORE_INDEX = '.neurodatapub-keys'
+
 
 def init_ssh_special_sibling(
     datalad_dataset_dir,
@@ -33,6 +38,10 @@ def init_ssh_special_sibling(
                 'remote_sibling_dir': "/path/to/remote/sibling/directory/.git"
             }
 
+        If it has a `'remote_shared_store_dir'` entry, the annexed files are
+        stored in this directory shared by several datasets with a `type=rsync`
+        special remote instead of the annex of the remote sibling.
+
     ssh_special_sibling_name : string
         Name of the created special remote sibling
 
@@ -52,9 +61,16 @@ def init_ssh_special_sibling(
     # Create the git annex command
     cmd = 'git annex initremote '
     cmd += f'{ssh_special_sibling_name} '
-    cmd += 'type=git '
-    cmd += f'location={ssh_special_sibling_args["remote_ssh_url"]}'
-    cmd += f'{ssh_special_sibling_args["remote_sibling_dir"]} '
+    if ssh_special_sibling_args.get("remote_shared_store_dir"):
+        # The objects are stored by key: the store is shared between datasets
+        cmd += 'type=rsync '
+        cmd += f'rsyncurl={ssh_special_sibling_args["remote_ssh_url"].replace("ssh://", "")}:'
+        cmd += f'{ssh_special_sibling_args["remote_shared_store_dir"]} '
+        cmd += 'encryption=none '
+    else:
+        cmd += 'type=git '
+        cmd += f'location={ssh_special_sibling_args["remote_ssh_url"]}'
+        cmd += f'{ssh_special_sibling_args["remote_sibling_dir"]} '
     cmd += 'autoenable=true'
 
     proc = None
@@ -113,3 +129,211 @@ def enable_ssh_special_sibling(
             print(e)
             return None, cmd
     return proc, cmd
+
+
+def configure_rsync_options(
+    datalad_dataset_dir,
+    rsync_options,
+    ssh_special_sibling_name=DEFAULT_SSH_REMOTE_NAME,
+    dryrun=False
+):
+    """
+    Function that sets the `rsync` options used by git-annex for the transfers to a remote.
+
+    Parameters
+    ----------
+    datalad_dataset_dir : string
+        Local path of Datalad dataset to be published
+
+    rsync_options : string
+        Options passed to `rsync`, e.g. as returned by
+        :func:`neurodatapub.utils.compression.get_rsync_compression_options`
+
+    ssh_special_sibling_name : string
+        Name of the special remote sibling
+
+    dryrun : bool
+        If `True`, only generates the commands and
+        do not execute them
+        (Default: `False`)
+
+    Returns
+    -------
+    proc : string
+        Output of `subprocess.run()`
+
+    cmd : string
+        Equivalent output command
+    """
+    cmd = f'git config remote.{ssh_special_sibling_name}.annex-rsync-options "{rsync_options}"'
+
+    proc = None
+    if not dryrun:
+        try:
+            print(f'... cmd: {cmd}')
+            proc = run(cmd, cwd=f'{datalad_dataset_dir}')
+        except Exception as e:
+            print('Failed')
+            print(e)
+            return None, cmd
+    return proc, cmd
+
+
+def get_annexed_content_not_in_remote(
+    datalad_dataset_dir,
+    remote_name
+):
+    """
+    Return the number and total size of annexed files not yet present in a git-annex remote.
+
+    Parameters
+    ----------
+    datalad_dataset_dir : string
+        Local path of Datalad dataset to be published
+
+    remote_name : string
+        Name of the git-annex remote
+
+    Returns
+    -------
+    nb_files : int
+        Number of annexed files whose content is not known to be in the remote
+
+    nb_bytes : int
+        Total size in bytes of the content of these files
+    """
+    cmd = f'git annex find --not --in={remote_name} '
+    cmd += "--format='${bytesize}\\n'"
+    nb_files, nb_bytes = 0, 0
+    try:
+        proc = run(cmd, cwd=f'{datalad_dataset_dir}')
+    except Exception as e:
+        print(f'\t* WARNING: Could not query the content of {remote_name}: {e}')
+        return nb_files, nb_bytes
+    for line in proc.stdout.decode().splitlines():
+        nb_files += 1
+        if line.strip().isdigit():
+            nb_bytes += int(line)
+    return nb_files, nb_bytes
+
+
+def _run_in_shared_store(sshurl, store_dir, script, input=None):
+    """Run a shell script on the server of a shared store (locally if `sshurl` is `None`), serialized with a lock of the store."""
+    lock = f'{store_dir}/{SHARED_STORE_INDEX}.lock'
+    remote_cmd = (f'mkdir -p {shlex.quote(store_dir)} && '
+                  f'flock {shlex.quote(lock)} sh -c {shlex.quote(script)}')
+    if sshurl is None:
+        return run(remote_cmd, input=input)
+    host = sshurl.replace('ssh://', '')
+    return run(f'ssh -o BatchMode=yes {host} {shlex.quote(remote_cmd)}', input=input)
+
+
+def get_shared_store_keys(sshurl, store_dir):
+    """
+    Return the keys present in a shared store of a SSH server.
+
+    The keys are read from the index of the store (:data:`SHARED_STORE_INDEX`),
+    which is built by listing the store if it does not exist yet.
+
+    Parameters
+    ----------
+    sshurl : string
+        SSH URL of the server in the form `ssh://server.example.org`,
+        or `None` for a local store
+
+    store_dir : string
+        Remote absolute path of the shared store
+
+    Returns
+    -------
+    keys : set of string
+        Keys present in the store (empty if the store could not be queried)
+    """
+    index = shlex.quote(f'{store_dir}/{SHARED_STORE_INDEX}')
+    # Objects are stored as <hashdirs>/<key>/<key>, temporary files start with "."
+    script = (f'if [ ! -f {index} ]; then '
+              f'find {shlex.quote(store_dir)} -mindepth 1 -type f ! -name ".*" -printf "%f\\n" '
+              f'> {index}.tmp && mv {index}.tmp {index}; fi; cat {index}')
+    try:
+        proc = _run_in_shared_store(sshurl, store_dir, script)
+    except Exception as e:
+        print(f'\t* WARNING: Could not read the index of the shared store {store_dir}: {e}')
+        return set()
+    return set(proc.stdout.decode().split())
+
+
+def record_shared_store_keys(sshurl, store_dir, keys):
+    """
+    Add keys uploaded to a shared store to its index.
+
+    Parameters
+    ----------
+    sshurl : string
+        SSH URL of the server in the form `ssh://server.example.org`,
+        or `None` for a local store
+
+    store_dir : string
+        Remote absolute path of the shared store
+
+    keys : iterable of string
+        Keys uploaded to the store
+    """
+    keys = sorted(keys)
+    if not keys:
+        return
+    index = shlex.quote(f'{store_dir}/{SHARED_STORE_INDEX}')
+    try:
+        _run_in_shared_store(
+            sshurl, store_dir, f'cat >> {index}',
+            input=''.join(f'{key}\n' for key in keys).encode()
+        )
+    except Exception as e:
+        print(f'\t* WARNING: Could not update the index of the shared store {store_dir}: {e}')
+
+
+def get_keys_in_remote(datalad_dataset_dir, remote_name, present=True):
+    """Return the keys of the annexed files of the dataset present (or not if `present` is `False`) in a remote."""
+    cmd = f'git annex find {"--in" if present else "--not --in"}={remote_name} '
+    cmd += "--format='${key}\\n'"
+    proc = run(cmd, cwd=f'{datalad_dataset_dir}')
+    return set(proc.stdout.decode().split())
+
+
+def mark_keys_present_in_remote(datalad_dataset_dir, keys, remote_name):
+    """
+    Record in the git-annex location log that keys are present in a remote.
+
+    It is used for the keys already uploaded to a shared store by other
+    datasets, such that they are not uploaded again.
+
+    Parameters
+    ----------
+    datalad_dataset_dir : string
+        Local path of Datalad dataset to be published
+
+    keys : set of string
+        Keys present in the remote
+
+    remote_name : string
+        Name of the git-annex remote
+
+    Returns
+    -------
+    nb_keys : int
+        Number of keys of the dataset newly marked as present in the remote
+    """
+    try:
+        missing = get_keys_in_remote(datalad_dataset_dir, remote_name, present=False) & keys
+        if not missing:
+            return 0
+        proc = run(f'git config --get remote.{remote_name}.annex-uuid', cwd=f'{datalad_dataset_dir}')
+        uuid = proc.stdout.decode().strip()
+        run(
+            'git annex setpresentkey --batch',
+            cwd=f'{datalad_dataset_dir}',
+            input=''.join(f'{key} {uuid} 1\n' for key in sorted(missing)).encode()
+        )
+    except Exception as e:
+        print(f'\t* WARNING: Could not mark the keys present in {remote_name}: {e}')
+        return 0
+    return len(missing)
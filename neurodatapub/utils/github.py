@@ -7,6 +7,7 @@
 """`neurodatapub.utils.github`: utils functions for authentication to Github."""
 
 from .process import run
+from .redact import redact_secrets
 
 
 def authenticate_github_token(
@@ -18,6 +19,9 @@ def authenticate_github_token(
     Function that configure Git's `hub.oauthtoken` with the provided token.
 
     It is used by Datalad/Git for authentication to GitHub [1]_.
+    The token is set in the configuration of the Datalad dataset repository
+    only, such that datasets published under different accounts do not
+    clobber each other.
 
     .. [1] `Datalad Handbook "8.3.4 Publish the dataset" <https://handbook.datalad.org/en/latest/basics/101-139-s3.html#publish-the-dataset>`_
 
@@ -39,19 +43,20 @@ def authenticate_github_token(
     proc : string
         Output of `subprocess.run()`
     """
-    # Create the git config command to add and set hub.oauthtoken
-    cmd = 'git config --global --add hub.oauthtoken '
+    # Create the git config command to set hub.oauthtoken
+    # (replacing any previous value) in the repository configuration
+    cmd = f'git -C "{datalad_dataset_dir}" config --local --replace-all hub.oauthtoken '
     cmd += f'{github_token}'
 
     proc = None
     if not dryrun:
         # Execute the git config command in the dataset directory
         try:
-            print(f'... cmd: {cmd}')
+            print(f'... cmd: {redact_secrets(cmd)}')
             proc = run(cmd, cwd=f'{datalad_dataset_dir}')
         except Exception as e:
             print('Failed')
-            print(e)
+            print(redact_secrets(str(e)))
             return None, cmd
     return proc, cmd
 
@@ -65,6 +70,7 @@ def authenticate_github_email(
     Function that configure Git's `user.email` with the provided email.
 
     It is used by GitHub to to associate commits with your GitHub account [2]_.
+    The email is set in the configuration of the Datalad dataset repository only.
 
     .. [2] `GitHub "About commit email addresses" <https://docs.github.com/en/account-and-profile/setting-up-and-managing-your-github-user-account/managing-email-preferences/setting-your-commit-email-address#about-commit-email-addresses>`_
 
@@ -89,8 +95,8 @@ def authenticate_github_email(
     cmd : string
         Equivalent output command
     """
-    # Create the git config command to set user.email
-    cmd = 'git config --global user.email '
+    # Create the git config command to set user.email in the repository configuration
+    cmd = f'git -C "{datalad_dataset_dir}" config --local user.email '
     cmd += f'{github_email}'
 
     proc = None
@@ -0,0 +1,193 @@
+# Copyright © 2021-2022 Connectomics Lab
+# University Hospital Center and University of Lausanne (UNIL-CHUV), Switzerland,
+# and contributors
+#
+#  This software is distributed under the open-source license Apache 2.0.
+
+"""`neurodatapub.utils.gitperf`: utils functions to tune the performance of the git repository of a Datalad dataset."""
+
+import re
+import sys
+import time
+import statistics
+import subprocess
+
+from .process import run
+
+# Configuration of the repositories with many files stored in git
+GIT_PERFORMANCE_PROFILE = {
+    # Smaller index, with the paths prefix-compressed
+    'index.version': '4',
+    # Only the changes of the index are written, in a separate file
+    'core.splitIndex': 'true',
+    # `git status` only lists again the directories modified since its last run
+    'core.untrackedCache': 'true',
+    # The history is walked with the commit-graph file
+    'core.commitGraph': 'true',
+    'fetch.writeCommitGraph': 'true',
+    'gc.writeCommitGraph': 'true',
+    # Packing uses all cores and reachability bitmaps
+    'pack.threads': '0',
+    'pack.useSparse': 'true',
+    'repack.writeBitmaps': 'true'
+}
+
+# Tasks of `git maintenance run` before a push
+GIT_MAINTENANCE_TASKS = ['loose-objects', 'incremental-repack', 'commit-graph']
+
+# Minimal version of git with the builtin file system monitor
+FSMONITOR_MIN_VERSION = (2, 36)
+
+
+def get_git_version():
+    """Return the version of git as a tuple of integers (`(0,)` if it cannot be found)."""
+    try:
+        proc = run('git --version')
+    except (OSError, subprocess.CalledProcessError):
+        return (0,)
+    match = re.search(r'(\d+)\.(\d+)(?:\.(\d+))?', proc.stdout.decode())
+    return tuple(int(part) for part in match.groups() if part is not None) if match else (0,)
+
+
+def is_fsmonitor_available():
+    """Return `True` if the builtin file system monitor of git is available (macOS and Windows)."""
+    return sys.platform in ('darwin', 'win32') and get_git_version() >= FSMONITOR_MIN_VERSION
+
+
+def get_git_performance_profile(fsmonitor=None):
+    """
+    Return the configuration of the git performance profile.
+
+    Parameters
+    ----------
+    fsmonitor : bool
+        If `True`, the builtin file system monitor is enabled (`core.fsmonitor`).
+        If `None`, it is enabled where available (Default: `None`)
+
+    Returns
+    -------
+    profile : dict
+        Values of the git configuration indexed by name
+    """
+    profile = dict(GIT_PERFORMANCE_PROFILE)
+    if fsmonitor is None:
+        fsmonitor = is_fsmonitor_available()
+    if fsmonitor:
+        profile['core.fsmonitor'] = 'true'
+    return profile
+
+
+def apply_git_performance_profile(datalad_dataset_dir, fsmonitor=None, dryrun=False):
+    """
+    Apply the git performance profile to the repository of a Datalad dataset.
+
+    The configuration is written in the repository (`git config`) and
+    the index is converted right away (`git update-index`).
+
+    Parameters
+    ----------
+    datalad_dataset_dir : string
+        Local path of the Datalad dataset
+
+    fsmonitor : bool
+        See :func:`get_git_performance_profile` (Default: `None`)
+
+    dryrun : bool
+        If `True`, only generates the commands and
+        do not execute them
+        (Default: `False`)
+
+    Returns
+    -------
+    `res` : subprocess.CompletedProcess
+        Result of the last command
+
+    `cmd` : string
+        Equivalent bash command
+    """
+    profile = get_git_performance_profile(fsmonitor)
+    cmds = [f'git config {name} {value}' for name, value in profile.items()]
+    cmds.append('git update-index --index-version 4 --split-index --untracked-cache')
+    res = None
+    if not dryrun:
+        for cmd in cmds:
+            res = run(cmd, cwd=datalad_dataset_dir)
+    return res, f'cd "{datalad_dataset_dir}" && ' + ' && '.join(cmds)
+
+
+def validate_git_performance_profile(datalad_dataset_dir, fsmonitor=None):
+    """
+    Check that the git performance profile is applied to the repository of a Datalad dataset.
+
+    Parameters
+    ----------
+    datalad_dataset_dir : string
+        Local path of the Datalad dataset
+
+    fsmonitor : bool
+        See :func:`get_git_performance_profile` (Default: `None`)
+
+    Returns
+    -------
+    mismatches : dict
+        Expected and actual values of the configurations
+        that differ from the profile, indexed by name
+    """
+    mismatches = {}
+    for name, value in get_git_performance_profile(fsmonitor).items():
+        try:
+            actual = run(f'git config --get {name}', cwd=datalad_dataset_dir).stdout.decode().strip()
+        except subprocess.CalledProcessError:
+            actual = None
+        if actual != value:
+            mismatches[name] = (value, actual)
+    return mismatches
+
+
+def run_git_maintenance(datalad_dataset_dir, dryrun=False):
+    """
+    Run the maintenance of the repository of a Datalad dataset before a push.
+
+    Loose objects are packed, the packs are consolidated incrementally and
+    the commit-graph is updated (`git maintenance run`, git >= 2.29). With
+    older versions of git, `git gc --auto` and `git commit-graph write` are run.
+
+    Parameters
+    ----------
+    datalad_dataset_dir : string
+        Local path of the Datalad dataset
+
+    dryrun : bool
+        If `True`, only generates the commands and
+        do not execute them
+        (Default: `False`)
+
+    Returns
+    -------
+    `res` : subprocess.CompletedProcess
+        Result of the maintenance
+
+    `cmd` : string
+        Equivalent bash command
+    """
+    # Tasks are run one after the other, such that the incremental
+    # repack finds the pack of the loose objects
+    cmd = ' && '.join(f'git maintenance run --task={task}' for task in GIT_MAINTENANCE_TASKS)
+    fallback = 'git gc --auto && git commit-graph write --reachable'
+    res = None
+    if not dryrun:
+        try:
+            res = run(cmd if get_git_version() >= (2, 29) else fallback, cwd=datalad_dataset_dir)
+        except subprocess.CalledProcessError as e:
+            print(f'\t* WARNING: Maintenance of the git repository failed: {e}')
+    return res, f'cd "{datalad_dataset_dir}" && {{ {cmd} || {{ {fallback}; }}; }}'
+
+
+def time_git_status(datalad_dataset_dir, repeat=3):
+    """Return the median duration in seconds of `git status` in a Datalad dataset over `repeat` runs."""
+    durations = []
+    for _ in range(max(repeat, 1)):
+        start = time.monotonic()
+        run('git status --porcelain=v1 --untracked-files=all', cwd=datalad_dataset_dir)
+        durations.append(time.monotonic() - start)
+    return statistics.median(durations)
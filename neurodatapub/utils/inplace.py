@@ -0,0 +1,203 @@
+# Copyright © 2021-2022 Connectomics Lab
+# University Hospital Center and University of Lausanne (UNIL-CHUV), Switzerland,
+# and contributors
+#
+#  This software is distributed under the open-source license Apache 2.0.
+
+"""`neurodatapub.utils.inplace`: utils functions to convert an input dataset into a Datalad dataset in place."""
+
+import os
+import tempfile
+import contextlib
+import subprocess
+
+from .process import run
+
+# Entries of the top directory that a Datalad dataset creates or relies on
+RESERVED_ENTRIES = ['.git', '.datalad', '.gitattributes', '.gitmodules']
+
+# Columns of the manifest of the files of a dataset converted in place
+MANIFEST_COLUMNS = ['path', 'size', 'mtime', 'symlink']
+
+
+def get_in_place_manifest_file(dataset_dir):
+    """Return the manifest of the files of a dataset before its conversion in place."""
+    return os.path.join(dataset_dir, '.git', 'neurodatapub', 'inplace-manifest.tsv')
+
+
+def check_in_place_conversion(dataset_dir, table=None):
+    """
+    Check that a dataset can be converted into a Datalad dataset in place.
+
+    Parameters
+    ----------
+    dataset_dir : string
+        Path of the input dataset
+
+    table : neurodatapub.utils.scan.FileTable
+        Table of the files of the dataset, used to check that the
+        directories of the files are writable (Default: `None`)
+
+    Returns
+    -------
+    problems : list of string
+        Reasons preventing the conversion (empty if it is safe)
+
+    warnings : list of string
+        Points to be aware of before converting the dataset
+    """
+    problems, warnings = [], []
+    if not os.access(dataset_dir, os.W_OK):
+        problems.append(f'{dataset_dir} is not writable')
+    for name in RESERVED_ENTRIES:
+        if os.path.lexists(os.path.join(dataset_dir, name)):
+            problems.append(f'{name} already exists in {dataset_dir}')
+    try:
+        proc = run('git rev-parse --show-toplevel', cwd=dataset_dir)
+    except subprocess.CalledProcessError:
+        pass
+    else:
+        problems.append(f'{dataset_dir} is inside the git repository {proc.stdout.decode().strip()}')
+    if table is not None:
+        # git-annex moves the annexed files, which requires
+        # write access to the directories that contain them
+        dirs = sorted(set(os.path.dirname(path) for path in table.paths))
+        read_only = [d or '.' for d in dirs if not os.access(os.path.join(dataset_dir, d), os.W_OK)]
+        if read_only:
+            problems.append(f'{len(read_only)} directories are not writable (e.g. {read_only[0]})')
+        links = [entry.path for entry in table if entry.flags]
+        if links:
+            warnings.append(f'{len(links)} symbolic links are committed as links, '
+                            f'the content of their targets is not published (e.g. {links[0]})')
+    return problems, warnings
+
+
+def write_in_place_manifest(dataset_dir, table, dryrun=False):
+    """
+    Write the manifest of the files of a dataset before its conversion in place.
+
+    The manifest is a tab-separated file with the relative path, the size,
+    the modification time (in seconds) and if the file is a symbolic link,
+    such that the original state of the dataset can be checked after the
+    conversion or restored with `git annex unannex`.
+
+    Parameters
+    ----------
+    dataset_dir : string
+        Path of the dataset converted in place
+
+    table : neurodatapub.utils.scan.FileTable
+        Table of the files of the dataset
+
+    dryrun : bool
+        If `True`, only generates the commands and
+        do not execute them
+        (Default: `False`)
+
+    Returns
+    -------
+    `res` : string
+        Path of the manifest
+
+    `cmd` : string
+        Equivalent bash command
+    """
+    manifest_file = get_in_place_manifest_file(dataset_dir)
+    res = None
+    if not dryrun:
+        os.makedirs(os.path.dirname(manifest_file), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(manifest_file), prefix='.inplace-manifest.')
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8', errors='surrogateescape') as f:
+                f.write('\t'.join(MANIFEST_COLUMNS) + '\n')
+                for entry in table.sorted():
+                    f.write(f'{entry.path}\t{entry.size}\t{entry.mtime / 1e9:.9f}\t{int(bool(entry.flags))}\n')
+            os.replace(tmp_path, manifest_file)
+        except BaseException:
+            with contextlib.suppress(OSError):
+                os.remove(tmp_path)
+            raise
+        res = manifest_file
+    header = '\\t'.join(MANIFEST_COLUMNS)
+    cmd = (f'mkdir -p "{os.path.dirname(manifest_file)}" && '
+           f'(printf "{header}\\n" && cd "{dataset_dir}" && '
+           "find . -path ./.git -prune -o ! -type d -printf '%P\\t%s\\t%T@\\t%y\\n' | sort) "
+           f'> "{manifest_file}"')
+    return res, cmd
+
+
+def load_in_place_manifest(dataset_dir):
+    """Return the sizes and symbolic link flags of the files recorded in the manifest of a dataset converted in place, indexed by path."""
+    entries = {}
+    with contextlib.suppress(OSError):
+        with open(get_in_place_manifest_file(dataset_dir), 'r',
+                  encoding='utf-8', errors='surrogateescape') as f:
+            next(f, None)
+            for line in f:
+                fields = line.rstrip('\n').split('\t')
+                if len(fields) == len(MANIFEST_COLUMNS):
+                    entries[fields[0]] = (int(fields[1]), fields[3] not in ('0', 'f'))
+    return entries
+
+
+def check_in_place_manifest(dataset_dir):
+    """
+    Check that the files of the manifest of a dataset converted in place are still present with the same size.
+
+    Annexed files are followed through their symbolic links, such that
+    locked and unlocked files are both checked against their content.
+
+    Parameters
+    ----------
+    dataset_dir : string
+        Path of the dataset converted in place
+
+    Returns
+    -------
+    missing : list of string
+        Relative paths of the files that are missing or whose size changed
+    """
+    missing = []
+    for path, (size, symlink) in load_in_place_manifest(dataset_dir).items():
+        fullpath = os.path.join(dataset_dir, path)
+        if symlink:
+            # Symbolic links of the original dataset are committed as they are
+            if not os.path.islink(fullpath):
+                missing.append(path)
+        elif not os.path.exists(fullpath) or os.path.getsize(fullpath) != size:
+            missing.append(path)
+    return missing
+
+
+def configure_unlocked_files(dataset_dir, dryrun=False):
+    """
+    Configure a dataset converted in place to keep its annexed files unlocked.
+
+    With `annex.addunlocked`, the annexed files stay regular files in
+    the working tree instead of being replaced by symbolic links, and with
+    `annex.thin`, their content is hard linked to the annex instead of
+    being copied, such that no extra disk space is used.
+
+    Parameters
+    ----------
+    dataset_dir : string
+        Path of the dataset converted in place
+
+    dryrun : bool
+        If `True`, only generates the commands and
+        do not execute them
+        (Default: `False`)
+
+    Returns
+    -------
+    `res` : subprocess.CompletedProcess
+        Result of the `git config` commands
+
+    `cmd` : string
+        Equivalent bash command
+    """
+    cmd = 'git config annex.addunlocked true && git config annex.thin true'
+    res = None
+    if not dryrun:
+        res = run(cmd, cwd=dataset_dir)
+    return res, f'cd "{dataset_dir}" && {cmd}'
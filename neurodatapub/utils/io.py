@@ -12,11 +12,19 @@ from .process import run
 def copy_content_to_datalad_dataset(
     bids_dir,
     datalad_dataset_dir,
+    jobs=None,
+    files_from=None,
+    ignore_existing=True,
+    stdout_callback=None,
     dryrun=False
 ):
     """
     Copy BIDS dataset content to target datalad dataset directory using `rsync`.
 
+    Symbolic links are copied as regular files (`rsync -L`). The files
+    that should not be copied (See :func:`neurodatapub.utils.symlinks.plan_symlinks`)
+    are left out of the list given with `files_from`.
+
     Parameters
     -------
     bids_dir : string
@@ -25,6 +33,26 @@ def copy_content_to_datalad_dataset(
     datalad_dataset_dir : string
         Local path of the directory of the datalad dataset being created
 
+    jobs : int or string
+        If given, the top-level entries of the dataset are copied
+        by parallel `rsync` processes launched by `xargs -P <jobs>`
+        (Default: `None`)
+
+    files_from : string
+        Path of a file listing the NUL-separated relative paths of the files
+        to be copied (see :meth:`neurodatapub.utils.scan.FileTable.write_file_list`).
+        If given, `rsync` copies only these files and does not walk the dataset again.
+        It has precedence over `jobs` (Default: `None`)
+
+    ignore_existing : bool
+        If `True`, the files already present in the datalad dataset are not
+        copied again. Set it to `False` to update modified files
+        (Default: `True`)
+
+    stdout_callback : function
+        Function called with each line printed by `rsync`
+        (Default: `None`)
+
     dryrun : bool
         If `True`, only generates the commands and
         do not execute them
@@ -43,16 +71,28 @@ def copy_content_to_datalad_dataset(
     if not bids_dir.endswith('/'):
         bids_dir += '/'
 
-    cmd = 'rsync --ignore-existing -vrL '
-    cmd += f'{bids_dir} '
-    cmd += f'{datalad_dataset_dir}'
+    options = '--ignore-existing ' if ignore_existing else ''
+    if files_from is not None:
+        cmd = f'rsync {options}-vL '
+        cmd += f'--from0 --files-from="{files_from}" '
+        cmd += f'"{bids_dir}" '
+        cmd += f'"{datalad_dataset_dir}"'
+    elif jobs is None:
+        cmd = f'rsync {options}-vrL '
+        cmd += f'{bids_dir} '
+        cmd += f'{datalad_dataset_dir}'
+    else:
+        cmd = f'find "{bids_dir}" -mindepth 1 -maxdepth 1 -print0 | '
+        cmd += f'xargs -0 -P {jobs} -I{{}} '
+        cmd += f'rsync {options}-vrL {{}} '
+        cmd += f'"{datalad_dataset_dir}/"'
 
     proc = None
     if not dryrun:
         # Execute the rsync command
         try:
             print(f'... cmd: {cmd}')
-            proc = run(cmd)
+            proc = run(cmd, stdout_callback=stdout_callback)
         except Exception as e:
             print('Failed')
             print(e)
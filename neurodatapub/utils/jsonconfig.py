@@ -10,6 +10,26 @@ import json
 import jsonschema
 from jsonschema import validate
 
+# Entries selecting the backend of a sibling (See `neurodatapub.utils.backends`)
+BACKEND_CONFIG_PROPERTIES = {
+    "backend": {
+        "type": "string",
+        "enum": ["remote", "local"]
+    },
+    "local_dir": {
+        "type": "string",
+        "pattern": "^/"
+    }
+}
+
+# Condition of the entries only required by the remote backend
+IS_REMOTE_BACKEND = {
+    "not": {
+        "properties": {"backend": {"const": "local"}},
+        "required": ["backend"]
+    }
+}
+
 # Describe the kind of json we expect for the configuration
 # of the git-annex special remote and github siblings
 SPECIAL_REMOTE_SIBLING_CONFIG_SCHEMA = {
@@ -27,9 +47,64 @@ SPECIAL_REMOTE_SIBLING_CONFIG_SCHEMA = {
             "type": "string",
             "pattern": "/.git$"
         },
-
+        "remote_shared_store_dir": {
+            "type": "string",
+            "pattern": "^/"
+        },
+        "transfer_compression": {
+            "oneOf": [
+                {
+                    "type": "string",
+                    "enum": ["none", "auto"]
+                },
+                {
+                    "type": "object",
+                    "properties": {
+                        "level": {
+                            "type": "integer",
+                            "minimum": 1,
+                            "maximum": 9
+                        },
+                        "skip_extensions": {
+                            "type": "array",
+                            "items": {
+                                "type": "string",
+                                "pattern": "^\\.?[\\w]+$"
+                            }
+                        }
+                    },
+                    "additionalProperties": False
+                }
+            ]
+        },
+        "throttle": {
+            "type": "object",
+            "properties": {
+                "latency": {
+                    "type": "number",
+                    "minimum": 0
+                },
+                "bandwidth": {
+                    "type": "number",
+                    "minimum": 0
+                },
+                "failure_rate": {
+                    "type": "number",
+                    "minimum": 0,
+                    "maximum": 1
+                },
+                "seed": {
+                    "type": "integer"
+                }
+            },
+            "additionalProperties": False
+        },
+        **BACKEND_CONFIG_PROPERTIES
     },
-    "required": ["remote_ssh_login", "remote_ssh_url", "remote_sibling_dir"]
+    "required": ["remote_sibling_dir"],
+    # The local backend does not connect through SSH
+    "if": IS_REMOTE_BACKEND,
+    "then": {"required": ["remote_ssh_login", "remote_ssh_url"]}
 }
 
 GITHUB_SIBLING_CONFIG_SCHEMA = {
@@ -58,14 +133,16 @@ GITHUB_SIBLING_CONFIG_SCHEMA = {
             "type": "string",
             "pattern": "^[\\w-]+$"
         },
+        **BACKEND_CONFIG_PROPERTIES
     },
     "required": [
         "github_login",
         "github_email",
         "github_organization",
-        "github_token",
         "github_repo_name"
-    ]
+    ],
+    "if": IS_REMOTE_BACKEND,
+    "then": {"required": ["github_token"]}
 }
 
 OSF_SIBLING_CONFIG_SCHEMA = {
@@ -75,14 +152,15 @@ OSF_SIBLING_CONFIG_SCHEMA = {
             "type": "string",
             "pattern": "^[\\w.-]+$"
         },
-    },
-    "properties": {
         "osf_dataset_title": {
             "type": "string",
             "pattern": "^[\\w\\s-]+$"
         },
+        **BACKEND_CONFIG_PROPERTIES
     },
-    "required": ["osf_token", "osf_dataset_title"]
+    "required": ["osf_dataset_title"],
+    "if": IS_REMOTE_BACKEND,
+    "then": {"required": ["osf_token"]}
 }
 
 
@@ -100,6 +178,21 @@ def validate_json_sibling_config(json_file, sibling_type=None):
     """
     with open(json_file, 'r') as f:
         json_dict = json.load(f)
+    return validate_sibling_config(json_dict, sibling_type=sibling_type)
+
+
+def validate_sibling_config(json_dict, sibling_type=None):
+    """
+    Validate a sibling configuration already loaded as a dictionary.
+
+    Parameters
+    ----------
+    json_dict : dict
+        Sibling configuration
+
+    sibling_type : ['git-annex-special-sibling','github-sibling', 'osf-sibling']
+        Type of sibling configuration
+    """
     try:
         if sibling_type == 'git-annex-special-sibling':
             validate(instance=json_dict, schema=SPECIAL_REMOTE_SIBLING_CONFIG_SCHEMA)
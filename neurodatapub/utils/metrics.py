@@ -0,0 +1,472 @@
+# Copyright © 2021-2022 Connectomics Lab
+# University Hospital Center and University of Lausanne (UNIL-CHUV), Switzerland,
+# and contributors
+#
+#  This software is distributed under the open-source license Apache 2.0.
+
+"""`neurodatapub.utils.metrics`: metrics of the publications exported in the Prometheus and OpenMetrics text formats."""
+
+import os
+import math
+import tempfile
+import threading
+import contextlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from .events import (
+    StageStarted, StageFinished, FileCopied, KeyHashed, KeyTransferred, Error
+)
+
+# Content types of the text formats
+PROMETHEUS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+OPENMETRICS_CONTENT_TYPE = 'application/openmetrics-text; version=1.0.0; charset=utf-8'
+
+DEFAULT_METRICS_PORT = 9765
+
+
+class Metric(object):
+
+    """Family of samples of a metric, indexed by the values of its labels.
+
+    Parameters
+    ----------
+    name : string
+        Name of the metric, without the `_total` suffix of the counters
+
+    documentation : string
+        Help text of the metric
+
+    labelnames : tuple of string
+        Names of the labels of the samples (Default: `()`)
+    """
+
+    kind = 'unknown'
+
+    # Value of a metric without labels before its first update
+    initial_value = 0
+
+    def __init__(self, name, documentation, labelnames=()):
+        """Constructor of :class:`Metric` object."""
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, '')) for name in self.labelnames)
+
+    def clear(self):
+        """Remove all the samples."""
+        with self._lock:
+            self._values = {}
+
+    def samples(self):
+        """Return the samples as a list of `(suffix, labels, value)`."""
+        with self._lock:
+            values = dict(self._values)
+        if not values and not self.labelnames:
+            values[()] = self.initial_value
+        return [('', dict(zip(self.labelnames, key)), value) for key, value in sorted(values.items())]
+
+
+class Counter(Metric):
+
+    """Metric whose value only increases."""
+
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        """Increment the sample of the `labels` by `amount`."""
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        """Return the samples as a list of `(suffix, labels, value)`."""
+        return [('_total', labels, value) for _, labels, value in super().samples()]
+
+
+class Gauge(Metric):
+
+    """Metric whose value can go up and down."""
+
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        """Set the sample of the `labels` to `value`."""
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, amount=1, **labels):
+        """Increment the sample of the `labels` by `amount` (which can be negative)."""
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Summary(Metric):
+
+    """Metric counting observations and their sum (e.g. durations)."""
+
+    kind = 'summary'
+
+    initial_value = (0, 0)
+
+    def observe(self, value, **labels):
+        """Record an observation of `value` in the sample of the `labels`."""
+        key = self._key(labels)
+        with self._lock:
+            count, total = self._values.get(key, (0, 0))
+            self._values[key] = (count + 1, total + value)
+
+    def samples(self):
+        """Return the samples as a list of `(suffix, labels, value)`."""
+        samples = []
+        for _, labels, (count, total) in super().samples():
+            samples += [('_count', labels, count), ('_sum', labels, total)]
+        return samples
+
+
+class MetricsRegistry(object):
+
+    """Registry of the metrics exported by a process.
+
+    Collectors can be added to update metrics computed on demand
+    (e.g. the depth of a queue) right before each export.
+    """
+
+    def __init__(self):
+        """Constructor of :class:`MetricsRegistry` object."""
+        self._metrics = {}
+        self._collectors = []
+        self._lock = threading.Lock()
+
+    def _get_or_create(self, cls, name, documentation, labelnames):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, documentation, labelnames)
+            elif not isinstance(metric, cls):
+                raise ValueError(f'Metric {name} is already registered as a {metric.kind}')
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        """Return the counter `name`, created if needed."""
+        return self._get_or_create(Counter, name, documentation, labelnames)
+
+    def gauge(self, name, documentation, labelnames=()):
+        """Return the gauge `name`, created if needed."""
+        return self._get_or_create(Gauge, name, documentation, labelnames)
+
+    def summary(self, name, documentation, labelnames=()):
+        """Return the summary `name`, created if needed."""
+        return self._get_or_create(Summary, name, documentation, labelnames)
+
+    def add_collector(self, collector):
+        """Add a function called without argument before each export."""
+        with self._lock:
+            self._collectors.append(collector)
+
+    def collect(self):
+        """Run the collectors and return the metrics sorted by name."""
+        with self._lock:
+            collectors = list(self._collectors)
+        for collector in collectors:
+            try:
+                collector()
+            except Exception as e:
+                print(f'\t* WARNING: Metrics collector {collector} failed: {e}')
+        with self._lock:
+            return [self._metrics[name] for name in sorted(self._metrics)]
+
+
+def _escape(value, quotes=True):
+    """Escape a label value or a help text (whose quotes are only escaped in the OpenMetrics format)."""
+    value = str(value).replace('\\', '\\\\').replace('\n', '\\n')
+    return value.replace('"', '\\"') if quotes else value
+
+
+def _format_value(value):
+    if isinstance(value, float):
+        if math.isnan(value):
+            return 'NaN'
+        if math.isinf(value):
+            return '+Inf' if value > 0 else '-Inf'
+        return repr(value)
+    return str(int(value))
+
+
+def render_metrics(registry, openmetrics=False):
+    """
+    Render the metrics of a registry in a text format.
+
+    Parameters
+    ----------
+    registry : MetricsRegistry
+        Registry of the metrics
+
+    openmetrics : bool
+        If `True`, the OpenMetrics format is used, otherwise the Prometheus
+        text format (version 0.0.4) read by the textfile collector of the
+        node exporter (Default: `False`)
+
+    Returns
+    -------
+    text : string
+        Rendered metrics
+    """
+    lines = []
+    for metric in registry.collect():
+        samples = metric.samples()
+        # In the Prometheus format, the family of a counter is named after its samples
+        family = metric.name if openmetrics or metric.kind != 'counter' else f'{metric.name}_total'
+        lines.append(f'# HELP {family} {_escape(metric.documentation, quotes=openmetrics)}')
+        lines.append(f'# TYPE {family} {metric.kind}')
+        for suffix, labels, value in samples:
+            label_str = ','.join(f'{name}="{_escape(label)}"' for name, label in labels.items())
+            if label_str:
+                label_str = '{' + label_str + '}'
+            lines.append(f'{metric.name}{suffix}{label_str} {_format_value(value)}')
+    if openmetrics:
+        lines.append('# EOF')
+    return '\n'.join(lines) + '\n'
+
+
+def write_metrics_textfile(registry, path):
+    """
+    Write the metrics of a registry in a file read by the textfile collector of the node exporter.
+
+    The file is written atomically, such that the collector never reads
+    a partial file. Its name should end with `.prom`.
+
+    Parameters
+    ----------
+    registry : MetricsRegistry
+        Registry of the metrics
+
+    path : string
+        Path of the file
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.neurodatapub-metrics.')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(render_metrics(registry))
+        # Readable by the node exporter
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except BaseException:
+        with contextlib.suppress(OSError):
+            os.remove(tmp_path)
+        raise
+
+
+def accepts_openmetrics(accept):
+    """Return `True` if the `Accept` header of a scrape request asks for the OpenMetrics format."""
+    return 'application/openmetrics-text' in (accept or '')
+
+
+class _MetricsRequestHandler(BaseHTTPRequestHandler):
+
+    """Handler of the scrapes of a :class:`MetricsExporter`."""
+
+    def do_GET(self):
+        if self.path.split('?')[0].rstrip('/') not in ('', '/metrics'):
+            self.send_error(404)
+            return
+        openmetrics = accepts_openmetrics(self.headers.get('Accept'))
+        body = render_metrics(self.server.registry, openmetrics=openmetrics).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', OPENMETRICS_CONTENT_TYPE if openmetrics else PROMETHEUS_CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Scrapes are too frequent to be printed
+        pass
+
+
+class MetricsExporter(object):
+
+    """Exporter of the metrics of a registry to a textfile and/or a local HTTP endpoint.
+
+    The textfile is rewritten every `interval` seconds and when the
+    exporter stops. The HTTP endpoint (`GET /metrics` on `127.0.0.1`)
+    renders the metrics at each scrape, in the OpenMetrics format if
+    the scraper asks for it.
+
+    Parameters
+    ----------
+    registry : MetricsRegistry
+        Registry of the metrics
+
+    textfile : string
+        Path of the textfile (Default: `None`, not written)
+
+    port : int
+        Port of the HTTP endpoint on `localhost`
+        (Default: `None`, not served)
+
+    interval : float
+        Interval in seconds between two writes of the textfile
+        (Default: `15`)
+    """
+
+    def __init__(self, registry, textfile=None, port=None, interval=15):
+        """Constructor of :class:`MetricsExporter` object."""
+        self.registry = registry
+        self.textfile = textfile
+        self.port = port
+        self.interval = interval
+        self._stop_event = threading.Event()
+        self._threads = []
+        self._server = None
+
+    def write(self):
+        """Write the textfile now."""
+        if self.textfile:
+            try:
+                write_metrics_textfile(self.registry, self.textfile)
+            except OSError as e:
+                print(f'\t* WARNING: Could not write the metrics to {self.textfile}: {e}')
+
+    def _write_periodically(self):
+        while not self._stop_event.wait(self.interval):
+            self.write()
+
+    def start(self):
+        """Start writing the textfile and serving the HTTP endpoint in background threads."""
+        self._stop_event.clear()
+        if self.textfile:
+            self.write()
+            self._threads.append(threading.Thread(
+                target=self._write_periodically, name='neurodatapub-metrics-textfile', daemon=True
+            ))
+        if self.port is not None:
+            self._server = ThreadingHTTPServer(('127.0.0.1', self.port), _MetricsRequestHandler)
+            self._server.daemon_threads = True
+            self._server.registry = self.registry
+            self._threads.append(threading.Thread(
+                target=self._server.serve_forever, name='neurodatapub-metrics-http', daemon=True
+            ))
+            print(f'> Metrics served on http://127.0.0.1:{self._server.server_address[1]}/metrics')
+        for thread in self._threads:
+            thread.start()
+        return self
+
+    def stop(self):
+        """Stop the background threads and write the textfile a last time."""
+        self._stop_event.set()
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+        self.write()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+class PublicationMetrics(object):
+
+    """Metrics of the publications, updated from the events of the projects.
+
+    The metrics are only updated by the callbacks of the event buses of the
+    projects, such that the hot paths pay the emission of an event, which is
+    coalesced by the bus, and not a metric update per file.
+
+    Parameters
+    ----------
+    registry : MetricsRegistry
+        Registry in which the metrics are created
+        (Default: `None`, a new registry)
+    """
+
+    _KINDS = (StageStarted, StageFinished, FileCopied, KeyHashed, KeyTransferred, Error)
+
+    def __init__(self, registry=None):
+        """Constructor of :class:`PublicationMetrics` object."""
+        self.registry = registry if registry is not None else MetricsRegistry()
+        r = self.registry
+        self.files_copied = r.counter(
+            'neurodatapub_files_copied', 'Files copied from the input dataset to the Datalad dataset')
+        self.copied_bytes = r.counter(
+            'neurodatapub_copied_bytes', 'Bytes copied from the input dataset to the Datalad dataset')
+        self.keys_hashed = r.counter(
+            'neurodatapub_keys_hashed', 'Files hashed and annexed by datalad save')
+        self.hashed_bytes = r.counter(
+            'neurodatapub_hashed_bytes', 'Bytes hashed and annexed by datalad save')
+        self.keys_transferred = r.counter(
+            'neurodatapub_keys_transferred', 'Annexed files transferred to a remote', ('remote',))
+        self.transferred_bytes = r.counter(
+            'neurodatapub_transferred_bytes', 'Bytes of annexed files transferred to a remote', ('remote',))
+        self.errors = r.counter(
+            'neurodatapub_errors', 'Errors reported by the stages', ('stage',))
+        self.stage_duration = r.summary(
+            'neurodatapub_stage_duration_seconds', 'Durations of the stages', ('stage', 'success'))
+        self.stages_running = r.gauge(
+            'neurodatapub_stages_running', 'Stages in progress', ('stage',))
+        self.stage_last_finished = r.gauge(
+            'neurodatapub_stage_last_finished_timestamp_seconds',
+            'Time of the last end of each stage', ('stage', 'success'))
+        self.batches = r.counter(
+            'neurodatapub_watch_batches', 'Batches of changes published in the "watch" mode', ('success',))
+        self.retries = r.counter(
+            'neurodatapub_watch_retries', 'Batches published again after a failure in the "watch" mode')
+        self.batch_paths = r.gauge(
+            'neurodatapub_watch_batch_paths',
+            'Changed paths of the last batch published in the "watch" mode (-1 for a full rescan)')
+        self.pending_paths = r.gauge(
+            'neurodatapub_watch_pending_paths',
+            'Changed paths waiting for the next batch in the "watch" mode')
+
+    def attach(self, bus):
+        """Update the metrics from the events of a bus and return the token of the subscription."""
+        return bus.subscribe(self.handle, kinds=self._KINDS)
+
+    def detach(self, bus, token):
+        """Stop updating the metrics from the events of a bus."""
+        bus.flush()
+        bus.unsubscribe(token)
+
+    def handle(self, event):
+        """Update the metrics from an event."""
+        if isinstance(event, FileCopied):
+            self.files_copied.inc(event.count)
+            self.copied_bytes.inc(event.nbytes)
+        elif isinstance(event, KeyHashed):
+            self.keys_hashed.inc(event.count)
+            self.hashed_bytes.inc(event.nbytes)
+        elif isinstance(event, KeyTransferred):
+            self.keys_transferred.inc(event.count, remote=event.remote)
+            self.transferred_bytes.inc(event.nbytes, remote=event.remote)
+        elif isinstance(event, StageStarted):
+            self.stages_running.inc(1, stage=event.stage)
+        elif isinstance(event, StageFinished):
+            success = str(bool(event.success)).lower()
+            self.stages_running.inc(-1, stage=event.stage)
+            self.stage_duration.observe(event.duration, stage=event.stage, success=success)
+            self.stage_last_finished.set(event.time, stage=event.stage, success=success)
+        elif isinstance(event, Error):
+            self.errors.inc(stage=event.stage)
+
+    def set_pending(self, npaths):
+        """Record the number of changed paths waiting for the next batch in the `"watch"` mode."""
+        self.pending_paths.set(npaths)
+
+    def record_batch(self, npaths, success, retry=False):
+        """Record a batch of changes published in the `"watch"` mode (`npaths` is `None` for a full rescan)."""
+        self.batch_paths.set(-1 if npaths is None else npaths)
+        self.batches.inc(success=str(bool(success)).lower())
+        if retry:
+            self.retries.inc()
@@ -0,0 +1,295 @@
+# Copyright © 2021-2022 Connectomics Lab
+# University Hospital Center and University of Lausanne (UNIL-CHUV), Switzerland,
+# and contributors
+#
+#  This software is distributed under the open-source license Apache 2.0.
+
+"""`neurodatapub.utils.plan`: utils functions to estimate the resources needed by a publication."""
+
+import os
+import time
+import shutil
+
+from .compression import estimate_compressed_size
+from .process import run
+
+# Extensions of files that are stored in git by the `text2git` configuration
+TEXT_EXTENSIONS = [
+    '.json', '.tsv', '.csv', '.txt', '.md', '.rst', '.bval', '.bvec',
+    '.vhdr', '.vmrk', '.py', '.sh', '.m', '.r', '.ipynb', '.html', '.yml',
+    '.yaml', '.toml', '.cfg', '.ini', '.bib', '.xml', '.svg', '.log'
+]
+TEXT_NAMES = ['README', 'CHANGES', 'LICENSE', '.bidsignore', '.gitattributes', '.gitignore']
+
+# Extensions of files that are annexed by the `text2git` configuration
+BINARY_EXTENSIONS = [
+    '.nii', '.gz', '.mgz', '.mgh', '.png', '.jpg', '.jpeg', '.tif', '.tiff',
+    '.edf', '.bdf', '.eeg', '.fif', '.set', '.fdt', '.mat', '.h5', '.hdf5',
+    '.npy', '.npz', '.zip', '.tar', '.bz2', '.xz', '.pdf', '.dcm', '.mp4',
+    '.snirf', '.con', '.sqd', '.ds', '.mef', '.gii', '.dtseries', '.pkl'
+]
+
+# Number of bytes sniffed to decide if a file of unknown type is binary (as git does)
+SNIFF_SIZE = 8000
+
+
+def is_annexed(path, size):
+    """
+    Predict if a file will be annexed or stored in git by the `text2git` configuration.
+
+    The prediction is based on the extension of the file. For unknown extensions,
+    the beginning of the file is sniffed for a NUL byte, as git does to detect binary files.
+
+    Parameters
+    ----------
+    path : string
+        Path of the file
+
+    size : int
+        Size of the file in bytes
+
+    Returns
+    -------
+    annexed : bool
+        `True` if the file is predicted to be annexed
+    """
+    if size == 0:
+        return False
+    name = os.path.basename(path)
+    ext = os.path.splitext(name)[1].lower()
+    if name in TEXT_NAMES or ext in TEXT_EXTENSIONS:
+        return False
+    if ext in BINARY_EXTENSIONS:
+        return True
+    try:
+        with open(path, 'rb') as f:
+            return b'\0' in f.read(SNIFF_SIZE)
+    except OSError:
+        return True
+
+
+def get_free_disk_space(path):
+    """Return the free disk space in bytes of the filesystem where `path` is or would be created."""
+    path = os.path.abspath(path)
+    while not os.path.exists(path):
+        path = os.path.dirname(path)
+    return shutil.disk_usage(path).free
+
+
+def measure_ssh_bandwidth(sshurl, user=None, nbytes=16 * 1024 * 1024, timeout=60):
+    """
+    Measure the upload bandwidth and the round-trip time to a SSH server.
+
+    It times a no-op command (round-trip time) and the upload
+    of `nbytes` random bytes discarded on the server.
+
+    Parameters
+    ----------
+    sshurl : string
+        SSH URL of the server in the form `ssh://server.example.org`
+
+    user : string
+        Login used to connect to the server (Default: `None`)
+
+    nbytes : int
+        Number of bytes uploaded for the probe
+        (Default: 16 MiB)
+
+    timeout : int
+        Timeout of the SSH connection in seconds
+        (Default: `60`)
+
+    Returns
+    -------
+    bandwidth : float
+        Upload bandwidth in bytes per second, or `None` if the probe failed
+
+    rtt : float
+        Round-trip time in seconds, or `None` if the probe failed
+    """
+    host = sshurl.replace('ssh://', '')
+    if user:
+        host = f'{user}@{host}'
+    ssh = f'ssh -o BatchMode=yes -o ConnectTimeout={timeout} {host}'
+    try:
+        # First connection may include the establishment of a master connection
+        run(f'{ssh} true')
+        start = time.monotonic()
+        run(f'{ssh} true')
+        rtt = time.monotonic() - start
+        start = time.monotonic()
+        run(f'head -c {nbytes} /dev/urandom | {ssh} "cat > /dev/null"')
+        elapsed = time.monotonic() - start
+    except Exception as e:
+        print(f'\t* WARNING: Bandwidth probe to {host} failed: {e}')
+        return None, None
+    return nbytes / max(elapsed - rtt, 1e-3), rtt
+
+
+def plan_publication(
+    table,
+    datalad_dataset_dir,
+    bandwidth=None,
+    rtt=0,
+    compression=None,
+    in_place=False
+):
+    """
+    Estimate the resources needed by the publication of a dataset.
+
+    Parameters
+    ----------
+    table : neurodatapub.utils.scan.FileTable
+        Table of the files of the input dataset, as returned
+        by :func:`neurodatapub.utils.scan.scan_directory`
+
+    datalad_dataset_dir : string
+        Local path of the Datalad dataset to be created
+
+    bandwidth : float
+        Upload bandwidth to the remotes in bytes per second
+        (Default: `None`, no estimation of the transfer time)
+
+    rtt : float
+        Round-trip time to the remote in seconds, accounted once
+        per annexed file (Default: `0`)
+
+    compression : dict
+        Compression policy of the transfers of the annexed files, as
+        returned by :func:`neurodatapub.utils.compression.get_compression_policy`
+        (Default: `None`, no compression)
+
+    in_place : bool
+        If `True`, the input dataset is converted into the Datalad dataset
+        in place, such that its files are not copied (Default: `False`)
+
+    Returns
+    -------
+    plan : dict
+        Dictionary with the total size and number of files, the git-vs-annex split,
+        the size per subject, the disk space required and available on the
+        Datalad dataset filesystem, the estimated bytes on the wire of the annexed
+        files and compression ratios per suffix, and the estimated transfer time (in seconds)
+    """
+    git_files, git_bytes = 0, 0
+    annex_files, annex_bytes = 0, 0
+    annexed = []
+    subjects = {}
+    for relpath, size in zip(table.paths, table.sizes):
+        if is_annexed(os.path.join(table.root, relpath), size):
+            annex_files += 1
+            annex_bytes += size
+            if compression is not None:
+                annexed.append((relpath, size))
+        else:
+            git_files += 1
+            git_bytes += size
+        top = relpath.split(os.sep, 1)[0]
+        if top.startswith('sub-'):
+            subject = subjects.setdefault(top, dict(files=0, bytes=0))
+            subject['files'] += 1
+            subject['bytes'] += size
+
+    # The content of annexed files is stored once in the annex, while files
+    # in git are both in the working tree and in the object database.
+    # In place, annexed files are moved (or hard linked) into the annex
+    # and only the git objects take extra space
+    required_disk = git_bytes if in_place else annex_bytes + 2 * git_bytes
+    free_disk = get_free_disk_space(datalad_dataset_dir)
+
+    annex_wire_bytes, compression_ratios = annex_bytes, {}
+    if compression is not None:
+        annex_wire_bytes, compression_ratios = estimate_compressed_size(table.root, annexed, compression)
+
+    transfer_time = None
+    if bandwidth:
+        transfer_time = (annex_wire_bytes + git_bytes) / bandwidth + annex_files * (rtt or 0)
+
+    return dict(
+        total_files=git_files + annex_files,
+        total_bytes=git_bytes + annex_bytes,
+        git_files=git_files,
+        git_bytes=git_bytes,
+        annex_files=annex_files,
+        annex_bytes=annex_bytes,
+        annex_wire_bytes=annex_wire_bytes,
+        compression_ratios=compression_ratios,
+        subjects=dict(sorted(subjects.items())),
+        required_disk=required_disk,
+        free_disk=free_disk,
+        enough_disk=required_disk < free_disk,
+        bandwidth=bandwidth,
+        rtt=rtt,
+        transfer_time=transfer_time
+    )
+
+
+def format_size(nbytes):
+    """
+    Return a human-readable representation of a size in bytes.
+
+    Parameters
+    ----------
+    nbytes : int or float
+        Size in bytes
+
+    Returns
+    -------
+    size : str
+        Size with one decimal in the largest unit (`B` to `PB`)
+        in which it is larger than 1, e.g. `'1.5 GB'`
+    """
+    for unit in ['B', 'KB', 'MB', 'GB', 'TB', 'PB']:
+        if abs(nbytes) < 1024 or unit == 'PB':
+            break
+        nbytes /= 1024
+    return f'{nbytes:.1f} {unit}'
+
+
+def format_plan(plan, max_subjects=20):
+    """
+    Format the report of a plan returned by :func:`plan_publication`.
+
+    Parameters
+    ----------
+    plan : dict
+        Plan returned by :func:`plan_publication`
+
+    max_subjects : int
+        Maximal number of subjects listed, from the largest
+        (Default: `20`)
+
+    Returns
+    -------
+    report : string
+        Report of the plan
+    """
+    report = f"""
+\tTotal : {plan['total_files']} files, {format_size(plan['total_bytes'])}
+\tIn git : {plan['git_files']} files, {format_size(plan['git_bytes'])}
+\tAnnexed : {plan['annex_files']} files, {format_size(plan['annex_bytes'])}"""
+    if plan['compression_ratios']:
+        ratio = plan['annex_wire_bytes'] / plan['annex_bytes'] if plan['annex_bytes'] else 1
+        report += (f"\n\tAnnexed on the wire : {format_size(plan['annex_wire_bytes'])} "
+                   f"with compression ({ratio:.0%})")
+        for suffix, ratio in sorted(plan['compression_ratios'].items(), key=lambda item: item[1]):
+            report += f'\n\t  - .{suffix} : {ratio:.0%}'
+    report += f"\n\tSubjects : {len(plan['subjects'])}"
+    largest = sorted(plan['subjects'].items(), key=lambda item: -item[1]['bytes'])
+    for subject, sizes in largest[:max_subjects]:
+        report += f"\n\t  - {subject} : {sizes['files']} files, {format_size(sizes['bytes'])}"
+    if len(largest) > max_subjects:
+        report += f'\n\t  - ... ({len(largest) - max_subjects} more)'
+    report += f"""
+\tRequired disk space : {format_size(plan['required_disk'])}
+\tFree disk space : {format_size(plan['free_disk'])}"""
+    if not plan['enough_disk']:
+        report += ' (NOT ENOUGH!)'
+    if plan['transfer_time'] is not None:
+        t = int(plan['transfer_time'])
+        report += f"""
+\tBandwidth : {format_size(plan['bandwidth'])}/s (round-trip time: {plan['rtt'] or 0:.3f} s)
+\tEstimated transfer time : {t // 3600:02d}:{t % 3600 // 60:02d}:{t % 60:02d}"""
+    else:
+        report += '\n\tEstimated transfer time : UNKNOWN (no bandwidth)'
+    return report
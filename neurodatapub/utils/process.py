@@ -7,13 +7,93 @@
 """`neurodatapub.utils.process`: utils functions to run command via subprocess."""
 
 import os
+import signal
 import subprocess
+import threading
+import contextlib
+import contextvars
 
+from .tracing import trace_command
 
-def run(command, env=None, cwd=None):
+# Registry in which the processes launched by `run()` are recorded
+# (set by `track_processes()` in the current thread / context)
+_current_registry = contextvars.ContextVar('process_registry', default=None)
+
+
+class ProcessRegistry(object):
+
+    """Thread-safe registry of the running processes launched by `run()`.
+
+    It allows a caller to terminate cleanly all the processes
+    that are running on its behalf, e.g. to cancel an operation.
+    """
+
+    def __init__(self):
+        """Constructor of :class:`ProcessRegistry` object."""
+        self._processes = set()
+        self._lock = threading.Lock()
+
+    def add(self, process):
+        """Record a running process."""
+        with self._lock:
+            self._processes.add(process)
+
+    def discard(self, process):
+        """Remove a process from the registry."""
+        with self._lock:
+            self._processes.discard(process)
+
+    def terminate(self, timeout=10):
+        """
+        Terminate all recorded processes and their children.
+
+        A `SIGTERM` is first sent to the process group of each process.
+        Processes still alive after `timeout` seconds are killed.
+
+        Parameters
+        ----------
+        timeout : float
+            Time in seconds given to the processes to exit
+            before being killed
+        """
+        with self._lock:
+            processes = list(self._processes)
+        for process in processes:
+            with contextlib.suppress(ProcessLookupError):
+                os.killpg(process.pid, signal.SIGTERM)
+        for process in processes:
+            try:
+                process.wait(timeout=timeout)
+            except subprocess.TimeoutExpired:
+                with contextlib.suppress(ProcessLookupError):
+                    os.killpg(process.pid, signal.SIGKILL)
+
+
+@contextlib.contextmanager
+def track_processes(registry):
+    """
+    Context manager that records in `registry` all the processes launched by `run()`.
+
+    Parameters
+    ----------
+    registry : ProcessRegistry
+        Registry in which the processes are recorded
+    """
+    token = _current_registry.set(registry)
+    try:
+        yield registry
+    finally:
+        _current_registry.reset(token)
+
+
+def run(command, env=None, cwd=None, stdout_callback=None, input=None):
     """
     Function calls to execute a command.
-    It runs the command specified as input via ``subprocess.run()``.
+    It runs the command specified as input via ``subprocess.Popen()``.
+
+    The command is started in a new process group such that it can be
+    terminated with all its children if it is recorded in a
+    :class:`ProcessRegistry` (see `track_processes()`).
 
     Parameters
     ----------
@@ -26,14 +106,45 @@ def run(command, env=None, cwd=None):
     cwd : Directory
         Specify a custom current working directory
 
+    stdout_callback : function
+        Function called with each line of the standard output
+        of the command, as soon as it is printed
+        (Default: `None`)
+
+    input : bytes
+        Data sent to the standard input of the command,
+        e.g. for commands run in `--batch` mode
+        (Default: `None`)
+
+    Returns
+    -------
+    process : subprocess.CompletedProcess
+        Completed process with captured `stdout` and `stderr`
+
+    Raises
+    ------
+    subprocess.CalledProcessError
+        If the command exits with a non-zero exit code
+
     Examples
     --------
     >>> cmd = 'ls "/path/to/folder"'
     >>> run(cmd) # doctest: +SKIP
 
     """
+    # Commands run in a traced stage are recorded as spans
+    with trace_command(command, cwd=cwd or os.getcwd()) as span:
+        process = _run(command, env, cwd, stdout_callback, input)
+        if span is not None:
+            span.set_attributes({'process.exit_code': 0, 'process.stdout_bytes': len(process.stdout)})
+    return process
+
 
-    merged_env = os.environ
+def _run(command, env, cwd, stdout_callback, input):
+    """Execute a command (See :func:`run`)."""
+    # Copy the environment such that a custom `env` is only
+    # seen by this command and not by the whole process
+    merged_env = dict(os.environ)
 
     if cwd is None:
         cwd = os.getcwd()
@@ -41,14 +152,58 @@ def run(command, env=None, cwd=None):
     if env is not None:
         merged_env.update(env)
 
-    # Python >=3.7
-    process = subprocess.run(
+    process = subprocess.Popen(
         command,
         shell=True,
         env=merged_env,
         cwd=cwd,
-        capture_output=True,
-        check=True
+        stdin=subprocess.PIPE if input is not None else None,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        start_new_session=True
     )
+    registry = _current_registry.get()
+    if registry is not None:
+        registry.add(process)
+    try:
+        if stdout_callback is None:
+            stdout, stderr = process.communicate(input=input)
+        else:
+            if input is not None:
+                # Feed the input in a thread to not block on a full pipe
+                def _write_input():
+                    with contextlib.suppress(BrokenPipeError):
+                        process.stdin.write(input)
+                        process.stdin.close()
+                threading.Thread(target=_write_input, daemon=True).start()
+            # Drain stderr in a thread to not block the command
+            # while its standard output is consumed line by line
+            stderr_chunks = []
+            stderr_reader = threading.Thread(
+                target=lambda: stderr_chunks.append(process.stderr.read()),
+                daemon=True
+            )
+            stderr_reader.start()
+            stdout_lines = []
+            for line in process.stdout:
+                stdout_lines.append(line)
+                stdout_callback(line.decode(errors='replace').rstrip('\n'))
+            process.wait()
+            stderr_reader.join()
+            stdout = b''.join(stdout_lines)
+            stderr = b''.join(stderr_chunks)
+    except BaseException:
+        # Do not leave the command running if the caller is interrupted
+        with contextlib.suppress(ProcessLookupError):
+            os.killpg(process.pid, signal.SIGTERM)
+        process.wait()
+        raise
+    finally:
+        if registry is not None:
+            registry.discard(process)
 
-    return process
+    if process.returncode:
+        raise subprocess.CalledProcessError(
+            process.returncode, command, output=stdout, stderr=stderr
+        )
+    return subprocess.CompletedProcess(command, process.returncode, stdout, stderr)
@@ -0,0 +1,244 @@
+# Copyright © 2021-2022 Connectomics Lab
+# University Hospital Center and University of Lausanne (UNIL-CHUV), Switzerland,
+# and contributors
+#
+#  This software is distributed under the open-source license Apache 2.0.
+
+"""`neurodatapub.utils.profiling`: utils functions to profile the CPU and memory usage of the stages of a project."""
+
+import os
+import re
+import sys
+import json
+import time
+import pstats
+import cProfile
+import resource
+import contextlib
+import tracemalloc
+
+from .scan import get_cache_dir
+from .plan import format_size
+
+# Modes of the profiling of the stages
+PROFILE_MODES = ['cpu', 'memory', 'both']
+
+# Name of the summary of the profiled stages in the run directory
+PROFILE_SUMMARY_FILE = 'profile-summary.json'
+
+
+def get_profile_run_dir():
+    """Return a new run directory for the profiles (`$XDG_CACHE_HOME/neurodatapub/profiles/<time>`)."""
+    return os.path.join(get_cache_dir(), 'profiles', time.strftime('%Y%m%d-%H%M%S'))
+
+
+def _maxrss_bytes(usage):
+    """Return the maximum resident set size of a `resource.getrusage()` result in bytes."""
+    # Kilobytes on Linux, bytes on macOS
+    return usage.ru_maxrss if sys.platform == 'darwin' else usage.ru_maxrss * 1024
+
+
+def _take_snapshot():
+    """Return a snapshot of the traced memory without the allocations of `tracemalloc` itself."""
+    return tracemalloc.take_snapshot().filter_traces((tracemalloc.Filter(False, tracemalloc.__file__),))
+
+
+class StageProfiler(object):
+
+    """Profiler of the CPU and memory usage of the stages of a :class:`~neurodatapub.project.NeuroDataPubProject`.
+
+    Each stage is profiled separately: when a stage starts inside another one,
+    the profile of the outer stage is paused, such that the profile of a
+    stage only covers the code run outside of its inner stages. The Datalad
+    commands called in process are included, while the work of the
+    subprocesses (`rsync`, `git`, `git-annex`) is accounted by their
+    resource usage (`resource.getrusage(resource.RUSAGE_CHILDREN)`), which
+    only includes the subprocesses that have terminated.
+
+    For each stage, the run directory receives the CPU profile
+    `<index>-<stage>.prof` (to be read with :mod:`pstats` or `snakeviz`)
+    and the top allocations `<index>-<stage>.allocations.txt`, and the
+    summary of all stages is written in `profile-summary.json`.
+
+    Parameters
+    ----------
+    output_dir : string
+        Run directory of the profiles
+
+    mode : {"cpu", "memory", "both"}
+        What is profiled (Default: `"both"`)
+
+    top : int
+        Number of allocation sites reported per stage (Default: `25`)
+    """
+
+    def __init__(self, output_dir, mode='both', top=25):
+        """Constructor of :class:`StageProfiler` object."""
+        if mode not in PROFILE_MODES:
+            raise ValueError(f'Unknown profile mode {mode} (should be one of {PROFILE_MODES})')
+        self.output_dir = os.path.abspath(output_dir)
+        self.mode = mode
+        self.top = top
+        self.stages = []
+        self._stack = []
+        self._count = 0
+        self._started_tracemalloc = False
+
+    @property
+    def cpu(self):
+        """`True` if the CPU usage is profiled."""
+        return self.mode in ('cpu', 'both')
+
+    @property
+    def memory(self):
+        """`True` if the memory allocations are traced."""
+        return self.mode in ('memory', 'both')
+
+    def _traced_peak(self):
+        """Return the peak of the traced memory since the last reset and reset it."""
+        peak = tracemalloc.get_traced_memory()[1]
+        if hasattr(tracemalloc, 'reset_peak'):
+            # Python >= 3.9, otherwise the peak is the one since tracing started
+            tracemalloc.reset_peak()
+        return peak
+
+    @contextlib.contextmanager
+    def profile(self, stage):
+        """
+        Context manager that profiles a block of code as the stage `stage`.
+
+        Parameters
+        ----------
+        stage : string
+            Name of the stage
+        """
+        parent = self._stack[-1] if self._stack else None
+        if parent is not None:
+            if parent['profiler'] is not None:
+                parent['profiler'].disable()
+            if self.memory:
+                parent['peak'] = max(parent['peak'], self._traced_peak())
+        elif self.memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracemalloc = True
+
+        frame = dict(
+            stage=stage,
+            index=self._count + 1,
+            profiler=cProfile.Profile() if self.cpu else None,
+            peak=0,
+            snapshot=None,
+            children=resource.getrusage(resource.RUSAGE_CHILDREN),
+            self_usage=resource.getrusage(resource.RUSAGE_SELF),
+            start=time.monotonic()
+        )
+        if self.memory:
+            self._traced_peak()
+            frame['snapshot'] = _take_snapshot()
+        self._count += 1
+        self._stack.append(frame)
+        if frame['profiler'] is not None:
+            frame['profiler'].enable()
+        try:
+            yield
+        finally:
+            if frame['profiler'] is not None:
+                frame['profiler'].disable()
+            self._stack.pop()
+            record = self._finish(frame)
+            self.stages.append(record)
+            if parent is not None:
+                if self.memory:
+                    parent['peak'] = max(parent['peak'], record['traced_peak'])
+                if parent['profiler'] is not None:
+                    parent['profiler'].enable()
+            else:
+                if self._started_tracemalloc:
+                    tracemalloc.stop()
+                    self._started_tracemalloc = False
+                self.write_summary()
+
+    def _finish(self, frame):
+        """Write the profiles of a stage and return its record in the summary."""
+        os.makedirs(self.output_dir, exist_ok=True)
+        name = re.sub(r'[^A-Za-z0-9_.-]', '_', frame['stage'])
+        prefix = os.path.join(self.output_dir, f"{frame['index']:03d}-{name}")
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        self_usage = resource.getrusage(resource.RUSAGE_SELF)
+        record = dict(
+            stage=frame['stage'],
+            index=frame['index'],
+            duration=time.monotonic() - frame['start'],
+            cpu_time=((self_usage.ru_utime - frame['self_usage'].ru_utime) +
+                      (self_usage.ru_stime - frame['self_usage'].ru_stime)),
+            # Peak of the process since it started
+            max_rss=_maxrss_bytes(self_usage),
+            children=dict(
+                user_time=children.ru_utime - frame['children'].ru_utime,
+                system_time=children.ru_stime - frame['children'].ru_stime,
+                # Largest of the terminated subprocesses since the process started
+                max_rss=_maxrss_bytes(children),
+                block_inputs=children.ru_inblock - frame['children'].ru_inblock,
+                block_outputs=children.ru_oublock - frame['children'].ru_oublock
+            )
+        )
+        if frame['profiler'] is not None:
+            record['cpu_profile'] = f'{prefix}.prof'
+            frame['profiler'].dump_stats(record['cpu_profile'])
+        if frame['snapshot'] is not None:
+            frame['peak'] = max(frame['peak'], self._traced_peak())
+            stats = _take_snapshot().compare_to(frame['snapshot'], 'lineno')
+            record['traced_peak'] = frame['peak']
+            record['allocated'] = sum(stat.size_diff for stat in stats if stat.size_diff > 0)
+            record['allocations_report'] = f'{prefix}.allocations.txt'
+            with open(record['allocations_report'], 'w') as f:
+                f.write(f"Top {self.top} allocation sites of the stage {frame['stage']} "
+                        f"(peak of traced memory: {format_size(frame['peak'])})\n\n")
+                for stat in stats[:self.top]:
+                    f.write(f'{stat}\n')
+        return record
+
+    def write_summary(self):
+        """Write the summary of the profiled stages in the run directory and return its path."""
+        os.makedirs(self.output_dir, exist_ok=True)
+        summary_file = os.path.join(self.output_dir, PROFILE_SUMMARY_FILE)
+        with open(summary_file, 'w') as f:
+            json.dump(dict(mode=self.mode, stages=self.stages), f, indent=4)
+        return summary_file
+
+
+def format_profile_summary(stages, top_functions=0):
+    """
+    Format the summary of the profiled stages as a table.
+
+    Parameters
+    ----------
+    stages : list of dict
+        Records of the stages (`StageProfiler.stages`)
+
+    top_functions : int
+        Number of the most time-consuming functions listed
+        per stage from its CPU profile (Default: `0`)
+
+    Returns
+    -------
+    summary : string
+        Formatted summary
+    """
+    lines = [f"{'Stage':<24}{'Duration':>10}{'CPU':>10}{'Children CPU':>14}"
+             f"{'Peak RSS':>12}{'Traced peak':>13}{'Allocated':>12}"]
+    for record in sorted(stages, key=lambda record: record['index']):
+        children = record['children']
+        traced_peak = format_size(record['traced_peak']) if 'traced_peak' in record else '-'
+        allocated = format_size(record['allocated']) if 'allocated' in record else '-'
+        lines.append(
+            f"{record['stage']:<24}{record['duration']:>9.1f}s{record['cpu_time']:>9.1f}s"
+            f"{children['user_time'] + children['system_time']:>13.1f}s"
+            f"{format_size(record['max_rss']):>12}{traced_peak:>13}{allocated:>12}"
+        )
+        if top_functions and record.get('cpu_profile'):
+            stats = pstats.Stats(record['cpu_profile'])
+            for (filename, lineno, function), stat in sorted(
+                    stats.stats.items(), key=lambda item: item[1][2], reverse=True)[:top_functions]:
+                lines.append(f"    {stat[2]:>8.2f}s  {os.path.basename(filename)}:{lineno}({function})")
+    return '\n'.join(lines)
@@ -0,0 +1,128 @@
+# Copyright © 2021-2022 Connectomics Lab
+# University Hospital Center and University of Lausanne (UNIL-CHUV), Switzerland,
+# and contributors
+#
+#  This software is distributed under the open-source license Apache 2.0.
+
+"""`neurodatapub.utils.pubstate`: utils functions to record the state of a Datalad dataset at its last publication."""
+
+import os
+import json
+import time
+import tempfile
+import contextlib
+import subprocess
+
+from .process import run
+
+
+def get_publication_state_file(datalad_dataset_dir):
+    """Return the file where the published states of a Datalad dataset are recorded."""
+    return os.path.join(datalad_dataset_dir, '.git', 'neurodatapub', 'published.json')
+
+
+def get_repository_state(datalad_dataset_dir):
+    """
+    Return the state of the repository of a Datalad dataset.
+
+    Parameters
+    ----------
+    datalad_dataset_dir : string
+        Local path of the Datalad dataset
+
+    Returns
+    -------
+    state : dict
+        Dictionary with the `"commit"` of `HEAD` and the commit of the
+        `git-annex` branch (`"annex"`), that records where the annexed
+        content is, or `None` if the repository has no commit
+    """
+    try:
+        proc = run(
+            'git rev-parse --verify -q HEAD && git rev-parse --verify -q refs/heads/git-annex',
+            cwd=datalad_dataset_dir
+        )
+    except subprocess.CalledProcessError:
+        return None
+    commit, annex = proc.stdout.decode().split()
+    return dict(commit=commit, annex=annex)
+
+
+def get_worktree_changes(datalad_dataset_dir):
+    """
+    Return the paths of the files of a Datalad dataset modified, added or removed since the last commit.
+
+    It relies on `git status`, which only reads the files whose
+    timestamps changed since they were last seen by git.
+
+    Parameters
+    ----------
+    datalad_dataset_dir : string
+        Local path of the Datalad dataset
+
+    Returns
+    -------
+    paths : list of string
+        Relative paths of the changed files
+    """
+    proc = run('git status --porcelain=v1 -z --untracked-files=all', cwd=datalad_dataset_dir)
+    entries = iter(os.fsdecode(proc.stdout).split('\0'))
+    paths = []
+    for entry in entries:
+        if not entry:
+            continue
+        status, path = entry[:2], entry[3:]
+        paths.append(path)
+        if 'R' in status or 'C' in status:
+            # The source of a rename or a copy follows its destination
+            paths.append(next(entries))
+    return paths
+
+
+def is_ancestor(datalad_dataset_dir, commit):
+    """Return `True` if `commit` exists and is an ancestor of `HEAD` in the Datalad dataset."""
+    try:
+        run(f'git merge-base --is-ancestor {commit} HEAD', cwd=datalad_dataset_dir)
+    except subprocess.CalledProcessError:
+        return False
+    return True
+
+
+def load_publication_states(datalad_dataset_dir):
+    """Return the published states of a Datalad dataset indexed by sibling name (empty if never published)."""
+    state_file = get_publication_state_file(datalad_dataset_dir)
+    try:
+        with open(state_file, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def record_publication_state(datalad_dataset_dir, sibling_name, state):
+    """
+    Record the state of a Datalad dataset successfully published to a sibling.
+
+    Parameters
+    ----------
+    datalad_dataset_dir : string
+        Local path of the Datalad dataset
+
+    sibling_name : string
+        Name of the sibling to which the dataset has been pushed
+
+    state : dict
+        State of the repository returned by :func:`get_repository_state`
+    """
+    state_file = get_publication_state_file(datalad_dataset_dir)
+    os.makedirs(os.path.dirname(state_file), exist_ok=True)
+    states = load_publication_states(datalad_dataset_dir)
+    states[sibling_name] = dict(state, time=time.strftime('%Y-%m-%dT%H:%M:%S%z'))
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(state_file), prefix='.published.')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(states, f, indent=4)
+        os.replace(tmp_path, state_file)
+    except BaseException:
+        with contextlib.suppress(OSError):
+            os.remove(tmp_path)
+        raise
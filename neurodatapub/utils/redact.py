@@ -0,0 +1,38 @@
+# Copyright © 2021-2022 Connectomics Lab
+# University Hospital Center and University of Lausanne (UNIL-CHUV), Switzerland,
+# and contributors
+#
+#  This software is distributed under the open-source license Apache 2.0.
+
+"""`neurodatapub.utils.redact`: utils function to hide the secrets of command lines."""
+
+import re
+
+# Arguments of the commands whose value is a secret
+# (token, or login of the versions that passed the token as login)
+_SECRET_PATTERNS = [
+    (re.compile(r'(hub\.oauthtoken\s+)("[^"]*"|\'[^\']*\'|\S+)'), r'\1***'),
+    (re.compile(r'(OSF_TOKEN=)("[^"]*"|\'[^\']*\'|\S+)'), r'\1"***"'),
+    (re.compile(r'(--github-login[\s=]+)("[^"]*"|\'[^\']*\'|\S+)'), r'\1***'),
+]
+
+
+def redact_secrets(text):
+    """
+    Hide the secrets given on command lines (`hub.oauthtoken`, `OSF_TOKEN=`, `--github-login`).
+
+    Parameters
+    ----------
+    text : string
+        Command line, log or message
+
+    Returns
+    -------
+    text : string
+        Text with the values of the secrets replaced by `***`
+    """
+    if not text:
+        return text
+    for pattern, replacement in _SECRET_PATTERNS:
+        text = pattern.sub(replacement, text)
+    return text
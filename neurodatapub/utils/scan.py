@@ -0,0 +1,433 @@
+# Copyright © 2021-2022 Connectomics Lab
+# University Hospital Center and University of Lausanne (UNIL-CHUV), Switzerland,
+# and contributors
+#
+#  This software is distributed under the open-source license Apache 2.0.
+
+"""`neurodatapub.utils.scan`: utils functions to scan the content of a dataset directory in parallel."""
+
+import os
+import sys
+import gzip
+import json
+import hashlib
+from array import array
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+# Directories that are never scanned
+EXCLUDED_DIRS = ['.git']
+
+# Flags of the entries of a file table
+FLAG_SYMLINK = 1
+
+# Magic number of the file table files
+_MAGIC = b'NDPSCAN1'
+
+FileEntry = namedtuple('FileEntry', ['path', 'size', 'mtime', 'inode', 'flags'])
+FileEntry.__doc__ = """Entry of a :class:`FileTable` (`mtime` is in nanoseconds)."""
+
+
+class FileTable(object):
+
+    """Compact table of the files of a directory tree.
+
+    Paths are stored in a single byte buffer and the sizes, modification times
+    (in ns), inodes and flags in typed arrays, which keeps the memory footprint
+    of trees with millions of files low.
+    The table also records the scanned directories and their modification times,
+    used by :func:`scan_directory` to rescan only the modified directories.
+
+    Attributes
+    ----------
+    root : string
+        Absolute path of the scanned directory
+
+    sizes, mtimes, inodes : array.array
+        Sizes in bytes, modification times in ns and inodes of the files
+
+    flags : array.array
+        Flags of the files (`FLAG_SYMLINK` if the file is a symlink)
+
+    dirs : list of string
+        Relative paths of the scanned directories (`""` for the root)
+
+    dir_mtimes : array.array
+        Modification times in ns of the scanned directories
+
+    Examples
+    --------
+    >>> table = scan_directory('/path/to/bids/dataset') # doctest: +SKIP
+    >>> len(table), table.total_bytes # doctest: +SKIP
+    (1234, 56789)
+    >>> table.get('dataset_description.json') # doctest: +SKIP
+    FileEntry(path='dataset_description.json', size=42, ...)
+    """
+
+    def __init__(self, root=None):
+        """Constructor of :class:`FileTable` object."""
+        self.root = os.path.abspath(root) if root is not None else None
+        self._names = bytearray()
+        self._offsets = array('q', [0])
+        self.sizes = array('q')
+        self.mtimes = array('q')
+        self.inodes = array('q')
+        self.flags = array('B')
+        self.dirs = []
+        self.dir_mtimes = array('q')
+        self._index = None
+
+    def append(self, path, size, mtime, inode=0, flags=0):
+        """Append a file to the table."""
+        self._names += path.encode('utf-8', 'surrogateescape')
+        self._offsets.append(len(self._names))
+        self.sizes.append(size)
+        self.mtimes.append(mtime)
+        self.inodes.append(inode)
+        self.flags.append(flags)
+        self._index = None
+
+    def path(self, i):
+        """Return the relative path of the `i`-th file."""
+        return self._names[self._offsets[i]:self._offsets[i + 1]].decode('utf-8', 'surrogateescape')
+
+    @property
+    def paths(self):
+        """Iterator over the relative paths of the files."""
+        return (self.path(i) for i in range(len(self)))
+
+    def entry(self, i):
+        """Return the `i`-th file as a :class:`FileEntry`."""
+        return FileEntry(self.path(i), self.sizes[i], self.mtimes[i], self.inodes[i], self.flags[i])
+
+    def get(self, path):
+        """Return the :class:`FileEntry` of the file at relative `path`, or `None`."""
+        if self._index is None:
+            self._index = {p: i for i, p in enumerate(self.paths)}
+        i = self._index.get(path)
+        return self.entry(i) if i is not None else None
+
+    @property
+    def total_bytes(self):
+        """Total size of the files in bytes."""
+        return sum(self.sizes)
+
+    def __len__(self):
+        """Return the number of files."""
+        return len(self.sizes)
+
+    def __iter__(self):
+        """Iterate over the files as :class:`FileEntry`."""
+        return (self.entry(i) for i in range(len(self)))
+
+    def __contains__(self, path):
+        """Return `True` if the table contains the file at relative `path`."""
+        return self.get(path) is not None
+
+    def __repr__(self):
+        """Define how a :class:`FileTable` object is rendered in `print()`."""
+        return f'FileTable(root={self.root!r}, files={len(self)}, bytes={self.total_bytes})'
+
+    def sorted(self):
+        """Return a copy of the table with the files sorted by path."""
+        paths = list(self.paths)
+        table = FileTable()
+        table.root = self.root
+        for i in sorted(range(len(paths)), key=paths.__getitem__):
+            table.append(paths[i], self.sizes[i], self.mtimes[i], self.inodes[i], self.flags[i])
+        order = sorted(range(len(self.dirs)), key=self.dirs.__getitem__)
+        table.dirs = [self.dirs[i] for i in order]
+        table.dir_mtimes = array('q', (self.dir_mtimes[i] for i in order))
+        return table
+
+    def filtered(self, predicate):
+        """
+        Return a copy of the table with only the files whose path satisfies `predicate`.
+
+        The directories are not kept, as the copy does not describe
+        their whole content and must not be used as a scan cache.
+        """
+        table = FileTable()
+        table.root = self.root
+        for i, path in enumerate(self.paths):
+            if predicate(path):
+                table.append(path, self.sizes[i], self.mtimes[i], self.inodes[i], self.flags[i])
+        return table
+
+    def diff(self, other):
+        """
+        Compare the table to a previous table of the same tree.
+
+        Parameters
+        ----------
+        other : FileTable
+            Previous table
+
+        Returns
+        -------
+        added, removed, modified : list of string
+            Relative paths of the files that have been added, removed,
+            or whose size or modification time changed since `other`
+        """
+        added, modified = [], []
+        for entry in self:
+            previous = other.get(entry.path)
+            if previous is None:
+                added.append(entry.path)
+            elif previous.size != entry.size or previous.mtime != entry.mtime:
+                modified.append(entry.path)
+        removed = [path for path in other.paths if path not in self]
+        return added, removed, modified
+
+    def updated(self, paths):
+        """
+        Return a copy of the table in which the files at or under `paths` are scanned again.
+
+        Parameters
+        ----------
+        paths : iterable of string
+            Relative paths of files or directories that changed
+
+        Returns
+        -------
+        table : FileTable
+            Updated table sorted by path
+        """
+        changed = set()
+        for path in sorted(paths):
+            # Skip the paths already covered by a changed parent directory
+            parent = os.path.dirname(path)
+            while parent and parent not in changed:
+                parent = os.path.dirname(parent)
+            if not parent:
+                changed.add(path)
+        prefixes = tuple(path + os.sep for path in changed)
+        table = FileTable()
+        table.root = self.root
+        for entry in self:
+            if entry.path not in changed and not entry.path.startswith(prefixes):
+                table.append(*entry)
+        for path in changed:
+            fullpath = os.path.join(self.root, path)
+            if os.path.isdir(fullpath):
+                for entry in scan_directory(fullpath):
+                    table.append(os.path.join(path, entry.path), *entry[1:])
+            elif os.path.isfile(fullpath):
+                st = os.stat(fullpath)
+                flags = FLAG_SYMLINK if os.path.islink(fullpath) else 0
+                table.append(path, st.st_size, st.st_mtime_ns, st.st_ino, flags)
+        return table.sorted()
+
+    def write_file_list(self, fileobj, paths=None):
+        """
+        Write NUL-separated relative paths, as expected by `rsync --from0 --files-from`.
+
+        Parameters
+        ----------
+        fileobj : file object
+            File opened in binary mode
+
+        paths : list of string
+            Paths to be written (Default: all files of the table)
+        """
+        if paths is None:
+            paths = self.paths
+        for path in paths:
+            fileobj.write(path.encode('utf-8', 'surrogateescape') + b'\0')
+
+    def save(self, filename):
+        """Save atomically the table in a gzip-compressed binary file."""
+        os.makedirs(os.path.dirname(os.path.abspath(filename)), exist_ok=True)
+        header = dict(
+            root=self.root,
+            nfiles=len(self),
+            ndirs=len(self.dirs),
+            byteorder=sys.byteorder
+        )
+        dir_names = '\0'.join(self.dirs).encode('utf-8', 'surrogateescape')
+        tmp_file = f'{filename}.{os.getpid()}.tmp'
+        with gzip.open(tmp_file, 'wb', compresslevel=1) as f:
+            f.write(_MAGIC)
+            f.write(json.dumps(header).encode() + b'\n')
+            for arr in [self._offsets, self.sizes, self.mtimes, self.inodes, self.flags, self.dir_mtimes]:
+                arr.tofile(f)
+            f.write(bytes(self._names))
+            f.write(dir_names)
+        os.replace(tmp_file, filename)
+
+    @classmethod
+    def load(cls, filename):
+        """Load a table saved with :meth:`save`."""
+        with gzip.open(filename, 'rb') as f:
+            if f.read(len(_MAGIC)) != _MAGIC:
+                raise ValueError(f'{filename} is not a file table')
+            header = json.loads(f.readline())
+            table = cls()
+            table.root = header['root']
+            nfiles, ndirs = header['nfiles'], header['ndirs']
+            table._offsets = array('q')
+            arrays = [
+                (table._offsets, nfiles + 1), (table.sizes, nfiles), (table.mtimes, nfiles),
+                (table.inodes, nfiles), (table.flags, nfiles), (table.dir_mtimes, ndirs)
+            ]
+            for arr, n in arrays:
+                arr.frombytes(f.read(n * arr.itemsize))
+                if len(arr) != n:
+                    raise ValueError(f'{filename} is truncated')
+                if header['byteorder'] != sys.byteorder:
+                    arr.byteswap()
+            table._names = bytearray(f.read(table._offsets[-1]))
+            dir_names = f.read().decode('utf-8', 'surrogateescape')
+            table.dirs = dir_names.split('\0') if ndirs else []
+        return table
+
+
+def get_cache_dir():
+    """Return the directory where `neurodatapub` caches data (`$XDG_CACHE_HOME/neurodatapub`)."""
+    cache_home = os.environ.get(
+        'XDG_CACHE_HOME',
+        os.path.join(os.path.expanduser('~'), '.cache')
+    )
+    return os.path.join(cache_home, 'neurodatapub')
+
+
+def get_scan_cache_file(root):
+    """Return the default path of the cache file of the scan of `root`."""
+    digest = hashlib.sha1(os.path.abspath(root).encode()).hexdigest()
+    return os.path.join(get_cache_dir(), 'scans', f'{digest}.ndpscan')
+
+
+def _cached_dirs_from_table(table):
+    """Return the entries of the directories of a table in the format of `_scan_single_dir()`."""
+    cached_dirs = {
+        reldir: dict(mtime=mtime, files=[], dirs=[])
+        for reldir, mtime in zip(table.dirs, table.dir_mtimes)
+    }
+    for reldir in table.dirs:
+        if reldir:
+            parent, name = os.path.split(reldir)
+            if parent in cached_dirs:
+                cached_dirs[parent]['dirs'].append(name)
+    for entry in table:
+        parent, name = os.path.split(entry.path)
+        if parent in cached_dirs:
+            cached_dirs[parent]['files'].append(
+                (name, entry.size, entry.mtime, entry.inode, entry.flags)
+            )
+    return cached_dirs
+
+
+def _scan_single_dir(root, reldir, ancestors, cached_dirs):
+    """Scan one directory.
+
+    If the modification time of the directory did not change since the cached scan,
+    its list of entries is reused and the files are not stat-ed again.
+
+    Returns
+    -------
+    dir_entry : dict
+        `{"mtime": ..., "files": [(name, size, mtime_ns, inode, flags), ...], "dirs": [name, ...]}`,
+        or `None` if the directory is one of its `ancestors` (symlink loop)
+
+    ancestors : frozenset
+        `(device, inode)` of the directory and its ancestors
+    """
+    path = os.path.join(root, reldir) if reldir else root
+    st = os.stat(path)
+    # Do not follow symlinks that loop to a parent directory
+    if (st.st_dev, st.st_ino) in ancestors:
+        return None, ancestors
+    ancestors = ancestors | {(st.st_dev, st.st_ino)}
+    cached = cached_dirs.get(reldir)
+    if cached is not None and cached['mtime'] == st.st_mtime_ns:
+        return cached, ancestors
+    files, dirs = [], []
+    with os.scandir(path) as it:
+        for entry in it:
+            try:
+                if entry.is_dir():
+                    if entry.name not in EXCLUDED_DIRS:
+                        dirs.append(entry.name)
+                elif entry.is_file():
+                    entry_st = entry.stat()
+                    flags = FLAG_SYMLINK if entry.is_symlink() else 0
+                    files.append(
+                        (entry.name, entry_st.st_size, entry_st.st_mtime_ns, entry_st.st_ino, flags)
+                    )
+            except OSError:
+                # Broken symlink or file removed during the scan
+                continue
+    return dict(mtime=st.st_mtime_ns, files=files, dirs=dirs), ancestors
+
+
+def scan_directory(root, jobs=None, cache_file=None):
+    """
+    Scan in parallel the content of a directory with `os.scandir()`.
+
+    Directories are scanned concurrently by a pool of threads, which hides
+    the latency of metadata operations on network filesystems. Symlinks are
+    followed as `rsync -L` does. The `.git` directories are excluded.
+
+    If `cache_file` is given, the table is saved in it and reused in the next scans:
+    the entries of directories whose modification time did not change are taken from the
+    cache without being stat-ed again. Note that the modification of the content of a file
+    does not change the modification time of its directory, such that the sizes
+    of such files in a cached scan may be outdated.
+
+    Parameters
+    ----------
+    root : string
+        Path of the directory to scan
+
+    jobs : int
+        Number of threads (Default: `min(32, 4 * os.cpu_count())`)
+
+    cache_file : string
+        Path to the cache file of the scan (Default: `None`)
+
+    Returns
+    -------
+    table : FileTable
+        Table of all files sorted by path
+    """
+    if jobs is None:
+        jobs = min(32, 4 * (os.cpu_count() or 1))
+
+    cached_dirs = {}
+    if cache_file is not None and os.path.exists(cache_file):
+        try:
+            cached_table = FileTable.load(cache_file)
+            if cached_table.root == os.path.abspath(root):
+                cached_dirs = _cached_dirs_from_table(cached_table)
+        except (OSError, ValueError, KeyError, EOFError) as e:
+            print(f'\t* WARNING: Could not load scan cache {cache_file}: {e}')
+
+    scanned_dirs = {}
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        pending = {executor.submit(_scan_single_dir, root, '', frozenset(), cached_dirs): ''}
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                reldir = pending.pop(future)
+                dir_entry, ancestors = future.result()
+                if dir_entry is None:
+                    continue
+                scanned_dirs[reldir] = dir_entry
+                for name in dir_entry['dirs']:
+                    subdir = os.path.join(reldir, name) if reldir else name
+                    pending[executor.submit(
+                        _scan_single_dir, root, subdir, ancestors, cached_dirs
+                    )] = subdir
+
+    table = FileTable(root)
+    for reldir in sorted(scanned_dirs):
+        dir_entry = scanned_dirs[reldir]
+        table.dirs.append(reldir)
+        table.dir_mtimes.append(dir_entry['mtime'])
+        for name, size, mtime, inode, flags in dir_entry['files']:
+            table.append(os.path.join(reldir, name) if reldir else name, size, mtime, inode, flags)
+    table = table.sorted()
+
+    if cache_file is not None:
+        table.save(cache_file)
+    return table
@@ -0,0 +1,260 @@
+# Copyright © 2021-2022 Connectomics Lab
+# University Hospital Center and University of Lausanne (UNIL-CHUV), Switzerland,
+# and contributors
+#
+#  This software is distributed under the open-source license Apache 2.0.
+
+"""`neurodatapub.utils.script`: utils functions to generate the bash script of the commands."""
+
+import os
+import datetime
+
+from neurodatapub.info import __version__
+
+# Shell variables defined in the header of the generated script
+# that can be used in the commands recorded in a ScriptPlan
+SCRIPT_JOBS_VAR = '${NEURODATAPUB_JOBS}'
+SCRIPT_NPROC_VAR = '${NEURODATAPUB_NPROC}'
+
+
+class ScriptStep(object):
+
+    """Command recorded as a step of a :class:`ScriptPlan`.
+
+    Attributes
+    ----------
+    name : string
+        Unique name of the step (used to name the shell function
+        and the completion marker of the step)
+
+    msg : string
+        Message describing the step
+
+    cmd : string
+        Bash command(s) executed by the step
+
+    depends_on : list of string
+        Names of the steps that should be completed before this step
+
+    check : string
+        Optional shell condition that, if true, indicates the step
+        has already been completed outside of the script
+    """
+
+    def __init__(self, name, msg, cmd, depends_on=None, check=None):
+        """Constructor of :class:`ScriptStep` object."""
+        self.name = name
+        self.msg = msg
+        self.cmd = cmd
+        self.depends_on = list(depends_on) if depends_on else []
+        self.check = check
+
+
+class ScriptPlan(object):
+
+    """Structured plan of the commands generated in `"generate_script"` mode.
+
+    Steps are recorded with their dependencies such that the plan can be rendered
+    as a script that runs independent steps in parallel as background jobs,
+    separated by `wait` barriers.
+
+    Attributes
+    ----------
+    steps : list of ScriptStep
+        Recorded steps in order of recording
+
+    name : string
+        Name of the script, `neurodatapub_DD-MM-YYYY_hh-mm-ss`, also given
+        to the files the steps depend on (e.g. the list of selected files)
+    """
+
+    def __init__(self):
+        """Constructor of :class:`ScriptPlan` object."""
+        self.steps = []
+        self.name = f'neurodatapub_{datetime.datetime.now().strftime("%d-%m-%Y_%H-%M-%S")}'
+
+    def add_step(self, name, msg, cmd, depends_on=None, check=None):
+        """Record a new step in the plan.
+
+        Parameters
+        ----------
+        name : string
+            Unique name of the step
+
+        msg : string
+            Message describing the step
+
+        cmd : string
+            Bash command(s) executed by the step
+
+        depends_on : list of string
+            Names of the steps that should be completed before this step.
+            Dependencies on steps that are not part of the plan are ignored.
+
+        check : string
+            Optional shell condition that, if true, indicates the step
+            has already been completed
+        """
+        if cmd is None:
+            return
+        if name in [step.name for step in self.steps]:
+            raise ValueError(f'Step {name} is already recorded in the plan')
+        self.steps.append(
+            ScriptStep(name=name, msg=msg, cmd=cmd, depends_on=depends_on, check=check)
+        )
+
+    def stages(self):
+        """Group the steps in stages of steps that can run in parallel.
+
+        Returns
+        -------
+        stages : list of list of ScriptStep
+            Each stage only depends on the steps of the previous stages
+        """
+        names = [step.name for step in self.steps]
+        level = {}
+        for step in self.steps:
+            # Steps are recorded in execution order, so that
+            # the dependencies of a step are always leveled before it
+            deps = [dep for dep in step.depends_on if dep in names]
+            level[step.name] = 1 + max([level[dep] for dep in deps], default=-1)
+        stages = [[] for _ in range(1 + max(level.values(), default=-1))]
+        for step in self.steps:
+            stages[level[step.name]].append(step)
+        return stages
+
+    def render(self, jobs='auto', state_dir=None):
+        """Render the plan as a re-runnable shell script.
+
+        Parameters
+        ----------
+        jobs : string or int
+            Default value of the number of parallel jobs used by
+            `datalad save` and `datalad push`. It can be overwritten
+            by the `NEURODATAPUB_JOBS` environment variable when
+            the script is executed
+            (Default: `"auto"`)
+
+        state_dir : string
+            Default directory where the completion markers of the steps
+            are stored. It can be overwritten by the `NEURODATAPUB_STATE_DIR`
+            environment variable when the script is executed
+            (Default: `.neurodatapub_state` next to the script)
+
+        Returns
+        -------
+        script : string
+            Content of the shell script
+        """
+        if state_dir is None:
+            state_dir = '$(dirname "$0")/.neurodatapub_state'
+        now = datetime.datetime.now()
+        script = f"""#!/bin/sh
+#
+# Generated by neurodatapub {__version__} on {now.strftime("%d-%m-%Y %H:%M:%S")}
+#
+# Independent steps run in parallel as background jobs separated by wait barriers.
+# Completed steps are recorded in $NEURODATAPUB_STATE_DIR so that the script
+# can be safely re-run after a failure.
+
+NEURODATAPUB_JOBS="${{NEURODATAPUB_JOBS:-{jobs}}}"
+if [ "$NEURODATAPUB_JOBS" = "auto" ]; then
+    NEURODATAPUB_NPROC="$(nproc 2>/dev/null || getconf _NPROCESSORS_ONLN 2>/dev/null || echo 4)"
+else
+    NEURODATAPUB_NPROC="$NEURODATAPUB_JOBS"
+fi
+NEURODATAPUB_STATE_DIR="${{NEURODATAPUB_STATE_DIR:-{state_dir}}}"
+mkdir -p "$NEURODATAPUB_STATE_DIR" || exit 1
+
+run_step() {{
+    if [ -f "$NEURODATAPUB_STATE_DIR/$1.done" ]; then
+        echo "> Skip $1 (already completed)"
+        return 0
+    fi
+    echo "> Run $1"
+    # Not called in a condition so that "set -e" applies in the step
+    "step_$1"
+    step_status=$?
+    if [ "$step_status" -eq 0 ]; then
+        touch "$NEURODATAPUB_STATE_DIR/$1.done"
+    else
+        echo "> ERROR: $1 failed" >&2
+    fi
+    return "$step_status"
+}}
+
+wait_all() {{
+    status=0
+    for pid in "$@"; do
+        wait "$pid" || status=1
+    done
+    [ "$status" -eq 0 ] || exit 1
+}}
+
+"""
+        for step in self.steps:
+            script += f'# {step.msg}\n'
+            script += f'step_{step.name}() (\n'
+            script += '    set -e\n'
+            if step.check:
+                script += f'    if {step.check}; then exit 0; fi\n'
+            # Commands are not re-indented to keep here-documents valid
+            cmd = step.cmd.strip('\n')
+            script += f'{cmd}\n'
+            script += ')\n\n'
+
+        for i, stage in enumerate(self.stages()):
+            script += f'# Stage {i + 1}\n'
+            if len(stage) == 1:
+                script += f'run_step {stage[0].name}\n'
+                script += '[ $? -eq 0 ] || exit 1\n\n'
+            else:
+                script += 'pids=""\n'
+                for step in stage:
+                    script += f'run_step {step.name} &\n'
+                    script += 'pids="$pids $!"\n'
+                script += 'wait_all $pids\n\n'
+        script += 'echo "> All steps completed"\n'
+        return script
+
+
+def write_script(script_plan, dataset_dir, jobs='auto'):
+    """
+    Write the script rendered from a :class:`ScriptPlan` in the `code/` folder of the dataset.
+
+    The script is called `<name of the plan>.sh`, i.e. `neurodatapub_DD-MM-YYYY_hh-mm-ss.sh`.
+    If the `code/` folder does not exist, it is created.
+
+    Parameters
+    ----------
+    script_plan : ScriptPlan
+        Plan of the commands to be recorded
+
+    dataset_dir : string
+        Local path of the input dataset
+
+    jobs : string or int
+        Default number of parallel jobs for `datalad save` and `datalad push`
+        (Default: `"auto"`)
+
+    Returns
+    -------
+    script_path : string
+        Path to the generated script
+    """
+    # Name of the script with the time stamp of the plan
+    script_name = script_plan.name
+    # Create the code folder if it does not exist
+    code_dir = os.path.join(dataset_dir, 'code')
+    if not os.path.exists(code_dir):
+        os.makedirs(code_dir, exist_ok=True)
+    script_path = os.path.join(code_dir, f'{script_name}.sh')
+    script = script_plan.render(
+        jobs=jobs,
+        state_dir=f'$(dirname "$0")/.{script_name}_state'
+    )
+    with open(script_path, 'w') as f:
+        f.writelines(script)
+    # Make the script executable
+    os.chmod(script_path, 0o755)
+    return script_path
@@ -7,15 +7,65 @@
 """`neurodatapub.utils.sshconfig`: utils function to edit SSH config."""
 
 import os
+import re
+import fcntl
+import tempfile
+import contextlib
 from pathlib import Path
 from datetime import datetime
 
 
+def get_ssh_config_path():
+    """Return the path of the SSH config file of the user (``~/.ssh/config``)."""
+    return os.path.join(str(Path.home()), '.ssh', 'config')
+
+
+def has_ssh_config_entry(content, host):
+    """Return `True` if the SSH config `content` has a `Host` entry that matches exactly `host`."""
+    pattern = re.compile(r'^\s*Host\s+(.*)$', re.IGNORECASE | re.MULTILINE)
+    return any(host in match.group(1).split() for match in pattern.finditer(content))
+
+
+@contextlib.contextmanager
+def _locked(path):
+    """Context manager that holds an exclusive lock associated with `path`.
+
+    The lock is taken on a separate lock file, as `path` itself
+    is replaced while the lock is held.
+    """
+    with open(f'{path}.neurodatapub.lock', 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def _replace_atomically(path, content):
+    """Replace the content of `path` by writing a temporary file renamed over it."""
+    mode = os.stat(path).st_mode & 0o777 if os.path.exists(path) else 0o600
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.config.neurodatapub.')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(content)
+            f.flush()
+            os.fsync(f.fileno())
+        os.chmod(tmp_path, mode)
+        os.replace(tmp_path, path)
+    except BaseException:
+        with contextlib.suppress(OSError):
+            os.remove(tmp_path)
+        raise
+
+
 def update_ssh_config(sshurl, user, dryrun=False):
     """
     Add a new entry to the SSH config file (``~/.ssh/config``).
 
     It sets the default user login to the SSH special remote.
+    The entry is added at the beginning of the file, only if no entry
+    exists for the host. The update is atomic and serialized with a lock,
+    such that it is safe when several processes update the file concurrently.
 
     Parameters
     -----------
@@ -31,60 +81,50 @@ def update_ssh_config(sshurl, user, dryrun=False):
         do not execute them
         (Default: `False`)
     """
-    # Return cmd to None is no operation is performed
-    cmd = None
-
     # Remove "ssh://" prefix in SSH URL
     sshurl = sshurl.replace('ssh://', '')
 
-    # Path to ssh config file
-    ssh_config_path = os.path.join(
-        str(Path.home()),
-        '.ssh',
-        'config'
-    )
+    # Path to ssh config file (a symlinked config file is kept as a symlink)
+    ssh_config_path = os.path.realpath(get_ssh_config_path())
     print(f'\t* Add new entry in {ssh_config_path}')
 
-    # Save the current content of an existing ssh config file
-    content = None
-    if os.path.exists(ssh_config_path):
-        with open(ssh_config_path, 'r+') as ssh_config:
-            content = ssh_config.read()
-
-    # Add the entry if it does not exist in the existing ssh config file
-    with open(ssh_config_path, 'w+') as ssh_config:
-        if (content and (f'Host {sshurl}' not in content))\
-                or content is None:
-            hdr = [
-                '## Added by NeuroDataPub ',
-                f'({datetime.strftime(datetime.now(), "%d. %B %Y %I:%M%p")}) ##\n',
-
-            ]
-            lines = [
-                f'Host {sshurl} \n',
-                f'\tHostName {sshurl} \n',
-                f'\tUser {user} \n\n'
-            ]
-            try:
-                if not dryrun:
-                    ssh_config.writelines(hdr + lines)
-                print(f'\t  - Entry:\n\n{"".join(lines)}')
-                cmd = f"""cat << EOF >> {ssh_config_path}
-
-{hdr}
-Host {sshurl}
-    HostName {sshurl}
-    User {user}
-EOF
+    hdr = ('## Added by NeuroDataPub '
+           f'({datetime.strftime(datetime.now(), "%d. %B %Y %I:%M%p")}) ##\n')
+    lines = [
+        f'Host {sshurl}\n',
+        f'\tHostName {sshurl}\n',
+        f'\tUser {user}\n\n'
+    ]
+    entry = ''.join(lines)
+
+    # Equivalent command, idempotent and serialized with flock
+    lock_path = f'{ssh_config_path}.neurodatapub.lock'
+    printf_entry = (hdr + entry).replace('%', '%%').replace('\t', '\\t').replace('\n', '\\n')
+    host_pattern = sshurl.replace('.', '\\.')
+    cmd = f"""mkdir -p "{os.path.dirname(ssh_config_path)}" && touch "{ssh_config_path}" && (
+    flock 9
+    if ! grep -qE '^[[:space:]]*Host[[:space:]]+(.*[[:space:]])?{host_pattern}([[:space:]]|$)' "{ssh_config_path}"; then
+        {{ printf '{printf_entry}'; cat "{ssh_config_path}"; }} > "{ssh_config_path}.tmp" && mv "{ssh_config_path}.tmp" "{ssh_config_path}"
+    fi
+) 9> "{lock_path}"
 """
-            except Exception as e:
-                print(f'\t  - ERROR:\n\n{e}')
-        else:
-            print(f'\t  - INFO: Entry for `Host {sshurl}` already existing!\n\n')
-
-    # Append the previous content of the existing ssh config file
-    if content and not dryrun:
-        with open(ssh_config_path, 'a') as ssh_config:
-            ssh_config.write(content)
-
+    if dryrun:
+        return cmd
+
+    try:
+        os.makedirs(os.path.dirname(ssh_config_path), mode=0o700, exist_ok=True)
+        with _locked(ssh_config_path):
+            content = ''
+            if os.path.exists(ssh_config_path):
+                with open(ssh_config_path, 'r') as ssh_config:
+                    content = ssh_config.read()
+            if has_ssh_config_entry(content, sshurl):
+                print(f'\t  - INFO: Entry for `Host {sshurl}` already existing!\n\n')
+            else:
+                # The first matching entry is used by ssh:
+                # the new entry is added before the existing ones
+                _replace_atomically(ssh_config_path, hdr + entry + content)
+                print(f'\t  - Entry:\n\n{entry}')
+    except Exception as e:
+        print(f'\t  - ERROR:\n\n{e}')
     return cmd
@@ -0,0 +1,200 @@
+# Copyright © 2021-2022 Connectomics Lab
+# University Hospital Center and University of Lausanne (UNIL-CHUV), Switzerland,
+# and contributors
+#
+#  This software is distributed under the open-source license Apache 2.0.
+
+"""`neurodatapub.utils.symlinks`: utils functions to ingest the symbolic links of an input dataset."""
+
+import os
+import shlex
+import shutil
+import subprocess
+
+from .process import run
+from .scan import FLAG_SYMLINK
+
+# Policies of the ingestion of the symbolic links of the input dataset
+SYMLINK_POLICIES = ['dereference', 'preserve-internal', 'annex-once']
+
+
+def plan_symlinks(table, policy='dereference', paths=None):
+    """
+    Decide how the symbolic links of an input dataset are ingested in the Datalad dataset.
+
+    With the `"dereference"` policy, every link is copied as a regular file
+    (`rsync -L`). With `"preserve-internal"`, links resolving to a file of the
+    table are recreated as relative links to this file in the Datalad dataset,
+    the other links being dereferenced. `"annex-once"` preserves internal links
+    as well, and copies the content of the other links resolving to the same
+    file (or of hard links of a same file) only once: the other paths are added
+    with the git-annex key of the copied one (See :func:`add_duplicates`).
+
+    Parameters
+    ----------
+    table : neurodatapub.utils.scan.FileTable
+        Table of the files of the input dataset
+
+    policy : {"dereference", "preserve-internal", "annex-once"}
+        Policy of the ingestion of the links (Default: `"dereference"`)
+
+    paths : iterable of string
+        If given, only these relative paths of the table are ingested,
+        links can still resolve to any file of the table (Default: `None`)
+
+    Returns
+    -------
+    links : dict
+        Relative paths of the targets of the links to recreate,
+        indexed by the relative paths of the links
+
+    duplicates : dict
+        Relative paths of the files whose key is reused,
+        indexed by the relative paths of the duplicates
+    """
+    if policy not in SYMLINK_POLICIES:
+        raise ValueError(f'Unknown symlink policy {policy} (should be one of {SYMLINK_POLICIES})')
+    links, duplicates = {}, {}
+    if policy == 'dereference':
+        return links, duplicates
+    root = os.path.realpath(table.root)
+    root_device = os.stat(table.root).st_dev
+    selected = set(table.paths) if paths is None else set(paths)
+    groups = {}
+    for entry in table:
+        device = root_device
+        if entry.flags & FLAG_SYMLINK:
+            fullpath = os.path.join(table.root, entry.path)
+            relpath = os.path.relpath(os.path.realpath(fullpath), root)
+            if (entry.path in selected and relpath in table and relpath != entry.path
+                    and not relpath.startswith(os.pardir + os.sep)):
+                links[entry.path] = relpath
+                continue
+            try:
+                # Links may point to another filesystem
+                device = os.stat(fullpath).st_dev
+            except OSError:
+                continue
+        if policy == 'annex-once':
+            # Links resolving to the same file (and hard links) share its inode
+            groups.setdefault((device, entry.inode, entry.size), []).append(entry)
+    for entries in groups.values():
+        if len(entries) < 2:
+            continue
+        # Regular files are preferred as the copied file of a group
+        entries.sort(key=lambda entry: (entry.flags & FLAG_SYMLINK, entry.path))
+        for entry in entries[1:]:
+            if entry.path in selected:
+                duplicates[entry.path] = entries[0].path
+    return links, duplicates
+
+
+def create_symlinks(datalad_dataset_dir, links, dryrun=False):
+    """
+    Recreate the internal symbolic links of the input dataset in the Datalad dataset.
+
+    Parameters
+    ----------
+    datalad_dataset_dir : string
+        Local path of the Datalad dataset
+
+    links : dict
+        Relative paths of the targets indexed by the relative
+        paths of the links, as returned by :func:`plan_symlinks`
+
+    dryrun : bool
+        If `True`, only generates the commands and
+        do not execute them
+        (Default: `False`)
+
+    Returns
+    -------
+    `res` : int
+        Number of links created
+
+    `cmd` : string
+        Equivalent bash command
+    """
+    cmds = []
+    for path, target in sorted(links.items()):
+        fullpath = os.path.join(datalad_dataset_dir, path)
+        relative_target = os.path.relpath(target, os.path.dirname(path) or os.curdir)
+        cmds.append(f'mkdir -p {shlex.quote(os.path.dirname(fullpath))} && '
+                    f'ln -sfn {shlex.quote(relative_target)} {shlex.quote(fullpath)}')
+        if not dryrun:
+            os.makedirs(os.path.dirname(fullpath), exist_ok=True)
+            if os.path.lexists(fullpath):
+                os.remove(fullpath)
+            os.symlink(relative_target, fullpath)
+    return (None if dryrun else len(cmds)), '\n'.join(cmds)
+
+
+def add_duplicates(datalad_dataset_dir, duplicates, dryrun=False):
+    """
+    Add the duplicates of saved files to the Datalad dataset without copying nor hashing them again.
+
+    The duplicates of an annexed file are added with its key by
+    `git annex fromkey`, while the duplicates of a file stored in git
+    are copied from it. They are staged and still need to be saved.
+
+    Parameters
+    ----------
+    datalad_dataset_dir : string
+        Local path of the Datalad dataset
+
+    duplicates : dict
+        Relative paths of the saved files indexed by the relative
+        paths of their duplicates, as returned by :func:`plan_symlinks`
+
+    dryrun : bool
+        If `True`, only generates the commands and
+        do not execute them
+        (Default: `False`)
+
+    Returns
+    -------
+    `res` : list of string
+        Relative paths of the duplicates added
+
+    `cmd` : string
+        Equivalent bash command
+    """
+    duplicates = {path: primary for path, primary in duplicates.items()
+                  if '\n' not in path and '\n' not in primary}
+    cmd = f'cd {shlex.quote(datalad_dataset_dir)}'
+    for path, primary in sorted(duplicates.items()):
+        path, primary = shlex.quote(path), shlex.quote(primary)
+        cmd += (f'\nmkdir -p "$(dirname {path})" && rm -f {path} && '
+                f'{{ git annex fromkey "$(git annex lookupkey {primary})" {path} || cp {primary} {path}; }}')
+    if dryrun or not duplicates:
+        return [], cmd
+
+    primaries = sorted(set(duplicates.values()))
+    try:
+        proc = run('git annex lookupkey --batch', cwd=datalad_dataset_dir,
+                   input=''.join(f'{primary}\n' for primary in primaries).encode())
+    except subprocess.CalledProcessError as e:
+        print(f'\t* WARNING: `git annex lookupkey` failed: {e}')
+        return [], cmd
+    # Files that are not annexed have an empty key
+    keys = dict(zip(primaries, os.fsdecode(proc.stdout).split('\n')))
+    added, fromkey_lines = [], []
+    for path, primary in sorted(duplicates.items()):
+        fullpath = os.path.join(datalad_dataset_dir, path)
+        os.makedirs(os.path.dirname(fullpath), exist_ok=True)
+        if os.path.lexists(fullpath):
+            os.remove(fullpath)
+        if keys.get(primary):
+            fromkey_lines.append(f'{keys[primary]} {path}')
+        else:
+            shutil.copyfile(os.path.join(datalad_dataset_dir, primary), fullpath)
+            added.append(path)
+    if fromkey_lines:
+        try:
+            run('git annex fromkey --batch', cwd=datalad_dataset_dir,
+                input=''.join(f'{line}\n' for line in fromkey_lines).encode())
+        except subprocess.CalledProcessError as e:
+            print(f'\t* WARNING: `git annex fromkey` failed: {e}')
+    added += [line.split(' ', 1)[1] for line in fromkey_lines
+              if os.path.lexists(os.path.join(datalad_dataset_dir, line.split(' ', 1)[1]))]
+    return sorted(added), cmd
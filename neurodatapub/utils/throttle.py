@@ -0,0 +1,291 @@
+# Copyright © 2021-2022 Connectomics Lab
+# University Hospital Center and University of Lausanne (UNIL-CHUV), Switzerland,
+# and contributors
+#
+#  This software is distributed under the open-source license Apache 2.0.
+
+"""`neurodatapub.utils.throttle`: git-annex special remote simulating a slow and unreliable network link to a local directory."""
+
+import os
+import sys
+import json
+import shlex
+import time
+import fcntl
+import random
+import hashlib
+import contextlib
+
+# Name of the external special remote (program `git-annex-remote-neurodatapub-throttle`)
+THROTTLE_EXTERNAL_TYPE = 'neurodatapub-throttle'
+
+# Files of the store shared by the processes of the remote (hidden, such that they are not taken for keys)
+THROTTLE_LOCK_FILE = '.neurodatapub-throttle.lock'
+THROTTLE_STATS_FILE = '.neurodatapub-throttle.jsonl'
+
+# Size of the blocks transferred between two throttling delays
+THROTTLE_BLOCK_SIZE = 64 * 1024
+
+# Parameters of the remote (given to `git annex initremote`)
+THROTTLE_CONFIGS = {
+    'directory': 'directory where the annexed files are stored',
+    'latency': 'delay in seconds added to each request (round-trip time)',
+    'bandwidth': 'bandwidth of the link in bytes per second, shared by all transfers (0 for no limit)',
+    'failure_rate': 'probability that a transfer fails',
+    'seed': 'seed of the simulated failures'
+}
+
+
+def get_throttle_initremote_options(directory, latency=0, bandwidth=0, failure_rate=0, seed=None):
+    """
+    Return the options of `git annex initremote` creating a throttled special remote.
+
+    Parameters
+    ----------
+    directory : string
+        Directory where the annexed files are stored
+
+    latency : float
+        Delay in seconds added to each request (Default: `0`)
+
+    bandwidth : float
+        Bandwidth of the link in bytes per second, shared by
+        all the transfers of the remote (Default: `0`, no limit)
+
+    failure_rate : float
+        Probability that a transfer fails (Default: `0`)
+
+    seed : int
+        Seed of the simulated failures (Default: `None`)
+
+    Returns
+    -------
+    options : string
+        Options of `git annex initremote`
+    """
+    options = f'type=external externaltype={THROTTLE_EXTERNAL_TYPE} encryption=none '
+    options += (f'directory={shlex.quote(directory)} latency={latency} '
+                f'bandwidth={int(bandwidth)} failure_rate={failure_rate}')
+    if seed is not None:
+        options += f' seed={seed}'
+    return options
+
+
+def load_throttle_stats(directory):
+    """Return the numbers of requests, transfers, simulated failures and bytes transferred by a throttled remote."""
+    totals = dict(requests=0, stored=0, retrieved=0, failures=0, bytes=0)
+    with contextlib.suppress(OSError):
+        with open(os.path.join(directory, THROTTLE_STATS_FILE), 'r') as f:
+            for line in f:
+                with contextlib.suppress(ValueError):
+                    record = json.loads(line)
+                    for name in totals:
+                        totals[name] += record.get(name, 0)
+    return totals
+
+
+class ThrottledRemote(object):
+
+    """External special remote storing the annexed files in a local directory through a simulated network link.
+
+    It speaks the external special remote protocol of git-annex [1]_ on
+    its standard input and output. Each request is delayed by `latency`,
+    the transfers of all the processes of the remote share the `bandwidth`
+    of the link, and each transfer fails with the probability `failure_rate`.
+    The counters of each process are appended to :data:`THROTTLE_STATS_FILE`
+    in the directory when it exits.
+
+    .. [1] `git-annex external special remote protocol <https://git-annex.branchable.com/design/external_special_remote_protocol/>`_
+
+    Parameters
+    ----------
+    input, output : file objects
+        Streams of the protocol (Default: standard input and output)
+    """
+
+    def __init__(self, input=None, output=None):
+        """Constructor of :class:`ThrottledRemote` object."""
+        self.input = input or sys.stdin
+        self.output = output or sys.stdout
+        self.directory = None
+        self.latency = 0.0
+        self.bandwidth = 0.0
+        self.failure_rate = 0.0
+        self.rng = random.Random()
+        self.stats = dict(requests=0, stored=0, retrieved=0, failures=0, bytes=0)
+
+    def send(self, *words):
+        """Send a message to git-annex."""
+        self.output.write(' '.join(str(word) for word in words) + '\n')
+        self.output.flush()
+
+    def get_config(self, name):
+        """Return the value of a parameter of the remote."""
+        self.send('GETCONFIG', name)
+        reply = self.input.readline().rstrip('\n')
+        return reply[len('VALUE '):] if reply.startswith('VALUE ') else ''
+
+    def _configure(self):
+        self.directory = self.get_config('directory')
+        self.latency = float(self.get_config('latency') or 0)
+        self.bandwidth = float(self.get_config('bandwidth') or 0)
+        self.failure_rate = float(self.get_config('failure_rate') or 0)
+        seed = self.get_config('seed')
+        # Each process of the remote draws different failures
+        self.rng = random.Random(f'{seed}-{os.getpid()}' if seed else None)
+
+    def key_path(self, key):
+        """Return the path of the file of a key in the directory."""
+        return os.path.join(self.directory, hashlib.md5(key.encode()).hexdigest()[:3], key)
+
+    def _request(self):
+        """Simulate the round trip of a request."""
+        self.stats['requests'] += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    @contextlib.contextmanager
+    def _link(self):
+        """Hold the link shared by the processes of the remote while a block is sent."""
+        with open(os.path.join(self.directory, THROTTLE_LOCK_FILE), 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _copy(self, source, target):
+        """Copy a file block by block at the bandwidth of the link and report the progress."""
+        tmp_path = os.path.join(os.path.dirname(target), f'.{os.path.basename(target)}.{os.getpid()}.tmp')
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        fail_at = None
+        if self.rng.random() < self.failure_rate:
+            # The transfer is interrupted at a random point
+            fail_at = self.rng.random() * os.path.getsize(source)
+        sent = 0
+        try:
+            with open(source, 'rb') as src, open(tmp_path, 'wb') as dst:
+                while True:
+                    block = src.read(THROTTLE_BLOCK_SIZE)
+                    if not block:
+                        break
+                    if fail_at is not None and sent + len(block) > fail_at:
+                        raise ConnectionError('simulated network failure')
+                    if self.bandwidth:
+                        with self._link():
+                            time.sleep(len(block) / self.bandwidth)
+                    dst.write(block)
+                    sent += len(block)
+                    self.send('PROGRESS', sent)
+            if fail_at is not None:
+                # Empty files fail before any byte is sent
+                raise ConnectionError('simulated network failure')
+            os.replace(tmp_path, target)
+        except BaseException:
+            with contextlib.suppress(OSError):
+                os.remove(tmp_path)
+            raise
+        finally:
+            self.stats['bytes'] += sent
+
+    def _transfer(self, direction, key, path):
+        self._request()
+        try:
+            if direction == 'STORE':
+                self._copy(path, self.key_path(key))
+                self.stats['stored'] += 1
+            else:
+                self._copy(self.key_path(key), path)
+                self.stats['retrieved'] += 1
+        except ConnectionError as e:
+            self.stats['failures'] += 1
+            self.send('TRANSFER-FAILURE', direction, key, e)
+        except OSError as e:
+            self.send('TRANSFER-FAILURE', direction, key, e.strerror or e)
+        else:
+            self.send('TRANSFER-SUCCESS', direction, key)
+
+    def handle(self, line):
+        """Answer a request of git-annex."""
+        words = line.split(' ')
+        request = words[0]
+        if request == 'INITREMOTE':
+            self._configure()
+            if not self.directory:
+                self.send('INITREMOTE-FAILURE', 'the directory parameter is required')
+                return
+            os.makedirs(self.directory, exist_ok=True)
+            self.send('INITREMOTE-SUCCESS')
+        elif request == 'PREPARE':
+            self._configure()
+            if not self.directory or not os.path.isdir(self.directory):
+                self.send('PREPARE-FAILURE', f'{self.directory} is not a directory')
+            else:
+                self.send('PREPARE-SUCCESS')
+        elif request == 'EXTENSIONS':
+            self.send('EXTENSIONS')
+        elif request == 'LISTCONFIGS':
+            for name, description in THROTTLE_CONFIGS.items():
+                self.send('CONFIG', name, description)
+            self.send('CONFIGEND')
+        elif request == 'GETCOST':
+            # Cost of a remote reached through the network
+            self.send('COST', 200)
+        elif request == 'GETAVAILABILITY':
+            self.send('AVAILABILITY', 'GLOBAL')
+        elif request == 'TRANSFER' and len(words) >= 4:
+            # The file name may contain spaces
+            direction, key, path = line.split(' ', 3)[1:]
+            self._transfer(direction, key, path)
+        elif request == 'CHECKPRESENT' and len(words) == 2:
+            self._request()
+            status = 'SUCCESS' if os.path.exists(self.key_path(words[1])) else 'FAILURE'
+            self.send(f'CHECKPRESENT-{status}', words[1])
+        elif request == 'REMOVE' and len(words) == 2:
+            self._request()
+            try:
+                os.remove(self.key_path(words[1]))
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                self.send('REMOVE-FAILURE', words[1], e.strerror or e)
+                return
+            self.send('REMOVE-SUCCESS', words[1])
+        elif request == 'ERROR':
+            raise RuntimeError(line)
+        else:
+            self.send('UNSUPPORTED-REQUEST')
+
+    def record_stats(self):
+        """Append the counters of the process to the statistics of the directory."""
+        if self.directory and self.stats['requests']:
+            with contextlib.suppress(OSError):
+                with open(os.path.join(self.directory, THROTTLE_STATS_FILE), 'a') as f:
+                    f.write(json.dumps(dict(self.stats, pid=os.getpid())) + '\n')
+
+    def serve(self):
+        """Answer the requests of git-annex until its input is closed."""
+        self.send('VERSION', 1)
+        try:
+            for line in self.input:
+                line = line.rstrip('\n')
+                if line:
+                    self.handle(line)
+        finally:
+            self.record_stats()
+
+
+def main():
+    """Entrypoint of the `git-annex-remote-neurodatapub-throttle` program run by git-annex."""
+    try:
+        ThrottledRemote().serve()
+    except RuntimeError as e:
+        print(e, file=sys.stderr)
+        return 1
+    except KeyboardInterrupt:
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
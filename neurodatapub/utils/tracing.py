@@ -0,0 +1,494 @@
+# Copyright © 2021-2022 Connectomics Lab
+# University Hospital Center and University of Lausanne (UNIL-CHUV), Switzerland,
+# and contributors
+#
+#  This software is distributed under the open-source license Apache 2.0.
+
+"""`neurodatapub.utils.tracing`: utils functions to trace the stages, Datalad calls and subprocesses of a publication."""
+
+import os
+import re
+import sys
+import json
+import time
+import types
+import functools
+import threading
+import contextlib
+import contextvars
+import subprocess
+
+from ..info import __version__
+from .redact import redact_secrets
+
+# Span in which the code of the current thread / context runs
+# (set by `Tracer.span()`, `trace_command()` and the traced Datalad calls)
+_current_span = contextvars.ContextVar('trace_span', default=None)
+
+# Functions of `datalad.api` recorded as spans by `instrument_datalad_api()`
+DATALAD_API_FUNCTIONS = [
+    'create', 'save', 'siblings', 'create_sibling', 'create_sibling_github',
+    'create_sibling_osf', 'push', 'publish'
+]
+
+# Values of the span kinds and status codes of the OpenTelemetry protocol
+SPAN_KIND_INTERNAL = 1
+SPAN_KIND_CLIENT = 3
+STATUS_CODE_OK = 1
+STATUS_CODE_ERROR = 2
+
+# Maximal length of the command lines recorded in the spans
+MAX_COMMAND_LENGTH = 1024
+
+_audit_hook_installed = False
+
+
+class Span(object):
+
+    """Operation of a publication, timed from its start to its end.
+
+    Attributes
+    ----------
+    name : string
+        Name of the span
+
+    span_id : string
+        Identifier of the span (16 hexadecimal digits)
+
+    parent : Span
+        Span in which this span started (`None` for a root span)
+
+    attributes : dict
+        Attributes of the span (dataset, remote, command, bytes, exit code, ...)
+
+    events : list of tuple
+        Time in nanoseconds, name and attributes of the events of the span
+    """
+
+    __slots__ = ('tracer', 'name', 'kind', 'span_id', 'parent', 'start_time', 'end_time',
+                 'attributes', 'events', 'status', 'message', 'thread_id', 'thread_name')
+
+    def __init__(self, tracer, name, kind=SPAN_KIND_INTERNAL, parent=None, attributes=None):
+        """Constructor of :class:`Span` object."""
+        self.tracer = tracer
+        self.name = name
+        self.kind = kind
+        self.span_id = os.urandom(8).hex()
+        self.parent = parent
+        self.attributes = dict(attributes or {})
+        self.events = []
+        self.status = STATUS_CODE_OK
+        self.message = ''
+        thread = threading.current_thread()
+        self.thread_id = getattr(thread, 'native_id', None) or threading.get_ident()
+        self.thread_name = thread.name
+        self.start_time = time.time_ns()
+        self.end_time = None
+
+    def set_attributes(self, attributes):
+        """Set attributes of the span."""
+        self.attributes.update(attributes)
+
+    def add_event(self, name, attributes=None):
+        """Record an event happening now in the span."""
+        self.events.append((time.time_ns(), name, dict(attributes or {})))
+
+    def set_error(self, error):
+        """Mark the span as failed because of `error` (an exception or a message)."""
+        self.status = STATUS_CODE_ERROR
+        self.message = f'{type(error).__name__}: {error}' if isinstance(error, BaseException) else str(error)
+
+    def to_otlp(self):
+        """Return the span as a dictionary in the JSON encoding of the OpenTelemetry protocol."""
+        span = dict(
+            traceId=self.tracer.trace_id,
+            spanId=self.span_id,
+            name=self.name,
+            kind=self.kind,
+            startTimeUnixNano=str(self.start_time),
+            endTimeUnixNano=str(self.end_time or time.time_ns()),
+            attributes=_otlp_attributes(dict(
+                self.attributes, **{'thread.id': self.thread_id, 'thread.name': self.thread_name}
+            )),
+            events=[
+                dict(timeUnixNano=str(t), name=name, attributes=_otlp_attributes(attributes))
+                for t, name, attributes in self.events
+            ],
+            status=dict(code=self.status, message=self.message) if self.message else dict(code=self.status)
+        )
+        if self.parent is not None:
+            span['parentSpanId'] = self.parent.span_id
+        return span
+
+
+def _otlp_value(value):
+    if isinstance(value, bool):
+        return dict(boolValue=value)
+    if isinstance(value, int):
+        # 64-bit integers are encoded as strings in JSON
+        return dict(intValue=str(value))
+    if isinstance(value, float):
+        return dict(doubleValue=value)
+    return dict(stringValue=str(value))
+
+
+def _otlp_attributes(attributes):
+    return [dict(key=key, value=_otlp_value(value))
+            for key, value in attributes.items() if value is not None]
+
+
+class Tracer(object):
+
+    """Tracer exporting the spans of a run to a JSON-lines file.
+
+    Each line of the file is an OTLP/JSON `ExportTraceServiceRequest`
+    holding one finished span, the format read by the `otlpjsonfile`
+    receiver of the OpenTelemetry collector, and the file can be
+    converted into a timeline with :func:`export_trace_timeline`.
+    All the spans of a tracer belong to the same trace.
+
+    Subprocesses started outside of :func:`~neurodatapub.utils.process.run`
+    (e.g. `git-annex` by Datalad) are recorded as `"subprocess"` events of
+    the current span, through an audit hook (`sys.addaudithook()`).
+
+    Parameters
+    ----------
+    trace_file : string
+        Path of the JSON-lines file, to which the spans are appended
+
+    Examples
+    --------
+    >>> tracer = Tracer('/tmp/trace.jsonl') # doctest: +SKIP
+    >>> with tracer.span('publish', **{'neurodatapub.dataset': '/path'}): # doctest: +SKIP
+    ...     run('git annex info')
+    >>> tracer.close() # doctest: +SKIP
+    """
+
+    def __init__(self, trace_file):
+        """Constructor of :class:`Tracer` object."""
+        self.trace_file = os.path.abspath(trace_file)
+        self.trace_id = os.urandom(16).hex()
+        os.makedirs(os.path.dirname(self.trace_file), exist_ok=True)
+        self._file = open(self.trace_file, 'a')
+        self._lock = threading.Lock()
+        self._resource = dict(attributes=_otlp_attributes({
+            'service.name': 'neurodatapub',
+            'service.version': __version__,
+            'process.pid': os.getpid(),
+            'process.command_line': redact_secrets(' '.join(sys.argv))[:MAX_COMMAND_LENGTH]
+        }))
+        _install_audit_hook()
+
+    def start_span(self, name, parent=None, kind=SPAN_KIND_INTERNAL, attributes=None):
+        """Start a span, child of `parent`, without making it the current span."""
+        return Span(self, name, kind=kind, parent=parent, attributes=attributes)
+
+    def end_span(self, span):
+        """End a span and export it."""
+        span.end_time = time.time_ns()
+        line = json.dumps(dict(resourceSpans=[dict(
+            resource=self._resource,
+            scopeSpans=[dict(scope=dict(name='neurodatapub', version=__version__), spans=[span.to_otlp()])]
+        )]))
+        with self._lock:
+            if not self._file.closed:
+                # Written line by line such that the spans of an interrupted run are kept
+                self._file.write(line + '\n')
+                self._file.flush()
+
+    @contextlib.contextmanager
+    def span(self, name, kind=SPAN_KIND_INTERNAL, **attributes):
+        """
+        Context manager that executes a block of code in a new span, child of the current span.
+
+        Parameters
+        ----------
+        name : string
+            Name of the span
+
+        kind : int
+            Kind of the span (Default: `SPAN_KIND_INTERNAL`)
+
+        attributes : dict
+            Attributes of the span
+
+        Yields
+        ------
+        span : Span
+            The new span
+        """
+        parent = _current_span.get()
+        span = self.start_span(name, parent=parent if parent is not None and parent.tracer is self else None,
+                               kind=kind, attributes=attributes)
+        token = _current_span.set(span)
+        try:
+            yield span
+        except BaseException as e:
+            span.set_error(e)
+            raise
+        finally:
+            _current_span.reset(token)
+            self.end_span(span)
+
+    def close(self):
+        """Close the trace file."""
+        with self._lock:
+            self._file.close()
+
+
+def get_current_span():
+    """Return the span in which the current code runs (`None` if it is not traced)."""
+    return _current_span.get()
+
+
+def set_span_attributes(attributes):
+    """Set attributes of the current span, if any (cheap when nothing is traced)."""
+    span = _current_span.get()
+    if span is not None:
+        span.attributes.update(attributes)
+
+
+def _audit_hook(event, args):
+    if event != 'subprocess.Popen':
+        return
+    span = _current_span.get()
+    # Commands of `run()` have their own span
+    if span is None or 'process.command_line' in span.attributes:
+        return
+    command = args[1]
+    if not isinstance(command, (str, bytes)):
+        command = ' '.join(os.fsdecode(arg) for arg in command)
+    span.add_event('subprocess', {
+        'process.command_line': redact_secrets(os.fsdecode(command))[:MAX_COMMAND_LENGTH],
+        'process.working_directory': os.fsdecode(args[2]) if args[2] is not None else None
+    })
+
+
+def _install_audit_hook():
+    """Install the audit hook recording the subprocesses (once, as audit hooks cannot be removed)."""
+    global _audit_hook_installed
+    if not _audit_hook_installed:
+        sys.addaudithook(_audit_hook)
+        _audit_hook_installed = True
+
+
+def _command_name(command):
+    """Return a short name of a command line, e.g. `"git annex copy"`."""
+    # Skip a leading `cd <dir> &&`
+    segment = command.split('&&', 1)[1] if command.startswith('cd ') and '&&' in command else command
+    words = []
+    for word in segment.split():
+        if len(words) == 3 or not re.match(r'^[A-Za-z][\w.-]*$', word):
+            break
+        words.append(word)
+    return ' '.join(words) or 'command'
+
+
+@contextlib.contextmanager
+def trace_command(command, cwd=None):
+    """
+    Context manager that records the execution of a command as a span, child of the current span.
+
+    Nothing is recorded outside of a traced span. The exit code of a failed
+    command is recorded from the `subprocess.CalledProcessError` it raises,
+    and the secrets of the command line are hidden (See
+    :func:`neurodatapub.utils.redact.redact_secrets`).
+
+    Parameters
+    ----------
+    command : string
+        Command line
+
+    cwd : string
+        Working directory of the command (Default: `None`)
+
+    Yields
+    ------
+    span : Span
+        Span of the command (`None` if it is not traced)
+    """
+    parent = _current_span.get()
+    if parent is None:
+        yield None
+        return
+    span = parent.tracer.start_span(
+        f'run {_command_name(command)}', parent=parent, kind=SPAN_KIND_CLIENT,
+        attributes={
+            'process.command_line': redact_secrets(command)[:MAX_COMMAND_LENGTH],
+            'process.working_directory': cwd
+        }
+    )
+    token = _current_span.set(span)
+    try:
+        yield span
+    except subprocess.CalledProcessError as e:
+        span.set_attributes({'process.exit_code': e.returncode})
+        span.set_error(f'Command exited with code {e.returncode}')
+        raise
+    except BaseException as e:
+        span.set_error(e)
+        raise
+    finally:
+        _current_span.reset(token)
+        parent.tracer.end_span(span)
+
+
+def _record_datalad_result(span, result, counts):
+    status = result.get('status') if isinstance(result, dict) else None
+    counts[status] = counts.get(status, 0) + 1
+    if status in ['error', 'impossible']:
+        span.add_event('datalad.result', {
+            'datalad.action': result.get('action'),
+            'datalad.status': status,
+            'datalad.path': result.get('path'),
+            'datalad.message': str(result.get('message'))
+        })
+
+
+def _end_datalad_span(span, counts):
+    span.set_attributes({'datalad.results': sum(counts.values())})
+    span.set_attributes({f'datalad.results.{status}': count for status, count in counts.items() if status})
+    if counts.get('error') or counts.get('impossible'):
+        span.set_error(f"{counts.get('error', 0) + counts.get('impossible', 0)} results failed")
+    span.tracer.end_span(span)
+
+
+def _traced_results(span, results):
+    """Generator of the results of a Datalad call returning a generator, ending its span when exhausted."""
+    counts = {}
+    try:
+        while True:
+            # The work of Datalad is done while the next result is generated
+            token = _current_span.set(span)
+            try:
+                result = next(results)
+            except StopIteration:
+                break
+            finally:
+                _current_span.reset(token)
+            _record_datalad_result(span, result, counts)
+            yield result
+    except BaseException as e:
+        span.set_error(e)
+        raise
+    finally:
+        _end_datalad_span(span, counts)
+
+
+def _traced_datalad_function(name, function):
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        parent = _current_span.get()
+        if parent is None:
+            return function(*args, **kwargs)
+        dataset = kwargs.get('dataset', kwargs.get('path') if name == 'create' else None)
+        remote = kwargs.get('to', kwargs.get('name'))
+        span = parent.tracer.start_span(f'datalad.{name}', parent=parent, attributes={
+            'datalad.command': name,
+            'neurodatapub.dataset': str(getattr(dataset, 'path', dataset)) if dataset is not None else None,
+            'neurodatapub.remote': remote if isinstance(remote, str) else None
+        })
+        token = _current_span.set(span)
+        try:
+            res = function(*args, **kwargs)
+        except BaseException as e:
+            span.set_error(e)
+            span.tracer.end_span(span)
+            raise
+        finally:
+            _current_span.reset(token)
+        if isinstance(res, types.GeneratorType):
+            return _traced_results(span, res)
+        counts = {}
+        for result in (res if isinstance(res, list) else []):
+            _record_datalad_result(span, result, counts)
+        _end_datalad_span(span, counts)
+        return res
+    wrapper._neurodatapub_traced = True
+    return wrapper
+
+
+def instrument_datalad_api():
+    """
+    Record the calls to the functions of `datalad.api` made in a traced span as spans.
+
+    The functions of :data:`DATALAD_API_FUNCTIONS` are wrapped once in the
+    `datalad.api` module. Outside of a traced span, the wrapped functions
+    are called directly.
+    """
+    import datalad.api
+    for name in DATALAD_API_FUNCTIONS:
+        function = getattr(datalad.api, name, None)
+        if function is not None and not getattr(function, '_neurodatapub_traced', False):
+            setattr(datalad.api, name, _traced_datalad_function(name, function))
+
+
+def load_trace(trace_file):
+    """Return the spans of a JSON-lines trace file, in the OTLP/JSON encoding."""
+    spans = []
+    with open(trace_file, 'r') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            for resource_spans in json.loads(line).get('resourceSpans', []):
+                for scope_spans in resource_spans.get('scopeSpans', []):
+                    spans += scope_spans.get('spans', [])
+    return spans
+
+
+def _attribute_values(attributes):
+    values = {}
+    for attribute in attributes:
+        value = attribute['value']
+        values[attribute['key']] = int(value['intValue']) if 'intValue' in value else next(iter(value.values()), None)
+    return values
+
+
+def export_trace_timeline(trace_file, timeline_file):
+    """
+    Convert a JSON-lines trace file into a timeline in the Chrome trace event format.
+
+    The timeline can be opened in Perfetto (https://ui.perfetto.dev) or in
+    `chrome://tracing`, with a row per thread and per trace.
+
+    Parameters
+    ----------
+    trace_file : string
+        Path of the JSON-lines trace file
+
+    timeline_file : string
+        Path of the JSON timeline
+
+    Returns
+    -------
+    nspans : int
+        Number of spans in the timeline
+    """
+    spans = load_trace(trace_file)
+    trace_ids = {}
+    trace_events = []
+    for span in spans:
+        attributes = _attribute_values(span.get('attributes', []))
+        # Runs appended to the same file are shown as separate processes
+        pid = trace_ids.setdefault(span['traceId'], len(trace_ids) + 1)
+        tid = attributes.pop('thread.id', 0)
+        start = int(span['startTimeUnixNano']) / 1000
+        status = span.get('status', {})
+        if status.get('code') == STATUS_CODE_ERROR:
+            attributes['error'] = status.get('message', '')
+        trace_events.append(dict(
+            name=span['name'], cat=attributes.get('datalad.command', span['name'].split(' ')[0]),
+            ph='X', ts=start, dur=int(span['endTimeUnixNano']) / 1000 - start,
+            pid=pid, tid=int(tid), args=attributes
+        ))
+        for event in span.get('events', []):
+            trace_events.append(dict(
+                name=event['name'], ph='i', s='t', ts=int(event['timeUnixNano']) / 1000,
+                pid=pid, tid=int(tid), args=_attribute_values(event.get('attributes', []))
+            ))
+    for trace_id, pid in trace_ids.items():
+        trace_events.append(dict(name='process_name', ph='M', pid=pid, args=dict(name=f'neurodatapub {trace_id[:8]}')))
+    os.makedirs(os.path.dirname(os.path.abspath(timeline_file)), exist_ok=True)
+    with open(timeline_file, 'w') as f:
+        json.dump(dict(traceEvents=trace_events, displayTimeUnit='ms'), f)
+    return len(spans)
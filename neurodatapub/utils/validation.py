@@ -0,0 +1,78 @@
+# Copyright © 2021-2022 Connectomics Lab
+# University Hospital Center and University of Lausanne (UNIL-CHUV), Switzerland,
+# and contributors
+#
+#  This software is distributed under the open-source license Apache 2.0.
+
+"""`neurodatapub.utils.validation`: utils functions to validate a BIDS dataset from its file table."""
+
+import os
+
+from bids_validator import BIDSValidator
+
+# Top-level directories that are not validated (as in `pybids`)
+NOT_VALIDATED_DIRS = ['code', 'derivatives', 'sourcedata', 'stimuli']
+
+
+def validate_bids_dataset(table):
+    """
+    Check the file names of a BIDS dataset from its file table.
+
+    It replaces the walk of the dataset by `BIDSLayout`: the paths of the
+    table are checked with the validator used by `pybids`.
+
+    Parameters
+    ----------
+    table : neurodatapub.utils.scan.FileTable
+        Table of the files of the dataset, as returned
+        by :func:`neurodatapub.utils.scan.scan_directory`
+
+    Returns
+    -------
+    summary : dict
+        Dictionary with the `"subjects"`, `"sessions"`,
+        the number of `"files"` and the `"invalid_files"`
+        not following the BIDS naming conventions
+
+    Raises
+    ------
+    ValueError
+        If the `dataset_description.json` file is missing
+    """
+    if 'dataset_description.json' not in table:
+        raise ValueError(
+            '"dataset_description.json" file is missing from project root. '
+            'Every valid BIDS dataset must have this file.'
+        )
+    validator = BIDSValidator()
+    subjects, sessions, invalid_files = set(), set(), []
+    for path in table.paths:
+        parts = path.split(os.sep)
+        if parts[0] in NOT_VALIDATED_DIRS or any(part.startswith('.') for part in parts):
+            continue
+        if parts[0].startswith('sub-'):
+            subjects.add(parts[0])
+            if len(parts) > 2 and parts[1].startswith('ses-'):
+                sessions.add(parts[1])
+        if not validator.is_bids('/' + '/'.join(parts)):
+            invalid_files.append(path)
+    return dict(
+        subjects=sorted(subjects),
+        sessions=sorted(sessions),
+        files=len(table),
+        invalid_files=invalid_files
+    )
+
+
+def format_bids_summary(summary, max_invalid_files=10):
+    """Format the summary returned by :func:`validate_bids_dataset`."""
+    report = (f"BIDS Dataset with {summary['files']} files | "
+              f"Subjects: {len(summary['subjects'])} | Sessions: {len(summary['sessions'])}")
+    invalid_files = summary['invalid_files']
+    if invalid_files:
+        report += f'\n\t* WARNING: {len(invalid_files)} files do not follow the BIDS naming conventions:'
+        for path in invalid_files[:max_invalid_files]:
+            report += f'\n\t  - {path}'
+        if len(invalid_files) > max_invalid_files:
+            report += f'\n\t  - ... ({len(invalid_files) - max_invalid_files} more)'
+    return report
@@ -0,0 +1,248 @@
+# Copyright © 2021-2022 Connectomics Lab
+# University Hospital Center and University of Lausanne (UNIL-CHUV), Switzerland,
+# and contributors
+#
+#  This software is distributed under the open-source license Apache 2.0.
+
+"""`neurodatapub.utils.verify`: utils functions to verify the annexed content published to a remote."""
+
+import os
+import json
+import time
+import shlex
+import random
+import threading
+import subprocess
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+
+from .process import run
+
+# Number of files checked by each `git annex fsck` process
+VERIFY_CHUNK_SIZE = 100
+
+
+def get_verification_log_file(datalad_dataset_dir, remote_name, checksum=False):
+    """Return the file where the progress of the verification of a remote is recorded."""
+    mode = 'checksum' if checksum else 'presence'
+    return os.path.join(
+        datalad_dataset_dir, '.git', 'neurodatapub', f'verify-{remote_name}-{mode}.jsonl'
+    )
+
+
+def list_annexed_files(datalad_dataset_dir):
+    """Return the keys and the relative paths of all the annexed files of a Datalad dataset, present or not."""
+    proc = run(
+        "git annex find --include='*' --format='${key}\\t${file}\\n'",
+        cwd=datalad_dataset_dir
+    )
+    files = []
+    for line in os.fsdecode(proc.stdout).splitlines():
+        key, path = line.split('\t', 1)
+        files.append((key, path))
+    return files
+
+
+def _load_verification_log(log_file):
+    """Return the header and the results of an unfinished verification (`None` if there is none to resume)."""
+    try:
+        with open(log_file, 'r') as f:
+            records = [json.loads(line) for line in f if line.strip()]
+    except (OSError, ValueError):
+        return None, {}
+    if not records or records[-1].get('complete'):
+        return None, {}
+    return records[0], {record['key']: record for record in records[1:] if 'key' in record}
+
+
+def _fsck_chunk(datalad_dataset_dir, remote_name, paths, checksum, env=None):
+    """Check a chunk of files in the remote with `git annex fsck` and return its JSON records."""
+    cmd = f'git annex fsck --from={remote_name} --json --json-error-messages'
+    if not checksum:
+        cmd += ' --fast'
+    cmd += ' -- ' + ' '.join(shlex.quote(path) for path in paths)
+    try:
+        proc = run(cmd, cwd=datalad_dataset_dir, env=env)
+        output = proc.stdout
+    except subprocess.CalledProcessError as e:
+        # fsck exits with an error if a file fails the check
+        output = e.output or b''
+    records = []
+    for line in os.fsdecode(output).splitlines():
+        try:
+            records.append(json.loads(line))
+        except ValueError:
+            continue
+    return records
+
+
+def verify_remote_content(
+    datalad_dataset_dir,
+    remote_name,
+    checksum=False,
+    sample=None,
+    jobs=4,
+    seed=None,
+    cancel_event=None,
+    env=None
+):
+    """
+    Check in parallel that the annexed content of a Datalad dataset is in a remote.
+
+    The files are checked in chunks by parallel `git annex fsck --from`
+    processes: with `--fast`, only the presence of the content is checked,
+    otherwise it is downloaded and its checksum verified. The results are
+    appended to a log file (see :func:`get_verification_log_file`), such that
+    an interrupted verification is resumed by the next call. The files for
+    which `git annex fsck` gives no result (e.g. if it fails before checking
+    them) are reported as unverified, and checked again by the next call.
+
+    Parameters
+    ----------
+    datalad_dataset_dir : string
+        Local path of the Datalad dataset
+
+    remote_name : string
+        Name of the git-annex remote
+
+    checksum : bool
+        If `True`, verify the checksum of the content and not only
+        its presence (Default: `False`)
+
+    sample : float or int
+        If given, only a random sample of the files is checked: a fraction
+        of the files if lower than 1, a number of files otherwise
+        (Default: `None`, all files)
+
+    jobs : int
+        Number of parallel `git annex fsck` processes (Default: `4`)
+
+    seed : int
+        Seed of the random sample (Default: `None`)
+
+    cancel_event : threading.Event
+        Event that stops the verification when set (Default: `None`)
+
+    env : dict
+        Environment variables set only for the `git annex fsck` processes,
+        e.g. the credentials of the remote (Default: `None`)
+
+    Returns
+    -------
+    summary : dict
+        Summary of the verification with the `"remote"`, the mode (`"checksum"`),
+        the number of annexed files (`"total"`), of files `"selected"`, `"checked"`
+        and `"resumed"` from a previous run, the lists of `"failed"` and
+        `"unverified"` files, if it is `"complete"` (all the selected files
+        checked), and the `"elapsed"` time in seconds
+    """
+    start = time.monotonic()
+    files = list_annexed_files(datalad_dataset_dir)
+    log_file = get_verification_log_file(datalad_dataset_dir, remote_name, checksum)
+    os.makedirs(os.path.dirname(log_file), exist_ok=True)
+
+    header, done = _load_verification_log(log_file)
+    if header is not None and header.get('sample') == sample:
+        selected = header['paths'] if sample else [path for _, path in files]
+        print(f'\t* Resume the verification of {len(selected) - len(done)} of {len(selected)} files')
+        mode = 'a'
+    else:
+        selected = [path for _, path in files]
+        if sample:
+            size = int(len(files) * sample) if sample < 1 else int(sample)
+            selected = sorted(random.Random(seed).sample(selected, min(max(size, 1), len(selected))))
+        header = dict(remote=remote_name, checksum=checksum, sample=sample,
+                      started=time.strftime('%Y-%m-%dT%H:%M:%S%z'))
+        if sample:
+            # The sample is recorded to be resumed
+            header['paths'] = selected
+        done = {}
+        mode = 'w'
+
+    keys = dict((path, key) for key, path in files)
+    # Files sharing a key are checked by a single record
+    resumed = sum(1 for path in selected if keys.get(path) in done)
+    failed = [record['file'] for record in done.values() if not record['success']]
+    unverified = []
+    pending = [path for path in selected if keys.get(path) not in done]
+    chunks = [pending[i:i + VERIFY_CHUNK_SIZE] for i in range(0, len(pending), VERIFY_CHUNK_SIZE)]
+    log_lock = threading.Lock()
+    checked = [resumed]
+
+    with open(log_file, mode) as log:
+        if mode == 'w':
+            log.write(json.dumps(header) + '\n')
+            log.flush()
+
+        def check(chunk):
+            if cancel_event is not None and cancel_event.is_set():
+                return
+            records = _fsck_chunk(datalad_dataset_dir, remote_name, chunk, checksum, env)
+            reported = set(record.get('file') for record in records if 'key' in record)
+            with log_lock:
+                # Not logged, such that they are checked again by the next run
+                unverified.extend(path for path in chunk if path not in reported)
+                for record in records:
+                    if 'key' not in record:
+                        continue
+                    entry = dict(key=record['key'], file=record.get('file'),
+                                 success=bool(record.get('success')))
+                    if not entry['success']:
+                        failed.append(entry['file'])
+                        entry['error'] = ' '.join(record.get('error-messages', []))
+                    log.write(json.dumps(entry) + '\n')
+                    checked[0] += 1
+                log.flush()
+
+        with ThreadPoolExecutor(max_workers=max(jobs, 1)) as executor:
+            # Each check runs in a copy of the context, such that its
+            # processes are tracked by the caller and can be cancelled
+            futures = [executor.submit(contextvars.copy_context().run, check, chunk) for chunk in chunks]
+            for future in futures:
+                future.result()
+
+        cancelled = cancel_event is not None and cancel_event.is_set()
+        complete = not cancelled and checked[0] == len(selected)
+        if complete:
+            log.write(json.dumps(dict(complete=True, failed=len(failed))) + '\n')
+
+    return dict(
+        remote=remote_name,
+        checksum=checksum,
+        total=len(files),
+        selected=len(selected),
+        checked=checked[0],
+        resumed=resumed,
+        failed=sorted(failed),
+        unverified=sorted(unverified),
+        complete=complete,
+        elapsed=time.monotonic() - start
+    )
+
+
+def format_verification_summary(summary, max_failed_files=10):
+    """Format the summary returned by :func:`verify_remote_content`."""
+    mode = 'checksum' if summary['checksum'] else 'presence'
+    report = (f"\n\tRemote : {summary['remote']} ({mode} check)"
+              f"\n\tFiles checked : {summary['checked']} of {summary['selected']} selected "
+              f"({summary['total']} annexed files, {summary['resumed']} resumed)"
+              f"\n\tElapsed time : {summary['elapsed']:.1f} s")
+    failed = summary['failed']
+    if failed:
+        report += f'\n\t* ERROR: {len(failed)} files failed the check:'
+        for path in failed[:max_failed_files]:
+            report += f'\n\t  - {path}'
+        if len(failed) > max_failed_files:
+            report += f'\n\t  - ... ({len(failed) - max_failed_files} more)'
+    elif summary['complete']:
+        report += '\n\tAll checked files are intact in the remote'
+    unverified = summary.get('unverified', [])
+    if unverified:
+        report += f'\n\t* ERROR: {len(unverified)} files could not be verified:'
+        for path in unverified[:max_failed_files]:
+            report += f'\n\t  - {path}'
+        if len(unverified) > max_failed_files:
+            report += f'\n\t  - ... ({len(unverified) - max_failed_files} more)'
+    if not summary['complete']:
+        report += '\n\t* WARNING: Verification incomplete, it will be resumed by the next run'
+    return report
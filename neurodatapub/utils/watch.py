@@ -0,0 +1,274 @@
+# Copyright © 2021-2022 Connectomics Lab
+# University Hospital Center and University of Lausanne (UNIL-CHUV), Switzerland,
+# and contributors
+#
+#  This software is distributed under the open-source license Apache 2.0.
+
+"""`neurodatapub.utils.watch`: utils functions to watch the changes of a dataset directory."""
+
+import os
+import sys
+import time
+import errno
+import select
+import struct
+import ctypes
+import ctypes.util
+
+from .scan import EXCLUDED_DIRS, scan_directory
+
+# Constants of <sys/inotify.h>
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 0o2000000
+
+# Events reporting that the content of a file or a directory changed
+WATCH_MASK = (IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO |
+              IN_CREATE | IN_DELETE)
+
+_EVENT_HEADER = struct.Struct('iIII')
+
+
+class InotifyWatcher(object):
+
+    """Watcher of the changes of a directory tree based on Linux `inotify`.
+
+    A watch is added on each directory of the tree, and on new directories
+    as soon as they are created. Symlinked directories are not followed.
+
+    Parameters
+    ----------
+    root : string
+        Path of the directory to watch
+
+    Raises
+    ------
+    OSError
+        If `inotify` is not available or the limit of watches
+        (`/proc/sys/fs/inotify/max_user_watches`) is reached
+    """
+
+    def __init__(self, root):
+        """Constructor of :class:`InotifyWatcher` object."""
+        self.root = os.path.abspath(root)
+        self._libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self._fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self._fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, f'inotify_init1 failed: {os.strerror(err)}')
+        self._watches = {}
+        self._add_tree('')
+
+    def _add_watch(self, reldir):
+        path = os.path.join(self.root, reldir) if reldir else self.root
+        wd = self._libc.inotify_add_watch(self._fd, os.fsencode(path), WATCH_MASK)
+        if wd < 0:
+            err = ctypes.get_errno()
+            if err == errno.ENOSPC:
+                raise OSError(err, 'The limit of inotify watches is reached: increase '
+                                   '/proc/sys/fs/inotify/max_user_watches')
+            # Directory removed in the meantime
+            return
+        self._watches[wd] = reldir
+
+    def _add_tree(self, reldir):
+        """Add a watch on a directory and its subdirectories."""
+        path = os.path.join(self.root, reldir) if reldir else self.root
+        for dirpath, dirnames, _ in os.walk(path):
+            dirnames[:] = [d for d in dirnames if d not in EXCLUDED_DIRS]
+            self._add_watch(os.path.relpath(dirpath, self.root) if dirpath != self.root else '')
+
+    def _remove_tree(self, reldir):
+        """Remove the watches of a directory moved away and of its subdirectories."""
+        prefix = reldir + os.sep
+        for wd, watched in list(self._watches.items()):
+            if watched == reldir or watched.startswith(prefix):
+                self._libc.inotify_rm_watch(self._fd, wd)
+                del self._watches[wd]
+
+    def read_changes(self, timeout):
+        """
+        Wait at most `timeout` seconds for changes.
+
+        Returns
+        -------
+        paths : set of string
+            Relative paths of the files and directories that changed
+
+        overflow : bool
+            `True` if events have been lost and the whole tree should be rescanned
+        """
+        paths, overflow = set(), False
+        ready, _, _ = select.select([self._fd], [], [], timeout)
+        if not ready:
+            return paths, overflow
+        while True:
+            try:
+                data = os.read(self._fd, 1024 * 1024)
+            except BlockingIOError:
+                break
+            offset = 0
+            while offset < len(data):
+                wd, mask, _, length = _EVENT_HEADER.unpack_from(data, offset)
+                offset += _EVENT_HEADER.size
+                name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+                offset += length
+                if mask & IN_Q_OVERFLOW:
+                    overflow = True
+                    continue
+                if mask & IN_IGNORED:
+                    self._watches.pop(wd, None)
+                    continue
+                reldir = self._watches.get(wd)
+                if reldir is None or name in EXCLUDED_DIRS:
+                    continue
+                relpath = os.path.join(reldir, name) if reldir else name
+                if mask & IN_ISDIR:
+                    if mask & (IN_CREATE | IN_MOVED_TO):
+                        # Files may have been created before the watch is added:
+                        # the whole directory is reported as changed
+                        self._add_tree(relpath)
+                    elif mask & IN_MOVED_FROM:
+                        self._remove_tree(relpath)
+                    elif not mask & IN_DELETE:
+                        continue
+                paths.add(relpath)
+        return paths, overflow
+
+    def close(self):
+        """Release the `inotify` file descriptor."""
+        if self._fd >= 0:
+            os.close(self._fd)
+            self._fd = -1
+
+
+class PollingWatcher(object):
+
+    """Watcher of the changes of a directory tree that compares periodic scans.
+
+    It is used when `inotify` is not available, e.g. on network filesystems
+    where the changes made by other hosts are not notified.
+
+    Parameters
+    ----------
+    root : string
+        Path of the directory to watch
+
+    interval : float
+        Time in seconds between two scans
+    """
+
+    def __init__(self, root, interval=60):
+        """Constructor of :class:`PollingWatcher` object."""
+        self.root = os.path.abspath(root)
+        self.interval = interval
+        self._table = scan_directory(self.root)
+        self._next_scan = time.monotonic() + interval
+
+    def read_changes(self, timeout):
+        """Wait at most `timeout` seconds for changes (see :meth:`InotifyWatcher.read_changes`)."""
+        delay = self._next_scan - time.monotonic()
+        if delay > timeout:
+            time.sleep(timeout)
+            return set(), False
+        time.sleep(max(delay, 0))
+        table = scan_directory(self.root)
+        added, removed, modified = table.diff(self._table)
+        self._table = table
+        self._next_scan = time.monotonic() + self.interval
+        return set(added + removed + modified), False
+
+    def close(self):
+        """Nothing to release."""
+
+
+def make_watcher(root, poll_interval=None):
+    """
+    Create the watcher of a directory tree.
+
+    Parameters
+    ----------
+    root : string
+        Path of the directory to watch
+
+    poll_interval : float
+        If given, the tree is scanned every `poll_interval` seconds
+        instead of relying on `inotify` (Default: `None`)
+
+    Returns
+    -------
+    watcher : InotifyWatcher or PollingWatcher
+        Watcher of the directory tree. `inotify` is used if
+        available, with a fallback on polling every minute.
+    """
+    if poll_interval is None and sys.platform.startswith('linux'):
+        try:
+            return InotifyWatcher(root)
+        except OSError as e:
+            print(f'\t* WARNING: {e}. Fall back on polling.')
+    return PollingWatcher(root, interval=poll_interval or 60)
+
+
+def watch_batches(watcher, debounce=60, max_delay=600, stop_event=None, pending_callback=None):
+    """
+    Generator of the batches of changes reported by a watcher.
+
+    Changes are accumulated until no change is reported during `debounce`
+    seconds, or until `max_delay` seconds after the first change of the
+    batch, such that bursts of changes are processed together.
+
+    Parameters
+    ----------
+    watcher : InotifyWatcher or PollingWatcher
+        Watcher of a directory tree
+
+    debounce : float
+        Quiet period in seconds ending a batch (Default: `60`)
+
+    max_delay : float
+        Maximal delay in seconds between the first change
+        of a batch and the batch (Default: `600`)
+
+    stop_event : threading.Event
+        Event that stops the generator when set (Default: `None`)
+
+    pending_callback : function
+        If given, function called with the number of changed paths waiting
+        for the next batch when it changes (Default: `None`)
+
+    Yields
+    ------
+    paths : set of string
+        Relative paths of the files and directories that changed,
+        or `None` if the whole tree should be rescanned
+    """
+    pending, overflow = set(), False
+    first = last = None
+    while stop_event is None or not stop_event.is_set():
+        timeout = 1.0
+        if first is not None:
+            deadline = min(last + debounce, first + max_delay)
+            timeout = min(timeout, max(deadline - time.monotonic(), 0))
+        paths, lost = watcher.read_changes(timeout)
+        now = time.monotonic()
+        if paths or lost:
+            pending |= paths
+            overflow |= lost
+            first = first if first is not None else now
+            last = now
+            if pending_callback is not None:
+                pending_callback(len(pending))
+        if first is not None and (now - last >= debounce or now - first >= max_delay):
+            if pending_callback is not None:
+                pending_callback(0)
+            yield None if overflow else pending
+            pending, overflow = set(), False
+            first = last = None
@@ -95,6 +95,8 @@ def main():
             entry_points={
                  "console_scripts": [
                      'neurodatapub = neurodatapub.cli.neurodatapub:main',
+                     'neurodatapub_benchmark = neurodatapub.cli.benchmark:main',
+                     'git-annex-remote-neurodatapub-throttle = neurodatapub.utils.throttle:main',
                  ]
             },
             license='Apache-2.0',
@@ -0,0 +1,76 @@
+# Copyright © 2021-2022 Connectomics Lab
+# University Hospital Center and University of Lausanne (UNIL-CHUV), Switzerland,
+# and contributors
+#
+#  This software is distributed under the open-source license Apache 2.0.
+
+"""Tests of `neurodatapub.utils.sshconfig`."""
+
+import os
+import re
+import multiprocessing
+
+import pytest
+
+from neurodatapub.utils.sshconfig import update_ssh_config
+
+HOSTS = [f'server{index}.example.org' for index in range(4)]
+
+EXISTING_CONFIG = 'Host gitlab.example.org\n\tUser git\n'
+
+
+def _update(barrier, host, user):
+    """Update the SSH config once all the processes are started."""
+    barrier.wait()
+    update_ssh_config(f'ssh://{host}', user)
+
+
+@pytest.fixture
+def home(tmp_path, monkeypatch):
+    """Use a temporary `HOME` with an existing SSH config."""
+    monkeypatch.setenv('HOME', str(tmp_path))
+    (tmp_path / '.ssh').mkdir(mode=0o700)
+    (tmp_path / '.ssh' / 'config').write_text(EXISTING_CONFIG)
+    (tmp_path / '.ssh' / 'config').chmod(0o600)
+    return tmp_path
+
+
+@pytest.mark.parametrize('processes_per_host', [8])
+def test_concurrent_updates(home, processes_per_host):
+    """Concurrent updates of the same SSH config add exactly one well-formed entry per host."""
+    context = multiprocessing.get_context('fork')
+    barrier = context.Barrier(len(HOSTS) * processes_per_host)
+    processes = [
+        context.Process(target=_update, args=(barrier, host, f'user{index}'))
+        for host in HOSTS
+        for index in range(processes_per_host)
+    ]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join(timeout=60)
+        assert process.exitcode == 0
+
+    content = (home / '.ssh' / 'config').read_text()
+    for host in HOSTS:
+        entries = re.findall(
+            rf'^## Added by NeuroDataPub \([^)]*\) ##\n'
+            rf'Host {re.escape(host)}\n\tHostName {re.escape(host)}\n\tUser user\d+\n\n',
+            content, re.MULTILINE
+        )
+        assert len(entries) == 1
+        assert len(re.findall(rf'^Host {re.escape(host)}$', content, re.MULTILINE)) == 1
+    # The previous entries are kept intact after the added ones
+    assert content.endswith(EXISTING_CONFIG)
+    assert content.count('## Added by NeuroDataPub') == len(HOSTS)
+    # No temporary file left behind
+    assert not [name for name in os.listdir(home / '.ssh') if name.startswith('.config.neurodatapub.')]
+    # The permissions of the SSH config are preserved
+    assert oct((home / '.ssh' / 'config').stat().st_mode & 0o777) == oct(0o600)
+
+
+def test_dryrun_leaves_config_unchanged(home):
+    """A dry run only returns the equivalent command."""
+    cmd = update_ssh_config(f'ssh://{HOSTS[0]}', 'user', dryrun=True)
+    assert 'flock 9' in cmd
+    assert (home / '.ssh' / 'config').read_text() == EXISTING_CONFIG